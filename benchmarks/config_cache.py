@@ -0,0 +1,73 @@
+"""
+Benchmark per-message config lookup for a worker with a large config.
+"""
+
+import sys
+import time
+
+from vumi.config import ConfigText, ConfigDict, ConfigList
+from vumi.message import TransportUserMessage
+from vumi.worker import BaseWorker, BaseConfig
+
+
+def make_config_class(num_fields):
+    fields = {}
+    for i in range(num_fields):
+        fields["text_%d" % (i,)] = ConfigText("Text field.", default="foo")
+        fields["dict_%d" % (i,)] = ConfigDict("Dict field.", default={})
+        fields["list_%d" % (i,)] = ConfigList("List field.", default=[])
+    return type("BenchConfig", (BaseConfig,), fields)
+
+
+def make_config(num_fields):
+    config = {}
+    for i in range(num_fields):
+        config["text_%d" % (i,)] = "text %d" % (i,)
+        config["dict_%d" % (i,)] = {"key": i}
+        config["list_%d" % (i,)] = [i, i + 1]
+    return config
+
+
+class BenchWorker(BaseWorker):
+    def setup_connectors(self):
+        pass
+
+    def setup_worker(self):
+        pass
+
+    def teardown_worker(self):
+        pass
+
+
+def time_get_config(worker, msg, loops):
+    start = time.time()
+    for i in range(loops):
+        worker.get_config(msg)
+    return (time.time() - start) / loops
+
+
+def run_bench(loops, num_fields):
+    BenchWorker.CONFIG_CLASS = make_config_class(num_fields)
+    worker = BenchWorker({}, make_config(num_fields))
+    msg = TransportUserMessage(
+        to_addr="1234", from_addr="5678", transport_name="bench",
+        transport_type="sms", content="Hi!")
+
+    uncached = worker.get_cached_config
+    worker.get_cached_config = lambda *a: worker.CONFIG_CLASS(worker.config)
+    uncached_time = time_get_config(worker, msg, loops)
+    worker.get_cached_config = uncached
+    cached_time = time_get_config(worker, msg, loops)
+
+    print "Config fields: %d" % (num_fields * 3,)
+    print "Loops: %d" % (loops,)
+    print "Time per message (uncached): %g" % (uncached_time,)
+    print "Time per message (cached): %g" % (cached_time,)
+    print "Saving per message: %g" % (uncached_time - cached_time,)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    loops = int(args[0]) if len(args) > 0 else 10000
+    num_fields = int(args[1]) if len(args) > 1 else 100
+    run_bench(loops, num_fields)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the table-driven GSM 03.38 codec against per-character lookups.
+"""
+
+import sys
+import time
+
+from vumi.codecs.vumi_codecs import GSM7BitCodec, GSM7BitPackedCodec
+
+
+class PerCharGSM7BitCodec(GSM7BitCodec):
+    """
+    The codec as it was before it used precomputed tables.
+    """
+
+    def encode(self, unicode_string, errors='strict'):
+        return self.encode_chars(unicode_string, errors)
+
+    def decode(self, byte_string, errors='strict'):
+        return self.decode_chars(byte_string, errors)
+
+
+def make_text(length):
+    text = u"Your balance is €12.50. Reply {STOP} to opt out! "
+    return (text * (length // len(text) + 1))[:length]
+
+
+def time_calls(func, arg, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        func(arg)
+    return (time.time() - start) / iterations
+
+
+def run_bench(iterations):
+    codecs = [
+        ('per-char', PerCharGSM7BitCodec()),
+        ('table', GSM7BitCodec()),
+        ('packed', GSM7BitPackedCodec()),
+    ]
+    for length in [160, 1000]:
+        text = make_text(length)
+        print "Payload: %d characters" % (length,)
+        for name, codec in codecs:
+            encoded = codec.encode(text)[0]
+            assert codec.decode(encoded)[0] == text
+            encode_time = time_calls(codec.encode, text, iterations)
+            decode_time = time_calls(codec.decode, encoded, iterations)
+            print "  Encode (%s): %g" % (name, encode_time)
+            print "  Decode (%s): %g" % (name, decode_time)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    iterations = int(args[0]) if len(args) > 0 else 10000
+    run_bench(iterations)
@@ -0,0 +1,73 @@
+"""
+Benchmark ContentKeywordRouter rule matching with a large number of rules.
+"""
+
+import random
+import sys
+import time
+
+from vumi.dispatchers.base import ContentKeywordRouter
+from vumi.message import TransportUserMessage
+from vumi.utils import get_first_word
+
+
+def make_rules(num_rules):
+    rules = []
+    for i in range(num_rules):
+        rule = {'app': 'app%d' % (i % 10,), 'keyword': 'kw%d' % (i,)}
+        if i % 2:
+            rule['to_addr'] = '%d' % (8000 + i % 5,)
+        if i % 3:
+            rule['prefix'] = '+2567%d' % (i % 10,)
+        rules.append(rule)
+    return rules
+
+
+def make_msgs(num_rules, num_msgs):
+    return [TransportUserMessage(
+        to_addr='%d' % (8000 + random.randrange(5),),
+        from_addr='+2567%d1234567' % (random.randrange(10),),
+        transport_name='bench', transport_type='sms',
+        content='kw%d rest of message' % (random.randrange(num_rules),))
+        for i in range(num_msgs)]
+
+
+def linear_match(router, keyword, msg):
+    return [rule for rule in router.rules
+            if router.is_msg_matching_routing_rules(keyword, msg, rule)]
+
+
+def time_matching(match, router, msgs):
+    start = time.time()
+    matched = 0
+    for msg in msgs:
+        keyword = get_first_word(msg['content']).lower()
+        matched += len(match(router, keyword, msg))
+    return (time.time() - start) / len(msgs), matched
+
+
+def run_bench(num_rules, num_msgs):
+    router = ContentKeywordRouter(None, {})
+    router.rules = make_rules(num_rules)
+    start = time.time()
+    router.compile_rules()
+    compile_time = time.time() - start
+    msgs = make_msgs(num_rules, num_msgs)
+
+    linear_time, linear_matched = time_matching(linear_match, router, msgs)
+    indexed_time, indexed_matched = time_matching(
+        ContentKeywordRouter.get_matching_rules, router, msgs)
+    assert linear_matched == indexed_matched
+
+    print "Rules: %d" % (num_rules,)
+    print "Messages: %d (%d matched)" % (num_msgs, indexed_matched)
+    print "Compile time: %g" % (compile_time,)
+    print "Time per message (linear): %g" % (linear_time,)
+    print "Time per message (indexed): %g" % (indexed_time,)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    num_rules = int(args[0]) if len(args) > 0 else 10000
+    num_msgs = int(args[1]) if len(args) > 1 else 1000
+    run_bench(num_rules, num_msgs)
@@ -0,0 +1,79 @@
+"""
+Benchmark the per-message overhead of passing messages through a
+MiddlewareStack.
+"""
+
+import sys
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.middleware.base import (
+    BaseMiddleware, MiddlewareStack, MiddlewareError)
+from vumi.tests.helpers import MessageHelper
+
+
+class PassThroughMiddleware(BaseMiddleware):
+    pass
+
+
+class InlineCallbacksMiddlewareStack(MiddlewareStack):
+    """
+    The stack as it was before it had a synchronous fast path.
+    """
+
+    def apply_consume(self, handler_name, message, connector_name):
+        return self._handle_inline(
+            self.consume_middlewares, 'consume_%s' % (handler_name,),
+            message, connector_name)
+
+    @inlineCallbacks
+    def _handle_inline(self, middlewares, handler_name, message,
+                       connector_name):
+        method_name = 'handle_%s' % (handler_name,)
+        for middleware in middlewares:
+            handler = getattr(middleware, method_name)
+            message = yield handler(message, connector_name)
+            if message is None:
+                raise MiddlewareError(
+                    'Returned value of %s.%s should never be None' % (
+                        middleware, method_name,))
+        returnValue(message)
+
+
+def make_stack(stack_class, num_middlewares):
+    config = {'consume_priority': 0, 'publish_priority': 0}
+    return stack_class([
+        PassThroughMiddleware('mw%d' % (i,), config, None)
+        for i in range(num_middlewares)])
+
+
+def time_stack(stack, msg, iterations):
+    results = []
+    start = time.time()
+    for i in xrange(iterations):
+        stack.apply_consume('inbound', msg, 'conn').addCallback(
+            results.append)
+    elapsed = time.time() - start
+    assert len(results) == iterations
+    return elapsed / iterations
+
+
+def run_bench(num_middlewares, iterations):
+    msg = MessageHelper().make_inbound('hello')
+    old_time = time_stack(
+        make_stack(InlineCallbacksMiddlewareStack, num_middlewares), msg,
+        iterations)
+    new_time = time_stack(
+        make_stack(MiddlewareStack, num_middlewares), msg, iterations)
+
+    print "Middlewares: %d" % (num_middlewares,)
+    print "Time per message (inlineCallbacks): %g" % (old_time,)
+    print "Time per message (fast path): %g" % (new_time,)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    num_middlewares = int(args[0]) if len(args) > 0 else 5
+    iterations = int(args[1]) if len(args) > 1 else 100000
+    run_bench(num_middlewares, iterations)
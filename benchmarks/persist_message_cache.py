@@ -0,0 +1,60 @@
+"""
+Benchmark reading ``OutboundMessage.msg`` from loaded message store objects.
+
+No Riak server is needed, the objects are built from stored data in memory.
+"""
+
+import sys
+import time
+
+from vumi.components.message_store import OutboundMessage
+from vumi.persist.riak_manager import RiakManager
+from vumi.tests.helpers import MessageHelper
+
+
+def make_objects(manager, num_objects):
+    msg_helper = MessageHelper()
+    stored_data = []
+    for i in xrange(num_objects):
+        msg = msg_helper.make_outbound("hello %d" % (i,))
+        stored_data.append(
+            OutboundMessage(manager, msg['message_id'], msg=msg).get_data())
+
+    objects = []
+    for data in stored_data:
+        key = data.pop('key')
+        riak_object = manager.riak_object(OutboundMessage, key)
+        riak_object.set_data(data)
+        objects.append(
+            OutboundMessage(manager, key, _riak_object=riak_object))
+    return objects
+
+
+def time_reads(objects, reads, clear_cache):
+    start = time.time()
+    for obj in objects:
+        for i in xrange(reads):
+            if clear_cache:
+                obj._field_cache.clear()
+            obj.msg['to_addr']
+    return time.time() - start
+
+
+def run_bench(num_objects, reads):
+    manager = RiakManager.from_config({'bucket_prefix': 'bench.'})
+    objects = make_objects(manager, num_objects)
+    uncached_time = time_reads(objects, reads, clear_cache=True)
+    for obj in objects:
+        obj._field_cache.clear()
+    cached_time = time_reads(objects, reads, clear_cache=False)
+
+    print "Objects: %d, reads per object: %d" % (num_objects, reads)
+    print "Total time (decode every read): %g" % (uncached_time,)
+    print "Total time (cached): %g" % (cached_time,)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    num_objects = int(args[0]) if len(args) > 0 else 10000
+    reads = int(args[1]) if len(args) > 1 else 4
+    run_bench(num_objects, reads)
@@ -1205,9 +1205,14 @@ class Sandbox(ApplicationWorker):
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        sandbox_id = self.sandbox_id_for_message(msg)
+
+        def make_config_data():
+            config = self.config.copy()
+            config['sandbox_id'] = sandbox_id
+            return config
+
+        return succeed(self.get_cached_config(sandbox_id, make_config_data))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -119,6 +119,17 @@ class TestSandbox(SandboxTestCaseBase):
         self.assertEqual(status, 0)
         self.assertEqual(msgs, ["err"])
 
+    @inlineCallbacks
+    def test_get_config_per_sandbox(self):
+        app = yield self.setup_app("")
+        msg1 = self.app_helper.make_inbound("foo", sandbox_id="sandbox1")
+        msg2 = self.app_helper.make_inbound("foo", sandbox_id="sandbox2")
+        config1 = yield app.get_config(msg1)
+        config2 = yield app.get_config(msg2)
+        self.assertEqual(config1.sandbox_id, "sandbox1")
+        self.assertEqual(config2.sandbox_id, "sandbox2")
+        self.assertTrue((yield app.get_config(msg1)) is config1)
+
     @inlineCallbacks
     def test_stderr_from_sandbox_with_multiple_lines(self):
         app = yield self.setup_app(
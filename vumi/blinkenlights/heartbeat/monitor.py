@@ -8,7 +8,7 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import LoopingCall
 
 from vumi.worker import BaseWorker
-from vumi.config import ConfigDict, ConfigInt
+from vumi.config import ConfigDict, ConfigInt, ConfigFloat
 from vumi.blinkenlights.heartbeat.publisher import HeartBeatMessage
 from vumi.blinkenlights.heartbeat.storage import Storage
 from vumi.persist.txredis_manager import TxRedisManager
@@ -22,6 +22,12 @@ WorkerIssue = collections.namedtuple('WorkerIssue',
                                       'start_time',
                                       'procs_count'])
 
+PerfIssue = collections.namedtuple('PerfIssue',
+                                   ['issue_type',
+                                    'start_time',
+                                    'value',
+                                    'threshold'])
+
 
 def assert_field(cfg, key):
     """
@@ -54,14 +60,20 @@ class WorkerInstance(object):
 
 class Worker(object):
 
-    def __init__(self, system_id, worker_name, min_procs):
+    def __init__(self, system_id, worker_name, min_procs,
+                 max_loop_lag=None, max_backlog=None):
         self.system_id = system_id
         self.name = worker_name
         self.min_procs = min_procs
+        self.max_loop_lag = max_loop_lag
+        self.max_backlog = max_backlog
         self.worker_id = generate_worker_id(system_id, worker_name)
         self._instances = set()
         self._instances_active = set()
+        self._telemetry = {}
+        self._telemetry_active = {}
         self.procs_count = 0
+        self.perf_issues = set()
 
     def to_dict(self):
         """Serializes information into basic dicts"""
@@ -79,8 +91,31 @@ class Worker(object):
             'min_procs': self.min_procs,
             'hosts': hosts,
         }
+        if self._telemetry:
+            obj['telemetry'] = self._telemetry_info()
         return obj
 
+    def _telemetry_info(self):
+        """List the telemetry reported by each worker instance."""
+        info = []
+        for ins, telemetry in self._telemetry.iteritems():
+            entry = {'host': ins.hostname, 'pid': ins.pid}
+            entry.update(telemetry)
+            info.append(entry)
+        return sorted(info, key=lambda e: (e['host'], e['pid']))
+
+    def _max_loop_lag(self):
+        lags = [t.get('loop_lag') for t in self._telemetry.itervalues()]
+        lags = [lag for lag in lags if lag is not None]
+        return max(lags) if lags else None
+
+    def _max_backlog(self):
+        backlogs = [
+            sum(c.get('in_flight', 0)
+                for c in t.get('connectors', {}).itervalues())
+            for t in self._telemetry.itervalues()]
+        return max(backlogs) if backlogs else None
+
     def _compute_host_info(self, instances):
         """Compute the number of worker instances running on each host."""
         counts = {}
@@ -107,6 +142,26 @@ class Worker(object):
             issue = WorkerIssue("min-procs-fail", time.time(), count)
             yield storage.open_or_update_issue(self.worker_id, issue)
         self.procs_count = count
+        yield self._audit_perf('loop-lag', self._max_loop_lag(),
+                               self.max_loop_lag, storage)
+        yield self._audit_perf('backlog', self._max_backlog(),
+                               self.max_backlog, storage)
+
+    @inlineCallbacks
+    def _audit_perf(self, issue_type, value, threshold, storage):
+        """
+        Open (or update) an issue if `value` exceeds `threshold` and clear any
+        previously opened issue of the same type otherwise.
+        """
+        if threshold is None:
+            return
+        if value is not None and value > threshold:
+            issue = PerfIssue(issue_type, time.time(), value, threshold)
+            yield storage.open_or_update_perf_issue(self.worker_id, issue)
+            self.perf_issues.add(issue_type)
+        elif issue_type in self.perf_issues:
+            yield storage.delete_perf_issue(self.worker_id, issue_type)
+            self.perf_issues.discard(issue_type)
 
     def snapshot(self):
         """
@@ -120,10 +175,18 @@ class Worker(object):
         """
         self._instances = self._instances_active
         self._instances_active = set()
+        self._telemetry = self._telemetry_active
+        self._telemetry_active = {}
 
-    def record(self, hostname, pid):
-        """Record that process (hostname,pid) checked in."""
-        self._instances_active.add(WorkerInstance(hostname, pid))
+    def record(self, hostname, pid, telemetry=None):
+        """
+        Record that process (hostname,pid) checked in, along with any
+        performance telemetry it reported.
+        """
+        ins = WorkerInstance(hostname, pid)
+        self._instances_active.add(ins)
+        if telemetry is not None:
+            self._telemetry_active[ins] = telemetry
 
 
 class System(object):
@@ -160,6 +223,17 @@ class HeartBeatMonitor(BaseWorker):
         monitored_systems = ConfigDict(
             "Tree of systems and workers.",
             required=True, static=True)
+        max_loop_lag = ConfigFloat(
+            "Reactor loop lag (in seconds) above which a 'loop-lag' issue is "
+            "raised for a worker. May be overridden per worker with a "
+            "'max_loop_lag' field. Disabled if not set.",
+            static=True)
+        max_backlog = ConfigInt(
+            "Number of in-flight messages in a single worker instance above "
+            "which a 'backlog' issue is raised for a worker. May be "
+            "overridden per worker with a 'max_backlog' field. Disabled if "
+            "not set.",
+            static=True)
 
     _task = None
 
@@ -174,6 +248,9 @@ class HeartBeatMonitor(BaseWorker):
         self._redis = yield TxRedisManager.from_config(redis_config)
         self._storage = Storage(self._redis)
 
+        self.max_loop_lag = config.max_loop_lag
+        self.max_backlog = config.max_backlog
+
         self._systems, self._workers = self.parse_config(
             config.monitored_systems)
 
@@ -213,7 +290,9 @@ class HeartBeatMonitor(BaseWorker):
                 min_procs = wkr_entry['min_procs']
                 wkr = Worker(system_id,
                              worker_name,
-                             min_procs)
+                             min_procs,
+                             wkr_entry.get('max_loop_lag', self.max_loop_lag),
+                             wkr_entry.get('max_backlog', self.max_backlog))
                 workers[wkr.worker_id] = wkr
                 system_workers.append(wkr)
             systems.append(System(system_id, system_id, system_workers))
@@ -227,6 +306,7 @@ class HeartBeatMonitor(BaseWorker):
         timestamp = msg['timestamp']
         hostname = msg['hostname']
         pid = msg['pid']
+        telemetry = msg.get('telemetry')
 
         # A bunch of discard rules:
         # 1. Unknown worker (Monitored workers need to be in the config)
@@ -239,7 +319,7 @@ class HeartBeatMonitor(BaseWorker):
             log.msg("Discarding heartbeat from '%s'. Too old" % worker_id)
             return
 
-        wkr.record(hostname, pid)
+        wkr.record(hostname, pid, telemetry)
 
     @inlineCallbacks
     def _sync_to_storage(self):
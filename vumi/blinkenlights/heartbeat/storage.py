@@ -7,6 +7,7 @@ Storage Schema:
  List of systems (JSON list): key = systems
  System state (JSON dict):    key = system:$SYSTEM_ID
  Worker issue (JSON dict):    key = worker:$WORKER_ID:issue
+ Performance issue (JSON dict): key = worker:$WORKER_ID:issue:$ISSUE_TYPE
 """
 
 import json
@@ -21,6 +22,10 @@ def issue_key(worker_id):
     return "worker:%s:issue" % worker_id
 
 
+def perf_issue_key(worker_id, issue_type):
+    return "worker:%s:issue:%s" % (worker_id, issue_type)
+
+
 def system_key(system_id):
     return "system:%s" % system_id
 
@@ -67,3 +72,28 @@ class Storage(object):
             issue_data = json.loads(issue_raw)
             issue_data['procs_count'] = issue.procs_count
         yield self._redis.set(key, json.dumps(issue_data))
+
+    def _perf_issue_to_dict(self, issue):
+        return {
+            'issue_type': issue.issue_type,
+            'start_time': issue.start_time,
+            'value': issue.value,
+            'threshold': issue.threshold,
+        }
+
+    @Manager.calls_manager
+    def delete_perf_issue(self, worker_id, issue_type):
+        key = perf_issue_key(worker_id, issue_type)
+        yield self._redis.delete(key)
+
+    @Manager.calls_manager
+    def open_or_update_perf_issue(self, worker_id, issue):
+        key = perf_issue_key(worker_id, issue.issue_type)
+        issue_raw = yield self._redis.get(key)
+        if issue_raw is None:
+            issue_data = self._perf_issue_to_dict(issue)
+        else:
+            issue_data = json.loads(issue_raw)
+            issue_data['value'] = issue.value
+            issue_data['threshold'] = issue.threshold
+        yield self._redis.set(key, json.dumps(issue_data))
@@ -0,0 +1,160 @@
+# -*- test-case-name: vumi.blinkenlights.heartbeat.tests.test_telemetry -*-
+
+"""
+Performance telemetry gathered by workers and published in heartbeats.
+"""
+
+import math
+import os
+import time
+from collections import deque
+
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+
+
+def percentile(values, pct):
+    """
+    Return the `pct` percentile (nearest rank) of `values` or ``None`` if
+    there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def process_rss():
+    """
+    Return the resident set size of this process in bytes, or ``None`` if it
+    can't be determined on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            rss_pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def open_fd_count():
+    """
+    Return the number of open file descriptors for this process, or ``None``
+    if it can't be determined on this platform.
+    """
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(fd_dir))
+        except (IOError, OSError):
+            pass
+    return None
+
+
+class HandlerStats(object):
+    """
+    Tracks in-flight messages, message rate and handler latency for a single
+    connector.
+
+    :param int max_samples:
+        Number of most recent latency samples kept for percentile
+        calculations.
+    :param callable get_time:
+        Function returning the current time in seconds. Defaults to
+        :func:`time.time`.
+    """
+
+    MAX_SAMPLES = 1000
+
+    def __init__(self, max_samples=MAX_SAMPLES, get_time=time.time):
+        self.get_time = get_time
+        self.in_flight = 0
+        self._processed = 0
+        self._latencies = deque(maxlen=max_samples)
+        self._window_start = get_time()
+
+    def message_started(self):
+        """
+        Record that a message has been handed to a handler and return the
+        start time to pass to :meth:`message_finished`.
+        """
+        self.in_flight += 1
+        return self.get_time()
+
+    def message_finished(self, start_time):
+        """
+        Record that handling of a message started at `start_time` has
+        completed (successfully or otherwise).
+        """
+        self.in_flight -= 1
+        self._processed += 1
+        self._latencies.append(self.get_time() - start_time)
+
+    def snapshot(self):
+        """
+        Return a dict of the current stats and start a new measurement window.
+        """
+        now = self.get_time()
+        elapsed = now - self._window_start
+        rate = self._processed / elapsed if elapsed > 0 else 0.0
+        stats = {
+            'in_flight': self.in_flight,
+            'rate': rate,
+            'p95_latency': percentile(self._latencies, 95),
+        }
+        self._processed = 0
+        self._latencies.clear()
+        self._window_start = now
+        return stats
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late the reactor runs a regularly scheduled call. The lag
+    reported is the largest delay observed since the last snapshot.
+
+    :param float interval:
+        Seconds between lag measurements.
+    :param clock:
+        An :class:`IReactorTime` provider. Defaults to the global reactor.
+    """
+
+    INTERVAL = 1.0
+
+    def __init__(self, interval=INTERVAL, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.interval = interval
+        self.clock = clock
+        self.max_lag = 0.0
+        self._last = None
+        self._task = None
+
+    def _tick(self):
+        now = self.clock.seconds()
+        if self._last is not None:
+            lag = max(0.0, now - self._last - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+        self._last = now
+
+    def start(self):
+        self._task = LoopingCall(self._tick)
+        self._task.clock = self.clock
+        done = self._task.start(self.interval, now=True)
+        done.addErrback(
+            lambda failure: log.err(failure, "LoopLagMonitor task died"))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
+        self._last = None
+
+    def snapshot(self):
+        """
+        Return the largest lag seen since the last snapshot and reset it.
+        """
+        lag, self.max_lag = self.max_lag, 0.0
+        return lag
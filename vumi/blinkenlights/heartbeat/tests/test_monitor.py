@@ -9,7 +9,7 @@ from twisted.internet.defer import inlineCallbacks
 
 from vumi.blinkenlights.heartbeat import publisher
 from vumi.blinkenlights.heartbeat import monitor
-from vumi.blinkenlights.heartbeat.storage import issue_key
+from vumi.blinkenlights.heartbeat.storage import issue_key, perf_issue_key
 from vumi.utils import generate_worker_id
 from vumi.tests.helpers import VumiTestCase, WorkerHelper, PersistenceHelper
 
@@ -71,6 +71,54 @@ class TestWorker(VumiTestCase):
         obj = wkr.to_dict()
         self.assertEqual(obj, expected_wkr_dict())
 
+    def test_to_dict_with_telemetry(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {'loop_lag': 0.5, 'connectors': {}})
+
+        wkr.snapshot()
+
+        expected = expected_wkr_dict()
+        expected['telemetry'] = [{
+            'host': 'host-1',
+            'pid': 34,
+            'loop_lag': 0.5,
+            'connectors': {},
+        }]
+        self.assertEqual(wkr.to_dict(), expected)
+
+    def test_snapshot_telemetry(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {'loop_lag': 0.5})
+        self.assertEqual(wkr._telemetry, {})
+
+        wkr.snapshot()
+        self.assertEqual(wkr._telemetry, {
+            monitor.WorkerInstance('host-1', 34): {'loop_lag': 0.5},
+        })
+        self.assertEqual(wkr._telemetry_active, {})
+
+    def test_max_loop_lag(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {'loop_lag': 0.5})
+        wkr.record('host-1', 35, {'loop_lag': 2.0})
+        wkr.record('host-1', 36, {'loop_lag': None})
+        wkr.snapshot()
+        self.assertEqual(wkr._max_loop_lag(), 2.0)
+
+    def test_max_loop_lag_no_telemetry(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34)
+        wkr.snapshot()
+        self.assertEqual(wkr._max_loop_lag(), None)
+
+    def test_max_backlog(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {'connectors': {
+            'a': {'in_flight': 3}, 'b': {'in_flight': 4}}})
+        wkr.record('host-1', 35, {'connectors': {'a': {'in_flight': 5}}})
+        wkr.snapshot()
+        self.assertEqual(wkr._max_backlog(), 7)
+
     def test_compute_host_info(self):
         wkr = monitor.Worker('system-1', 'foo', 1)
         wkr.record('host-1', 34)
@@ -147,7 +195,7 @@ class TestHeartBeatMonitor(VumiTestCase):
         self.worker = yield self.worker_helper.get_worker(
             monitor.HeartBeatMonitor, config, start=False)
 
-    def gen_fake_attrs(self, timestamp):
+    def gen_fake_attrs(self, timestamp, telemetry=None):
         sys_id = 'system-1'
         wkr_name = 'twitter_transport'
         wkr_id = generate_worker_id(sys_id, wkr_name)
@@ -160,8 +208,32 @@ class TestHeartBeatMonitor(VumiTestCase):
             'timestamp': timestamp,
             'pid': 345,
         }
+        if telemetry is not None:
+            attrs['telemetry'] = telemetry
         return attrs
 
+    def gen_fake_telemetry(self, loop_lag=0.0, in_flight=0):
+        return {
+            'loop_lag': loop_lag,
+            'rss': 1024,
+            'open_fds': 10,
+            'connectors': {
+                'twitter_transport': {
+                    'in_flight': in_flight,
+                    'rate': 1.0,
+                    'p95_latency': 0.1,
+                },
+            },
+        }
+
+    @inlineCallbacks
+    def audit_with_telemetry(self, telemetry):
+        attrs = self.gen_fake_attrs(time.time(), telemetry)
+        self.worker.update(attrs)
+        wkr = self.worker._workers[attrs['worker_id']]
+        wkr.snapshot()
+        yield wkr.audit(self.worker._storage)
+
     @inlineCallbacks
     def test_update(self):
         # Test the processing of a message.
@@ -272,3 +344,80 @@ class TestHeartBeatMonitor(VumiTestCase):
         system = json.loads((yield fkredis.get('system:system-1')))
         system['timestamp'] = 2
         self.assertEqual(system, expected)
+
+    @inlineCallbacks
+    def test_update_telemetry(self):
+        yield self.worker.startWorker()
+        telemetry = self.gen_fake_telemetry()
+        attrs = self.gen_fake_attrs(time.time(), telemetry)
+        self.worker.update(attrs)
+
+        wkr = self.worker._workers[attrs['worker_id']]
+        self.assertEqual(wkr._telemetry_active, {
+            monitor.WorkerInstance('test-host-1', 345): telemetry,
+        })
+
+    @inlineCallbacks
+    def test_parse_config_thresholds(self):
+        yield self.worker.startWorker()
+        self.worker.max_loop_lag = 1.5
+        self.worker.max_backlog = 100
+        systems, workers = self.worker.parse_config({
+            'system-1': {
+                'system_id': 'system-1',
+                'workers': {
+                    'foo': {'name': 'foo', 'min_procs': 1},
+                    'bar': {'name': 'bar', 'min_procs': 1,
+                            'max_loop_lag': 0.5, 'max_backlog': 10},
+                },
+            },
+        })
+        foo = workers['system-1:foo']
+        self.assertEqual((foo.max_loop_lag, foo.max_backlog), (1.5, 100))
+        bar = workers['system-1:bar']
+        self.assertEqual((bar.max_loop_lag, bar.max_backlog), (0.5, 10))
+
+    @inlineCallbacks
+    def test_audit_loop_lag_disabled(self):
+        yield self.worker.startWorker()
+        yield self.audit_with_telemetry(self.gen_fake_telemetry(loop_lag=10))
+        key = perf_issue_key('system-1:twitter_transport', 'loop-lag')
+        issue = yield self.worker._redis.get(key)
+        self.assertEqual(issue, None)
+
+    @inlineCallbacks
+    def test_audit_loop_lag(self):
+        yield self.worker.startWorker()
+        wkr = self.worker._workers['system-1:twitter_transport']
+        wkr.max_loop_lag = 1.0
+        key = perf_issue_key(wkr.worker_id, 'loop-lag')
+
+        yield self.audit_with_telemetry(self.gen_fake_telemetry(loop_lag=2.5))
+        issue = json.loads((yield self.worker._redis.get(key)))
+        self.assertEqual(issue['issue_type'], 'loop-lag')
+        self.assertEqual(issue['value'], 2.5)
+        self.assertEqual(issue['threshold'], 1.0)
+
+        yield self.audit_with_telemetry(self.gen_fake_telemetry(loop_lag=0.1))
+        issue = yield self.worker._redis.get(key)
+        self.assertEqual(issue, None)
+        self.assertEqual(wkr.perf_issues, set())
+
+    @inlineCallbacks
+    def test_audit_backlog(self):
+        yield self.worker.startWorker()
+        wkr = self.worker._workers['system-1:twitter_transport']
+        wkr.max_backlog = 50
+        key = perf_issue_key(wkr.worker_id, 'backlog')
+
+        yield self.audit_with_telemetry(
+            self.gen_fake_telemetry(in_flight=75))
+        issue = json.loads((yield self.worker._redis.get(key)))
+        self.assertEqual(issue['issue_type'], 'backlog')
+        self.assertEqual(issue['value'], 75)
+        self.assertEqual(issue['threshold'], 50)
+
+        yield self.audit_with_telemetry(
+            self.gen_fake_telemetry(in_flight=5))
+        issue = yield self.worker._redis.get(key)
+        self.assertEqual(issue, None)
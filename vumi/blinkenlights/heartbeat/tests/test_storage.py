@@ -81,3 +81,37 @@ class TestStorage(VumiTestCase):
         yield self.stg.open_or_update_issue('foo', iss)
         res = yield self.redis.get(storage.issue_key('foo'))
         self.assertEqual(res, json.dumps(obj))
+
+    @inlineCallbacks
+    def test_delete_perf_issue(self):
+        iss = monitor.PerfIssue('loop-lag', 5, 2.0, 1.0)
+        yield self.stg.open_or_update_perf_issue('worker-1', iss)
+
+        key = storage.perf_issue_key('worker-1', 'loop-lag')
+        res = yield self.redis.get(key)
+        self.assertEqual(type(res), str)
+
+        yield self.stg.delete_perf_issue('worker-1', 'loop-lag')
+        res = yield self.redis.get(key)
+        self.assertEqual(res, None)
+
+    @inlineCallbacks
+    def test_open_or_update_perf_issue(self):
+        obj = {
+            'issue_type': 'backlog',
+            'start_time': 5,
+            'value': 80,
+            'threshold': 50,
+        }
+        key = storage.perf_issue_key('foo', 'backlog')
+        iss = monitor.PerfIssue('backlog', 5, 80, 50)
+        yield self.stg.open_or_update_perf_issue('foo', iss)
+        res = yield self.redis.get(key)
+        self.assertEqual(json.loads(res), obj)
+
+        # now update the issue, the start time is preserved
+        iss = monitor.PerfIssue('backlog', 7, 90, 50)
+        obj['value'] = 90
+        yield self.stg.open_or_update_perf_issue('foo', iss)
+        res = yield self.redis.get(key)
+        self.assertEqual(json.loads(res), obj)
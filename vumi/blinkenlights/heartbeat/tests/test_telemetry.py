@@ -0,0 +1,139 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for vumi.blinkenlights.heartbeat.telemetry"""
+
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.heartbeat import telemetry
+from vumi.tests.helpers import VumiTestCase
+
+
+class FakeTime(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestPercentile(VumiTestCase):
+
+    def test_no_values(self):
+        self.assertEqual(telemetry.percentile([], 95), None)
+
+    def test_single_value(self):
+        self.assertEqual(telemetry.percentile([3], 95), 3)
+
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(telemetry.percentile(values, 95), 95)
+        self.assertEqual(telemetry.percentile(values, 50), 50)
+        self.assertEqual(telemetry.percentile(values, 100), 100)
+
+    def test_unordered(self):
+        self.assertEqual(telemetry.percentile([5, 1, 4, 2, 3], 95), 5)
+
+
+class TestProcessInfo(VumiTestCase):
+
+    def test_process_rss(self):
+        rss = telemetry.process_rss()
+        if rss is not None:
+            self.assertTrue(rss > 0)
+
+    def test_open_fd_count(self):
+        fds = telemetry.open_fd_count()
+        if fds is not None:
+            self.assertTrue(fds > 0)
+
+
+class TestHandlerStats(VumiTestCase):
+
+    def test_in_flight(self):
+        stats = telemetry.HandlerStats(get_time=FakeTime())
+        start1 = stats.message_started()
+        start2 = stats.message_started()
+        self.assertEqual(stats.in_flight, 2)
+        stats.message_finished(start1)
+        self.assertEqual(stats.in_flight, 1)
+        stats.message_finished(start2)
+        self.assertEqual(stats.in_flight, 0)
+
+    def test_snapshot(self):
+        clock = FakeTime()
+        stats = telemetry.HandlerStats(get_time=clock)
+        for i in range(20):
+            start = stats.message_started()
+            clock.now += 0.5
+            stats.message_finished(start)
+        stats.message_started()
+        self.assertEqual(stats.snapshot(), {
+            'in_flight': 1,
+            'rate': 2.0,
+            'p95_latency': 0.5,
+        })
+
+    def test_snapshot_resets_window(self):
+        clock = FakeTime()
+        stats = telemetry.HandlerStats(get_time=clock)
+        stats.message_finished(stats.message_started())
+        clock.now += 1
+        stats.snapshot()
+        clock.now += 1
+        self.assertEqual(stats.snapshot(), {
+            'in_flight': 0,
+            'rate': 0.0,
+            'p95_latency': None,
+        })
+
+    def test_snapshot_no_elapsed_time(self):
+        stats = telemetry.HandlerStats(get_time=FakeTime())
+        stats.message_finished(stats.message_started())
+        self.assertEqual(stats.snapshot()['rate'], 0.0)
+
+    def test_max_samples(self):
+        clock = FakeTime()
+        stats = telemetry.HandlerStats(max_samples=5, get_time=clock)
+        start = stats.message_started()
+        clock.now += 10
+        stats.message_finished(start)
+        for i in range(5):
+            stats.message_finished(stats.message_started())
+        self.assertEqual(stats.snapshot()['p95_latency'], 0)
+
+
+class TestLoopLagMonitor(VumiTestCase):
+
+    def mk_monitor(self, interval=1.0):
+        clock = Clock()
+        monitor = telemetry.LoopLagMonitor(interval=interval, clock=clock)
+        self.add_cleanup(monitor.stop)
+        return monitor, clock
+
+    def test_no_lag(self):
+        monitor, clock = self.mk_monitor()
+        monitor.start()
+        clock.pump([1.0] * 5)
+        self.assertEqual(monitor.snapshot(), 0.0)
+
+    def test_lag(self):
+        monitor, clock = self.mk_monitor()
+        monitor.start()
+        clock.advance(1.0)
+        clock.advance(3.5)
+        clock.advance(0.5)
+        self.assertEqual(monitor.snapshot(), 2.5)
+
+    def test_snapshot_resets(self):
+        monitor, clock = self.mk_monitor()
+        monitor.start()
+        clock.advance(3.0)
+        self.assertEqual(monitor.snapshot(), 2.0)
+        clock.advance(1.0)
+        self.assertEqual(monitor.snapshot(), 0.0)
+
+    def test_stop(self):
+        monitor, clock = self.mk_monitor()
+        monitor.start()
+        monitor.stop()
+        self.assertEqual(clock.getDelayedCalls(), [])
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from vumi.codecs.ivumi_codecs import IVumiCodec
-from vumi.codecs.vumi_codecs import VumiCodec, VumiCodecException
+from vumi.codecs.vumi_codecs import (
+    VumiCodec, VumiCodecException, GSM7BitCodec)
 
 from twisted.trial.unittest import TestCase
 
@@ -97,3 +98,81 @@ class TestVumiCodec(TestCase):
         self.assertEqual(
             self.codec.decode(
                 u'Zoë'.encode('utf-8'), "gsm0338", 'replace'), u'Zo??')
+
+    def test_encode_gsm0338_extended_with_errors(self):
+        self.assertEqual(
+            self.codec.encode(u"Zoë costs €5", "gsm0338", 'replace'),
+            'Zo? costs \x1be5')
+
+    def test_decode_gsm0338_escaped_escape(self):
+        self.assertEqual(
+            self.codec.decode('a\x1b\x1bb', 'gsm0338'), u'a`b')
+
+    def test_decode_gsm0338_trailing_escape(self):
+        self.assertRaises(
+            UnicodeDecodeError, self.codec.decode, 'foo\x1b', 'gsm0338')
+        self.assertEqual(
+            self.codec.decode('foo\x1b', 'gsm0338', 'replace'), u'foo?')
+
+    def test_gsm0338_round_trip(self):
+        gsm = GSM7BitCodec()
+        text = gsm.gsm_basic_charset.replace(u'\x1b', u'') + u'^{}\\[~]|€'
+        encoded = self.codec.encode(text, 'gsm0338')
+        self.assertEqual(encoded, gsm.encode_chars(text)[0])
+        self.assertEqual(self.codec.decode(encoded, 'gsm0338'), text)
+
+    def test_encode_gsm0338_packed(self):
+        self.assertEqual(
+            self.codec.encode(u"hellohello", "gsm0338_packed"),
+            'e8329bfd4697d9ec37'.decode('hex'))
+
+    def test_encode_gsm0338_packed_padding(self):
+        self.assertEqual(
+            self.codec.encode(u"1234567", "gsm0338_packed"),
+            '31d98c56b3dd1a'.decode('hex'))
+
+    def test_decode_gsm0338_packed(self):
+        self.assertEqual(
+            self.codec.decode(
+                'e8329bfd4697d9ec37'.decode('hex'), "gsm0338_packed"),
+            u"hellohello")
+        self.assertEqual(
+            self.codec.decode(
+                '31d98c56b3dd1a'.decode('hex'), "gsm0338_packed"),
+            u"1234567")
+
+    def test_encode_gsm0338_packed_trailing_cr(self):
+        self.assertEqual(
+            self.codec.encode(u"1234567\r", "gsm0338_packed"),
+            '31d98c56b3dd1a0d'.decode('hex'))
+
+    def test_gsm0338_packed_round_trip(self):
+        for length in range(20):
+            for suffix in [u"", u"\r", u"\r\r", u"\r" * 6]:
+                text = (u"foo €bar" * 3)[:length] + suffix
+                self.assertEqual(
+                    self.codec.decode(
+                        self.codec.encode(text, "gsm0338_packed"),
+                        "gsm0338_packed"),
+                    text)
+        text = u'+-mO\xbf*?\r'
+        self.assertEqual(
+            self.codec.decode(
+                self.codec.encode(text, "gsm0338_packed"), "gsm0338_packed"),
+            text)
+
+    def test_segment_count_gsm0338(self):
+        self.assertEqual(self.codec.segment_count(u"a" * 160, 'gsm0338'), 1)
+        self.assertEqual(self.codec.segment_count(u"a" * 161, 'gsm0338'), 2)
+        self.assertEqual(self.codec.segment_count(u"€" * 80, 'gsm0338'), 1)
+        self.assertEqual(self.codec.segment_count(u"€" * 81, 'gsm0338'), 2)
+        self.assertEqual(self.codec.segment_count(u"a" * 307, 'gsm0338'), 3)
+        self.assertEqual(self.codec.segment_count(u"Zoë", 'gsm0338'), None)
+
+    def test_segment_count_ucs2(self):
+        self.assertEqual(self.codec.segment_count(u"ë" * 70, 'ucs2'), 1)
+        self.assertEqual(self.codec.segment_count(u"ë" * 71, 'ucs2'), 2)
+        self.assertEqual(self.codec.segment_count(u"ë" * 135, 'ucs2'), 3)
+
+    def test_segment_count_unknown_encoding(self):
+        self.assertEqual(self.codec.segment_count(u"a", 'utf-8'), None)
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.codecs.tests.test_vumi_codecs -*-
 # -*- coding: utf-8 -*-
 import codecs
+import struct
 import sys
 
 from vumi.codecs.ivumi_codecs import IVumiCodec
@@ -12,6 +13,77 @@ class VumiCodecException(Exception):
     pass
 
 
+def count_segments(units, single_segment, multipart_segment):
+    """
+    Return the number of SMS segments needed for a message `units` long, if
+    a single segment holds `single_segment` units and each part of a
+    multipart message holds `multipart_segment` units.
+    """
+    if units <= single_segment:
+        return 1
+    return -(-units // multipart_segment)
+
+
+def pack_septets(byte_string):
+    """
+    Pack a string of 7-bit characters into octets, least significant bit
+    first.
+
+    If the last octet would have seven bits of padding, a carriage return is
+    added so that the padding isn't read as an extra ``@``. As GSM 03.38
+    requires, a message whose own trailing carriage return would then look
+    like padding gets a second one. More generally, a carriage return is
+    added whenever the message ends in more carriage returns than
+    :func:`unpack_septets` keeps as they are. (This only fails to round trip
+    for a message ending in seven or more carriage returns that then needs
+    padding too, which gains an extra carriage return.)
+    """
+    length = len(byte_string)
+    if _trailing_crs(byte_string) > length % 8:
+        byte_string += '\r'
+        length += 1
+    if length % 8 == 7:
+        byte_string += '\r'
+        length += 1
+    septets = bytearray(byte_string) + bytearray(-length % 8)
+    result = []
+    # Every eight septets fit exactly in seven octets.
+    for i in xrange(0, len(septets), 8):
+        s0, s1, s2, s3, s4, s5, s6, s7 = septets[i:i + 8]
+        result.append(struct.pack(
+            '<Q', s0 | s1 << 7 | s2 << 14 | s3 << 21 | s4 << 28 | s5 << 35 |
+            s6 << 42 | s7 << 49)[:7])
+    return ''.join(result)[:(length * 7 + 7) // 8]
+
+
+def unpack_septets(byte_string):
+    """
+    Unpack octets packed by :func:`pack_septets` into 7-bit characters.
+
+    A carriage return that ends on an octet boundary is assumed to be padding
+    and is dropped, as is one of the carriage returns :func:`pack_septets`
+    doubles.
+    """
+    length = len(byte_string) * 8 // 7
+    octets = byte_string + '\0' * (-len(byte_string) % 7)
+    result = bytearray()
+    for i in xrange(0, len(octets), 7):
+        value, = struct.unpack('<Q', octets[i:i + 7] + '\0')
+        result.extend((
+            value & 0x7f, value >> 7 & 0x7f, value >> 14 & 0x7f,
+            value >> 21 & 0x7f, value >> 28 & 0x7f, value >> 35 & 0x7f,
+            value >> 42 & 0x7f, value >> 49 & 0x7f))
+    del result[length:]
+    result = str(result)
+    if _trailing_crs(result) > length % 8:
+        result = result[:-1]
+    return result
+
+
+def _trailing_crs(byte_string):
+    return len(byte_string) - len(byte_string.rstrip('\r'))
+
+
 class GSM7BitCodec(codecs.Codec):
     """
     This has largely been copied from:
@@ -32,7 +104,30 @@ class GSM7BitCodec(codecs.Codec):
 
     gsm_extension_map = dict((l, i) for i, l in enumerate(gsm_extension))
 
+    # Tables for the C-level charmap codec. The decoding tables have an entry
+    # for every byte value, with u'\ufffe' marking bytes that aren't valid.
+    # Extension characters encode to an escape followed by their index.
+    gsm_decoding_table = gsm_basic_charset + u'\ufffe' * 128
+    gsm_extension_decoding_table = gsm_extension + u'\ufffe' * 128
+    gsm_encoding_map = dict(
+        (ord(l), '\x1b' + chr(i)) for i, l in enumerate(gsm_extension)
+        if l != u'`')
+    gsm_encoding_map.update(
+        (ord(l), chr(i)) for i, l in enumerate(gsm_basic_charset))
+
+    SINGLE_SEGMENT_SEPTETS = 160
+    MULTIPART_SEGMENT_SEPTETS = 153
+
     def encode(self, unicode_string, errors='strict'):
+        try:
+            obj = codecs.charmap_encode(
+                unicode_string, 'strict', self.gsm_encoding_map)[0]
+        except UnicodeEncodeError:
+            # Let the slow path deal with the error handling.
+            return self.encode_chars(unicode_string, errors)
+        return (obj, len(obj))
+
+    def encode_chars(self, unicode_string, errors='strict'):
         result = []
         for position, c in enumerate(unicode_string):
             idx = self.gsm_basic_charset_map.get(c)
@@ -69,12 +164,53 @@ class GSM7BitCodec(codecs.Codec):
         return chr(self.gsm_basic_charset_map.get('?'))
 
     def decode(self, byte_string, errors='strict'):
+        try:
+            obj = self.decode_table(byte_string)
+        except UnicodeDecodeError:
+            # Let the slow path deal with the error handling.
+            return self.decode_chars(byte_string, errors)
+        return (obj, len(obj))
+
+    def decode_table(self, byte_string):
+        """
+        Decode `byte_string` a run of basic characters at a time, raising
+        :class:`UnicodeDecodeError` if it contains any invalid bytes.
+        """
+        charmap_decode = codecs.charmap_decode
+        if '\x1b' not in byte_string:
+            return charmap_decode(
+                byte_string, 'strict', self.gsm_decoding_table)[0]
+        result = []
+        start = 0
+        while True:
+            esc = byte_string.find('\x1b', start)
+            if esc == -1:
+                break
+            result.append(charmap_decode(
+                byte_string[start:esc], 'strict', self.gsm_decoding_table)[0])
+            ext = byte_string[esc + 1:esc + 2]
+            if not ext:
+                raise UnicodeDecodeError(
+                    'gsm0338', byte_string, esc, esc + 1,
+                    'truncated escape sequence')
+            result.append(charmap_decode(
+                ext, 'strict', self.gsm_extension_decoding_table)[0])
+            start = esc + 2
+        result.append(charmap_decode(
+            byte_string[start:], 'strict', self.gsm_decoding_table)[0])
+        return u''.join(result)
+
+    def decode_chars(self, byte_string, errors='strict'):
         res = iter(byte_string)
         result = []
         for position, c in enumerate(res):
             try:
                 if c == chr(27):
-                    c = next(res)
+                    c = next(res, None)
+                    if c is None:
+                        # A trailing escape is as invalid as an unknown byte.
+                        c = chr(27)
+                        raise IndexError(c)
                     result.append(self.gsm_extension[ord(c)])
                 else:
                     result.append(self.gsm_basic_charset[ord(c)])
@@ -103,6 +239,47 @@ class GSM7BitCodec(codecs.Codec):
     def handle_decode_replace_error(self, char, position, obj):
         return u'?'
 
+    def septet_count(self, unicode_string):
+        """
+        Return the number of septets `unicode_string` encodes to, or ``None``
+        if it can't be encoded without errors.
+        """
+        try:
+            obj = codecs.charmap_encode(
+                unicode_string, 'strict', self.gsm_encoding_map)[0]
+        except UnicodeEncodeError:
+            return None
+        return len(obj)
+
+    def segment_count(self, unicode_string):
+        """
+        Return the number of SMS segments needed to send `unicode_string`, or
+        ``None`` if it can't be encoded without errors.
+
+        This is an estimate, because it doesn't account for extension
+        characters that can't be split across segment boundaries.
+        """
+        septets = self.septet_count(unicode_string)
+        if septets is None:
+            return None
+        return count_segments(
+            septets, self.SINGLE_SEGMENT_SEPTETS,
+            self.MULTIPART_SEGMENT_SEPTETS)
+
+
+class GSM7BitPackedCodec(GSM7BitCodec):
+    """
+    GSM 03.38 with septets packed eight to every seven octets.
+    """
+
+    def encode(self, unicode_string, errors='strict'):
+        obj, _ = GSM7BitCodec.encode(self, unicode_string, errors)
+        obj = pack_septets(obj)
+        return (obj, len(obj))
+
+    def decode(self, byte_string, errors='strict'):
+        return GSM7BitCodec.decode(self, unpack_septets(byte_string), errors)
+
 
 class UCS2Codec(codecs.Codec):
     """
@@ -115,12 +292,24 @@ class UCS2Codec(codecs.Codec):
     def decode(self, input, errors='strict'):
         return codecs.utf_16_be_decode(input, errors)
 
+    SINGLE_SEGMENT_UNITS = 70
+    MULTIPART_SEGMENT_UNITS = 67
+
+    def segment_count(self, unicode_string):
+        """
+        Return the number of SMS segments needed to send `unicode_string`.
+        """
+        units = len(codecs.utf_16_be_encode(unicode_string)[0]) // 2
+        return count_segments(
+            units, self.SINGLE_SEGMENT_UNITS, self.MULTIPART_SEGMENT_UNITS)
+
 
 class VumiCodec(object):
     implements(IVumiCodec)
 
     custom_codecs = {
         'gsm0338': GSM7BitCodec(),
+        'gsm0338_packed': GSM7BitPackedCodec(),
         'ucs2': UCS2Codec()
     }
 
@@ -147,3 +336,14 @@ class VumiCodec(object):
             decoder = codecs.getdecoder(encoding)
         obj, length = decoder(byte_string, errors)
         return obj
+
+    def segment_count(self, unicode_string, encoding):
+        """
+        Return an estimate of the number of SMS segments needed to send
+        `unicode_string` encoded with `encoding`, or ``None`` if it can't be
+        encoded or there's no estimate for the encoding.
+        """
+        codec = self.custom_codecs.get(encoding)
+        if codec is None:
+            return None
+        return codec.segment_count(unicode_string)
@@ -0,0 +1,180 @@
+# -*- test-case-name: vumi.components.tests.test_delay_queue -*-
+
+"""
+A Redis-backed queue of items that become due at a given time.
+
+Storage Schema:
+
+ Due times (zset):        key = $NAME:due (member = item id, score = due time)
+ Payloads (hash):         key = $NAME:payloads (field = item id)
+
+Claiming an item moves its due time to the visibility timeout after the
+claim instead of removing it, so an item that is claimed but never acked
+(because the worker died, for example) becomes due again once the timeout
+expires.
+"""
+
+import time
+from uuid import uuid4
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager, gather_calls
+
+
+class DelayQueue(object):
+    """
+    A queue of string payloads scored by the time they become due.
+
+    :param redis:
+        Redis manager (sync or async) the queue is stored in.
+    :param str name:
+        Prefix for the queue's Redis keys.
+    :param float visibility_timeout:
+        Seconds a claimed item stays hidden from other claimers before it is
+        delivered again if it hasn't been acked.
+    :param int batch_size:
+        Default maximum number of items returned by :meth:`claim_due`.
+    :param callable get_time:
+        Function returning the current time in seconds. Defaults to
+        :func:`time.time`.
+    """
+
+    DEFAULT_VISIBILITY_TIMEOUT = 60
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, redis, name='delay_queue',
+                 visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+                 batch_size=DEFAULT_BATCH_SIZE, get_time=time.time):
+        self.redis = redis
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.batch_size = batch_size
+        self.get_time = get_time
+
+    def due_key(self):
+        return "%s:due" % (self.name,)
+
+    def payloads_key(self):
+        return "%s:payloads" % (self.name,)
+
+    def _now(self, now):
+        return self.get_time() if now is None else now
+
+    @Manager.calls_manager('redis')
+    def add(self, payload, delay, now=None, item_id=None):
+        """
+        Add `payload` to the queue, due `delay` seconds after `now`.
+
+        :returns: The item id, which is generated if not given.
+        """
+        if item_id is None:
+            item_id = uuid4().get_hex()
+        due = self._now(now) + delay
+        yield gather_calls([
+            self.redis.hset(self.payloads_key(), item_id, payload),
+            self.redis.zadd(self.due_key(), **{item_id: due}),
+        ])
+        returnValue(item_id)
+
+    @Manager.calls_manager('redis')
+    def claim_due(self, now=None, limit=None):
+        """
+        Claim up to `limit` items due at or before `now`.
+
+        Each item is claimed by atomically incrementing its due time by the
+        difference between the score we read and ``now`` plus the visibility
+        timeout. Because the item was due, that difference is at least the
+        visibility timeout, so if another claimer moved the item between our
+        read and our increment the result lands at least a visibility timeout
+        away from our target and we know we lost. Concurrent claimers
+        therefore never get the same item, however overdue it is. Once we've
+        won, the due time is set to exactly ``now`` plus the visibility
+        timeout so it isn't off by the floating point error of the increment.
+
+        :returns: A list of ``(item_id, payload)`` tuples in due order.
+        """
+        now = self._now(now)
+        if limit is None:
+            limit = self.batch_size
+        due = yield self.redis.zrangebyscore(
+            self.due_key(), '-inf', now, start=0, num=limit, withscores=True)
+        if not due:
+            returnValue([])
+
+        target = now + self.visibility_timeout
+        new_scores = yield gather_calls([
+            self.redis.zincrby(self.due_key(), item_id, target - score)
+            for item_id, score in due])
+        # Compare with a tolerance because the increment is done in floating
+        # point. Any competing increment is at least a visibility timeout.
+        tolerance = self.visibility_timeout / 2.0
+        claimed = [
+            item_id for (item_id, score), new_score in zip(due, new_scores)
+            if abs(float(new_score) - target) < tolerance]
+        if not claimed:
+            returnValue([])
+        yield gather_calls([
+            self.redis.zadd(self.due_key(), **{item_id: target})
+            for item_id in claimed])
+
+        payloads = yield gather_calls([
+            self.redis.hget(self.payloads_key(), item_id)
+            for item_id in claimed])
+        items = []
+        orphans = []
+        for item_id, payload in zip(claimed, payloads):
+            if payload is None:
+                # Acked while we were claiming it, so our increment (or the
+                # exact due time we set) recreated the zset entry.
+                orphans.append(item_id)
+            else:
+                items.append((item_id, payload))
+        if orphans:
+            yield gather_calls([
+                self.redis.zrem(self.due_key(), item_id)
+                for item_id in orphans])
+        returnValue(items)
+
+    @Manager.calls_manager('redis')
+    def ack(self, *item_ids):
+        """
+        Remove claimed (or unclaimed) items from the queue.
+        """
+        if not item_ids:
+            return
+        calls = [self.redis.zrem(self.due_key(), item_id)
+                 for item_id in item_ids]
+        calls.append(self.redis.hdel(self.payloads_key(), *item_ids))
+        yield gather_calls(calls)
+
+    def get(self, item_id):
+        """
+        Return the payload of an item, or ``None`` if there is no such item.
+        """
+        return self.redis.hget(self.payloads_key(), item_id)
+
+    def due_time(self, item_id):
+        """
+        Return the time an item is (next) due, or ``None`` if there is no such
+        item.
+        """
+        return self.redis.zscore(self.due_key(), item_id)
+
+    def count(self):
+        """
+        Return the number of items in the queue, claimed or not.
+        """
+        return self.redis.zcard(self.due_key())
+
+    def count_due(self, now=None):
+        """
+        Return the number of items due at or before `now`.
+        """
+        return self.redis.zcount(self.due_key(), '-inf', self._now(now))
+
+    def item_ids(self):
+        """
+        Return the ids of all items in the queue in due order.
+        """
+        return self.redis.zrange(self.due_key(), 0, -1)
@@ -289,6 +289,7 @@ class MessageStore(object):
         while index_page is not None:
             for key, timestamp, addr in index_page:
                 yield self.cache.add_from_addr(batch_id, addr)
+                yield self.cache.add_inbound_stats(batch_id, timestamp, addr)
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
@@ -316,6 +317,7 @@ class MessageStore(object):
         while index_page is not None:
             for key, timestamp, addr in index_page:
                 yield self.cache.add_to_addr(batch_id, addr)
+                yield self.cache.add_outbound_stats(batch_id, timestamp, addr)
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
@@ -635,6 +637,22 @@ class MessageStore(object):
         """
         return self.cache.get_query_results(batch_id, token, start, stop, asc)
 
+    def get_keys_page_for_token(self, batch_id, token, page_size, start=0,
+                                stop=-1, asc=False):
+        """
+        Returns the first page of the resulting keys of a search.
+
+        :param str token:
+            The token returned by `find_inbound_keys_matching()`
+        :param int page_size:
+            The number of keys in each page.
+
+        :returns:
+            A :class:`QueryResultsPage` for the keys from `start` to `stop`.
+        """
+        return self.cache.get_query_results_page(
+            batch_id, token, page_size, start, stop, asc)
+
     def count_keys_for_token(self, batch_id, token):
         """
         Count the number of keys in the token's result set.
@@ -953,6 +971,64 @@ class MessageStore(object):
             key_with_ts_and_value_formatter, self, msg_id, results))
 
     @Manager.calls_manager
+    def _scan_batch_stats(self, model_proxy, batch_id, max_results, start,
+                          end):
+        """
+        Count the messages and collect the unique addresses in a time range
+        by paging through the batch's address index.
+
+        :returns:
+            A ``(total, addresses)`` tuple.
+        """
+        total = 0
+        addresses = set()
+
+        start_value, end_value = self._start_end_values(batch_id, start, end)
+        if max_results is None:
+            max_results = self.DEFAULT_MAX_RESULTS
+        raw_page = yield model_proxy.index_keys_page(
+            'batches_with_addresses', start_value, end_value,
+            return_terms=True, max_results=max_results)
+        page = IndexPageWrapper(
+            key_with_ts_and_value_formatter, self, batch_id, raw_page)
+
+        while page is not None:
+            results = list(page)
+            total += len(results)
+            addresses.update(addr for key, timestamp, addr in results)
+            page = yield page.next_page()
+
+        returnValue((total, addresses))
+
+    @Manager.calls_manager
+    def _batch_stats(self, model_proxy, get_cached_stats, batch_id,
+                     max_results, start, end):
+        split = None
+        if (yield self.cache.uses_stats_buckets(batch_id)):
+            split = self.cache.split_stats_range(start, end)
+
+        if split is None:
+            total, addresses = yield self._scan_batch_stats(
+                model_proxy, batch_id, max_results, start, end)
+            returnValue({
+                "total": total,
+                "unique_addresses": len(addresses),
+            })
+
+        first_bucket, last_bucket, edges = split
+        total = 0
+        addresses = set()
+        for edge_start, edge_end in edges:
+            edge_total, edge_addresses = yield self._scan_batch_stats(
+                model_proxy, batch_id, max_results, edge_start, edge_end)
+            total += edge_total
+            addresses.update(edge_addresses)
+
+        stats = yield get_cached_stats(
+            batch_id, first_bucket, last_bucket, addresses)
+        stats["total"] += total
+        returnValue(stats)
+
     def batch_inbound_stats(self, batch_id, max_results=None,
                             start=None, end=None):
         """
@@ -976,32 +1052,17 @@ class MessageStore(object):
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        If the cache has kept stats buckets for this batch, the whole buckets
+        in the range are read from the cache and only the partial buckets at
+        either end are counted with Riak index queries. The unique address
+        count is approximate in that case (see
+        :meth:`MessageStoreCache.get_inbound_stats`). Otherwise this method
+        performs multiple Riak index queries over the whole range.
         """
-        total = 0
-        unique_addresses = set()
-
-        start_value, end_value = self._start_end_values(batch_id, start, end)
-        if max_results is None:
-            max_results = self.DEFAULT_MAX_RESULTS
-        raw_page = yield self.inbound_messages.index_keys_page(
-            'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
-        page = IndexPageWrapper(
-            key_with_ts_and_value_formatter, self, batch_id, raw_page)
-
-        while page is not None:
-            results = list(page)
-            total += len(results)
-            unique_addresses.update(addr for key, timestamp, addr in results)
-            page = yield page.next_page()
+        return self._batch_stats(
+            self.inbound_messages, self.cache.get_inbound_stats, batch_id,
+            max_results, start, end)
 
-        returnValue({
-            "total": total,
-            "unique_addresses": len(unique_addresses),
-        })
-
-    @Manager.calls_manager
     def batch_outbound_stats(self, batch_id, max_results=None,
                              start=None, end=None):
         """
@@ -1025,30 +1086,11 @@ class MessageStore(object):
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        See :meth:`batch_inbound_stats` for how the stats are computed.
         """
-        total = 0
-        unique_addresses = set()
-
-        start_value, end_value = self._start_end_values(batch_id, start, end)
-        if max_results is None:
-            max_results = self.DEFAULT_MAX_RESULTS
-        raw_page = yield self.outbound_messages.index_keys_page(
-            'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
-        page = IndexPageWrapper(
-            key_with_ts_and_value_formatter, self, batch_id, raw_page)
-
-        while page is not None:
-            results = list(page)
-            total += len(results)
-            unique_addresses.update(addr for key, timestamp, addr in results)
-            page = yield page.next_page()
-
-        returnValue({
-            "total": total,
-            "unique_addresses": len(unique_addresses),
-        })
+        return self._batch_stats(
+            self.outbound_messages, self.cache.get_outbound_stats, batch_id,
+            max_results, start, end)
 
 
 class IndexPageWrapper(object):
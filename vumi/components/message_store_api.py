@@ -4,7 +4,7 @@ import functools
 
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.service import Worker
 from vumi.message import JSONMessageEncoder
@@ -21,6 +21,8 @@ class MatchResource(resource.Resource):
     """
 
     DEFAULT_RESULT_SIZE = 20
+    # Number of results to load and write at a time
+    RESULT_PAGE_SIZE = 100
 
     REQ_TTL_HEADER = 'X-VMS-Match-TTL'
     REQ_WAIT_HEADER = 'X-VMS-Match-Wait'
@@ -45,8 +47,8 @@ class MatchResource(resource.Resource):
             'inbound': message_store.find_inbound_keys_matching,
             'outbound': message_store.find_outbound_keys_matching,
         }.get(direction), batch_id)
-        self._results_cb = functools.partial(
-            message_store.get_keys_for_token, batch_id)
+        self._results_page_cb = functools.partial(
+            message_store.get_keys_page_for_token, batch_id)
         self._count_cb = functools.partial(
             message_store.count_keys_for_token, batch_id)
         self._in_progress_cb = functools.partial(
@@ -99,26 +101,46 @@ class MatchResource(resource.Resource):
     def _render_results(self, request, token, start, stop, keys_only, asc):
         in_progress = yield self._in_progress_cb(token)
         count = yield self._count_cb(token)
-        keys = yield self._results_cb(token, start, stop, asc)
         self._add_resp_header(request, self.RESP_IN_PROGRESS_HEADER,
             str(int(in_progress)))
         self._add_resp_header(request, self.RESP_COUNT_HEADER, str(count))
-        if keys_only:
-            request.write(json.dumps(keys))
-        else:
-            messages = []
-            for bunch in self._load_bunches_cb(keys):
-                # inbound & outbound messages have a `.msg` attribute which
-                # is the actual message stored, they share the same message_id
-                # as the key.
-                messages.extend([msg.msg.payload for msg in (yield bunch)
-                                    if msg.msg])
-
-            # sort the results in the order that the keys specified
-            messages.sort(key=lambda msg: keys.index(msg['message_id']))
-            request.write(json.dumps(messages, cls=JSONMessageEncoder))
+        # The results are written a page at a time, so we never hold more
+        # than a page of keys or messages in memory.
+        keys_page = yield self._results_page_cb(
+            token, self.RESULT_PAGE_SIZE, start, stop, asc)
+        request.write('[')
+        first = True
+        while keys_page is not None:
+            if keys_only:
+                items = list(keys_page)
+            else:
+                items = yield self._load_messages(list(keys_page))
+            for item in items:
+                if not first:
+                    request.write(', ')
+                first = False
+                request.write(json.dumps(item, cls=JSONMessageEncoder))
+            if keys_page.has_next_page():
+                keys_page = yield keys_page.next_page()
+            else:
+                keys_page = None
+        request.write(']')
         request.finish()
 
+    @inlineCallbacks
+    def _load_messages(self, keys):
+        messages = {}
+        for bunch in self._load_bunches_cb(keys):
+            # inbound & outbound messages have a `.msg` attribute which
+            # is the actual message stored, they share the same message_id
+            # as the key.
+            for msg in (yield bunch):
+                if msg.msg:
+                    messages[msg.msg['message_id']] = msg.msg.payload
+
+        # return the results in the order that the keys specified
+        returnValue([messages[key] for key in keys if key in messages])
+
     def render_GET(self, request):
         token = request.args['token'][0]
         start = int(request.args['start'][0] if 'start' in request.args else 0)
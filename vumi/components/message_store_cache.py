@@ -1,15 +1,17 @@
 # -*- test-case-name: vumi.components.tests.test_message_store_cache -*-
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
+from calendar import timegm
+from datetime import datetime, timedelta
 import hashlib
 import json
 import time
+from uuid import uuid4
 
 from twisted.internet.defer import returnValue
 
-from vumi.persist.redis_base import Manager
-from vumi.message import TransportEvent, parse_vumi_date
+from vumi.persist.redis_base import Manager, gather_calls
+from vumi.message import TransportEvent, parse_vumi_date, format_vumi_date
 from vumi.errors import VumiError
 
 
@@ -34,10 +36,18 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    INBOUND_STATS_KEY = 'inbound_stats'
+    OUTBOUND_STATS_KEY = 'outbound_stats'
+    STATS_BUCKETS_KEY = 'stats_buckets'
     TRUNCATE_MESSAGE_KEY_COUNT_AT = 2000
 
+    # Message stats are bucketed by the hour
+    STATS_BUCKET_SIZE = 60 * 60
+
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
+    # Number of search result keys to store at once
+    QUERY_RESULTS_CHUNK_SIZE = 1000
 
     def __init__(self, redis):
         # Store redis as `manager` as well since @Manager.calls_manager
@@ -83,6 +93,15 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def inbound_stats_key(self, batch_id):
+        return self.batch_key(self.INBOUND_STATS_KEY, batch_id)
+
+    def outbound_stats_key(self, batch_id):
+        return self.batch_key(self.OUTBOUND_STATS_KEY, batch_id)
+
+    def stats_buckets_key(self, batch_id):
+        return self.batch_key(self.STATS_BUCKETS_KEY, batch_id)
+
     def uses_counters(self, batch_id):
         """
         Returns ``True`` if ``batch_id`` has moved to the new system
@@ -106,6 +125,17 @@ class MessageStoreCache(object):
         """
         return self.redis.exists(self.event_count_key(batch_id))
 
+    def uses_stats_buckets(self, batch_id):
+        """
+        Returns ``True`` if message stats for ``batch_id`` have been kept in
+        time buckets since the batch was started or last reconciled.
+
+        Stats buckets for older batches only cover messages added after the
+        code that maintains them was deployed, so they can't be used to
+        answer stats queries until the batch has been reconciled.
+        """
+        return self.redis.exists(self.stats_buckets_key(batch_id))
+
     @Manager.calls_manager
     def switch_to_counters(self, batch_id):
         """
@@ -178,6 +208,8 @@ class MessageStoreCache(object):
             yield self.redis.set(self.inbound_count_key(batch_id), 0)
             yield self.redis.set(self.outbound_count_key(batch_id), 0)
             yield self.redis.set(self.event_count_key(batch_id), 0)
+        yield self.redis.set(
+            self.stats_buckets_key(batch_id), self.STATS_BUCKET_SIZE)
 
     @Manager.calls_manager
     def init_status(self, batch_id):
@@ -223,8 +255,23 @@ class MessageStoreCache(object):
         yield self.redis.delete(self.status_key(batch_id))
         yield self.redis.delete(self.to_addr_key(batch_id))
         yield self.redis.delete(self.from_addr_key(batch_id))
+        yield self.clear_stats(self.inbound_stats_key(batch_id))
+        yield self.clear_stats(self.outbound_stats_key(batch_id))
+        yield self.redis.delete(self.stats_buckets_key(batch_id))
         yield self.redis.srem(self.batch_key(), batch_id)
 
+    @Manager.calls_manager
+    def clear_stats(self, stats_key):
+        """
+        Remove the stats hash at ``stats_key`` and the HyperLogLogs for all
+        of its buckets.
+        """
+        buckets = yield self.redis.hgetall(stats_key)
+        yield gather_calls([
+            self.redis.delete(self.key(stats_key, bucket))
+            for bucket in buckets])
+        yield self.redis.delete(stats_key)
+
     def get_timestamp(self, timestamp):
         """
         Return a timestamp value for a datetime value.
@@ -233,20 +280,159 @@ class MessageStoreCache(object):
             timestamp = parse_vumi_date(timestamp)
         return time.mktime(timestamp.timetuple())
 
+    def _bucket_start(self, timestamp):
+        seconds = timegm(timestamp.timetuple()) % self.STATS_BUCKET_SIZE
+        return timestamp - timedelta(
+            seconds=seconds, microseconds=timestamp.microsecond)
+
+    def get_stats_bucket(self, timestamp):
+        """
+        Return the stats bucket (the UTC timestamp of the start of the bucket)
+        for a datetime value or a string matching VUMI_DATE_FORMAT.
+        """
+        if isinstance(timestamp, basestring):
+            timestamp = parse_vumi_date(timestamp)
+        return timegm(self._bucket_start(timestamp).timetuple())
+
+    def split_stats_range(self, start=None, end=None):
+        """
+        Split a time range into the stats buckets that fall entirely within
+        it and the partial ranges at either end that aren't covered by a whole
+        bucket.
+
+        :param str start:
+            Optional start timestamp string matching VUMI_DATE_FORMAT.
+
+        :param str end:
+            Optional end timestamp string matching VUMI_DATE_FORMAT.
+
+        :returns:
+            ``None`` if the range doesn't cover any whole buckets, otherwise a
+            ``(first_bucket, last_bucket, edges)`` tuple. ``first_bucket`` and
+            ``last_bucket`` are ``None`` if the range is unbounded at that end
+            and ``edges`` is a list of ``(start, end)`` timestamp string pairs
+            for the partial ranges. All ranges are inclusive.
+        """
+        bucket_size = timedelta(seconds=self.STATS_BUCKET_SIZE)
+        tick = timedelta(microseconds=1)
+        first_bucket = last_bucket = None
+        edges = []
+        if start is not None:
+            start_dt = parse_vumi_date(start)
+            first_dt = self._bucket_start(start_dt)
+            if first_dt != start_dt:
+                first_dt += bucket_size
+                edges.append((start, format_vumi_date(first_dt - tick)))
+            first_bucket = timegm(first_dt.timetuple())
+        if end is not None:
+            after_dt = parse_vumi_date(end) + tick
+            next_dt = self._bucket_start(after_dt)
+            if next_dt != after_dt:
+                edges.append((format_vumi_date(next_dt), end))
+            last_bucket = timegm((next_dt - bucket_size).timetuple())
+        if None not in (first_bucket, last_bucket):
+            if first_bucket > last_bucket:
+                return None
+        return first_bucket, last_bucket, edges
+
+    def _add_stats(self, stats_key, timestamp, addr):
+        bucket = self.get_stats_bucket(timestamp)
+        return gather_calls([
+            self.redis.hincrby(stats_key, bucket, 1),
+            self.redis.pfadd(self.key(stats_key, bucket),
+                             addr.encode('utf-8')),
+        ])
+
+    @Manager.calls_manager
+    def _get_stats(self, stats_key, first_bucket, last_bucket, addresses):
+        counts = yield self.redis.hgetall(stats_key)
+        buckets = [
+            bucket for bucket in counts
+            if (first_bucket is None or int(bucket) >= first_bucket) and
+            (last_bucket is None or int(bucket) <= last_bucket)]
+        total = sum(int(counts[bucket]) for bucket in buckets)
+        hll_keys = [self.key(stats_key, bucket) for bucket in buckets]
+        if addresses:
+            addresses_key = self.key(stats_key, 'tmp', uuid4().get_hex())
+            yield self.redis.pfadd(
+                addresses_key, *[addr.encode('utf-8') for addr in addresses])
+            unique_addresses = yield self.redis.pfcount(
+                addresses_key, *hll_keys)
+            yield self.redis.delete(addresses_key)
+        elif hll_keys:
+            unique_addresses = yield self.redis.pfcount(*hll_keys)
+        else:
+            unique_addresses = 0
+        returnValue({
+            "total": total,
+            "unique_addresses": unique_addresses,
+        })
+
+    def add_inbound_stats(self, batch_id, timestamp, from_addr):
+        """
+        Count an inbound message in the stats bucket for its timestamp.
+        Generally this is done when `add_inbound_message()` is called.
+        """
+        return self._add_stats(
+            self.inbound_stats_key(batch_id), timestamp, from_addr)
+
+    def add_outbound_stats(self, batch_id, timestamp, to_addr):
+        """
+        Count an outbound message in the stats bucket for its timestamp.
+        Generally this is done when `add_outbound_message()` is called.
+        """
+        return self._add_stats(
+            self.outbound_stats_key(batch_id), timestamp, to_addr)
+
+    def get_inbound_stats(self, batch_id, first_bucket=None, last_bucket=None,
+                          addresses=()):
+        """
+        Return inbound message stats for the stats buckets from
+        ``first_bucket`` to ``last_bucket`` inclusive.
+
+        :param addresses:
+            Addresses of messages counted elsewhere (outside the buckets) to
+            include in the unique address count.
+
+        :returns:
+            ``dict`` containing 'total' and 'unique_addresses' entries. The
+            unique address count uses Redis's HyperLogLog functionality, so
+            it is subject to a standard error of 0.81%.
+        """
+        return self._get_stats(
+            self.inbound_stats_key(batch_id), first_bucket, last_bucket,
+            addresses)
+
+    def get_outbound_stats(self, batch_id, first_bucket=None,
+                           last_bucket=None, addresses=()):
+        """
+        Return outbound message stats for the stats buckets from
+        ``first_bucket`` to ``last_bucket`` inclusive.
+
+        See :meth:`get_inbound_stats` for details.
+        """
+        return self._get_stats(
+            self.outbound_stats_key(batch_id), first_bucket, last_bucket,
+            addresses)
+
     @Manager.calls_manager
     def add_outbound_message(self, batch_id, msg):
         """
         Add an outbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(
+        new_entry = yield self.add_outbound_message_key(
             batch_id, msg['message_id'], timestamp)
         yield self.add_to_addr(batch_id, msg['to_addr'])
+        if new_entry:
+            yield self.add_outbound_stats(
+                batch_id, msg['timestamp'], msg['to_addr'])
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
+        Returns 0 if the key already exists in the set, 1 if it doesn't.
         """
         new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -258,6 +444,7 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.outbound_count_key(batch_id))
                 yield self.truncate_outbound_message_keys(batch_id)
+        returnValue(new_entry)
 
     @Manager.calls_manager
     def add_outbound_message_count(self, batch_id, count):
@@ -337,14 +524,18 @@ class MessageStoreCache(object):
         Add an inbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(
+        new_entry = yield self.add_inbound_message_key(
             batch_id, msg['message_id'], timestamp)
         yield self.add_from_addr(batch_id, msg['from_addr'])
+        if new_entry:
+            yield self.add_inbound_stats(
+                batch_id, msg['timestamp'], msg['from_addr'])
 
     @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
-        Add a message key, weighted with the timestamp to the batch_id
+        Add a message key, weighted with the timestamp to the batch_id.
+        Returns 0 if the key already exists in the set, 1 if it doesn't.
         """
         new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -355,6 +546,7 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.inbound_count_key(batch_id))
                 yield self.truncate_inbound_message_keys(batch_id)
+        returnValue(new_entry)
 
     @Manager.calls_manager
     def add_inbound_message_count(self, batch_id, count):
@@ -576,7 +768,14 @@ class MessageStoreCache(object):
         Store the inbound query results for a query that was started with
         `start_inbound_query`. Internally this grabs the timestamps from
         the cache (there is an assumption that it has already been reconciled)
-        and orders the results accordingly.
+        and orders the results accordingly. Keys that aren't in the cache are
+        left out of the results.
+
+        The timestamps are fetched and the results stored in chunks of
+        `QUERY_RESULTS_CHUNK_SIZE` keys, with the lookups for each chunk
+        pipelined and each chunk written with a single ZADD. The expiry is
+        set along with each chunk, so a partly stored result set still
+        expires.
 
         :param str token:
             The token to store the results under.
@@ -599,14 +798,22 @@ class MessageStoreCache(object):
 
         # populate the results set weighted according to the timestamps
         # that are already known in the cache.
-        for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
-                key.encode('utf-8'): timestamp,
-            })
+        chunk_size = self.QUERY_RESULTS_CHUNK_SIZE
+        for i in xrange(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            timestamps = yield gather_calls([
+                self.redis.zscore(score_set_key, key) for key in chunk])
+            scores = dict(
+                (key.encode('utf-8'), timestamp)
+                for key, timestamp in zip(chunk, timestamps)
+                if timestamp is not None)
+            if scores:
+                # Auto expire after TTL
+                yield gather_calls([
+                    self.redis.zadd(result_key, **scores),
+                    self.redis.expire(result_key, ttl),
+                ])
 
-        # Auto expire after TTL
-        yield self.redis.expire(result_key, ttl)
         # Remove from the list of in progress search operations.
         yield self.redis.srem(self.search_token_key(batch_id), token)
 
@@ -625,9 +832,95 @@ class MessageStoreCache(object):
         result_key = self.search_result_key(batch_id, token)
         return self.redis.zrange(result_key, start, stop, desc=not asc)
 
+    @Manager.calls_manager
+    def get_query_results_page(self, batch_id, token, page_size, start=0,
+                               stop=-1, asc=False):
+        """
+        Return a :class:`QueryResultsPage` with up to `page_size` of the
+        results for the query token, starting at index `start`. Further pages
+        are fetched with the page's ``next_page()`` method until index `stop`
+        is reached. As with :meth:`get_query_results`, negative indexes count
+        from the end of the results, so the default `stop` of ``-1`` means
+        the last result.
+        """
+        if start < 0 or stop < -1:
+            # Later pages can't be fetched relative to the end of the results,
+            # since results may be added, so we resolve the indexes now.
+            count = yield self.count_query_results(batch_id, token)
+            if start < 0:
+                start = max(count + start, 0)
+            if stop < -1:
+                stop = count + stop
+                if stop < start:
+                    returnValue(QueryResultsPage(
+                        self, batch_id, token, [], page_size, start, stop,
+                        asc))
+        page_stop = start + page_size - 1
+        if stop >= 0:
+            page_stop = min(page_stop, stop)
+        keys = yield self.get_query_results(
+            batch_id, token, start, page_stop, asc)
+        returnValue(QueryResultsPage(
+            self, batch_id, token, keys, page_size, start, stop, asc))
+
     def count_query_results(self, batch_id, token):
         """
         Return the number of results for the query token.
         """
         result_key = self.search_result_key(batch_id, token)
         return self.redis.zcard(result_key)
+
+
+class QueryResultsPage(object):
+    """
+    A page of search result keys from the cache.
+
+    This has the same interface as the message store's index pages, so
+    large result sets can be processed a page at a time.
+    """
+
+    def __init__(self, cache, batch_id, token, keys, page_size, start, stop,
+                 asc):
+        self.manager = cache.manager
+        self._cache = cache
+        self._batch_id = batch_id
+        self._token = token
+        self._keys = keys
+        self._page_size = page_size
+        self._next_start = start + len(keys)
+        self._stop = stop
+        self._asc = asc
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def has_next_page(self):
+        """
+        Indicate whether there may be more results to follow.
+
+        :returns:
+            ``True`` if there may be more results, ``False`` if this is the
+            last page.
+        """
+        if len(self._keys) < self._page_size:
+            return False
+        return self._stop < 0 or self._next_start <= self._stop
+
+    @Manager.calls_manager
+    def next_page(self):
+        """
+        Fetch the next page of results.
+
+        :returns:
+            A new :class:`QueryResultsPage` object containing the next page
+            of results, or ``None`` if this is the last page.
+        """
+        if not self.has_next_page():
+            returnValue(None)
+        page = yield self._cache.get_query_results_page(
+            self._batch_id, self._token, self._page_size, self._next_start,
+            self._stop, self._asc)
+        returnValue(page)
@@ -1,17 +1,23 @@
 # -*- test-case-name: vumi.components.tests.test_message_store_resource -*-
 
+from collections import deque
+
 import iso8601
 
 from twisted.application.internet import StreamServerEndpointService
-from twisted.internet.defer import DeferredList, inlineCallbacks
-from twisted.web.resource import NoResource, Resource
-from twisted.web.server import NOT_DONE_YET
-
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.resource import (
+    NoResource, Resource, EncodingResourceWrapper)
+from twisted.web.server import NOT_DONE_YET, GzipEncoderFactory
+from zope.interface import implements
+
+from vumi import log
 from vumi.components.message_store import MessageStore
 from vumi.components.message_formatters import (
     JsonFormatter, CsvFormatter, CsvEventFormatter)
 from vumi.config import (
-    ConfigDict, ConfigText, ConfigServerEndpoint, ConfigInt,
+    ConfigDict, ConfigText, ConfigServerEndpoint, ConfigInt, ConfigBool,
     ServerEndpointFallback)
 from vumi.message import format_vumi_date
 from vumi.persist.txriak_manager import TxRiakManager
@@ -21,14 +27,6 @@ from vumi.utils import build_web_site
 from vumi.worker import BaseWorker
 
 
-# NOTE: Thanks Ned http://stackoverflow.com/a/312464!
-def chunks(l, n):
-    """ Yield successive n-sized chunks from l.
-    """
-    for i in xrange(0, len(l), n):
-        yield l[i:i + n]
-
-
 class ParameterError(Exception):
     """
     Exception raised while trying to parse a parameter.
@@ -36,6 +34,128 @@ class ParameterError(Exception):
     pass
 
 
+class MessageExporter(object):
+    """
+    Streams the messages for a sequence of key pages to a request.
+
+    Up to `concurrency` messages are fetched at once and a new fetch is
+    started as soon as one finishes, so a slow fetch only holds up its own
+    slot. Messages are written in the order their fetches finish.
+
+    The exporter is registered with the request as a push producer. When the
+    transport's write buffer is full, no new fetches are started until the
+    transport asks for more data, so a slow client doesn't make us buffer
+    the whole export in memory. For the same reason, the next page of keys
+    is only fetched once fewer than `concurrency` keys are waiting to be
+    fetched and we aren't paused.
+
+    If a page of keys can't be fetched, the connection is aborted so that
+    the client doesn't mistake the truncated export for a complete one.
+
+    :param resource:
+        The :class:`MessageStoreProxyResource` to fetch and write messages
+        with.
+    :param request:
+        The request to write messages to.
+    :param int concurrency:
+        Maximum number of messages to fetch at once.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, resource, request, concurrency):
+        self.resource = resource
+        self.request = request
+        self.concurrency = concurrency
+        self.paused = False
+        self.stopped = False
+        self.in_flight = 0
+        self._keys = deque()
+        self._keys_page = None
+        self._page_d = None
+        self._done = Deferred()
+
+    def start(self, keys_page):
+        """
+        Start exporting messages.
+
+        :returns:
+            A deferred that fires when all messages have been exported, the
+            connection has been lost or the export has failed.
+        """
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addBoth(lambda _: self.stopProducing())
+        self._add_page(keys_page)
+        return self._done
+
+    def _add_page(self, keys_page):
+        self._page_d = None
+        self._keys.extend(keys_page)
+        self._keys_page = keys_page if keys_page.has_next_page() else None
+        self._fill()
+
+    def _fetch_page(self):
+        keys_page, self._keys_page = self._keys_page, None
+        self._page_d = keys_page.next_page()
+        self._page_d.addCallbacks(self._add_page, self._page_failed)
+
+    def _page_failed(self, failure):
+        log.err(failure, "Error fetching keys page for export.")
+        self._page_d = None
+        self.stopProducing()
+        self.request.unregisterProducer()
+        self.request.transport.abortConnection()
+
+    def _fill(self):
+        while (self._keys and self.in_flight < self.concurrency and
+               not (self.paused or self.stopped)):
+            key = self._keys.popleft()
+            self.in_flight += 1
+            d = self.resource.get_message(
+                self.resource.message_store, key)
+            d.addCallback(self._write_message)
+            d.addErrback(log.err, "Error fetching message for export.")
+            d.addBoth(self._fetch_done)
+        if (self._keys_page is not None and
+                len(self._keys) < self.concurrency and
+                not (self.paused or self.stopped)):
+            # We fetch the next page while the keys we have left are being
+            # processed.
+            self._fetch_page()
+        else:
+            self._check_done()
+
+    def _write_message(self, message):
+        if not self.stopped:
+            self.resource.write_message(message, self.request)
+
+    def _fetch_done(self, _):
+        self.in_flight -= 1
+        self._fill()
+
+    def _check_done(self):
+        if self._done.called or self.in_flight:
+            return
+        if self.stopped:
+            self._done.callback(None)
+        elif (not self._keys and self._keys_page is None and
+                self._page_d is None):
+            self.request.unregisterProducer()
+            self.request.finish()
+            self._done.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._fill()
+
+    def stopProducing(self):
+        self.stopped = True
+        self._check_done()
+
+
 class MessageStoreProxyResource(Resource):
 
     isLeaf = True
@@ -82,10 +202,7 @@ class MessageStoreProxyResource(Resource):
         else:
             d = self.get_keys_page_for_time(
                 self.message_store, self.batch_id, start, end)
-        request.connection_has_been_closed = False
-        request.notifyFinish().addBoth(
-            lambda _: setattr(request, 'connection_has_been_closed', True))
-        d.addCallback(self.fetch_pages, concurrency, request)
+        d.addCallback(self.export_messages, concurrency, request)
         return NOT_DONE_YET
 
     def get_keys_page(self, message_store, batch_id):
@@ -97,66 +214,14 @@ class MessageStoreProxyResource(Resource):
     def get_message(self, message_store, message_id):
         raise NotImplementedError('To be implemented by sub-class.')
 
-    def fetch_pages(self, keys_page, concurrency, request):
-        """
-        Process a page of keys and each subsequent page.
-
-        The keys for the current page are handed off to :meth:`fetch_page` for
-        processing. If there is another page, we fetch that while the current
-        page is being handled and add a callback to process it when the
-        current page is finished.
-
-        When there are no more pages, we add a callback to close the request.
-        """
-        if request.connection_has_been_closed:
-            # We're no longer connected, so stop doing work.
-            return
-        d = self.fetch_page(keys_page, concurrency, request)
-        if keys_page.has_next_page():
-            # We fetch the next page before waiting for the current page to be
-            # processed.
-            next_page_d = keys_page.next_page()
-            d.addCallback(lambda _: next_page_d)
-            # Add this method as a callback to operate on the next page. It's
-            # like recursion, but without worrying about stack size.
-            d.addCallback(self.fetch_pages, concurrency, request)
-        else:
-            # No more pages, so close the request.
-            d.addCallback(self.finish_request_cb, request)
-        return d
-
-    def finish_request_cb(self, _result, request):
-        if not request.connection_has_been_closed:
-            # We need to check for this here in case we lose the connection
-            # while delivering the last page.
-            return request.finish()
-
-    @inlineCallbacks
-    def fetch_page(self, keys_page, concurrency, request):
+    def export_messages(self, keys_page, concurrency, request):
         """
-        Process a page of keys in chunks of concurrently-fetched messages.
+        Write the messages for a page of keys and each subsequent page.
         """
-        for keys in chunks(list(keys_page), concurrency):
-            if request.connection_has_been_closed:
-                # We're no longer connected, so stop doing work.
-                return
-            yield self.handle_chunk(keys, request)
-
-    def handle_chunk(self, message_keys, request):
-        """
-        Concurrently fetch a chunk of messages and write each to the response.
-        """
-        return DeferredList([
-            self.handle_message(key, request) for key in message_keys])
-
-    def handle_message(self, message_key, request):
-        d = self.get_message(self.message_store, message_key)
-        d.addCallback(self.write_message, request)
-        return d
+        return MessageExporter(self, request, concurrency).start(keys_page)
 
     def write_message(self, message, request):
-        if not request.content.closed:
-            self.formatter.write_row(request, message)
+        self.formatter.write_row(request, message)
 
 
 class InboundResource(MessageStoreProxyResource):
@@ -215,27 +280,34 @@ class BatchResource(Resource):
         'events.csv': (EventResource, CsvEventFormatter),
     }
 
-    def __init__(self, message_store, batch_id):
+    def __init__(self, message_store, batch_id, gzip=False):
         Resource.__init__(self)
         self.message_store = message_store
         self.batch_id = batch_id
+        self.gzip = gzip
 
     def getChild(self, path, request):
         if path not in self.RESOURCES:
             return NoResource()
         resource_class, message_formatter = self.RESOURCES.get(path)
-        return resource_class(
+        resource = resource_class(
             self.message_store, self.batch_id, message_formatter())
+        if self.gzip:
+            # Responses are only compressed if the client accepts gzip.
+            resource = EncodingResourceWrapper(
+                resource, [GzipEncoderFactory()])
+        return resource
 
 
 class MessageStoreResource(Resource):
 
-    def __init__(self, message_store):
+    def __init__(self, message_store, gzip=False):
         Resource.__init__(self)
         self.message_store = message_store
+        self.gzip = gzip
 
     def getChild(self, path, request):
-        return BatchResource(self.message_store, path)
+        return BatchResource(self.message_store, path, gzip=self.gzip)
 
 
 class MessageStoreResourceWorker(BaseWorker):
@@ -256,6 +328,9 @@ class MessageStoreResourceWorker(BaseWorker):
             'Riak client configuration.', default={}, static=True)
         redis_manager = ConfigDict(
             'Redis client configuration.', default={}, static=True)
+        gzip = ConfigBool(
+            'Compress exports with gzip for clients that accept it.',
+            default=False, static=True)
 
         # TODO: Deprecate these fields when confmodel#5 is done.
         host = ConfigText(
@@ -276,7 +351,8 @@ class MessageStoreResourceWorker(BaseWorker):
         self.store = MessageStore(self._riak, redis)
 
         site = build_web_site({
-            config.web_path: MessageStoreResource(self.store),
+            config.web_path: MessageStoreResource(
+                self.store, gzip=config.gzip),
             config.health_path: httprpc.HttpRpcHealthResource(self),
         })
         self.addService(
@@ -7,24 +7,39 @@ import time
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
+from vumi.persist.redis_base import Manager, gather_calls
+from vumi.utils import LRUCache
 
 
 class SessionManager(object):
     """A manager for sessions.
 
-    :param TxRedisManager redis:
-        Redis manager object.
+    :param redis:
+        Redis manager object (sync or async).
     :param int max_session_length:
         Time before a session expires. Default is None (never expire).
     :param float gc_period:
         Deprecated and ignored.
+    :param int cache_size:
+        Number of sessions to cache in memory. Default is None (no cache).
+        Sessions are only cached by this process, so this should only be
+        enabled if other processes don't modify the sessions this one reads.
+    :param float cache_ttl:
+        Time before a cached session is reloaded from Redis. Default is None
+        (only reload once evicted).
     """
 
-    def __init__(self, redis, max_session_length=None, gc_period=None):
+    SCAN_COUNT = 100
+
+    def __init__(self, redis, max_session_length=None, gc_period=None,
+                 cache_size=None, cache_ttl=None):
         self.max_session_length = max_session_length
         self.redis = redis
         if gc_period is not None:
             log.warning("SessionManager 'gc_period' parameter is deprecated.")
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(cache_size, ttl=cache_ttl)
 
     @inlineCallbacks
     def stop(self, stop_redis=True):
@@ -33,36 +48,81 @@ class SessionManager(object):
 
     @classmethod
     def from_redis_config(cls, config, key_prefix=None,
-                          max_session_length=None, gc_period=None):
+                          max_session_length=None, gc_period=None,
+                          cache_size=None, cache_ttl=None):
         """Create a `SessionManager` instance using `TxRedisManager`.
         """
         from vumi.persist.txredis_manager import TxRedisManager
         d = TxRedisManager.from_config(config)
         if key_prefix is not None:
             d.addCallback(lambda m: m.sub_manager(key_prefix))
-        return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
+        return d.addCallback(lambda m: cls(
+            m, max_session_length, gc_period, cache_size=cache_size,
+            cache_ttl=cache_ttl))
+
+    def _session_key(self, user_id):
+        return "%s:%s" % ('session', user_id)
+
+    @inlineCallbacks
+    def scan_active_sessions(self, cursor=None, count=SCAN_COUNT):
+        """Return a page of active user_ids and associated sessions.
+
+        Uses SCAN rather than KEYS, so Redis isn't blocked while the whole
+        keyspace is walked. The sessions in each page are loaded together.
+
+        :returns:
+            A tuple of ``(next_cursor, [(user_id, session), ...])``.
+            ``next_cursor`` is ``None`` once all keys have been scanned. A page
+            may be empty even if there are more sessions to come.
+        """
+        next_cursor, keys = yield self.redis.scan(cursor, 'session:*', count)
+        user_ids = [key.split(':', 1)[1] for key in keys]
+        sessions = yield gather_calls(
+            [self.load_session(user_id) for user_id in user_ids])
+        # A session may expire between the scan and the load.
+        returnValue((next_cursor, [
+            (user_id, session) for user_id, session in zip(user_ids, sessions)
+            if session]))
 
     @inlineCallbacks
     def active_sessions(self):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        Walks the session keys using :meth:`scan_active_sessions`. This is
+        still O(n) over the total number of keys in redis, so try not to hit
+        this too often.
         """
-        keys = yield self.redis.keys('session:*')
         sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
-
+        cursor = None
+        while True:
+            cursor, page = yield self.scan_active_sessions(cursor)
+            sessions.extend(page)
+            if cursor is None:
+                break
         returnValue(sessions)
 
+    @Manager.calls_manager('redis')
     def load_session(self, user_id):
         """
-        Load session data from Redis
+        Load session data from Redis (or from the cache, if enabled)
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.hgetall(ukey)
+        if self.cache is not None:
+            session = self.cache.get(user_id)
+            if session is not None:
+                returnValue(dict(session))
+        session = yield self.redis.hgetall(self._session_key(user_id))
+        if self.cache is not None:
+            self._cache_session(session, user_id)
+        returnValue(session)
+
+    def _cache_session(self, session, user_id):
+        if session:
+            ttl = self.cache.ttl
+            if self.max_session_length:
+                ttl = min(ttl or self.max_session_length,
+                          self.max_session_length)
+            self.cache.set(user_id, dict(session), ttl=ttl)
+        return session
 
     def schedule_session_expiry(self, user_id, timeout):
         """
@@ -75,28 +135,39 @@ class SessionManager(object):
         timeout : int
             The number of seconds after which this session should expire
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.expire(ukey, timeout)
+        return self.redis.expire(self._session_key(user_id), timeout)
 
     @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
+
+        The old session is cleared, the new one is saved and its expiry set
+        without waiting for each other, so this costs a single round-trip.
         """
-        yield self.clear_session(user_id)
+        ukey = self._session_key(user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        calls = [
+            self.clear_session(user_id),
+            self.redis.hmset(ukey, defaults),
+        ]
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            calls.append(self.schedule_session_expiry(
+                user_id, int(self.max_session_length)))
+        calls.append(self.redis.hgetall(ukey))
+        results = yield gather_calls(calls)
+        session = results[-1]
+        if self.cache is not None:
+            self._cache_session(session, user_id)
+        returnValue(session)
 
     def clear_session(self, user_id):
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.delete(ukey)
+        if self.cache is not None:
+            self.cache.pop(user_id)
+        return self.redis.delete(self._session_key(user_id))
 
     @inlineCallbacks
     def save_session(self, user_id, session):
@@ -112,7 +183,8 @@ class SessionManager(object):
             values that are dictionaries are converted to strings by Redis.
 
         """
-        ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+        if self.cache is not None:
+            self.cache.pop(user_id)
+        if session:
+            yield self.redis.hmset(self._session_key(user_id), session)
         returnValue(session)
@@ -0,0 +1,184 @@
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred)
+
+from vumi.components.delay_queue import DelayQueue
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+
+class FakeTime(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestDelayQueue(VumiTestCase):
+
+    is_sync = False
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(is_sync=self.is_sync))
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = FakeTime()
+        self.queue = self.mk_queue()
+
+    def mk_queue(self, **kw):
+        kw.setdefault('get_time', self.clock)
+        kw.setdefault('visibility_timeout', 30)
+        return DelayQueue(self.redis, 'test_queue', **kw)
+
+    @inlineCallbacks
+    def add_items(self, count, delay=0):
+        item_ids = []
+        for i in range(count):
+            item_id = yield self.queue.add("payload %s" % (i,), delay)
+            item_ids.append(item_id)
+        returnValue(item_ids)
+
+    @inlineCallbacks
+    def test_add(self):
+        item_id = yield self.queue.add("foo", 10)
+        self.assertEqual((yield self.queue.get(item_id)), "foo")
+        self.assertEqual((yield self.queue.due_time(item_id)), 1010.0)
+        self.assertEqual((yield self.queue.count()), 1)
+
+    @inlineCallbacks
+    def test_add_with_item_id(self):
+        item_id = yield self.queue.add("foo", 10, now=50, item_id="item1")
+        self.assertEqual(item_id, "item1")
+        self.assertEqual((yield self.queue.due_time("item1")), 60.0)
+
+    @inlineCallbacks
+    def test_claim_due_nothing_due(self):
+        yield self.queue.add("foo", 10)
+        self.assertEqual((yield self.queue.claim_due()), [])
+        self.assertEqual((yield self.queue.count_due()), 0)
+
+    @inlineCallbacks
+    def test_claim_due(self):
+        item_id = yield self.queue.add("foo", 10)
+        self.clock.now += 10
+        self.assertEqual((yield self.queue.count_due()), 1)
+        claimed = yield self.queue.claim_due()
+        self.assertEqual(claimed, [(item_id, "foo")])
+        # The item is hidden until the visibility timeout expires.
+        self.assertEqual((yield self.queue.claim_due()), [])
+        self.assertEqual((yield self.queue.due_time(item_id)), 1040.0)
+
+    @inlineCallbacks
+    def test_claim_due_order_and_limit(self):
+        late = yield self.queue.add("late", -5)
+        early = yield self.queue.add("early", -10)
+        yield self.queue.add("future", 10)
+        claimed = yield self.queue.claim_due(limit=1)
+        self.assertEqual(claimed, [(early, "early")])
+        claimed = yield self.queue.claim_due()
+        self.assertEqual(claimed, [(late, "late")])
+
+    @inlineCallbacks
+    def test_claim_due_batch_size(self):
+        self.queue = self.mk_queue(batch_size=3)
+        yield self.add_items(5)
+        self.assertEqual(len((yield self.queue.claim_due())), 3)
+        self.assertEqual(len((yield self.queue.claim_due())), 2)
+        self.assertEqual((yield self.queue.claim_due()), [])
+
+    @inlineCallbacks
+    def test_claim_due_redelivers_unacked(self):
+        [item_id] = yield self.add_items(1)
+        yield self.queue.claim_due()
+        self.clock.now += 30
+        claimed = yield self.queue.claim_due()
+        self.assertEqual(claimed, [(item_id, "payload 0")])
+
+    @inlineCallbacks
+    def test_claim_due_concurrent_claimers(self):
+        item_ids = yield self.add_items(3)
+        other_queue = self.mk_queue()
+        claimed = yield self.queue.claim_due(limit=1)
+        claimed_1 = yield self.queue.claim_due()
+        claimed_2 = yield other_queue.claim_due()
+        all_claimed = [i for i, _ in claimed + claimed_1 + claimed_2]
+        self.assertEqual(sorted(all_claimed), sorted(item_ids))
+
+    @inlineCallbacks
+    def test_claim_due_lost_race(self):
+        [item_id] = yield self.add_items(1)
+        # Simulate another claimer bumping the score between our read and our
+        # increment.
+        orig_zrangebyscore = self.redis.zrangebyscore
+
+        def zrangebyscore(*args, **kw):
+            d = orig_zrangebyscore(*args, **kw)
+            self.redis.zincrby(self.queue.due_key(), item_id, 30)
+            return d
+
+        self.patch(self.redis, 'zrangebyscore', zrangebyscore)
+        self.assertEqual((yield self.queue.claim_due()), [])
+
+    @inlineCallbacks
+    def test_claim_due_overdue_concurrent_claimers(self):
+        item_id = yield self.queue.add("foo", -3600)
+        other_queue = self.mk_queue()
+        self.assertEqual(
+            (yield self.queue.claim_due()), [(item_id, "foo")])
+        self.assertEqual((yield self.queue.due_time(item_id)), 1030.0)
+        self.assertEqual((yield other_queue.claim_due()), [])
+        self.assertEqual((yield self.queue.claim_due()), [])
+
+    @inlineCallbacks
+    def test_claim_due_overdue_interleaved_claimers(self):
+        item_id = yield self.queue.add("foo", -3600)
+        other_queue = self.mk_queue()
+        # Start the other claimer between our read and our increment.
+        orig_zrangebyscore = self.redis.zrangebyscore
+        other_d = []
+
+        def zrangebyscore(*args, **kw):
+            result = orig_zrangebyscore(*args, **kw)
+            self.patch(self.redis, 'zrangebyscore', orig_zrangebyscore)
+            other_d.append(maybeDeferred(other_queue.claim_due))
+            return result
+
+        self.patch(self.redis, 'zrangebyscore', zrangebyscore)
+        claimed = yield self.queue.claim_due()
+        other_claimed = yield other_d[0]
+        self.assertEqual(claimed + other_claimed, [(item_id, "foo")])
+
+    @inlineCallbacks
+    def test_claim_due_sets_exact_due_time(self):
+        self.clock.now = 1476812345.123456
+        item_id = yield self.queue.add("foo", -3600.987654)
+        self.assertEqual(
+            (yield self.queue.claim_due()), [(item_id, "foo")])
+        self.assertEqual(
+            (yield self.queue.due_time(item_id)), self.clock.now + 30)
+
+    @inlineCallbacks
+    def test_claim_due_orphaned_entry(self):
+        yield self.redis.zadd(self.queue.due_key(), orphan=900)
+        self.assertEqual((yield self.queue.claim_due()), [])
+        self.assertEqual((yield self.queue.count()), 0)
+
+    @inlineCallbacks
+    def test_ack(self):
+        item_ids = yield self.add_items(3)
+        yield self.queue.claim_due()
+        yield self.queue.ack(*item_ids[:2])
+        self.assertEqual((yield self.queue.item_ids()), item_ids[2:])
+        self.assertEqual((yield self.queue.get(item_ids[0])), None)
+        self.assertEqual((yield self.queue.get(item_ids[2])), "payload 2")
+
+    @inlineCallbacks
+    def test_ack_nothing(self):
+        yield self.add_items(1)
+        yield self.queue.ack()
+        self.assertEqual((yield self.queue.count()), 1)
+
+
+class TestDelayQueueSync(TestDelayQueue):
+
+    is_sync = True
@@ -1552,6 +1552,104 @@ class TestMessageStore(TestMessageStoreBase):
 
         self.assertEqual(outbound_stats_2, {"total": 2, "unique_addresses": 2})
 
+    @inlineCallbacks
+    def create_bucketed_inbound_messages(self, batch_id):
+        """
+        Create inbound messages every 20 minutes from 10:00 to 13:40, with
+        the from_addr cycling through four addresses.
+        """
+        start = datetime(2015, 4, 1, 10, 0)
+        for i in range(12):
+            msg = self.msg_helper.make_inbound(
+                "foo", from_addr=u'0000%s' % (i % 4,),
+                timestamp=start + timedelta(minutes=20 * i))
+            yield self.store.add_inbound_message(msg, batch_id=batch_id)
+
+    @inlineCallbacks
+    def test_batch_inbound_stats_uses_stats_buckets(self):
+        """
+        batch_inbound_stats combines the cached stats buckets with index
+        queries for the partial buckets at either end of the range.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        yield self.create_bucketed_inbound_messages(batch_id)
+
+        queried_ranges = []
+        scan_batch_stats = self.store._scan_batch_stats
+
+        def record_scan(model_proxy, batch_id, max_results, start, end):
+            queried_ranges.append((start, end))
+            return scan_batch_stats(
+                model_proxy, batch_id, max_results, start, end)
+        self.patch(self.store, '_scan_batch_stats', record_scan)
+
+        self.assertEqual(
+            (yield self.store.batch_inbound_stats(batch_id)),
+            {"total": 12, "unique_addresses": 4})
+        self.assertEqual(queried_ranges, [])
+
+        # 10:20 to 12:59 covers the 11:00 and 12:00 buckets and two messages
+        # before them.
+        self.assertEqual(
+            (yield self.store.batch_inbound_stats(
+                batch_id, start="2015-04-01 10:20:00.000000",
+                end="2015-04-01 12:59:59.999999")),
+            {"total": 8, "unique_addresses": 4})
+        self.assertEqual(queried_ranges, [
+            ("2015-04-01 10:20:00.000000", "2015-04-01 10:59:59.999999")])
+
+    @inlineCallbacks
+    def test_batch_inbound_stats_within_one_bucket(self):
+        """
+        batch_inbound_stats uses an index query if the range doesn't cover
+        any whole stats buckets.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        yield self.create_bucketed_inbound_messages(batch_id)
+        self.assertEqual(
+            (yield self.store.batch_inbound_stats(
+                batch_id, start="2015-04-01 11:10:00.000000",
+                end="2015-04-01 11:50:00.000000")),
+            {"total": 2, "unique_addresses": 2})
+
+    @inlineCallbacks
+    def test_batch_inbound_stats_without_stats_buckets(self):
+        """
+        batch_inbound_stats falls back to index queries for batches that
+        don't have stats buckets.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        yield self.create_bucketed_inbound_messages(batch_id)
+        yield self.store.cache.clear_batch(batch_id)
+        self.assertEqual(
+            (yield self.store.batch_inbound_stats(
+                batch_id, start="2015-04-01 10:20:00.000000",
+                end="2015-04-01 12:59:59.999999")),
+            {"total": 8, "unique_addresses": 4})
+
+    @inlineCallbacks
+    def test_batch_outbound_stats_uses_stats_buckets(self):
+        """
+        batch_outbound_stats combines the cached stats buckets with index
+        queries for the partial buckets at either end of the range.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        start = datetime(2015, 4, 1, 10, 0)
+        for i in range(12):
+            msg = self.msg_helper.make_outbound(
+                "foo", to_addr=u'0000%s' % (i % 4,),
+                timestamp=start + timedelta(minutes=20 * i))
+            yield self.store.add_outbound_message(msg, batch_id=batch_id)
+
+        self.assertEqual(
+            (yield self.store.batch_outbound_stats(batch_id)),
+            {"total": 12, "unique_addresses": 4})
+        self.assertEqual(
+            (yield self.store.batch_outbound_stats(
+                batch_id, start="2015-04-01 11:00:00.000000",
+                end="2015-04-01 12:30:00.000000")),
+            {"total": 5, "unique_addresses": 4})
+
 
 class TestMessageStoreCache(TestMessageStoreBase):
 
@@ -1670,6 +1768,14 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status['ack'], 10)
         self.assertEqual(batch_status['sent'], 10)
 
+        self.assertTrue((yield cache.uses_stats_buckets(batch_id)))
+        self.assertEqual(
+            (yield cache.get_inbound_stats(batch_id)),
+            {"total": 6, "unique_addresses": 3})
+        self.assertEqual(
+            (yield cache.get_outbound_stats(batch_id)),
+            {"total": 10, "unique_addresses": 2})
+
     @inlineCallbacks
     def test_reconcile_cache_with_old_and_new_messages(self):
         """
@@ -260,3 +260,32 @@ class TestMessageStoreAPI(VumiTestCase):
         self.assertResultCount(response, 0)
         self.assertEqual(json.loads(response.delivered_body), [])
         self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_paged_inbound_match_resource(self):
+        self.patch(self.match_resource, 'RESULT_PAGE_SIZE', 5)
+        messages = yield self.create_inbound(self.batch_id, 22,
+                                                'hello world {0}')
+        token = yield self.do_query('inbound', self.batch_id, '.*',
+                                                wait=True)
+        response = yield self.do_get(
+            'batch/%s/inbound/match/?token=%s&start=1&stop=-1' % (
+                self.batch_id, token))
+        self.assertResultCount(response, 22)
+        self.assertJSONResultEqual(response.delivered_body, messages[1:])
+        self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_paged_keys_outbound_match_resource(self):
+        self.patch(self.match_resource, 'RESULT_PAGE_SIZE', 5)
+        messages = yield self.create_outbound(self.batch_id, 22,
+                                                'hello world {0}')
+        token = yield self.do_query('outbound', self.batch_id, '.*',
+                                                wait=True)
+        response = yield self.do_get(
+            'batch/%s/outbound/match/?token=%s&keys=1&stop=14' % (
+                self.batch_id, token))
+        self.assertResultCount(response, 22)
+        self.assertEqual(json.loads(response.delivered_body),
+            [msg['message_id'] for msg in messages[:15]])
+        self.assertEqual(response.code, 200)
@@ -373,6 +373,223 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
             (yield self.cache.count_query_results(self.batch_id, token)),
             10)
 
+    @inlineCallbacks
+    def test_store_query_results_chunked(self):
+        self.cache.QUERY_RESULTS_CHUNK_SIZE = 3
+        now = datetime.now()
+        message_ids = []
+        for i in range(10):
+            msg_in = self.msg_helper.make_inbound('hello-%s' % (i,))
+            msg_in['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+            message_ids.append(msg_in['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'inbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        # Keys that aren't in the cache are left out.
+        yield self.cache.store_query_results(
+            self.batch_id, token, message_ids + ['unknown'], 'inbound', 120)
+        self.assertFalse(
+            (yield self.cache.is_query_in_progress(self.batch_id, token)))
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token)),
+            list(reversed(message_ids)))
+        result_key = self.cache.search_result_key(self.batch_id, token)
+        ttl = yield self.redis.ttl(result_key)
+        self.assertTrue(0 < ttl <= 120)
+
+    @inlineCallbacks
+    def test_get_query_results_page(self):
+        now = datetime.now()
+        message_ids = []
+        for i in range(10):
+            msg_in = self.msg_helper.make_inbound('hello-%s' % (i,))
+            msg_in['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+            message_ids.append(msg_in['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'inbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        yield self.cache.store_query_results(
+            self.batch_id, token, message_ids, 'inbound', 120)
+
+        page = yield self.cache.get_query_results_page(
+            self.batch_id, token, 4, asc=True)
+        self.assertEqual(list(page), message_ids[0:4])
+        self.assertTrue(page.has_next_page())
+        page = yield page.next_page()
+        self.assertEqual(list(page), message_ids[4:8])
+        self.assertTrue(page.has_next_page())
+        page = yield page.next_page()
+        self.assertEqual(list(page), message_ids[8:10])
+        self.assertFalse(page.has_next_page())
+
+        page = yield self.cache.get_query_results_page(
+            self.batch_id, token, 4, start=1, stop=5)
+        self.assertEqual(list(page), list(reversed(message_ids))[1:5])
+        self.assertTrue(page.has_next_page())
+        page = yield page.next_page()
+        self.assertEqual(list(page), list(reversed(message_ids))[5:6])
+        self.assertFalse(page.has_next_page())
+        next_page = yield page.next_page()
+        self.assertEqual(next_page, None)
+
+        page = yield self.cache.get_query_results_page(
+            self.batch_id, token, 4, stop=-2, asc=True)
+        self.assertEqual(list(page), message_ids[0:4])
+        page = yield page.next_page()
+        self.assertEqual(list(page), message_ids[4:8])
+        page = yield page.next_page()
+        self.assertEqual(list(page), message_ids[8:9])
+        self.assertFalse(page.has_next_page())
+
+        page = yield self.cache.get_query_results_page(
+            self.batch_id, token, 4, start=-3, asc=True)
+        self.assertEqual(list(page), message_ids[7:10])
+        self.assertFalse(page.has_next_page())
+
+        page = yield self.cache.get_query_results_page(
+            self.batch_id, token, 4, start=5, stop=-6)
+        self.assertEqual(list(page), [])
+        self.assertFalse(page.has_next_page())
+
+    def test_get_stats_bucket(self):
+        self.assertEqual(self.cache.STATS_BUCKET_SIZE, 3600)
+        bucket = self.cache.get_stats_bucket(datetime(2015, 4, 1, 12, 0))
+        self.assertEqual(bucket, 1427889600)
+        self.assertEqual(
+            self.cache.get_stats_bucket("2015-04-01 12:59:59.999999"), bucket)
+        self.assertEqual(
+            self.cache.get_stats_bucket("2015-04-01 13:00:00"), bucket + 3600)
+
+    def test_split_stats_range_unbounded(self):
+        self.assertEqual(self.cache.split_stats_range(), (None, None, []))
+
+    def test_split_stats_range_on_bucket_boundaries(self):
+        bucket = self.cache.get_stats_bucket("2015-04-01 12:00:00")
+        self.assertEqual(
+            self.cache.split_stats_range(
+                "2015-04-01 12:00:00.000000", "2015-04-01 13:59:59.999999"),
+            (bucket, bucket + 3600, []))
+        self.assertEqual(
+            self.cache.split_stats_range(start="2015-04-01 12:00:00.000000"),
+            (bucket, None, []))
+        self.assertEqual(
+            self.cache.split_stats_range(end="2015-04-01 13:59:59.999999"),
+            (None, bucket + 3600, []))
+
+    def test_split_stats_range_with_edges(self):
+        bucket = self.cache.get_stats_bucket("2015-04-01 12:00:00")
+        self.assertEqual(
+            self.cache.split_stats_range(
+                "2015-04-01 11:30:00.000000", "2015-04-01 14:15:00.000000"),
+            (bucket, bucket + 3600, [
+                ("2015-04-01 11:30:00.000000", "2015-04-01 11:59:59.999999"),
+                ("2015-04-01 14:00:00.000000", "2015-04-01 14:15:00.000000"),
+            ]))
+
+    def test_split_stats_range_no_whole_buckets(self):
+        self.assertEqual(
+            self.cache.split_stats_range(
+                "2015-04-01 11:30:00.000000", "2015-04-01 12:59:59.999998"),
+            None)
+        self.assertEqual(
+            self.cache.split_stats_range(
+                "2015-04-01 12:10:00.000000", "2015-04-01 12:20:00.000000"),
+            None)
+
+    @inlineCallbacks
+    def test_uses_stats_buckets(self):
+        self.assertTrue((yield self.cache.uses_stats_buckets(self.batch_id)))
+        self.assertFalse(
+            (yield self.cache.uses_stats_buckets('unstarted-batch')))
+
+    @inlineCallbacks
+    def test_add_inbound_message_stats(self):
+        now = datetime(2015, 4, 1, 12, 0, 5)
+        # Six messages in the 12:00 bucket and four in the 11:00 bucket.
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message, now=now)
+        bucket = self.cache.get_stats_bucket(now)
+        self.assertEqual(
+            (yield self.cache.get_inbound_stats(self.batch_id)),
+            {"total": 10, "unique_addresses": 10})
+        self.assertEqual(
+            (yield self.cache.get_inbound_stats(
+                self.batch_id, bucket, bucket)),
+            {"total": 6, "unique_addresses": 6})
+        self.assertEqual(
+            (yield self.cache.get_inbound_stats(
+                self.batch_id, last_bucket=bucket - 3600)),
+            {"total": 4, "unique_addresses": 4})
+        self.assertEqual(
+            (yield self.cache.get_inbound_stats(
+                self.batch_id, first_bucket=bucket + 3600)),
+            {"total": 0, "unique_addresses": 0})
+        self.assertEqual(
+            (yield self.cache.get_outbound_stats(self.batch_id)),
+            {"total": 0, "unique_addresses": 0})
+
+    @inlineCallbacks
+    def test_add_outbound_message_stats(self):
+        now = datetime(2015, 4, 1, 12, 0, 5)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_outbound_message, now=now)
+        bucket = self.cache.get_stats_bucket(now)
+        self.assertEqual(
+            (yield self.cache.get_outbound_stats(self.batch_id)),
+            {"total": 10, "unique_addresses": 10})
+        self.assertEqual(
+            (yield self.cache.get_outbound_stats(
+                self.batch_id, bucket, bucket)),
+            {"total": 6, "unique_addresses": 6})
+        self.assertEqual(
+            (yield self.cache.get_inbound_stats(self.batch_id)),
+            {"total": 0, "unique_addresses": 0})
+
+    @inlineCallbacks
+    def test_add_message_stats_idempotence(self):
+        for i in range(5):
+            msg = self.msg_helper.make_inbound("inbound")
+            msg['message_id'] = 'the-same-thing'
+            yield self.cache.add_inbound_message(self.batch_id, msg)
+        self.assertEqual(
+            (yield self.cache.get_inbound_stats(self.batch_id)),
+            {"total": 1, "unique_addresses": 1})
+
+    @inlineCallbacks
+    def test_get_stats_with_addresses(self):
+        now = datetime(2015, 4, 1, 12, 0, 5)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message, now=now, count=3)
+        stats = yield self.cache.get_inbound_stats(
+            self.batch_id, addresses=set([u'from-1', u'from-99']))
+        self.assertEqual(stats, {"total": 3, "unique_addresses": 4})
+        # The temporary HyperLogLog used for the merge is cleaned up.
+        self.assertEqual(
+            (yield self.redis.keys(
+                self.cache.key(self.cache.inbound_stats_key(self.batch_id),
+                               'tmp', '*'))),
+            [])
+
+    @inlineCallbacks
+    def test_clear_batch_stats(self):
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_outbound_message)
+        yield self.cache.clear_batch(self.batch_id)
+        self.assertFalse((yield self.cache.uses_stats_buckets(self.batch_id)))
+        self.assertEqual(
+            (yield self.cache.get_inbound_stats(self.batch_id)),
+            {"total": 0, "unique_addresses": 0})
+        self.assertEqual(
+            (yield self.cache.get_outbound_stats(self.batch_id)),
+            {"total": 0, "unique_addresses": 0})
+        for stats_key in [self.cache.inbound_stats_key(self.batch_id),
+                          self.cache.outbound_stats_key(self.batch_id)]:
+            self.assertEqual((yield self.redis.keys(stats_key + '*')), [])
+
 
 class TestMessageStoreCacheWithCounters(MessageStoreCacheTestCase):
 
@@ -2,12 +2,15 @@
 
 import json
 from datetime import datetime
+from gzip import GzipFile
+from StringIO import StringIO
 from urllib import urlencode
 
 from twisted.internet import reactor
 from twisted.internet.defer import (
     inlineCallbacks, Deferred, succeed, gatherResults)
 from twisted.web.server import Site
+from twisted.web.test.requesthelper import DummyRequest
 
 from vumi.components.message_formatters import JsonFormatter
 
@@ -27,7 +30,7 @@ class TestMessageStoreResource(VumiTestCase):
         self.msg_helper = self.add_helper(MessageHelper())
 
     @inlineCallbacks
-    def start_server(self):
+    def start_server(self, gzip=False):
         try:
             from vumi.components.message_store_resource import (
                 MessageStoreResourceWorker)
@@ -37,6 +40,7 @@ class TestMessageStoreResource(VumiTestCase):
         config = self.persistence_helper.mk_config({
             'twisted_endpoint': 'tcp:0',
             'web_path': '/resource_path/',
+            'gzip': gzip,
         })
 
         worker = yield self.worker_helper.get_worker(
@@ -275,8 +279,41 @@ class TestMessageStoreResource(VumiTestCase):
         # Wait for all the in-progress loads to finish.
         fetched_msg_ids = yield gatherResults(res.fetch.values())
 
+        # Fetches that were in flight when the connection was lost are
+        # finished, but the last message is never fetched.
         sorted_message_ids = sorted(msg['message_id'] for msg in msgs)
-        self.assertEqual(set(fetched_msg_ids), set(sorted_message_ids[:4]))
+        self.assertTrue(
+            set(sorted_message_ids[:4]).issubset(fetched_msg_ids))
+        self.assertFalse(sorted_message_ids[-1] in res.fetch)
+
+    @inlineCallbacks
+    def test_get_inbound_gzip(self):
+        yield self.start_server(gzip=True)
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_inbound(batch_id, 'føø')
+        msg2 = yield self.make_inbound(batch_id, 'føø')
+        url = '%s/%s/%s/%s' % (
+            self.url, 'resource_path', batch_id, 'inbound.json')
+        resp = yield http_request_full(
+            method='GET', url=url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Encoding'), ['gzip'])
+        body = GzipFile(fileobj=StringIO(resp.delivered_body)).read()
+        messages = map(json.loads, filter(None, body.split('\n')))
+        self.assertEqual(
+            set([msg['message_id'] for msg in messages]),
+            set([msg1['message_id'], msg2['message_id']]))
+
+    @inlineCallbacks
+    def test_get_inbound_gzip_not_accepted(self):
+        yield self.start_server(gzip=True)
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg = yield self.make_inbound(batch_id, 'føø')
+        resp = yield self.make_request('GET', batch_id, 'inbound.json')
+        self.assertEqual(resp.headers.getRawHeaders('Content-Encoding'), None)
+        [message] = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(message['message_id'], msg['message_id'])
 
     @inlineCallbacks
     def test_get_inbound_for_time_range(self):
@@ -497,3 +534,216 @@ class TestMessageStoreResource(VumiTestCase):
         self.assertEqual(
             set([ev['event_id'] for ev in events]),
             set([ack2['event_id'], ack3['event_id']]))
+
+
+class FakeKeysPage(object):
+    def __init__(self, pages):
+        self._keys, self._pages = pages[0], pages[1:]
+        self.next_page_d = None
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def has_next_page(self):
+        return bool(self._pages)
+
+    def next_page(self):
+        self.next_page_d = Deferred()
+        return self.next_page_d
+
+
+class FakeStoreResource(object):
+    message_store = None
+
+    def __init__(self):
+        self.fetches = {}
+        self.written = []
+
+    def get_message(self, message_store, key):
+        self.fetches[key] = Deferred()
+        return self.fetches[key]
+
+    def write_message(self, message, request):
+        self.written.append(message)
+
+
+class AbortableTransport(object):
+    aborted = False
+
+    def abortConnection(self):
+        self.aborted = True
+
+
+class ProducerRequest(DummyRequest):
+    """
+    A DummyRequest that doesn't drive its producer.
+    """
+
+    def __init__(self, *args, **kw):
+        DummyRequest.__init__(self, *args, **kw)
+        self.transport = AbortableTransport()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = (producer, streaming)
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class TestMessageExporter(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.components.message_store_resource import (
+                MessageExporter)
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.resource = FakeStoreResource()
+        self.request = ProducerRequest([''])
+        self.MessageExporter = MessageExporter
+
+    def start_exporter(self, keys_page, concurrency):
+        exporter = self.MessageExporter(
+            self.resource, self.request, concurrency)
+        return exporter, exporter.start(keys_page)
+
+    def assert_fetching(self, keys):
+        self.assertEqual(sorted(self.resource.fetches.keys()), sorted(keys))
+
+    def finish_fetch(self, key):
+        self.resource.fetches[key].callback('msg-%s' % (key,))
+
+    def test_registers_push_producer(self):
+        exporter, _ = self.start_exporter(FakeKeysPage([['a']]), 1)
+        self.assertEqual(self.request.producer, (exporter, True))
+
+    def test_sliding_window(self):
+        exporter, done = self.start_exporter(
+            FakeKeysPage([['a', 'b', 'c', 'd']]), 2)
+        self.assert_fetching(['a', 'b'])
+        # A slow fetch doesn't stop others from starting.
+        self.finish_fetch('b')
+        self.assert_fetching(['a', 'b', 'c'])
+        self.finish_fetch('c')
+        self.assert_fetching(['a', 'b', 'c', 'd'])
+        self.assertEqual(exporter.in_flight, 2)
+        self.finish_fetch('d')
+        self.assertFalse(done.called)
+        self.finish_fetch('a')
+        self.assertEqual(
+            self.resource.written, ['msg-b', 'msg-c', 'msg-d', 'msg-a'])
+        self.assertTrue(done.called)
+        self.assertEqual(self.request.finished, 1)
+        self.assertEqual(self.request.producer, None)
+
+    def test_next_page(self):
+        page = FakeKeysPage([['a'], ['b', 'c']])
+        exporter, done = self.start_exporter(page, 2)
+        self.assert_fetching(['a'])
+        self.finish_fetch('a')
+        self.assertFalse(done.called)
+        page.next_page_d.callback(FakeKeysPage([['b', 'c']]))
+        self.assert_fetching(['a', 'b', 'c'])
+        self.finish_fetch('b')
+        self.finish_fetch('c')
+        self.assertTrue(done.called)
+        self.assertEqual(self.request.finished, 1)
+
+    def test_next_page_waits_for_window(self):
+        page = FakeKeysPage([['a', 'b', 'c'], ['d']])
+        exporter, done = self.start_exporter(page, 1)
+        self.assert_fetching(['a'])
+        self.finish_fetch('a')
+        # We still have as many keys waiting as we can fetch at once.
+        self.assertEqual(page.next_page_d, None)
+        self.finish_fetch('b')
+        self.assertNotEqual(page.next_page_d, None)
+        page.next_page_d.callback(FakeKeysPage([['d']]))
+        self.finish_fetch('c')
+        self.finish_fetch('d')
+        self.assertTrue(done.called)
+        self.assertEqual(
+            self.resource.written, ['msg-a', 'msg-b', 'msg-c', 'msg-d'])
+
+    def test_next_page_not_fetched_while_paused(self):
+        page = FakeKeysPage([['a'], ['b']])
+        exporter, done = self.start_exporter(page, 1)
+        next_page = FakeKeysPage([['b'], ['c']])
+        page.next_page_d.callback(next_page)
+        exporter.pauseProducing()
+        self.finish_fetch('a')
+        self.assertEqual(next_page.next_page_d, None)
+        exporter.resumeProducing()
+        self.assert_fetching(['a', 'b'])
+        self.assertNotEqual(next_page.next_page_d, None)
+
+    def test_next_page_error(self):
+        page = FakeKeysPage([['a'], ['b']])
+        exporter, done = self.start_exporter(page, 2)
+        page.next_page_d.errback(ValueError("bad"))
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertFalse(done.called)
+        self.finish_fetch('a')
+        self.assertTrue(done.called)
+        self.assertEqual(self.resource.written, [])
+        self.assertTrue(self.request.transport.aborted)
+        self.assertEqual(self.request.finished, 0)
+        self.assertEqual(self.request.producer, None)
+
+    def test_pause_and_resume(self):
+        exporter, done = self.start_exporter(
+            FakeKeysPage([['a', 'b', 'c']]), 2)
+        exporter.pauseProducing()
+        self.finish_fetch('a')
+        self.finish_fetch('b')
+        # In-flight fetches are written, but no new ones are started.
+        self.assertEqual(self.resource.written, ['msg-a', 'msg-b'])
+        self.assert_fetching(['a', 'b'])
+        exporter.resumeProducing()
+        self.assert_fetching(['a', 'b', 'c'])
+        self.finish_fetch('c')
+        self.assertTrue(done.called)
+
+    def test_stop_producing(self):
+        exporter, done = self.start_exporter(
+            FakeKeysPage([['a', 'b', 'c']]), 2)
+        exporter.stopProducing()
+        self.assertFalse(done.called)
+        self.finish_fetch('a')
+        self.finish_fetch('b')
+        self.assert_fetching(['a', 'b'])
+        self.assertEqual(self.resource.written, [])
+        self.assertTrue(done.called)
+        self.assertEqual(self.request.finished, 0)
+
+    def test_fetch_error(self):
+        exporter, done = self.start_exporter(FakeKeysPage([['a', 'b']]), 2)
+        self.resource.fetches['a'].errback(ValueError("bad"))
+        self.finish_fetch('b')
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(self.resource.written, ['msg-b'])
+        self.assertTrue(done.called)
+        self.assertEqual(self.request.finished, 1)
+
+
+class TestBatchResource(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.components.message_store_resource import (
+                BatchResource)
+        except ImportError, e:
+            import_skip(e, 'riak')
+        self.BatchResource = BatchResource
+
+    def test_get_child(self):
+        from vumi.components.message_store_resource import InboundResource
+        resource = self.BatchResource(None, 'batch').getChild(
+            'inbound.json', None)
+        self.assertTrue(isinstance(resource, InboundResource))
+
+    def test_get_child_gzip(self):
+        from twisted.web.resource import EncodingResourceWrapper
+        resource = self.BatchResource(None, 'batch', gzip=True).getChild(
+            'inbound.json', None)
+        self.assertTrue(isinstance(resource, EncodingResourceWrapper))
@@ -70,3 +70,121 @@ class TestSessionManager(VumiTestCase):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_save_empty_session(self):
+        yield self.sm.create_session("u1")
+        self.assertEqual((yield self.sm.save_session("u1", {})), {})
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session.keys(), ['created_at'])
+
+    @inlineCallbacks
+    def test_scan_active_sessions(self):
+        for i in range(5):
+            yield self.sm.create_session("u%s" % (i,))
+        user_ids = []
+        cursor = None
+        pages = 0
+        while True:
+            cursor, page = yield self.sm.scan_active_sessions(cursor, count=2)
+            pages += 1
+            for user_id, session in page:
+                self.assertEqual(session.keys(), ['created_at'])
+                user_ids.append(user_id)
+            if cursor is None:
+                break
+        self.assertTrue(pages > 1)
+        self.assertEqual(sorted(user_ids), ["u0", "u1", "u2", "u3", "u4"])
+
+    @inlineCallbacks
+    def test_scan_active_sessions_ignores_other_keys(self):
+        yield self.manager.set("other", "foo")
+        yield self.sm.create_session("u1", foo="bar")
+        cursor, page = yield self.sm.scan_active_sessions()
+        self.assertEqual(cursor, None)
+        self.assertEqual([user_id for user_id, _ in page], ["u1"])
+
+    @inlineCallbacks
+    def test_from_redis_config(self):
+        sm = yield SessionManager.from_redis_config(
+            {'FAKE_REDIS': 'yes'}, key_prefix='sessions',
+            max_session_length=60, cache_size=5, cache_ttl=10)
+        self.add_cleanup(sm.stop)
+        self.assertEqual(sm.max_session_length, 60)
+        self.assertEqual(sm.cache.ttl, 10)
+        yield sm.create_session("u1")
+        self.assertTrue("u1" in sm.cache)
+
+    @inlineCallbacks
+    def test_create_session_sets_expiry(self):
+        self.sm.max_session_length = 60.0
+        yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertTrue(0 < ttl <= 60)
+
+
+class TestSessionManagerCache(VumiTestCase):
+
+    is_sync = False
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(is_sync=self.is_sync))
+        self.manager = yield self.persistence_helper.get_redis_manager()
+        yield self.manager._purge_all()  # Just in case
+        self.sm = SessionManager(self.manager, cache_size=2)
+        self.add_cleanup(self.sm.stop)
+
+    @inlineCallbacks
+    def test_load_session_cached(self):
+        session = yield self.sm.create_session("u1", foo="bar")
+        yield self.manager.hset("session:u1", "foo", "baz")
+        self.assertEqual((yield self.sm.load_session("u1")), session)
+
+    @inlineCallbacks
+    def test_load_session_returns_copy(self):
+        yield self.sm.create_session("u1", foo="bar")
+        session = yield self.sm.load_session("u1")
+        session["foo"] = "baz"
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session["foo"], "bar")
+
+    @inlineCallbacks
+    def test_load_session_populates_cache(self):
+        yield self.manager.hmset("session:u1", {"foo": "bar"})
+        self.assertEqual((yield self.sm.load_session("u1")), {"foo": "bar"})
+        self.assertTrue("u1" in self.sm.cache)
+
+    @inlineCallbacks
+    def test_load_missing_session_not_cached(self):
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+        self.assertFalse("u1" in self.sm.cache)
+
+    @inlineCallbacks
+    def test_save_session_invalidates_cache(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.save_session("u1", {"foo": "baz"})
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session["foo"], "baz")
+
+    @inlineCallbacks
+    def test_clear_session_invalidates_cache(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_cache_evicts_least_recently_used(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.create_session("u2")
+        yield self.sm.load_session("u1")
+        yield self.sm.create_session("u3")
+        self.assertTrue("u1" in self.sm.cache)
+        self.assertFalse("u2" in self.sm.cache)
+        self.assertTrue("u3" in self.sm.cache)
+
+
+class TestSessionManagerCacheSync(TestSessionManagerCache):
+
+    is_sync = True
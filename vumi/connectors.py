@@ -2,6 +2,7 @@ from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
 
 from vumi import log
 from vumi.middleware import MiddlewareStack
+from vumi.blinkenlights.heartbeat.telemetry import HandlerStats
 from vumi.message import (
     TransportMessage, TransportEvent, TransportUserMessage, TransportStatus)
 
@@ -18,7 +19,7 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, max_unconfirmed=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -26,8 +27,10 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._max_unconfirmed = max_unconfirmed
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
+        self.stats = HandlerStats()
 
     def _rkey(self, mtype):
         return '%s.%s' % (self.name, mtype)
@@ -56,7 +59,8 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher = yield self.worker.publish_to(
+            self._rkey(mtype), max_unconfirmed=self._max_unconfirmed)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
@@ -87,9 +91,15 @@ class BaseConnector(object):
         handler = self._endpoint_handlers[mtype].get(endpoint_name)
         if handler is None:
             handler = self._default_handlers.get(mtype)
+        start_time = self.stats.message_started()
         d = self._middlewares.apply_consume(mtype, msg, self.name)
         d.addCallback(handler)
-        return d.addErrback(self._ignore_message, msg)
+        d.addErrback(self._ignore_message, msg)
+        return d.addBoth(self._message_finished, start_time)
+
+    def _message_finished(self, result, start_time):
+        self.stats.message_finished(start_time)
+        return result
 
     def _publish_message(self, mtype, msg, endpoint_name):
         if endpoint_name is not None:
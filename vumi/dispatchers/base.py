@@ -10,7 +10,7 @@ from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 from vumi.service import Worker
 from vumi.errors import ConfigError, DispatcherError
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.utils import load_class_by_string, get_first_word
+from vumi.utils import load_class_by_string, get_first_word, PrefixTrie
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
 from vumi.components.session import SessionManager
@@ -473,6 +473,7 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
+    ANY_TO_ADDR = object()
 
     def setup_routing(self):
         self.r_config = self.config.get('redis_manager', {})
@@ -490,6 +491,7 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         for transport_name, keyword in keyword_mappings.items():
             self.rules.append({'app': transport_name,
                                'keyword': keyword.lower()})
+        self.compile_rules()
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
@@ -505,6 +507,21 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.session_manager = SessionManager(
             self.redis, self.expire_routing_timeout)
 
+    def compile_rules(self):
+        """Build an index of the routing rules so that finding the rules
+        matching a message doesn't require checking every rule.
+
+        The index maps each keyword to a dict mapping `to_addr` values (or
+        ``ANY_TO_ADDR`` for rules without one) to a trie of `prefix` values.
+        """
+        self._rule_index = {}
+        for i, rule in enumerate(self.rules):
+            to_addrs = self._rule_index.setdefault(rule['keyword'], {})
+            to_addr = rule.get('to_addr', self.ANY_TO_ADDR)
+            if to_addr not in to_addrs:
+                to_addrs[to_addr] = PrefixTrie()
+            to_addrs[to_addr].add(rule.get('prefix', ''), (i, rule))
+
     def get_message_key(self, message):
         return 'message:%s' % (message,)
 
@@ -524,15 +541,36 @@ class ContentKeywordRouter(SimpleDispatchRouter):
                     (not 'prefix' in rule) or
                     (msg['from_addr'].startswith(rule['prefix']))])
 
+    def get_matching_rules(self, keyword, msg):
+        """Return the rules matching a message, in the order they were
+        configured.
+        """
+        matcher = type(self).is_msg_matching_routing_rules.__func__
+        if matcher is not (
+                ContentKeywordRouter.is_msg_matching_routing_rules.__func__):
+            # A subclass has custom matching logic, so the index can't be
+            # used.
+            return [rule for rule in self.rules
+                    if self.is_msg_matching_routing_rules(keyword, msg, rule)]
+        to_addrs = self._rule_index.get(keyword)
+        if not to_addrs:
+            return []
+        from_addr = msg['from_addr'] or ''
+        matches = []
+        for to_addr in (self.ANY_TO_ADDR, msg['to_addr']):
+            trie = to_addrs.get(to_addr)
+            if trie is not None:
+                matches.extend(trie.matches(from_addr))
+        return [rule for _, rule in sorted(matches)]
+
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
         matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
+        for rule in self.get_matching_rules(keyword, msg):
+            matched = True
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(rule['app'], msg.copy())
         if not matched:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
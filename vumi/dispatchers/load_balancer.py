@@ -1,20 +1,136 @@
 # -*- test-case-name: vumi.dispatchers.tests.test_load_balancer -*-
 
-"""Router for round-robin load balancing between two transports."""
+"""Router for load balancing between two or more transports."""
 
 import itertools
+from collections import OrderedDict
+
+from twisted.internet import reactor
 
 from vumi import log
 from vumi.errors import ConfigError
 from vumi.dispatchers.base import BaseDispatchRouter
 
 
+class TransportStats(object):
+    """Outstanding messages, ack latency and error rate for a transport.
+
+    Latency and error rate are exponentially weighted moving averages over
+    the acks and nacks received for the transport. A message that times out
+    counts as an error with the outstanding timeout as its latency.
+    """
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.outstanding = 0
+        self.latency = None
+        self.reset_errors()
+        self.ejected_until = None
+
+    def reset_errors(self):
+        self.events = 0
+        self.error_rate = 0.0
+
+    def record_event(self, latency, error):
+        self.events += 1
+        self.error_rate += self.weight * (float(error) - self.error_rate)
+        if latency is None:
+            return
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.weight * (latency - self.latency)
+
+
+class RoundRobinStrategy(object):
+    """Choose each transport in turn."""
+
+    def __init__(self, router):
+        self.router = router
+        self.transport_name_cycle = itertools.cycle(
+            router.dispatcher.transport_names)
+
+    def choose(self, transport_names):
+        while True:
+            transport_name = self.transport_name_cycle.next()
+            if transport_name in transport_names:
+                return transport_name
+
+
+class WeightedRoundRobinStrategy(object):
+    """Choose transports in proportion to their configured weights.
+
+    Uses smooth weighted round-robin, so a transport with a large weight
+    doesn't get all of its share in one burst.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        weights = router.config.get('weights', {})
+        self.weights = dict(
+            (name, weights.get(name, 1))
+            for name in router.dispatcher.transport_names)
+        self.current = dict((name, 0) for name in self.weights)
+
+    def choose(self, transport_names):
+        total = 0
+        for name in transport_names:
+            self.current[name] += self.weights[name]
+            total += self.weights[name]
+        chosen = max(transport_names, key=lambda name: self.current[name])
+        self.current[chosen] -= total
+        return chosen
+
+
+class LeastOutstandingStrategy(RoundRobinStrategy):
+    """Choose the transport with the fewest messages waiting for an ack.
+
+    Ties are broken by round-robin.
+    """
+
+    def choose(self, transport_names):
+        stats = self.router.transport_stats
+        fewest = min(stats[name].outstanding for name in transport_names)
+        return super(LeastOutstandingStrategy, self).choose(
+            [name for name in transport_names
+             if stats[name].outstanding == fewest])
+
+
+class LatencyStrategy(RoundRobinStrategy):
+    """Choose the transport with the lowest expected wait for an ack.
+
+    The expected wait is the transport's average ack latency multiplied by
+    one more than the number of messages it has waiting for an ack.
+    Transports that haven't acked anything yet are tried first, but only with
+    one message at a time until we know their latency.
+    """
+
+    def expected_wait(self, stats):
+        if stats.latency is None:
+            if stats.outstanding:
+                return float('inf')
+            return -1
+        return stats.latency * (stats.outstanding + 1)
+
+    def choose(self, transport_names):
+        stats = self.router.transport_stats
+        waits = dict(
+            (name, self.expected_wait(stats[name]))
+            for name in transport_names)
+        lowest = min(waits.values())
+        return super(LatencyStrategy, self).choose(
+            [name for name in transport_names if waits[name] == lowest])
+
+
 class LoadBalancingRouter(BaseDispatchRouter):
-    """Router that does round-robin dispatching to transports.
+    """Router that balances outbound messages between transports.
 
     Supports only one exposed name and requires at least one transport
     name.
 
+    Acks and nacks for outbound messages are used to keep track of each
+    transport's outstanding messages, ack latency and error rate.
+
     Configuration options:
 
     :param bool reply_affinity:
@@ -24,8 +140,41 @@ class LoadBalancingRouter(BaseDispatchRouter):
     :param bool rewrite_transport_name:
         If set to true, rewrites message `transport_names` in both
         directions. Default: true.
+    :param str strategy:
+        How to choose a transport for outbound messages that aren't
+        replies with reply affinity. One of ``round_robin``,
+        ``weighted_round_robin``, ``least_outstanding`` (fewest messages
+        waiting for an ack) or ``latency`` (lowest expected wait for an
+        ack). Default: ``round_robin``.
+    :param dict weights:
+        Mapping from transport name to integer weight for the
+        ``weighted_round_robin`` strategy. Transports not listed have a
+        weight of 1.
+    :param float stats_weight:
+        Weight given to each new ack or nack in the moving averages of
+        latency and error rate. Default: 0.2.
+    :param float error_threshold:
+        If a transport's error rate reaches this, it is sent no new
+        messages for ``ejection_time`` seconds. If all transports are
+        ejected, they are all used. Default: no ejection.
+    :param int ejection_min_events:
+        Minimum number of acks and nacks needed before a transport may be
+        ejected. Default: 10.
+    :param float ejection_time:
+        Seconds a transport is ejected for. Default: 60.
+    :param float outstanding_timeout:
+        Seconds after which a message with no ack or nack is counted as an
+        error (with this as its latency) and no longer outstanding.
+        Default: 300.
     """
 
+    STRATEGIES = {
+        'round_robin': RoundRobinStrategy,
+        'weighted_round_robin': WeightedRoundRobinStrategy,
+        'least_outstanding': LeastOutstandingStrategy,
+        'latency': LatencyStrategy,
+    }
+
     def setup_routing(self):
         self.reply_affinity = self.config.get('reply_affinity', True)
         self.rewrite_transport_names = self.config.get(
@@ -37,10 +186,97 @@ class LoadBalancingRouter(BaseDispatchRouter):
         if not self.dispatcher.transport_names:
             raise ConfigError("At least one transport name is needed for %s" %
                               (type(self).__name__,))
-        self.transport_name_cycle = itertools.cycle(
-            self.dispatcher.transport_names)
         self.transport_name_set = set(self.dispatcher.transport_names)
 
+        strategy = self.config.get('strategy', 'round_robin')
+        if strategy not in self.STRATEGIES:
+            raise ConfigError("Unknown strategy %r for %s." % (
+                strategy, type(self).__name__))
+        self.strategy = self.STRATEGIES[strategy](self)
+        self.error_threshold = self.config.get('error_threshold')
+        self.ejection_min_events = self.config.get('ejection_min_events', 10)
+        self.ejection_time = self.config.get('ejection_time', 60)
+        self.outstanding_timeout = self.config.get('outstanding_timeout', 300)
+        stats_weight = self.config.get('stats_weight', 0.2)
+        self.transport_stats = dict(
+            (name, TransportStats(stats_weight))
+            for name in self.dispatcher.transport_names)
+        # Maps message_id to (transport_name, timestamp) in the order
+        # messages were sent.
+        self.unacked = OrderedDict()
+        self.clock = reactor
+
+    def get_time(self):
+        return self.clock.seconds()
+
+    def choose_transport_name(self):
+        now = self.get_time()
+        available = [
+            name for name in self.dispatcher.transport_names
+            if not self.is_ejected(name, now)]
+        return self.strategy.choose(
+            available or self.dispatcher.transport_names)
+
+    def is_ejected(self, transport_name, now):
+        stats = self.transport_stats[transport_name]
+        if stats.ejected_until is None:
+            return False
+        if now < stats.ejected_until:
+            return True
+        stats.ejected_until = None
+        log.info("LoadBalancer is sending messages to %r again." % (
+            transport_name,))
+        return False
+
+    def track_outbound(self, transport_name, msg):
+        now = self.get_time()
+        self.expire_outstanding(now)
+        # A resent message is only outstanding on the transport it was most
+        # recently sent to.
+        previous = self.unacked.pop(msg['message_id'], None)
+        if previous is not None:
+            self.transport_stats[previous[0]].outstanding -= 1
+        self.unacked[msg['message_id']] = (transport_name, now)
+        self.transport_stats[transport_name].outstanding += 1
+
+    def expire_outstanding(self, now):
+        cutoff = now - self.outstanding_timeout
+        while self.unacked:
+            message_id, (transport_name, timestamp) = next(
+                self.unacked.iteritems())
+            if timestamp > cutoff:
+                break
+            del self.unacked[message_id]
+            self.record_event(
+                transport_name, self.outstanding_timeout, True, now)
+
+    def track_event(self, event):
+        if event['event_type'] not in ('ack', 'nack'):
+            return
+        sent = self.unacked.pop(event['user_message_id'], None)
+        if sent is None:
+            return
+        transport_name, timestamp = sent
+        now = self.get_time()
+        self.record_event(
+            transport_name, now - timestamp, event['event_type'] == 'nack',
+            now)
+
+    def record_event(self, transport_name, latency, error, now):
+        stats = self.transport_stats[transport_name]
+        stats.outstanding -= 1
+        stats.record_event(latency, error)
+        if self.error_threshold is None:
+            return
+        if (stats.events >= self.ejection_min_events and
+                stats.error_rate >= self.error_threshold):
+            log.warning(
+                "LoadBalancer is ejecting %r for %s seconds because its error"
+                " rate is %.2f." % (
+                    transport_name, self.ejection_time, stats.error_rate))
+            stats.ejected_until = now + self.ejection_time
+            stats.reset_errors()
+
     def push_transport_name(self, msg, transport_name):
         hm = msg['helper_metadata']
         lm = hm.setdefault('load_balancer', {})
@@ -65,6 +301,7 @@ class LoadBalancingRouter(BaseDispatchRouter):
         self.dispatcher.publish_inbound_message(self.exposed_name, msg)
 
     def dispatch_inbound_event(self, msg):
+        self.track_event(msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = self.exposed_name
         self.dispatcher.publish_inbound_event(self.exposed_name, msg)
@@ -77,9 +314,10 @@ class LoadBalancingRouter(BaseDispatchRouter):
                             " reply for unknown load balancer endpoint %r was"
                             " was received. Using round-robin routing instead."
                             % (transport_name,))
-                transport_name = self.transport_name_cycle.next()
+                transport_name = self.choose_transport_name()
         else:
-            transport_name = self.transport_name_cycle.next()
+            transport_name = self.choose_transport_name()
+        self.track_outbound(transport_name, msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = transport_name
         self.dispatcher.publish_outbound_message(transport_name, msg)
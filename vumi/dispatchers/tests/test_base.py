@@ -1,7 +1,8 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter,
+    ContentKeywordRouter)
 from vumi.dispatchers.tests.helpers import DispatcherHelper, DummyDispatcher
 from vumi.errors import DispatcherError
 from vumi.tests.utils import LogCatcher
@@ -534,6 +535,48 @@ class TestContentKeywordRouter(VumiTestCase):
             'keyword1 rest of msg', to_addr='8181', from_addr='+256788601462')
         self.assert_dispatched('app1', [msg])
 
+    @inlineCallbacks
+    def test_inbound_message_routing_to_addr_and_prefix(self):
+        msg1 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8182', from_addr='+256788601462')
+        msg2 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+255788601462')
+        self.assert_dispatched('app1', [])
+        self.assert_dispatched('app3', [msg1, msg2])
+
+    @inlineCallbacks
+    def test_inbound_message_routing_no_match(self):
+        msg = yield self.send_inbound('KEYWORD4 rest of msg')
+        self.assert_dispatched('app1', [])
+        self.assert_dispatched('app2', [])
+        self.assert_dispatched('app3', [])
+        self.assert_dispatched('fallback_app', [msg])
+
+    def test_get_matching_rules_order(self):
+        self.router.rules = [
+            {'app': 'a', 'keyword': 'kw', 'prefix': '+2567'},
+            {'app': 'b', 'keyword': 'kw', 'to_addr': '8181'},
+            {'app': 'c', 'keyword': 'kw', 'prefix': '+256'},
+            {'app': 'd', 'keyword': 'kw', 'to_addr': '8181', 'prefix': '+'},
+            {'app': 'e', 'keyword': 'kw'},
+            {'app': 'f', 'keyword': 'other'},
+        ]
+        self.router.compile_rules()
+        msg = self.disp_helper.make_inbound(
+            'kw', to_addr='8181', from_addr='+256788601462')
+        rules = self.router.get_matching_rules('kw', msg)
+        self.assertEqual([r['app'] for r in rules], ['a', 'b', 'c', 'd', 'e'])
+
+    def test_get_matching_rules_custom_matching(self):
+        class CustomKeywordRouter(ContentKeywordRouter):
+            def is_msg_matching_routing_rules(self, keyword, msg, rule):
+                return rule['app'] == 'app2'
+
+        self.patch(self.router, '__class__', CustomKeywordRouter)
+        msg = self.disp_helper.make_inbound('KEYWORD1')
+        rules = self.router.get_matching_rules('keyword1', msg)
+        self.assertEqual([r['app'] for r in rules], ['app2', 'app2'])
+
     @inlineCallbacks
     def test_inbound_event_routing_ok(self):
         yield self.router.session_manager.create_session(
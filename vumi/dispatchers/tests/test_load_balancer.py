@@ -1,8 +1,10 @@
 """Tests for vumi.dispatchers.load_balancer."""
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 
 from vumi.dispatchers.load_balancer import LoadBalancingRouter
+from vumi.errors import ConfigError
 from vumi.dispatchers.tests.helpers import DummyDispatcher
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 from vumi.tests.utils import LogCatcher
@@ -167,3 +169,222 @@ class TestLoadBalancingWithoutRewriteTransportNames(BaseLoadBalancingTestCase):
         self.router.dispatch_outbound_message(msg1)
         [new_msg] = self.dispatcher.transport_publisher['transport_1'].msgs
         self.assertEqual(new_msg['transport_name'], 'round_robin')
+
+
+class FakeTransport(DummyDispatcher.DummyPublisher):
+    """
+    A publisher standing in for a transport that acks (or nacks) each
+    message it is sent after a simulated delay.
+    """
+
+    def __init__(self, router, clock, msg_helper, latency, fail=False):
+        super(FakeTransport, self).__init__()
+        self.router = router
+        self.clock = clock
+        self.msg_helper = msg_helper
+        self.latency = latency
+        self.fail = fail
+
+    def publish_message(self, msg):
+        super(FakeTransport, self).publish_message(msg)
+        if self.latency is None:
+            return
+        if self.fail:
+            event = self.msg_helper.make_nack(msg)
+        else:
+            event = self.msg_helper.make_ack(msg)
+        self.clock.callLater(
+            self.latency, self.router.dispatch_inbound_event, event)
+
+
+class TestLoadBalancingStrategies(VumiTestCase):
+
+    def setUp(self):
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.clock = Clock()
+
+    @inlineCallbacks
+    def mk_router(self, transports, **config):
+        """
+        Create a router for fake transports with the given latencies.
+        """
+        config.update({
+            "transport_names": sorted(transports),
+            "exposed_names": ["round_robin"],
+        })
+        self.dispatcher = DummyDispatcher(config)
+        router = LoadBalancingRouter(self.dispatcher, config)
+        self.add_cleanup(router.teardown_routing)
+        yield router.setup_routing()
+        router.clock = self.clock
+        for name, latency in transports.items():
+            self.dispatcher.transport_publisher[name] = FakeTransport(
+                router, self.clock, self.msg_helper, latency)
+        returnValue(router)
+
+    def send_msgs(self, router, count, interval=0):
+        """
+        Send `count` messages and return the names of the transports they
+        were sent to.
+        """
+        sent_to = []
+        for i in range(count):
+            msg = self.msg_helper.make_outbound('msg %d' % (i,))
+            router.dispatch_outbound_message(msg)
+            sent_to.append(msg['transport_name'])
+            self.clock.advance(interval)
+        return sent_to
+
+    def msg_counts(self):
+        return dict(
+            (name, len(publisher.msgs)) for name, publisher
+            in self.dispatcher.transport_publisher.items())
+
+    @inlineCallbacks
+    def test_unknown_strategy(self):
+        yield self.assertFailure(
+            self.mk_router({"transport_1": 1}, strategy="random"),
+            ConfigError)
+
+    @inlineCallbacks
+    def test_round_robin_ignores_latency(self):
+        router = yield self.mk_router(
+            {"transport_1": 10, "transport_2": 1})
+        self.send_msgs(router, 100, interval=0.5)
+        self.assertEqual(
+            self.msg_counts(), {"transport_1": 50, "transport_2": 50})
+
+    @inlineCallbacks
+    def test_weighted_round_robin(self):
+        router = yield self.mk_router(
+            {"transport_1": None, "transport_2": None},
+            strategy="weighted_round_robin", weights={"transport_1": 3})
+        for i in range(8):
+            router.dispatch_outbound_message(
+                self.msg_helper.make_outbound('msg %d' % (i,)))
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(
+            [msg['content'] for msg in publishers['transport_2'].msgs],
+            ['msg 2', 'msg 6'])
+        self.assertEqual(self.msg_counts(), {
+            "transport_1": 6, "transport_2": 2})
+
+    @inlineCallbacks
+    def test_least_outstanding(self):
+        router = yield self.mk_router(
+            {"transport_1": 10, "transport_2": 1},
+            strategy="least_outstanding")
+        self.send_msgs(router, 100, interval=0.5)
+        counts = self.msg_counts()
+        self.assertTrue(counts["transport_2"] > 4 * counts["transport_1"])
+        self.clock.advance(10)
+        self.assertEqual(router.transport_stats["transport_1"].outstanding, 0)
+        self.assertEqual(router.transport_stats["transport_2"].outstanding, 0)
+        self.assertEqual(router.unacked, {})
+
+    @inlineCallbacks
+    def test_least_outstanding_ties(self):
+        router = yield self.mk_router(
+            {"transport_1": None, "transport_2": None},
+            strategy="least_outstanding")
+        self.send_msgs(router, 4)
+        self.assertEqual(self.msg_counts(), {
+            "transport_1": 2, "transport_2": 2})
+
+    @inlineCallbacks
+    def test_latency(self):
+        router = yield self.mk_router(
+            {"transport_1": 10, "transport_2": 1}, strategy="latency")
+        self.send_msgs(router, 100, interval=0.5)
+        counts = self.msg_counts()
+        self.assertTrue(counts["transport_2"] > 4 * counts["transport_1"])
+        self.assertEqual(router.transport_stats["transport_2"].latency, 1)
+
+    @inlineCallbacks
+    def test_latency_tries_unknown_transports(self):
+        router = yield self.mk_router(
+            {"transport_1": 1, "transport_2": 1}, strategy="latency")
+        router.transport_stats["transport_1"].latency = 0.01
+        self.assertEqual(self.send_msgs(router, 1), ["transport_2"])
+
+    @inlineCallbacks
+    def test_latency_avoids_unresponsive_transport(self):
+        router = yield self.mk_router(
+            {"transport_1": None, "transport_2": 0.1}, strategy="latency",
+            outstanding_timeout=5)
+        self.send_msgs(router, 1000, interval=0.05)
+        counts = self.msg_counts()
+        self.assertTrue(counts["transport_1"] < 20)
+        self.assertEqual(router.transport_stats["transport_1"].latency, 5)
+
+    @inlineCallbacks
+    def test_latency_waits_for_unknown_transports(self):
+        router = yield self.mk_router(
+            {"transport_1": None, "transport_2": None}, strategy="latency")
+        router.transport_stats["transport_1"].latency = 10
+        router.transport_stats["transport_1"].outstanding = 2
+        self.assertEqual(
+            self.send_msgs(router, 2), ["transport_2", "transport_1"])
+
+    @inlineCallbacks
+    def test_eject_failing_transport(self):
+        router = yield self.mk_router(
+            {"transport_1": 1, "transport_2": 1}, error_threshold=0.5,
+            ejection_min_events=3, ejection_time=30, stats_weight=0.5)
+        self.dispatcher.transport_publisher["transport_1"].fail = True
+        with LogCatcher() as lc:
+            sent_to = self.send_msgs(router, 8, interval=1)
+            [ejected] = lc.messages()
+        self.assertEqual(
+            ejected, "LoadBalancer is ejecting 'transport_1' for 30 seconds"
+            " because its error rate is 0.88.")
+        self.assertEqual(sent_to, [
+            "transport_1", "transport_2", "transport_1", "transport_2",
+            "transport_1", "transport_2", "transport_2", "transport_2"])
+
+        self.clock.advance(30)
+        self.assertEqual(
+            self.send_msgs(router, 2), ["transport_1", "transport_2"])
+
+    @inlineCallbacks
+    def test_all_transports_ejected(self):
+        router = yield self.mk_router(
+            {"transport_1": 1, "transport_2": 1}, error_threshold=0.5,
+            ejection_min_events=1)
+        for name in ["transport_1", "transport_2"]:
+            router.transport_stats[name].ejected_until = 60
+        self.assertEqual(
+            self.send_msgs(router, 2), ["transport_1", "transport_2"])
+
+    @inlineCallbacks
+    def test_outstanding_timeout(self):
+        router = yield self.mk_router(
+            {"transport_1": None, "transport_2": None},
+            outstanding_timeout=10)
+        self.send_msgs(router, 2)
+        self.assertEqual(len(router.unacked), 2)
+        self.clock.advance(10)
+        self.send_msgs(router, 1)
+        self.assertEqual(len(router.unacked), 1)
+        stats = router.transport_stats["transport_2"]
+        self.assertEqual(stats.outstanding, 0)
+        self.assertEqual(stats.events, 1)
+        self.assertEqual(stats.error_rate, 0.2)
+        self.assertEqual(stats.latency, 10)
+
+    @inlineCallbacks
+    def test_resent_message(self):
+        router = yield self.mk_router(
+            {"transport_1": None, "transport_2": None})
+        msg = self.msg_helper.make_outbound('msg')
+        router.dispatch_outbound_message(msg)
+        router.dispatch_outbound_message(msg)
+        self.assertEqual(msg['transport_name'], "transport_2")
+        self.assertEqual(router.unacked.keys(), [msg['message_id']])
+        stats = router.transport_stats
+        self.assertEqual(stats["transport_1"].outstanding, 0)
+        self.assertEqual(stats["transport_2"].outstanding, 1)
+
+        router.dispatch_inbound_event(self.msg_helper.make_ack(msg))
+        self.assertEqual(stats["transport_2"].outstanding, 0)
+        self.assertEqual(router.unacked, {})
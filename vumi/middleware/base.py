@@ -1,7 +1,8 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 from confmodel import Config
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
@@ -186,11 +187,19 @@ class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
     """
 
+    MESSAGE_TYPES = ('inbound', 'outbound', 'event', 'failure')
+
     def __init__(self, middlewares):
         self.consume_middlewares = self._sort_by_priority(
             middlewares, 'consume_priority')
         self.publish_middlewares = self._sort_by_priority(
             reversed(middlewares), 'publish_priority')
+        self._handlers = {}
+        for message_type in self.MESSAGE_TYPES:
+            self._get_handlers(
+                self.consume_middlewares, 'consume_%s' % (message_type,))
+            self._get_handlers(
+                self.publish_middlewares, 'publish_%s' % (message_type,))
 
     @staticmethod
     def _sort_by_priority(middlewares, priority_key):
@@ -198,27 +207,57 @@ class MiddlewareStack(object):
         # order within priority levels.
         return sorted(middlewares, key=lambda mw: getattr(mw, priority_key))
 
-    @inlineCallbacks
-    def _handle(self, middlewares, handler_name, message, connector_name):
-        method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, connector_name)
-            if message is None:
-                raise MiddlewareError(
-                    'Returned value of %s.%s should never be None' % (
-                        middleware, method_name,))
-        returnValue(message)
+    def _get_handlers(self, middlewares, handler_name):
+        """
+        Return a list of ``(middleware, bound_handler)`` pairs for
+        `handler_name`, looking the handlers up the first time it is used.
+        """
+        handlers = self._handlers.get(handler_name)
+        if handlers is None:
+            method_name = 'handle_%s' % (handler_name,)
+            handlers = self._handlers[handler_name] = [
+                (middleware, getattr(middleware, method_name))
+                for middleware in middlewares]
+        return handlers
+
+    def _handle(self, handlers, handler_name, message, connector_name,
+                start=0):
+        # Handlers are called synchronously until one of them returns a
+        # Deferred. The rest of the stack is run when it fires.
+        try:
+            for index in xrange(start, len(handlers)):
+                message = handlers[index][1](message, connector_name)
+                if isinstance(message, Deferred):
+                    return message.addCallback(
+                        self._resume, handlers, handler_name, connector_name,
+                        index)
+                self._check_result(handlers, handler_name, index, message)
+        except Exception:
+            return fail()
+        return succeed(message)
+
+    def _resume(self, message, handlers, handler_name, connector_name, index):
+        self._check_result(handlers, handler_name, index, message)
+        return self._handle(
+            handlers, handler_name, message, connector_name, index + 1)
+
+    def _check_result(self, handlers, handler_name, index, message):
+        if message is None:
+            raise MiddlewareError(
+                'Returned value of %s.handle_%s should never be None' % (
+                    handlers[index][0], handler_name,))
 
     def apply_consume(self, handler_name, message, connector_name):
         handler_name = 'consume_%s' % (handler_name,)
         return self._handle(
-            self.consume_middlewares, handler_name, message, connector_name)
+            self._get_handlers(self.consume_middlewares, handler_name),
+            handler_name, message, connector_name)
 
     def apply_publish(self, handler_name, message, connector_name):
         handler_name = 'publish_%s' % (handler_name,)
         return self._handle(
-            self.publish_middlewares, handler_name, message, connector_name)
+            self._get_handlers(self.publish_middlewares, handler_name),
+            handler_name, message, connector_name)
 
     @inlineCallbacks
     def teardown(self):
@@ -1,11 +1,17 @@
 # -*- test-case-name: vumi.middleware.tests.test_provider_setter -*-
 
-from confmodel.fields import ConfigDict, ConfigText
+import csv
+import os
+
+from confmodel.fields import ConfigDict, ConfigFloat, ConfigText
+from twisted.internet import reactor, threads
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import LoopingCall
 
 from vumi import log
 from vumi.errors import VumiError
 from vumi.middleware.base import TransportMiddleware, BaseMiddlewareConfig
-from vumi.utils import normalize_msisdn
+from vumi.utils import normalize_msisdn, PrefixTrie
 
 
 class ProviderSettingMiddlewareError(VumiError):
@@ -69,7 +75,14 @@ class AddressPrefixProviderSettingMiddlewareConfig(BaseMiddlewareConfig):
     provider_prefixes = ConfigDict(
         "Mapping from address prefix to provider value. Longer prefixes are "
         "checked first to avoid ambiguity. If no prefix matches, the provider"
-        " value will be set to ``None``.", required=True, static=True)
+        " value will be set to ``None``.", default={}, static=True)
+    provider_prefix_file = ConfigText(
+        "Optional path to a CSV file of ``prefix,provider`` lines. These are "
+        "added to ``provider_prefixes``, replacing any with the same prefix.",
+        static=True)
+    reload_interval = ConfigFloat(
+        "Seconds between checks for changes to ``provider_prefix_file``. If "
+        "absent, the file is only read at startup.", static=True)
     normalize_msisdn = ConfigNormalizeMsisdn(
         "Optional MSISDN normalization config. If present, this dict should "
         "contain a (mandatory) ``country_code`` field and an optional boolean "
@@ -78,6 +91,11 @@ class AddressPrefixProviderSettingMiddlewareConfig(BaseMiddlewareConfig):
         " (This normalization is only used for the prefix check. The "
         "``from_addr`` field on the message is not modified.)", static=True)
 
+    def post_validate(self):
+        if not (self.provider_prefixes or self.provider_prefix_file):
+            self.raise_config_error(
+                "requires either provider_prefixes or provider_prefix_file.")
+
 
 class AddressPrefixProviderSettingMiddleware(TransportMiddleware):
     """
@@ -93,6 +111,16 @@ class AddressPrefixProviderSettingMiddleware(TransportMiddleware):
         checked first to avoid ambiguity. If no prefix matches, the provider
         value will be set to ``None``.
 
+    :param str provider_prefix_file:
+        Optional path to a CSV file of ``prefix,provider`` lines. These are
+        added to ``provider_prefixes``, replacing any with the same prefix.
+
+    :param float reload_interval:
+        Seconds between checks for changes to ``provider_prefix_file``. When
+        the file changes, it is read in a thread and the new prefixes replace
+        the old ones all at once. If the file can't be read, the old prefixes
+        are kept. If absent, the file is only read at startup.
+
     :param dict normalize_msisdn:
         Optional MSISDN normalization config. If present, this dict should
         contain a (mandatory) ``country_code`` field and an optional boolean
@@ -111,10 +139,73 @@ class AddressPrefixProviderSettingMiddleware(TransportMiddleware):
     CONFIG_CLASS = AddressPrefixProviderSettingMiddlewareConfig
 
     def setup_middleware(self):
-        prefixes = self.config.provider_prefixes.items()
-        self.provider_prefixes = sorted(
-            prefixes, key=lambda item: -len(item[0]))
         self.normalize_config = self.config.normalize_msisdn
+        self.prefix_file = self.config.provider_prefix_file
+        self.prefix_file_mtime = None
+        self.clock = reactor
+        self.reload_call = None
+
+        prefixes = self.config.provider_prefixes
+        if self.prefix_file is not None:
+            self.prefix_file_mtime = os.path.getmtime(self.prefix_file)
+            prefixes = self.load_prefixes(self.prefix_file)
+        self.provider_trie = self.build_trie(prefixes)
+
+        if self.prefix_file is not None and self.config.reload_interval:
+            self.reload_call = LoopingCall(self.reload_prefixes)
+            self.reload_call.clock = self.clock
+            self.reload_call.start(self.config.reload_interval, now=False)
+
+    def teardown_middleware(self):
+        if self.reload_call is not None and self.reload_call.running:
+            self.reload_call.stop()
+
+    def load_prefixes(self, filename):
+        """
+        Return the configured prefixes updated with those in `filename`.
+        """
+        prefixes = dict(self.config.provider_prefixes)
+        with open(filename, 'rb') as prefix_file:
+            for row in csv.reader(prefix_file):
+                if not row or row[0].startswith('#'):
+                    continue
+                prefix, provider = [field.strip() for field in row]
+                prefixes[prefix] = provider
+        return prefixes
+
+    def build_trie(self, prefixes):
+        trie = PrefixTrie()
+        for prefix, provider in prefixes.iteritems():
+            trie.add(prefix, provider)
+        return trie
+
+    def reload_prefixes(self):
+        """
+        Rebuild the prefix trie if the prefix file has changed since it was
+        last read. The old trie is used until the new one is ready.
+        """
+        try:
+            mtime = os.path.getmtime(self.prefix_file)
+        except OSError:
+            log.err(None, "Error checking provider prefix file %r." % (
+                self.prefix_file,))
+            return succeed(None)
+        if mtime == self.prefix_file_mtime:
+            return succeed(None)
+        return self._reload_prefixes(mtime)
+
+    @inlineCallbacks
+    def _reload_prefixes(self, mtime):
+        try:
+            trie = yield threads.deferToThread(
+                lambda: self.build_trie(self.load_prefixes(self.prefix_file)))
+        except Exception:
+            log.err(None, "Error loading provider prefix file %r." % (
+                self.prefix_file,))
+            return
+        self.provider_trie = trie
+        self.prefix_file_mtime = mtime
+        log.info("Reloaded provider prefixes from %r." % (self.prefix_file,))
 
     def normalize_addr(self, addr):
         if self.normalize_config:
@@ -130,11 +221,7 @@ class AddressPrefixProviderSettingMiddleware(TransportMiddleware):
                 "Address for determining message provider cannot be None,"
                 " skipping message"))
             return None
-        addr = self.normalize_addr(addr)
-        for prefix, provider in self.provider_prefixes:
-            if addr.startswith(prefix):
-                return provider
-        return None
+        return self.provider_trie.longest_match(self.normalize_addr(addr))
 
     def handle_inbound(self, message, connector_name):
         if message.get("provider") is None:
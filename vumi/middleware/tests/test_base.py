@@ -2,11 +2,11 @@ import yaml
 import itertools
 
 from confmodel.fields import ConfigInt
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 
 from vumi.middleware.base import (
     BaseMiddleware, MiddlewareStack, create_middlewares_from_config,
-    setup_middlewares_from_config, BaseMiddlewareConfig)
+    setup_middlewares_from_config, BaseMiddlewareConfig, MiddlewareError)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -81,6 +81,26 @@ class ToyAsymmetricMiddleware(ToyMiddleware):
         return self._handle('publish_failure', message, connector_name)
 
 
+class ToyDeferredMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        self.worker.processed(self.name, direction, message, connector_name)
+        self.d = Deferred()
+        return self.d
+
+
+class ToyNoneMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        return None
+
+
+class ToyBrokenMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        raise ValueError("broken")
+
+
 class TestMiddlewareStack(VumiTestCase):
 
     @inlineCallbacks
@@ -220,6 +240,72 @@ class TestMiddlewareStack(VumiTestCase):
             ('pasym', 'event', 'dummy_msg.pn.p1_2.p1_1.p2.pasym', 'end_foo'),
         ])
 
+    @inlineCallbacks
+    def test_apply_returns_deferred(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertTrue(isinstance(d, Deferred))
+        self.assertEqual((yield d), 'dummy_msg.mw1.mw2.mw3')
+
+    @inlineCallbacks
+    def test_apply_with_deferred_middleware(self):
+        mw2 = yield self.mkmiddleware('mw2', ToyDeferredMiddleware)
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            mw2,
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertNoResult(d)
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+            ('mw2', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+        ])
+        mw2.d.callback('dummy_msg.mw1.mw2')
+        self.assertEqual((yield d), 'dummy_msg.mw1.mw2.mw3')
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+            ('mw2', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+            ('mw3', 'inbound', 'dummy_msg.mw1.mw2.mw3', 'end_foo'),
+        ])
+
+    @inlineCallbacks
+    def test_apply_with_none_result(self):
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            (yield self.mkmiddleware('mw2', ToyNoneMiddleware)),
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        err = yield self.assertFailure(
+            self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo'),
+            MiddlewareError)
+        self.assertTrue(str(err).endswith(
+            '.handle_consume_inbound should never be None'))
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+        ])
+
+    @inlineCallbacks
+    def test_apply_with_deferred_none_result(self):
+        mw2 = yield self.mkmiddleware('mw2', ToyDeferredMiddleware)
+        self.stack = MiddlewareStack([
+            mw2, (yield self.mkmiddleware('mw3', ToyMiddleware))])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        mw2.d.callback(None)
+        yield self.assertFailure(d, MiddlewareError)
+        self.assert_processed([
+            ('mw2', 'inbound', 'dummy_msg', 'end_foo'),
+        ])
+
+    @inlineCallbacks
+    def test_apply_with_exception(self):
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyBrokenMiddleware)),
+            (yield self.mkmiddleware('mw2', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('outbound', 'dummy_msg', 'end_foo')
+        yield self.assertFailure(d, ValueError)
+        self.assert_processed([])
+
 
 class TestUtilityFunctions(VumiTestCase):
 
@@ -1,5 +1,10 @@
 """Tests for vumi.middleware.provider_setter."""
 
+import os
+
+from confmodel.errors import ConfigError
+from twisted.internet.defer import inlineCallbacks
+
 from vumi.middleware.provider_setter import (
     StaticProviderSettingMiddleware, AddressPrefixProviderSettingMiddleware,
     ProviderSettingMiddlewareError)
@@ -59,8 +64,22 @@ class TestAddressPrefixProviderSettingMiddleware(VumiTestCase):
         mw = AddressPrefixProviderSettingMiddleware(
             "address_prefix_provider_setter", config, dummy_worker)
         mw.setup_middleware()
+        self.add_cleanup(mw.teardown_middleware)
         return mw
 
+    def mk_prefix_file(self, content, mtime=None):
+        filename = self.mktemp()
+        with open(filename, 'wb') as prefix_file:
+            prefix_file.write(content)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def assert_provider(self, mw, from_addr, provider):
+        msg = self.msg_helper.make_inbound(None, from_addr=from_addr)
+        processed_msg = mw.handle_inbound(msg, "dummy_connector")
+        self.assertEqual(processed_msg.get("provider"), provider)
+
     def assert_middleware_error(self, msg):
         [err] = self.flushLoggedErrors(ProviderSettingMiddlewareError)
         self.assertEqual(str(err.value), msg)
@@ -221,3 +240,69 @@ class TestAddressPrefixProviderSettingMiddleware(VumiTestCase):
         self.assert_middleware_error(
             "Address for determining message provider cannot be None,"
             " skipping message")
+
+    def test_no_prefixes(self):
+        """
+        At least one of provider_prefixes and provider_prefix_file must be
+        configured.
+        """
+        self.assertRaises(ConfigError, self.mk_middleware, {})
+
+    def test_provider_prefix_file(self):
+        """
+        Prefixes in the prefix file are added to the configured prefixes,
+        replacing any that are the same.
+        """
+        filename = self.mk_prefix_file(
+            "# prefix,provider\n"
+            "+123,FILE-MNO\n"
+            "\n"
+            "+1234, OTHER-MNO\n")
+        mw = self.mk_middleware({
+            "provider_prefixes": {"+12": "MY-MNO", "+123": "YOUR-MNO"},
+            "provider_prefix_file": filename,
+        })
+        self.assert_provider(mw, "+12000", "MY-MNO")
+        self.assert_provider(mw, "+12300", "FILE-MNO")
+        self.assert_provider(mw, "+12345", "OTHER-MNO")
+        self.assertEqual(mw.reload_call, None)
+
+    @inlineCallbacks
+    def test_reload_provider_prefix_file(self):
+        """
+        The prefix file is reloaded if it has changed.
+        """
+        filename = self.mk_prefix_file("+123,MY-MNO\n", mtime=1000)
+        mw = self.mk_middleware({
+            "provider_prefix_file": filename,
+            "reload_interval": 60,
+        })
+        self.assertEqual(mw.reload_call.interval, 60)
+        self.assert_provider(mw, "+12345", "MY-MNO")
+
+        os.rename(self.mk_prefix_file("+123,YOUR-MNO\n", mtime=1000),
+                  filename)
+        yield mw.reload_prefixes()
+        self.assert_provider(mw, "+12345", "MY-MNO")
+
+        os.utime(filename, (2000, 2000))
+        yield mw.reload_prefixes()
+        self.assert_provider(mw, "+12345", "YOUR-MNO")
+
+    @inlineCallbacks
+    def test_reload_provider_prefix_file_error(self):
+        """
+        If the prefix file can't be loaded, the old prefixes are kept.
+        """
+        filename = self.mk_prefix_file("+123,MY-MNO\n", mtime=1000)
+        mw = self.mk_middleware({"provider_prefix_file": filename})
+        os.rename(
+            self.mk_prefix_file("+123,MY-MNO,extra\n", mtime=2000), filename)
+        yield mw.reload_prefixes()
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assert_provider(mw, "+12345", "MY-MNO")
+
+        os.remove(filename)
+        yield mw.reload_prefixes()
+        [err] = self.flushLoggedErrors(OSError)
+        self.assert_provider(mw, "+12345", "MY-MNO")
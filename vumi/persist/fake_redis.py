@@ -4,6 +4,7 @@ import fnmatch
 from functools import wraps
 from itertools import takewhile, dropwhile
 import os
+import pickle
 from zlib import crc32
 
 from hyperloglog import HyperLogLog
@@ -60,6 +61,9 @@ class FakeRedis(object):
         self._clean_up_expires()
         self._clean_up_delayed_calls()
 
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
     def _encode(self, value):
         # Replicated from
         # redis-py's redis/connection.py
@@ -181,6 +185,22 @@ class FakeRedis(object):
 
         return [cursor, fnmatch.filter(output, match)]
 
+    @maybe_async
+    def dump(self, key):
+        # The real serialization format is opaque, so we use our own.
+        if key not in self._data:
+            return None
+        return pickle.dumps(self._data[key])
+
+    @maybe_async
+    def restore(self, key, ttl, value):
+        if key in self._data:
+            raise ResponseError("BUSYKEY Target key name already exists.")
+        self._set_key(key, pickle.loads(value))
+        if ttl:
+            self.expire.sync(self, key, ttl / 1000.0)
+        return True
+
     @maybe_async
     def flushdb(self):
         self._data = {}
@@ -193,9 +213,13 @@ class FakeRedis(object):
         return self._data.get(key)
 
     @maybe_async
-    def set(self, key, value):
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self._data:
+            return None
         value = self._encode(value)  # set() sets string value
         self._set_key(key, value)
+        if ex is not None:
+            self.expire.sync(self, key, ex)
         return True
 
     @maybe_async
@@ -420,6 +444,11 @@ class FakeRedis(object):
         zval = self._data.get(key, Zset())
         return zval.zscore(value)
 
+    @maybe_async
+    def zincrby(self, key, value, amount=1):
+        zval = self._setdefault_key(key, Zset())
+        return zval.zincrby(value, amount)
+
     @maybe_async
     def zremrangebyrank(self, key, start, stop):
         zval = self._setdefault_key(key, Zset())
@@ -535,9 +564,43 @@ class FakeRedis(object):
         return hll.card() != old_card
 
     @maybe_async
-    def pfcount(self, key):
-        hll = self._data.get(key, HyperLogLog(0.01))
-        return len(hll)
+    def pfcount(self, key, *keys):
+        return len(self._merge_hlls((key,) + keys))
+
+    def _merge_hlls(self, keys):
+        merged = HyperLogLog(0.01)
+        hlls = [self._data[key] for key in keys if key in self._data]
+        if hlls:
+            merged.update(*hlls)
+        return merged
+
+
+class FakeRedisPipeline(object):
+    """
+    A fake pipeline for a :class:`FakeRedis` in sync mode.
+
+    Calls are queued and only made when :meth:`execute` is called, which
+    returns a list of their results in order.
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        func = getattr(self._fake_redis, name)
+
+        def queue_call(*args, **kw):
+            self._calls.append((func, args, kw))
+            return self
+        return queue_call
+
+    def __len__(self):
+        return len(self._calls)
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [func(*args, **kw) for func, args, kw in calls]
 
 
 class Zset(object):
@@ -622,6 +685,12 @@ class Zset(object):
             if value == val:
                 return score
 
+    def zincrby(self, val, amount):
+        score = self.zscore(val) or 0.0
+        score += self._to_float(amount)
+        self.zadd(**{val: score})
+        return score
+
     def zremrangebyrank(self, start, stop):
         start, stop = self._redis_range_to_py_range(start, stop)
         deleted_keys = self._zval[start:stop]
@@ -103,6 +103,13 @@ class FieldDescriptor(object):
         """
         pass
 
+    def flush(self, modelobj):
+        """
+        Write any changes to cached values back to the model data before the
+        model is saved.
+        """
+        pass
+
     def __repr__(self):
         return "<%s key=%s field=%r>" % (self.__class__.__name__, self.key,
                                          self.field)
@@ -313,22 +320,64 @@ class VumiMessageDescriptor(FieldDescriptor):
     def _timestamp_from_json(self, value):
         return parse_vumi_date(value)
 
-    def set_value(self, modelobj, msg):
-        """Set the value associated with this descriptor."""
-        self._clear_keys(modelobj)
-        if msg is None:
-            return
+    def _message_to_riak(self, msg):
+        raw_values = {}
         for key, value in msg.payload.iteritems():
             if key == self.message_class._CACHE_ATTRIBUTE:
                 continue
             # TODO: timestamp as datetime in payload must die.
             if key == "timestamp":
                 value = self._timestamp_to_json(value)
-            full_key = "%s%s" % (self.prefix, key)
+            raw_values["%s%s" % (self.prefix, key)] = value
+        return raw_values
+
+    def _get_cached(self, modelobj):
+        """
+        Return a ``(data, msg)`` tuple if there is a cached message for the
+        model's current data, otherwise ``None``.
+        """
+        cached = modelobj._field_cache.get(self.key)
+        if cached is None:
+            return None
+        if cached[0] is not modelobj._riak_object.get_data():
+            # The data has been replaced (by a migration, for example).
+            return None
+        return cached
+
+    def _set_cached(self, modelobj, msg):
+        modelobj._field_cache[self.key] = (
+            modelobj._riak_object.get_data(), msg)
+
+    def _clear_cached(self, modelobj):
+        modelobj._field_cache.pop(self.key, None)
+
+    def set_riak_data(self, modelobj, raw_value, key=None):
+        self._clear_cached(modelobj)
+        super(VumiMessageDescriptor, self).set_riak_data(
+            modelobj, raw_value, key)
+
+    def delete_riak_data(self, modelobj, key=None):
+        self._clear_cached(modelobj)
+        super(VumiMessageDescriptor, self).delete_riak_data(modelobj, key)
+
+    def set_value(self, modelobj, msg):
+        """Set the value associated with this descriptor."""
+        self._clear_keys(modelobj)
+        if msg is None:
+            return
+        for full_key, value in self._message_to_riak(msg).iteritems():
             self.set_riak_data(modelobj, value, full_key)
 
     def get_value(self, modelobj):
-        """Get the value associated with this descriptor."""
+        """Get the value associated with this descriptor.
+
+        The decoded message is cached on the model object, so repeated
+        access returns the same message object. Changes made to that message
+        are written back to the model data when the model is saved.
+        """
+        cached = self._get_cached(modelobj)
+        if cached is not None:
+            return cached[1]
         payload = {}
         for key, value in modelobj._riak_object.get_data().iteritems():
             if key.startswith(self.prefix):
@@ -337,9 +386,33 @@ class VumiMessageDescriptor(FieldDescriptor):
                 if key == "timestamp":
                     value = self._timestamp_from_json(value)
                 payload[key] = value
-        if not payload:
-            return None
-        return self.field.message_class(**to_kwargs(payload))
+        msg = None
+        if payload:
+            msg = self.field.message_class(**to_kwargs(payload))
+        self._set_cached(modelobj, msg)
+        return msg
+
+    def flush(self, modelobj):
+        """
+        Write the cached message back to the model data if it has been
+        changed since it was decoded.
+        """
+        cached = self._get_cached(modelobj)
+        if cached is None or cached[1] is None:
+            return
+        data, msg = cached
+        raw_values = self._message_to_riak(msg)
+        changed = False
+        for key in data.keys():
+            if key.startswith(self.prefix) and key not in raw_values:
+                self.delete_riak_data(modelobj, key)
+                changed = True
+        for key, value in raw_values.iteritems():
+            if key not in data or data[key] != value:
+                self.set_riak_data(modelobj, value, key)
+                changed = True
+        if changed:
+            self._set_cached(modelobj, msg)
 
 
 class VumiMessage(Field):
@@ -208,6 +208,8 @@ class Model(object):
 
     def __init__(self, manager, key, _riak_object=None, **field_values):
         self._fields_changed = []
+        # Decoded field values cached by field descriptors.
+        self._field_cache = {}
         self.manager = manager
         self.key = key
         if _riak_object is not None:
@@ -281,6 +283,8 @@ class Model(object):
             A deferred that fires once the data is saved (or None if
             using a synchronous manager).
         """
+        for descriptor in self.field_descriptors.itervalues():
+            descriptor.flush(self)
         return self.manager.store(self)
 
     def delete(self):
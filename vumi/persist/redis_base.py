@@ -3,6 +3,8 @@
 import os
 from functools import wraps
 
+from twisted.internet.defer import Deferred, FirstError, gatherResults
+
 from vumi.persist.ast_magic import make_function
 from vumi.persist.fake_redis import FakeRedis
 
@@ -33,6 +35,27 @@ def make_callfunc(name, redis_call):
                          redis_call.kwarg, redis_call.defaults)
 
 
+def gather_calls(results):
+    """
+    Wait for the results of several Redis calls made without waiting for each
+    other.
+
+    For async managers the calls are all sent to the server before any reply
+    is read, so a batch of calls costs a single round-trip. Sync managers
+    return results directly, so we have nothing to wait for.
+    """
+    if any(isinstance(r, Deferred) for r in results):
+        d = gatherResults(results, consumeErrors=True)
+        d.addErrback(_unwrap_first_error)
+        return d
+    return results
+
+
+def _unwrap_first_error(failure):
+    failure.trap(FirstError)
+    return failure.value.subFailure
+
+
 class RedisCall(object):
     def __init__(self, args, vararg=None, kwarg=None, defaults=(),
                  filter_func=None, key_args=('key',)):
@@ -234,11 +257,13 @@ class Manager(object):
     scan = RedisCall(['cursor', 'match', 'count'],
                      defaults=['*', None], key_args=['match'],
                      filter_func='_unkeys_scan')
+    dump = RedisCall(['key'])
+    restore = RedisCall(['key', 'ttl', 'value'])
 
     # String operations
 
     get = RedisCall(['key'])
-    set = RedisCall(['key', 'value'])
+    set = RedisCall(['key', 'value', 'ex', 'nx'], defaults=[None, False])
     setnx = RedisCall(['key', 'value'])
     delete = RedisCall(['key'])
     setex = RedisCall(['key', 'seconds', 'value'])
@@ -285,6 +310,7 @@ class Manager(object):
         ['key', 'min', 'max', 'start', 'num', 'withscores'],
         defaults=['-inf', '+inf', None, None, False])
     zscore = RedisCall(['key', 'value'])
+    zincrby = RedisCall(['key', 'value', 'amount'], defaults=[1])
     zcount = RedisCall(['key', 'min', 'max'])
     zremrangebyrank = RedisCall(['key', 'start', 'stop'])
 
@@ -310,4 +336,4 @@ class Manager(object):
     # HyperLogLog operations
 
     pfadd = RedisCall(['key'], vararg='values')
-    pfcount = RedisCall(['key'])
+    pfcount = RedisCall(['key'], vararg='keys', key_args=['key', 'keys'])
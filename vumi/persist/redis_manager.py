@@ -47,6 +47,17 @@ class VumiRedis(redis.Redis):
             cursor = None
         return (cursor, keys)
 
+    def pipeline(self, transaction=True, shard_hint=None):
+        return VumiPipeline(
+            self.connection_pool, self.response_callbacks, transaction,
+            shard_hint)
+
+
+class VumiPipeline(redis.client.BasePipeline, VumiRedis):
+    """
+    Pipeline with the same API customisations as :class:`VumiRedis`.
+    """
+
 
 class RedisManager(Manager):
 
@@ -99,3 +110,49 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def pipeline(self):
+        """
+        Return a :class:`RedisPipeline` that queues calls made through it
+        and sends them all to the server in a single round-trip when its
+        ``execute()`` method is called.
+        """
+        return RedisPipeline(self)
+
+
+class RedisPipeline(Manager):
+    """
+    A (non-transactional) pipeline of calls to a :class:`RedisManager`.
+
+    Calls return nothing useful. :meth:`execute` sends all the queued calls to
+    the server and returns a list of their results, filtered and with key
+    prefixes stripped in the same way as calls made through the manager.
+    Only single redis calls can be pipelined, not manager methods that are
+    implemented in terms of several calls.
+    """
+
+    def __init__(self, manager):
+        super(RedisPipeline, self).__init__(
+            manager._client.pipeline(transaction=False), manager._config,
+            manager._key_prefix, key_separator=manager._key_separator)
+        self.RESPONSE_ERROR = manager.RESPONSE_ERROR
+        self._filters = []
+
+    def __len__(self):
+        return len(self._filters)
+
+    def _make_redis_call(self, call, *args, **kw):
+        getattr(self._client, call)(*args, **kw)
+        self._filters.append(None)
+
+    def _filter_redis_results(self, func, results):
+        self._filters[-1] = func
+
+    def execute(self):
+        """
+        Send all the queued calls and return a list of their results.
+        """
+        filters, self._filters = self._filters, []
+        results = self._client.execute()
+        return [result if func is None else func(result)
+                for func, result in zip(filters, results)]
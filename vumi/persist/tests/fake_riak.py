@@ -0,0 +1,264 @@
+"""
+A fake Riak node that implements enough of Riak's HTTP interface to test
+:mod:`vumi.persist.txriak_http` without a real Riak server.
+"""
+
+import csv
+import json
+from email.utils import formatdate
+from urllib import unquote_plus
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+
+class FakeRiakObject(object):
+    def __init__(self, key):
+        self.key = key
+        self.data = ''
+        self.content_type = 'application/json'
+        self.indexes = []
+        self.usermeta = {}
+        self.version = 0
+        self.last_modified = None
+
+    def update(self, headers, data):
+        self.data = data
+        self.indexes = []
+        self.usermeta = {}
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-type':
+                self.content_type = value
+            elif name.startswith('x-riak-index-'):
+                field = name[len('x-riak-index-'):]
+                for line in csv.reader([value], skipinitialspace=True):
+                    for token in line:
+                        if field.endswith('_int'):
+                            token = int(token)
+                        self.indexes.append((field, token))
+            elif name.startswith('x-riak-meta-'):
+                self.usermeta[name[len('x-riak-meta-'):]] = value
+        self.version += 1
+        self.last_modified = formatdate(usegmt=True)
+
+    def write_to(self, request):
+        request.setHeader('Content-Type', self.content_type)
+        request.setHeader(
+            'X-Riak-Vclock',
+            ('vclock%s' % (self.version,)).encode('base64').strip())
+        request.setHeader('Last-Modified', self.last_modified)
+        request.setHeader('ETag', '"%s"' % (self.version,))
+        fields = {}
+        for field, value in self.indexes:
+            fields.setdefault(field, []).append(str(value))
+        for field, values in fields.items():
+            request.setHeader('X-Riak-Index-%s' % (field,), ', '.join(values))
+        for key, value in self.usermeta.items():
+            request.setHeader('X-Riak-Meta-%s' % (key,), value)
+        return self.data
+
+
+class FakeRiak(Resource):
+    """
+    A fake Riak node's HTTP interface.
+
+    Supports object operations, secondary index queries (including
+    pagination), bucket and key listing, bucket properties, legacy search
+    queries of the form ``field:value`` and map reduce jobs with no phases or
+    only ``reduce_identity`` phases. Streamed map reduce results are sent one
+    result per part.
+
+    :ivar list mapred_jobs:
+        Map reduce jobs received, decoded from JSON.
+    :ivar str mapred_error:
+        If set, map reduce requests fail with this as the response body.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.buckets = {}
+        self.bucket_props = {}
+        self.mapred_jobs = []
+        self.mapred_error = None
+
+    def render(self, request):
+        segments = [unquote_plus(s) for s in request.path.split('/')[1:]]
+        handler = {
+            'buckets': self.render_buckets,
+            'mapred': self.render_mapred,
+            'solr': self.render_solr,
+        }.get(segments[0])
+        if handler is None:
+            return self.respond(request, 404, 'not found')
+        return handler(request, segments[1:])
+
+    def respond(self, request, code, body='', json_data=None):
+        request.setResponseCode(code)
+        if json_data is not None:
+            request.setHeader('Content-Type', 'application/json')
+            body = json.dumps(json_data)
+        return body
+
+    def arg(self, request, name, default=None):
+        return request.args.get(name, [default])[0]
+
+    def render_buckets(self, request, segments):
+        if not segments:
+            buckets = [name for name, objs in self.buckets.items() if objs]
+            return self.respond(request, 200, json_data={'buckets': buckets})
+        bucket_name, segments = segments[0], segments[1:]
+        resource = segments[0] if segments else None
+        if resource == 'props':
+            return self.render_props(request, bucket_name)
+        if resource == 'index':
+            return self.render_index(request, bucket_name, *segments[1:])
+        if resource == 'keys' and len(segments) == 2:
+            return self.render_object(request, bucket_name, segments[1])
+        if resource == 'keys' and request.method == 'GET':
+            keys = self.buckets.get(bucket_name, {}).keys()
+            return self.respond(request, 200, json_data={'keys': keys})
+        return self.respond(request, 404, 'not found')
+
+    def render_props(self, request, bucket_name):
+        if request.method == 'GET':
+            props = self.bucket_props.get(bucket_name, {})
+            return self.respond(request, 200, json_data={'props': props})
+        if request.method == 'PUT':
+            props = json.loads(request.content.read())['props']
+            self.bucket_props.setdefault(bucket_name, {}).update(props)
+            return self.respond(request, 204)
+        if request.method == 'DELETE':
+            self.bucket_props.pop(bucket_name, None)
+            return self.respond(request, 204)
+        return self.respond(request, 405)
+
+    def render_object(self, request, bucket_name, key):
+        bucket = self.buckets.setdefault(bucket_name, {})
+        if request.method == 'GET':
+            if key not in bucket:
+                return self.respond(request, 404, 'not found\n')
+            return bucket[key].write_to(request)
+        if request.method == 'PUT':
+            obj = bucket.setdefault(key, FakeRiakObject(key))
+            obj.update(
+                [(name, ', '.join(values)) for name, values
+                 in request.requestHeaders.getAllRawHeaders()],
+                request.content.read())
+            if self.arg(request, 'returnbody') == 'true':
+                return obj.write_to(request)
+            return self.respond(request, 204)
+        if request.method == 'DELETE':
+            if bucket.pop(key, None) is None:
+                return self.respond(request, 404, 'not found\n')
+            return self.respond(request, 204)
+        return self.respond(request, 405)
+
+    def index_entries(self, bucket_name, index, start, end=None):
+        """
+        Return a sorted list of ``(term, key)`` pairs matching an index query.
+        """
+        bucket = self.buckets.get(bucket_name, {})
+        if index.endswith('_int'):
+            start = int(start)
+            end = int(end) if end is not None else None
+        if end is None:
+            end = start
+        entries = []
+        for key, obj in bucket.items():
+            if index == '$bucket':
+                entries.append((key, key))
+                continue
+            if index == '$key':
+                values = [key]
+            else:
+                values = [v for field, v in obj.indexes if field == index]
+            entries.extend((v, key) for v in values if start <= v <= end)
+        return sorted(entries)
+
+    def render_index(self, request, bucket_name, index, start, end=None):
+        entries = self.index_entries(bucket_name, index, start, end)
+        continuation = self.arg(request, 'continuation')
+        if continuation is not None:
+            last = tuple(json.loads(continuation.decode('base64')))
+            entries = [entry for entry in entries if entry > last]
+        response = {}
+        max_results = self.arg(request, 'max_results')
+        if max_results is not None and len(entries) > int(max_results):
+            entries = entries[:int(max_results)]
+            response['continuation'] = json.dumps(
+                entries[-1]).encode('base64').strip()
+        if self.arg(request, 'return_terms') == 'true':
+            response['results'] = [{str(term): key} for term, key in entries]
+        else:
+            response['keys'] = [key for _, key in entries]
+        return self.respond(request, 200, json_data=response)
+
+    def mapred_inputs(self, inputs):
+        if isinstance(inputs, list):
+            return [[entry[0], entry[1]] for entry in inputs]
+        if 'index' in inputs:
+            start = inputs.get('key', inputs.get('start'))
+            entries = self.index_entries(
+                inputs['bucket'], inputs['index'], start, inputs.get('end'))
+            return [[inputs['bucket'], key] for _, key in entries]
+        return [[inputs['bucket'], key]
+                for key in self.buckets.get(inputs['bucket'], {})]
+
+    def render_mapred(self, request, segments):
+        job = json.loads(request.content.read())
+        self.mapred_jobs.append(job)
+        if self.mapred_error is not None:
+            return self.respond(request, 500, self.mapred_error)
+        for phase in job['query']:
+            [(phase_type, spec)] = phase.items()
+            if spec.get('function') != 'reduce_identity':
+                return self.respond(
+                    request, 500, json_data={'error': 'unsupported phase'})
+        results = self.mapred_inputs(job['inputs'])
+        if self.arg(request, 'chunked') == 'true':
+            return self.stream_mapred(request, len(job['query']) - 1, results)
+        return self.respond(request, 200, json_data=results)
+
+    def stream_mapred(self, request, phase, results):
+        boundary = 'fakeriakboundary'
+        request.setHeader(
+            'Content-Type', 'multipart/mixed; boundary=%s' % (boundary,))
+        for result in results:
+            request.write('\r\n--%s\r\nContent-Type: application/json\r\n'
+                          '\r\n%s' % (boundary, json.dumps({
+                              'phase': max(phase, 0), 'data': [result]})))
+        request.write('\r\n--%s--\r\n' % (boundary,))
+        request.finish()
+        return NOT_DONE_YET
+
+    def render_solr(self, request, segments):
+        bucket_name = segments[0]
+        field, _, value = self.arg(request, 'q').partition(':')
+        keys = []
+        if self.bucket_props.get(bucket_name, {}).get('search'):
+            for key, obj in sorted(self.buckets.get(bucket_name, {}).items()):
+                if str(json.loads(obj.data).get(field)) == value:
+                    keys.append(key)
+        start = int(self.arg(request, 'start', 0))
+        rows = int(self.arg(request, 'rows', 10))
+        docs = [{'id': key, 'index': bucket_name, 'fields': {}, 'props': {}}
+                for key in keys[start:start + rows]]
+        return self.respond(request, 200, json_data={'response': {
+            'numFound': len(keys), 'start': start, 'maxScore': '0.0',
+            'docs': docs}})
+
+
+def start_fake_riak(fake_riak=None):
+    """
+    Start a :class:`FakeRiak` listening on a local port.
+
+    :returns: A ``(fake_riak, listening_port)`` tuple.
+    """
+    if fake_riak is None:
+        fake_riak = FakeRiak()
+    port = reactor.listenTCP(0, Site(fake_riak), interface='127.0.0.1')
+    return fake_riak, port
@@ -273,6 +273,17 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(redis, 0.1, 'zscore', 'set', 'one')
         yield self.assert_redis_op(redis, 0.2, 'zscore', 'set', 'two')
 
+    @inlineCallbacks
+    def test_zincrby(self):
+        redis = yield self.get_redis()
+        yield redis.zadd('set', one=1.5)
+        yield self.assert_redis_op(redis, 4.0, 'zincrby', 'set', 'one', 2.5)
+        yield self.assert_redis_op(redis, 4.0, 'zscore', 'set', 'one')
+        yield self.assert_redis_op(redis, 1.0, 'zincrby', 'set', 'two')
+        yield self.assert_redis_op(
+            redis, [('two', 1.0), ('one', 4.0)],
+            'zrange', 'set', 0, -1, withscores=True)
+
     @inlineCallbacks
     def test_hgetall_returns_copy(self):
         redis = yield self.get_redis()
@@ -500,6 +511,26 @@ class FakeRedisTestMixin(object):
         yield redis.hset("hash_key", "a", 1.0)
         yield self.assert_redis_op(redis, 'hash', 'type', 'hash_key')
 
+    @inlineCallbacks
+    def test_dump_restore(self):
+        redis = yield self.get_redis()
+        yield self.assert_redis_op(redis, None, 'dump', 'unknown_key')
+        yield redis.zadd("zset_key", a=1.0, b=2.0)
+        dumped = yield redis.dump("zset_key")
+        yield self.assert_redis_op(
+            redis, True, 'restore', 'zset_copy', 0, dumped)
+        yield self.assert_redis_op(
+            redis, [('a', 1.0), ('b', 2.0)], 'zrange', 'zset_copy', 0, -1,
+            withscores=True)
+        # Changing the copy doesn't change the original.
+        yield redis.zadd("zset_copy", c=3.0)
+        yield self.assert_redis_op(redis, 2, 'zcard', 'zset_key')
+        yield self.assert_redis_op(
+            redis, True, 'restore', 'temp_copy', 10000, dumped)
+        yield self.assert_redis_op(redis, 10, 'ttl', 'temp_copy')
+        yield self.assert_redis_error(
+            redis, 'restore', 'zset_copy', 0, dumped)
+
     @inlineCallbacks
     def test_charset_encoding_default(self):
         # Redis client assumes utf-8
@@ -549,6 +580,16 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(redis, 0, 'pfadd', 'hll2', 'a', 'b')
         yield self.assert_redis_op(redis, 2, 'pfcount', 'hll2')
 
+    @inlineCallbacks
+    def test_pfcount_multiple_keys(self):
+        redis = yield self.get_redis()
+        yield redis.pfadd('hll1', 'a', 'b')
+        yield redis.pfadd('hll2', 'b', 'c')
+        yield self.assert_redis_op(redis, 3, 'pfcount', 'hll1', 'hll2')
+        yield self.assert_redis_op(
+            redis, 3, 'pfcount', 'hll1', 'hll2', 'missing')
+        yield self.assert_redis_op(redis, 0, 'pfcount', 'missing')
+
 
 class FakeRedisUnverifiedTestMixin(object):
     """
@@ -954,6 +954,65 @@ class TestVumiMessage(VumiTestCase):
         self.assertTrue(cache_attr not in m2.msg)
         self.assertEqual(m2.msg, m1.msg)
 
+    @needs_riak
+    @Manager.calls_manager
+    def test_vumimessage_field_cached(self):
+        """
+        The decoded message is cached until the field is set.
+        """
+        msg_helper = self.add_helper(MessageHelper())
+        msg_model = self.manager.proxy(self.VumiMessageModel)
+        yield msg_model("foo", msg=msg_helper.make_inbound("foo")).save()
+
+        m1 = yield msg_model.load("foo")
+        self.assertTrue(m1.msg is m1.msg)
+
+        msg2 = msg_helper.make_inbound("bar")
+        m1.msg = msg2
+        self.assertEqual(m1.msg, msg2)
+        self.assertFalse(m1.msg is msg2)
+        self.assertTrue(m1.msg is m1.msg)
+
+    @needs_riak
+    @Manager.calls_manager
+    def test_vumimessage_field_changes_saved(self):
+        """
+        Changes made to the returned message are written back when the model
+        is saved.
+        """
+        msg_helper = self.add_helper(MessageHelper())
+        msg_model = self.manager.proxy(self.VumiMessageModel)
+        yield msg_model("foo", msg=msg_helper.make_inbound("foo")).save()
+
+        m1 = yield msg_model.load("foo")
+        m1.msg["content"] = "changed"
+        m1.msg["helper_metadata"]["extra"] = {"a": 1}
+        field_changes = watch_model_changes(m1)
+        yield m1.save()
+        self.assertEqual(set(field_changes), set(["msg"]))
+        self.assertEqual(m1.get_data()["msg.content"], "changed")
+
+        m2 = yield msg_model.load("foo")
+        self.assertEqual(m2.msg, m1.msg)
+        self.assertEqual(m2.msg["content"], "changed")
+        self.assertEqual(m2.msg["helper_metadata"]["extra"], {"a": 1})
+
+    @needs_riak
+    @Manager.calls_manager
+    def test_vumimessage_field_unchanged_not_rewritten(self):
+        """
+        Reading the message doesn't change the model data when it is saved.
+        """
+        msg_helper = self.add_helper(MessageHelper())
+        msg_model = self.manager.proxy(self.VumiMessageModel)
+        yield msg_model("foo", msg=msg_helper.make_inbound("foo")).save()
+
+        m1 = yield msg_model.load("foo")
+        self.assertEqual(m1.msg["content"], "foo")
+        field_changes = watch_model_changes(m1)
+        yield m1.save()
+        self.assertEqual(field_changes, [])
+
 
 class ReferencedModel(Model):
     """
@@ -72,3 +72,31 @@ class TestRedisManager(VumiTestCase):
         self.manager.setex("key-ttl", 30, "value")
         ttl = self.manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
+
+    def test_set_nx_ex(self):
+        self.assertEqual(self.manager.set("lock", "a", ex=30, nx=True), True)
+        self.assertEqual(self.manager.set("lock", "b", ex=30, nx=True), None)
+        self.assertEqual(self.manager.get("lock"), "a")
+        ttl = self.manager.ttl("lock")
+        self.assertTrue(10 <= ttl <= 30)
+
+    def test_pipeline(self):
+        self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.get('foo')
+        pipe.set('baz', 'quux')
+        pipe.keys()
+        pipe.rpush('list', 'a')
+        self.assertEqual(len(pipe), 4)
+        # Nothing is sent until we execute the pipeline.
+        self.assertEqual(self.manager.get('baz'), None)
+        [foo, set_result, keys, list_len] = pipe.execute()
+        self.assertEqual(
+            (foo, set_result, sorted(keys), list_len),
+            ('bar', True, ['baz', 'foo'], 1))
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual(self.manager.get('baz'), 'quux')
+        self.assertEqual(self.manager.lrange('list', 0, -1), ['a'])
+
+    def test_pipeline_empty(self):
+        self.assertEqual(self.manager.pipeline().execute(), [])
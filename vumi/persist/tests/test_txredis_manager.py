@@ -107,6 +107,17 @@ class TestTxRedisManager(VumiTestCase):
         ttl = yield manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
 
+    @inlineCallbacks
+    def test_set_nx_ex(self):
+        manager = yield self.get_manager()
+        locked = yield manager.set("lock", "a", ex=30, nx=True)
+        self.assertEqual(locked, True)
+        locked = yield manager.set("lock", "b", ex=30, nx=True)
+        self.assertEqual(locked, None)
+        self.assertEqual((yield manager.get("lock")), "a")
+        ttl = yield manager.ttl("lock")
+        self.assertTrue(10 <= ttl <= 30)
+
     @skip_fake_redis
     @inlineCallbacks
     def test_reconnect_sub_managers(self):
@@ -0,0 +1,194 @@
+"""Tests for vumi.persist.txriak_http."""
+
+from twisted.internet.defer import inlineCallbacks, gatherResults
+
+from vumi.persist.model import Manager
+from vumi.persist.tests.test_txriak_manager import (
+    CommonRiakManagerTests, CommonTxRiakManagerTests, DummyModel)
+from vumi.tests.helpers import VumiTestCase, import_skip
+
+
+class TestTxRiakHttpManager(CommonRiakManagerTests, CommonTxRiakManagerTests,
+                            VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        try:
+            from riak import RiakError
+            from vumi.persist.txriak_http import TxRiakHttpManager
+            from vumi.persist.tests.fake_riak import start_fake_riak
+        except ImportError, e:
+            import_skip(e, 'riak', 'riak')
+        self.RiakError = RiakError
+        self.fake_riak, port = start_fake_riak()
+        self.add_cleanup(port.stopListening)
+        self.config = {
+            'bucket_prefix': 'test.',
+            'transport_type': 'txhttp',
+            'port': port.getHost().port,
+        }
+        self.manager = TxRiakHttpManager.from_config(self.config)
+        self.add_cleanup(self.manager.close_manager)
+        self.add_cleanup(self.manager.purge_all)
+        yield self.manager.purge_all()
+
+    def test_call_decorator(self):
+        self.assertEqual(type(self.manager).call_decorator, inlineCallbacks)
+
+    def test_transport_class(self):
+        self.assertEqual(self.manager.client.protocol, 'txhttp')
+
+    def test_from_config_via_txriak_manager(self):
+        from vumi.persist.txriak_manager import TxRiakManager
+        manager = TxRiakManager.from_config(self.config)
+        self.assertEqual(type(manager), type(self.manager))
+        self.assertEqual(manager.client.protocol, 'txhttp')
+
+    def test_from_config_with_max_connections(self):
+        manager = type(self.manager).from_config({
+            'bucket_prefix': 'test.',
+            'max_connections': 3,
+        })
+        self.assertEqual(manager.client._transport.max_connections, 3)
+
+    @Manager.calls_manager
+    def test_run_riak_map_reduce_with_timeout(self):
+        # The fake Riak server can't run Javascript, so we make it fail the
+        # way Riak does when a job times out.
+        self.fake_riak.mapred_error = '{"error":"timeout"}'
+        parent = super(TestTxRiakHttpManager, self)
+        yield parent.test_run_riak_map_reduce_with_timeout()
+        [job] = self.fake_riak.mapred_jobs
+        self.assertEqual(job['timeout'], 10)
+
+    @Manager.calls_manager
+    def test_stream_riak_map_reduce(self):
+        for i in range(3):
+            dummy = self.mkdummy(str(i), {"a": i})
+            dummy.add_index('test_index_bin', 'test_key')
+            yield self.manager.store(dummy)
+
+        mr = self.manager.riak_map_reduce()
+        mr.index('test.dummy_model', 'test_index_bin', 'test_key')
+        parts = []
+        yield mr.stream(lambda phase, data: parts.append((phase, data)))
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(set(phase for phase, _ in parts), set([0]))
+        self.assertEqual(
+            sorted(data[0][1] for _, data in parts), ['0', '1', '2'])
+        [job] = self.fake_riak.mapred_jobs
+        self.assertFalse('timeout' in job)
+
+    @Manager.calls_manager
+    def test_stream_riak_map_reduce_with_timeout(self):
+        mr = self.manager.riak_map_reduce()
+        mr.index('test.dummy_model', 'test_index_bin', 'test_key')
+        yield mr.stream(lambda phase, data: None, timeout=10)
+        [job] = self.fake_riak.mapred_jobs
+        self.assertEqual(job['timeout'], 10)
+
+    @Manager.calls_manager
+    def test_stream_riak_map_reduce_error(self):
+        self.fake_riak.mapred_error = '{"error":"timeout"}'
+        mr = self.manager.riak_map_reduce()
+        mr.index('test.dummy_model', 'test_index_bin', 'test_key')
+        try:
+            yield mr.stream(lambda phase, data: None)
+        except self.RiakError as e:
+            self.assertTrue('timeout' in str(e))
+        else:
+            self.fail("Expected RiakError.")
+
+    @Manager.calls_manager
+    def test_stream_riak_map_reduce_callback_error(self):
+        for i in range(2):
+            dummy = self.mkdummy(str(i), {"a": i})
+            dummy.add_index('test_index_bin', 'test_key')
+            yield self.manager.store(dummy)
+
+        def callback(phase, data):
+            raise ValueError("bad")
+
+        mr = self.manager.riak_map_reduce()
+        mr.index('test.dummy_model', 'test_index_bin', 'test_key')
+        try:
+            yield mr.stream(callback)
+        except ValueError:
+            pass
+        else:
+            self.fail("Expected ValueError.")
+        # The connection is freed for other requests.
+        transport = self.manager.client._transport
+        self.assertEqual(transport.in_flight, 0)
+
+    @Manager.calls_manager
+    def test_store_and_load_indexes(self):
+        dummy1 = self.mkdummy("foo", {"a": 1})
+        dummy1.add_index('test_index_bin', 'value1')
+        dummy1.add_index('test_index_bin', 'value2')
+        dummy1.add_index('count_int', 5)
+        yield self.manager.store(dummy1)
+
+        dummy2 = yield self.manager.load(DummyModel, "foo")
+        self.assertEqual(sorted(dummy2._riak_object.get_indexes()), [
+            ('count_int', 5),
+            ('test_index_bin', 'value1'),
+            ('test_index_bin', 'value2'),
+        ])
+
+    @Manager.calls_manager
+    def test_index_keys_page(self):
+        for i in range(5):
+            dummy = self.mkdummy("key%s" % (i,), {"a": i})
+            dummy.add_index('test_index_bin', 'value%s' % (i,))
+            yield self.manager.store(dummy)
+
+        page1 = yield self.manager.index_keys_page(
+            DummyModel, 'test_index_bin', 'value1', 'value4', max_results=2,
+            return_terms=True)
+        self.assertEqual(list(page1), [
+            (u'value1', u'key1'), (u'value2', u'key2')])
+        self.assertTrue(page1.has_next_page())
+        page2 = yield page1.next_page()
+        self.assertEqual(list(page2), [
+            (u'value3', u'key3'), (u'value4', u'key4')])
+        self.assertFalse(page2.has_next_page())
+        self.assertEqual((yield page2.next_page()), None)
+
+    @Manager.calls_manager
+    def test_index_keys_exact_match(self):
+        for i in range(3):
+            dummy = self.mkdummy("key%s" % (i,), {"a": i})
+            dummy.add_index('test_index_bin', 'value%s' % (i % 2,))
+            yield self.manager.store(dummy)
+        keys = yield self.manager.index_keys(
+            DummyModel, 'test_index_bin', 'value0')
+        self.assertEqual(sorted(keys), [u'key0', u'key2'])
+
+    @Manager.calls_manager
+    def test_real_search(self):
+        yield self.manager.riak_enable_search(DummyModel)
+        for i in range(3):
+            yield self.manager.store(self.mkdummy("key%s" % (i,), {"a": i}))
+        keys = yield self.manager.real_search(DummyModel, 'a:1')
+        self.assertEqual(keys, [u'key1'])
+
+    @Manager.calls_manager
+    def test_concurrent_requests_limited(self):
+        manager = type(self.manager).from_config(
+            dict(self.config, max_connections=2))
+        self.add_cleanup(manager.close_manager)
+        transport = manager.client._transport
+        stores = []
+        for i in range(5):
+            dummy = DummyModel(manager, "key%s" % (i,))
+            dummy.set_riak(manager.riak_object(dummy, dummy.key))
+            stores.append(manager.store(dummy))
+        self.assertEqual(transport.in_flight, 2)
+        self.assertEqual(transport.waiting, 3)
+        yield gatherResults(stores)
+        self.assertEqual(transport.in_flight, 0)
+        self.assertEqual(transport.waiting, 0)
+        keys = yield self.manager.index_keys(
+            DummyModel, '$bucket', self.manager.bucket_name(DummyModel), None)
+        self.assertEqual(len(keys), 5)
@@ -1,6 +1,9 @@
 """Tests for vumi.persist.txriak_manager."""
 
-from twisted.internet.defer import inlineCallbacks
+import threading
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, DeferredSemaphore)
 
 from vumi.persist.model import Manager, VumiRiakError
 from vumi.tests.helpers import VumiTestCase, import_skip
@@ -334,7 +337,92 @@ class CommonRiakManagerTests(object):
                 "Expected VumiRiakError using closed manager, nothing raised.")
 
 
-class TestTxRiakManager(CommonRiakManagerTests, VumiTestCase):
+class CommonTxRiakManagerTests(object):
+    """Common tests for async Riak managers.
+
+    Tests assume self.manager is set to a suitable async Riak manager.
+    """
+
+    def test_from_config_with_load_concurrency(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'load_concurrency': 3,
+                                           })
+        self.assertEqual(manager._load_limiter.limit, 3)
+
+    def test_sub_manager_shares_load_limiter(self):
+        sub_manager = self.manager.sub_manager("foo.")
+        self.assertIdentical(
+            sub_manager._load_limiter, self.manager._load_limiter)
+
+    @inlineCallbacks
+    def store_dummies(self, count):
+        keys = []
+        for i in range(count):
+            dummy = self.mkdummy("key%s" % (i,), {"a": i})
+            yield self.manager.store(dummy)
+            keys.append(dummy.key)
+        returnValue(keys)
+
+    def track_loads(self):
+        loads = {'in_flight': 0, 'max_in_flight': 0, 'started': []}
+        load = self.manager.load
+
+        def tracking_load(modelcls, key, result=None):
+            loads['started'].append(key)
+            loads['in_flight'] += 1
+            loads['max_in_flight'] = max(
+                loads['max_in_flight'], loads['in_flight'])
+            d = load(modelcls, key, result)
+            d.addBoth(lambda r: loads.update(
+                in_flight=loads['in_flight'] - 1) or r)
+            return d
+
+        self.manager.load = tracking_load
+        return loads
+
+    @inlineCallbacks
+    def test_load_all_bunches_ordered(self):
+        keys = yield self.store_dummies(5)
+        self.manager.load_bunch_size = 2
+        keys.insert(2, "unknown")
+
+        result_keys = []
+        for result_bunch in self.manager.load_all_bunches(DummyModel, keys):
+            bunch = yield result_bunch
+            result_keys.extend(result.key for result in bunch)
+        self.assertEqual(result_keys, [k for k in keys if k != "unknown"])
+
+    @inlineCallbacks
+    def test_load_all_bunches_concurrency_limited(self):
+        keys = yield self.store_dummies(6)
+        self.manager._load_limiter = DeferredSemaphore(2)
+        loads = self.track_loads()
+
+        [bunch] = self.manager.load_all_bunches(DummyModel, keys)
+        self.assertEqual(loads['in_flight'], 2)
+        results = yield bunch
+        self.assertEqual(len(results), 6)
+        self.assertEqual(loads['max_in_flight'], 2)
+
+    @inlineCallbacks
+    def test_load_all_bunches_reads_ahead(self):
+        keys = yield self.store_dummies(6)
+        self.manager.load_bunch_size = 2
+        loads = self.track_loads()
+
+        bunches = self.manager.load_all_bunches(DummyModel, keys)
+        first = yield bunches.next()
+        self.assertEqual([obj.key for obj in first], keys[:2])
+        # The second bunch started loading when the first was handed out.
+        self.assertEqual(loads['started'], keys[:4])
+        rest = yield gatherResults(list(bunches))
+        self.assertEqual(
+            [obj.key for bunch in rest for obj in bunch], keys[2:])
+
+
+class TestTxRiakManager(CommonRiakManagerTests, CommonTxRiakManagerTests,
+                        VumiTestCase):
 
     @inlineCallbacks
     def setUp(self):
@@ -371,3 +459,145 @@ class TestTxRiakManager(CommonRiakManagerTests, VumiTestCase):
             'bucket_prefix': 'test.',
             })
         self.assertEqual(manager.client.protocol, 'http')
+
+    def test_from_config_with_threadpool_size(self):
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({
+            'bucket_prefix': 'test.',
+            'threadpool_size': 4,
+            })
+        self.add_cleanup(manager.close_manager)
+        self.assertEqual(manager.client.threadpool.size, 4)
+        self.assertEqual(
+            type(manager.client._raw_client._http_pool).__name__,
+            'ThreadLocalPool')
+
+    def test_from_config_without_threadpool_size(self):
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({'bucket_prefix': 'test.'})
+        self.assertFalse(manager.client.threadpool.dedicated)
+
+    @Manager.calls_manager
+    def test_threadpool_metrics(self):
+        threadpool = self.manager.client.threadpool
+        threadpool.snapshot()
+        yield self.manager.store(self.mkdummy("foo", {"a": 1}))
+        yield self.manager.load(DummyModel, "foo")
+        metrics = threadpool.snapshot()
+        self.assertEqual(metrics['in_flight'], 0)
+        self.assertEqual(metrics['queued'], 0)
+        self.assertEqual(metrics['operations']['store']['count'], 1)
+        self.assertEqual(metrics['operations']['reload']['count'], 1)
+
+
+class TestRiakThreadPool(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import (
+                RiakThreadPool, ThreadLocalPool)
+        except ImportError, e:
+            import_skip(e, 'riak', 'riak')
+        self.RiakThreadPool = RiakThreadPool
+        self.ThreadLocalPool = ThreadLocalPool
+
+    def make_threadpool(self, size=None):
+        threadpool = self.RiakThreadPool(size)
+        self.add_cleanup(threadpool.stop)
+        return threadpool
+
+    @inlineCallbacks
+    def test_run(self):
+        threadpool = self.make_threadpool()
+        result = yield threadpool.run('add', lambda a, b: a + b, 1, b=2)
+        self.assertEqual(result, 3)
+        self.assertEqual(threadpool._threadpool, None)
+
+    @inlineCallbacks
+    def test_run_dedicated(self):
+        threadpool = self.make_threadpool(2)
+        self.assertEqual(threadpool._threadpool, None)
+        thread_name = yield threadpool.run(
+            'name', lambda: threading.current_thread().name)
+        self.assertTrue('riak' in thread_name)
+        self.assertEqual(threadpool._threadpool.max, 2)
+        threadpool.stop()
+        self.assertEqual(threadpool._threadpool, None)
+
+    @inlineCallbacks
+    def test_run_error(self):
+        threadpool = self.make_threadpool()
+
+        def fail():
+            raise ValueError("bad")
+
+        yield self.assertFailure(threadpool.run('fail', fail), ValueError)
+        metrics = threadpool.snapshot()
+        self.assertEqual(metrics['in_flight'], 0)
+        self.assertEqual(metrics['operations']['fail']['count'], 1)
+
+    @inlineCallbacks
+    def test_snapshot(self):
+        threadpool = self.make_threadpool(1)
+        self.assertEqual(threadpool.snapshot(), {
+            'threads': 1,
+            'queued': 0,
+            'in_flight': 0,
+            'p95_queue_wait': None,
+            'max_queue_wait': None,
+            'operations': {},
+        })
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        d1 = threadpool.run('block', block)
+        d2 = threadpool.run('noop', lambda: None)
+        started.wait()
+        metrics = threadpool.snapshot()
+        self.assertEqual(metrics['in_flight'], 1)
+        self.assertEqual(metrics['queued'], 1)
+        release.set()
+        yield gatherResults([d1, d2])
+
+        metrics = threadpool.snapshot()
+        self.assertEqual(metrics['in_flight'], 0)
+        self.assertEqual(metrics['queued'], 0)
+        self.assertEqual(
+            sorted(metrics['operations'].keys()), ['block', 'noop'])
+        self.assertEqual(metrics['operations']['block']['count'], 1)
+        self.assertTrue(metrics['max_queue_wait'] >= 0)
+        self.assertEqual(threadpool.snapshot()['operations'], {})
+
+    @inlineCallbacks
+    def test_thread_local_pool(self):
+        made = []
+
+        def make_pool():
+            pool = [len(made)]
+            made.append(pool)
+            return pool
+
+        local_pool = self.ThreadLocalPool(make_pool)
+        threadpool = self.make_threadpool(2)
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_pool(block):
+            pool = local_pool._pool()
+            if block:
+                started.set()
+                release.wait()
+            return pool
+
+        d1 = threadpool.run('get_pool', get_pool, True)
+        started.wait()
+        pool2 = yield threadpool.run('get_pool', get_pool, False)
+        release.set()
+        pool1 = yield d1
+        self.assertNotEqual(pool1, pool2)
+        self.assertEqual(sorted(local_pool), [0, 1])
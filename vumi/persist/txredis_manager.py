@@ -94,8 +94,19 @@ class VumiRedis(txr.Redis):
         self._send('LPOP', key)
         return self.getResponse()
 
-    def set(self, key, value, *args, **kw):
-        d = super(VumiRedis, self).set(key, value, *args, **kw)
+    def set(self, key, value, ex=None, nx=False, *args, **kw):
+        if ex is None and not nx:
+            d = super(VumiRedis, self).set(key, value, *args, **kw)
+        else:
+            # txredis's set() can't combine an expiry with NX, so we send the
+            # command ourselves.
+            command = ['SET', key, value]
+            if ex is not None:
+                command.extend(['EX', ex])
+            if nx:
+                command.append('NX')
+            self._send(*command)
+            d = self.getResponse()
         d.addCallback(self._ok_to_true)
         return d
 
@@ -122,17 +133,17 @@ class VumiRedis(txr.Redis):
                                  "values and scores")
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
-        orig_zadd = super(VumiRedis, self).zadd
-        d = succeed(0)
-
-        def do_zadd(s, key, member, score):
-            d = orig_zadd(key, member, score)
-            d.addCallback(lambda r: r + s)
-            return d
-
+        if not pieces:
+            return succeed(0)
+        if len(pieces) == 1:
+            [(member, score)] = pieces
+            return super(VumiRedis, self).zadd(key, member, score)
+        # Add all the members with a single variadic ZADD. txredis expects
+        # score, member pairs for this form.
+        score_members = []
         for member, score in pieces:
-            d.addCallback(do_zadd, key, member, score)
-        return d
+            score_members.extend([score, member])
+        return super(VumiRedis, self).zadd(key, *score_members)
 
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
@@ -147,6 +158,11 @@ class VumiRedis(txr.Redis):
             d.addCallback(lambda r: [(v, score_cast_func(s)) for v, s in r])
         return d
 
+    def zincrby(self, key, value, amount=1):
+        d = self.zincr(key, value, amount)
+        d.addCallback(float)
+        return d
+
     def scan(self, cursor, match=None, count=None):
         """
         Scan through all the keys in the database returning those that
@@ -195,6 +211,24 @@ class VumiRedis(txr.Redis):
         d.addCallback(lambda r: r if r is not None else 'none')
         return d
 
+    # txredis doesn't implement this.
+    def dump(self, key):
+        """
+        Return a serialized version of the value stored at the given key, or
+        ``None`` if the key doesn't exist.
+        """
+        self._send('DUMP', key)
+        return self.getResponse()
+
+    # txredis doesn't implement this.
+    def restore(self, key, ttl, value):
+        """
+        Create a key from a value serialized with :meth:`dump`, expiring after
+        ``ttl`` milliseconds if ``ttl`` is not zero.
+        """
+        self._send('RESTORE', key, ttl, value)
+        return self.getResponse().addCallback(self._ok_to_true)
+
     # txredis doesn't implement this.
     def pfadd(self, key, *values):
         """
@@ -208,15 +242,16 @@ class VumiRedis(txr.Redis):
         return self.getResponse()
 
     # txredis doesn't implement this.
-    def pfcount(self, key):
+    def pfcount(self, key, *keys):
         """
-        Return the approximate cardinality of the HyperLogLog at the given key.
+        Return the approximate cardinality of the HyperLogLog at the given key
+        or of the union of the HyperLogLogs at all the given keys.
 
         .. note::
 
            Requires redis server 2.8.9 or later.
         """
-        self._send('PFCOUNT', key)
+        self._send('PFCOUNT', key, *keys)
         return self.getResponse()
 
 
@@ -0,0 +1,611 @@
+# -*- test-case-name: vumi.persist.tests.test_txriak_http -*-
+
+"""
+An async manager implementation that talks to Riak's HTTP interface from the
+reactor instead of running the riak Python package's blocking client in
+threads.
+
+The riak package is still used for everything that doesn't touch the network
+(Riak objects, map reduce jobs, URL construction and response parsing).
+"""
+
+import json
+import re
+from cgi import parse_header
+from email import message_from_string
+from StringIO import StringIO
+from uuid import uuid4
+
+from riak import RiakObject, RiakMapReduce, RiakError
+from riak.client.index_page import IndexPage
+from riak.mapreduce import RiakLinkPhase
+from riak.transports.http.codec import RiakHttpCodec
+from riak.transports.http.resources import RiakHttpResources
+from riak.util import decode_index_value
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred,
+    DeferredSemaphore, Deferred, succeed)
+from twisted.internet.protocol import Protocol
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, FileBodyProducer, ResponseDone, readBody)
+from twisted.web.http_headers import Headers
+
+from vumi.persist.model import VumiRiakError
+from vumi.persist.riak_base import (
+    VumiRiakClientBase, VumiIndexPageBase, VumiRiakBucketBase,
+    VumiRiakObjectBase)
+from vumi.persist.txriak_manager import TxRiakManager, riakErrorHandler
+
+
+class MapReduceStreamProtocol(Protocol):
+    """
+    Parses a streamed (``multipart/mixed``) map reduce response body as it
+    arrives and calls `callback` with the phase number and data of each part.
+
+    :param str boundary:
+        The multipart boundary from the response's content type.
+    :param callable callback:
+        Called with ``(phase, data)`` for each part.
+    :param Deferred finished:
+        Fired when the body has been read, or errbacked if the connection
+        fails, the response contains an error or `callback` raises.
+    """
+
+    def __init__(self, boundary, callback, finished):
+        self.boundary_re = re.compile(
+            '\r?\n--%s(?:--)?\r?\n' % (re.escape(boundary),))
+        self.callback = callback
+        self.finished = finished
+        self.buffer = ''
+        self.seen_first = False
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.buffer += data
+        try:
+            self._parse_parts()
+        except Exception:
+            self.finished.errback()
+            self.transport.stopProducing()
+
+    def _parse_parts(self):
+        while not self.finished.called:
+            match = self.boundary_re.search(self.buffer)
+            if match is None:
+                return
+            part = self.buffer[:match.start()]
+            self.buffer = self.buffer[match.end():]
+            if not self.seen_first:
+                # Everything before the first boundary is preamble.
+                self.seen_first = True
+                continue
+            payload = json.loads(message_from_string(part).get_payload())
+            if 'error' in payload:
+                raise RiakError(payload['error'])
+            self.callback(payload['phase'], payload['data'])
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
+class TxRiakHttpTransport(RiakHttpResources, RiakHttpCodec):
+    """
+    Reactor-native transport for Riak's HTTP interface.
+
+    Requests are made over a pool of persistent connections to a single
+    node. At most `max_connections` requests are in flight at once and any
+    further requests wait (in order) for one of those to finish, so the
+    number of connections to the node is bounded.
+
+    :param str host:
+        Riak node hostname.
+    :param int port:
+        Riak node HTTP port.
+    :param str client_id:
+        Client id sent with writes. A random one is generated if omitted.
+    :param int max_connections:
+        Maximum number of concurrent requests (and connections).
+    :param reactor:
+        Reactor to make connections with. Defaults to the global reactor.
+    """
+
+    DEFAULT_MAX_CONNECTIONS = 20
+    ACCEPT = 'multipart/mixed, application/json, */*;q=0.5'
+
+    # We require Riak 1.4 or later for paginated index queries, so we don't
+    # need to ask the node which resources it provides.
+    resources = {
+        'riak_kv_wm_buckets': '/buckets',
+        'riak_kv_wm_mapred': '/mapred',
+        'riak_kv_wm_ping': '/ping',
+        'riak_kv_wm_stats': '/stats',
+        'riak_solr_searcher_wm': '/solr',
+        'riak_solr_indexer_wm': '/solr',
+    }
+
+    def __init__(self, host='127.0.0.1', port=8098, client_id=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.base_url = 'http://%s:%s' % (host, port)
+        self._client_id = client_id or 'vumi_%s' % (uuid4().hex,)
+        self.max_connections = max_connections
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_connections
+        self.agent = Agent(reactor, pool=self.pool)
+        self._semaphore = DeferredSemaphore(max_connections)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+    def check_http_code(self, status, expected_statuses):
+        if status not in expected_statuses:
+            raise RiakError('Expected status %s, received %s' %
+                            (expected_statuses, status))
+
+    @property
+    def in_flight(self):
+        """
+        The number of requests currently in flight.
+        """
+        return self.max_connections - self._semaphore.tokens
+
+    @property
+    def waiting(self):
+        """
+        The number of requests waiting for a connection.
+        """
+        return len(self._semaphore.waiting)
+
+    def request(self, method, path, headers=None, body=None):
+        """
+        Make a request to the Riak node.
+
+        :returns:
+            A deferred that fires with a ``(status, headers, body)`` tuple.
+            The header names are lowercase and repeated headers are joined
+            with commas.
+        """
+        return self._semaphore.run(self._request, method, path, headers, body)
+
+    def _send_request(self, method, path, headers, body):
+        request_headers = Headers({'Accept': [self.ACCEPT]})
+        if headers is not None:
+            for name, value in headers.items():
+                request_headers.addRawHeader(name, value)
+        producer = None
+        if body is not None:
+            producer = FileBodyProducer(StringIO(body))
+        url = self.base_url + path
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return self.agent.request(method, url, request_headers, producer)
+
+    def _response_headers(self, response):
+        return dict(
+            (name.lower(), ', '.join(values))
+            for name, values in response.headers.getAllRawHeaders())
+
+    @inlineCallbacks
+    def _request(self, method, path, headers, body):
+        response = yield self._send_request(method, path, headers, body)
+        response_body = yield readBody(response)
+        returnValue(
+            (response.code, self._response_headers(response), response_body))
+
+    # Riak operations.
+
+    @inlineCallbacks
+    def get(self, robj):
+        url = self.object_path(robj.bucket.name, robj.key)
+        response = yield self.request('GET', url)
+        self._parse_body(robj, response, [200, 300, 404])
+        returnValue(robj)
+
+    @inlineCallbacks
+    def put(self, robj):
+        url = self.object_path(robj.bucket.name, robj.key, returnbody=True)
+        method = 'POST' if robj.key is None else 'PUT'
+        headers = self._build_put_headers(robj)
+        response = yield self.request(
+            method, url, headers, str(robj.encoded_data))
+        self._parse_body(robj, response, [200, 201, 204, 300])
+        returnValue(robj)
+
+    @inlineCallbacks
+    def delete(self, robj):
+        url = self.object_path(robj.bucket.name, robj.key)
+        headers = {}
+        if robj.vclock is not None:
+            headers['X-Riak-Vclock'] = robj.vclock.encode('base64')
+        status, _, _ = yield self.request('DELETE', url, headers)
+        self.check_http_code(status, [204, 404])
+        returnValue(robj.clear())
+
+    @inlineCallbacks
+    def get_index(self, bucket_name, index, startkey, endkey=None,
+                  return_terms=None, max_results=None, continuation=None):
+        """
+        Run a secondary index query.
+
+        :returns:
+            A deferred that fires with a ``(results, continuation)`` tuple.
+        """
+        url = self.index_path(
+            bucket_name, index, startkey, endkey, return_terms=return_terms,
+            max_results=max_results, continuation=continuation)
+        status, _, body = yield self.request('GET', url)
+        self.check_http_code(status, [200])
+        json_data = json.loads(body)
+        if return_terms and u'results' in json_data:
+            results = []
+            for result in json_data[u'results']:
+                term, key = result.items()[0]
+                results.append((decode_index_value(index, term), key))
+        else:
+            results = json_data[u'keys']
+        if max_results and u'continuation' in json_data:
+            returnValue((results, json_data[u'continuation']))
+        returnValue((results, None))
+
+    @inlineCallbacks
+    def mapred(self, inputs, query, timeout=None):
+        job = {'inputs': inputs, 'query': query}
+        if timeout is not None:
+            job['timeout'] = timeout
+        status, headers, body = yield self.request(
+            'POST', self.mapred_path(),
+            {'Content-Type': 'application/json'}, json.dumps(job))
+        if status != 200:
+            raise RiakError(
+                'Error running MapReduce operation. Headers: %s Body: %s' %
+                (repr(headers), repr(body)))
+        returnValue(json.loads(body))
+
+    def stream_mapred(self, inputs, query, callback, timeout=None):
+        """
+        Run a map reduce job and call `callback` with ``(phase, data)`` for
+        each batch of results as Riak sends them.
+
+        The request holds one of the transport's connections until the whole
+        response has been read.
+
+        :returns:
+            A deferred that fires when all the results have been received.
+        """
+        return self._semaphore.run(
+            self._stream_mapred, inputs, query, callback, timeout)
+
+    @inlineCallbacks
+    def _stream_mapred(self, inputs, query, callback, timeout):
+        job = {'inputs': inputs, 'query': query}
+        if timeout is not None:
+            job['timeout'] = timeout
+        response = yield self._send_request(
+            'POST', self.mapred_path(chunked=True),
+            {'Content-Type': 'application/json'}, json.dumps(job))
+        if response.code != 200:
+            body = yield readBody(response)
+            raise RiakError(
+                'Error running MapReduce operation. Headers: %s Body: %s' %
+                (repr(self._response_headers(response)), repr(body)))
+        [content_type] = response.headers.getRawHeaders('content-type')
+        _, params = parse_header(content_type)
+        finished = Deferred()
+        response.deliverBody(
+            MapReduceStreamProtocol(params['boundary'], callback, finished))
+        yield finished
+
+    @inlineCallbacks
+    def get_buckets(self):
+        status, _, body = yield self.request('GET', self.bucket_list_path())
+        if status != 200:
+            raise RiakError('Error getting buckets.')
+        returnValue(json.loads(body)['buckets'])
+
+    @inlineCallbacks
+    def get_keys(self, bucket_name):
+        status, _, body = yield self.request(
+            'GET', self.key_list_path(bucket_name))
+        if status != 200:
+            raise RiakError('Error listing keys.')
+        returnValue(json.loads(body)['keys'])
+
+    @inlineCallbacks
+    def get_bucket_props(self, bucket_name):
+        status, _, body = yield self.request(
+            'GET', self.bucket_properties_path(bucket_name))
+        if status != 200:
+            raise RiakError('Error getting bucket properties.')
+        returnValue(json.loads(body)['props'])
+
+    @inlineCallbacks
+    def set_bucket_props(self, bucket_name, props):
+        status, _, _ = yield self.request(
+            'PUT', self.bucket_properties_path(bucket_name),
+            {'Content-Type': 'application/json'}, json.dumps({'props': props}))
+        if status != 204:
+            raise RiakError('Error setting bucket properties.')
+        returnValue(True)
+
+    @inlineCallbacks
+    def clear_bucket_props(self, bucket_name):
+        status, _, _ = yield self.request(
+            'DELETE', self.bucket_properties_path(bucket_name))
+        if status == 405:
+            returnValue(False)
+        if status != 204:
+            raise RiakError('Error %s clearing bucket properties.' % status)
+        returnValue(True)
+
+    @inlineCallbacks
+    def search(self, index, query, **params):
+        status, _, body = yield self.request(
+            'GET', self.solr_select_path(index, query, **params))
+        if status != 200:
+            raise RiakError('Error running search query.')
+        returnValue(self._normalize_json_search_response(json.loads(body)))
+
+
+class VumiTxRiakHttpClient(VumiRiakClientBase):
+    """
+    Wrapper around a RiakClient and a :class:`TxRiakHttpTransport`.
+
+    The RiakClient is only used to build Riak objects locally. All network
+    access goes through the transport.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8098, client_id=None,
+                 max_connections=TxRiakHttpTransport.DEFAULT_MAX_CONNECTIONS,
+                 reactor=None, **client_args):
+        # The RiakClient never connects, but it still needs a valid protocol.
+        client_args.update(host=host, protocol='http')
+        super(VumiTxRiakHttpClient, self).__init__(**client_args)
+        self._transport = TxRiakHttpTransport(
+            host, port, client_id=client_id, max_connections=max_connections,
+            reactor=reactor)
+
+    @property
+    def protocol(self):
+        return 'txhttp'
+
+    @property
+    def transport(self):
+        """
+        Raise an exception if closed, otherwise return the transport.
+        """
+        if self._closed:
+            raise VumiRiakError("Can't use closed Riak client.")
+        return self._transport
+
+    def close(self):
+        self._closed = True
+        self._raw_client.close()
+        return self._transport.close()
+
+    @inlineCallbacks
+    def _purge_all(self, bucket_prefix):
+        """
+        Purge all objects and buckets properties belonging to buckets with the
+        given prefix.
+
+        NOTE: This operation should *ONLY* be used in tests.
+        """
+        # We need to use a potentially closed client here, so we bypass the
+        # check and reclose afterwards if necessary.
+        transport = self._transport
+        buckets = yield transport.get_buckets()
+        for bucket_name in buckets:
+            if bucket_name.startswith(bucket_prefix):
+                keys = yield transport.get_keys(bucket_name)
+                bucket = self._raw_client.bucket(bucket_name)
+                yield gatherResults([
+                    transport.delete(RiakObject(self, bucket, key))
+                    for key in keys])
+                yield transport.clear_bucket_props(bucket_name)
+        if self._closed:
+            yield self.close()
+
+
+class VumiTxRiakHttpIndexPage(VumiIndexPageBase):
+    """
+    Wrapper around a page of index query results.
+
+    Iterating over this object will return the results for the current page.
+    """
+
+    def __init__(self, index_page, bucket):
+        super(VumiTxRiakHttpIndexPage, self).__init__(index_page)
+        self._bucket = bucket
+
+    # Methods that touch the network.
+
+    def next_page(self):
+        """
+        Fetch the next page of results.
+
+        :returns:
+            A new :class:`VumiTxRiakHttpIndexPage` object containing the next
+            page of results.
+        """
+        if not self.has_next_page():
+            return succeed(None)
+        page = self._index_page
+        return self._bucket.get_index_page(
+            page.index, page.startkey, page.endkey,
+            return_terms=page.return_terms, max_results=page.max_results,
+            continuation=page.continuation)
+
+
+class VumiTxRiakHttpBucket(VumiRiakBucketBase):
+    """
+    Wrapper around a RiakBucket to manage network access better.
+    """
+
+    def __init__(self, riak_bucket, client):
+        super(VumiTxRiakHttpBucket, self).__init__(riak_bucket)
+        self._client = client
+
+    # Methods that touch the network.
+
+    def get_index(self, index_name, start_value, end_value=None,
+                  return_terms=None):
+        d = self.get_index_page(
+            index_name, start_value, end_value, return_terms=return_terms)
+        d.addCallback(list)
+        return d
+
+    def get_index_page(self, index_name, start_value, end_value=None,
+                       return_terms=None, max_results=None, continuation=None):
+        d = maybeDeferred(
+            lambda: self._client.transport.get_index(
+                self.get_name(), index_name, start_value, end_value,
+                return_terms=return_terms, max_results=max_results,
+                continuation=continuation))
+        d.addCallback(
+            self._make_index_page, index_name, start_value, end_value,
+            return_terms, max_results)
+        d.addErrback(riakErrorHandler)
+        return d
+
+    def _make_index_page(self, result, index_name, start_value, end_value,
+                         return_terms, max_results):
+        page = IndexPage(
+            None, self._riak_bucket, index_name, start_value, end_value,
+            return_terms, max_results, None)
+        page.results, page.continuation = result
+        return VumiTxRiakHttpIndexPage(page, self)
+
+
+class VumiTxRiakHttpObject(VumiRiakObjectBase):
+    """
+    Wrapper around a RiakObject to manage network access better.
+    """
+
+    def get_bucket(self):
+        return VumiTxRiakHttpBucket(
+            self._riak_obj.bucket, self._riak_obj.client)
+
+    # Methods that touch the network.
+
+    def _call_and_wrap(self, func):
+        """
+        Call a function that touches the network and wrap the result in this
+        class.
+        """
+        d = maybeDeferred(func)
+        d.addCallback(type(self))
+        d.addErrback(riakErrorHandler)
+        return d
+
+    def _transport_call(self, op_name):
+        transport = self._riak_obj.client.transport
+        return getattr(transport, op_name)(self._riak_obj)
+
+    def store(self):
+        return self._call_and_wrap(lambda: self._transport_call('put'))
+
+    def reload(self):
+        return self._call_and_wrap(lambda: self._transport_call('get'))
+
+    def delete(self):
+        return self._call_and_wrap(lambda: self._transport_call('delete'))
+
+
+class TxRiakHttpManager(TxRiakManager):
+    """
+    An async persistence manager that uses a reactor-native HTTP client.
+
+    In addition to the usual Riak manager config, this accepts
+    ``max_connections`` to limit the number of concurrent requests to Riak.
+    """
+
+    riak_object_class = VumiTxRiakHttpObject
+
+    @classmethod
+    def from_config(cls, config):
+        config = config.copy()
+        max_connections = config.pop(
+            'max_connections', TxRiakHttpTransport.DEFAULT_MAX_CONNECTIONS)
+        client_args, manager_args = cls._parse_config(config)
+        client_args['max_connections'] = max_connections
+        client = VumiTxRiakHttpClient(**client_args)
+        return cls(client, **manager_args)
+
+    def close_manager(self):
+        if self._parent is None:
+            # Only top-level managers may close the client.
+            return self.client.close()
+        return succeed(None)
+
+    def riak_bucket(self, bucket_name):
+        bucket = self.client.bucket(bucket_name)
+        if bucket is not None:
+            bucket = VumiTxRiakHttpBucket(bucket, self.client)
+        return bucket
+
+    def riak_map_reduce(self):
+        """
+        Return a map reduce job whose network methods are asynchronous.
+
+        ``run(timeout=None)`` returns a deferred that fires with the results.
+        Because an iterator can't be consumed without blocking,
+        ``stream(callback, timeout=None)`` calls ``callback(phase, data)`` for
+        each batch of results as it arrives and returns a deferred that fires
+        when the job is done.
+        """
+        mapreduce = RiakMapReduce(self.client)
+        # We replace the two methods that hit the network to prevent
+        # accidental sync calls in other code.
+        mapreduce.run = lambda timeout=None: self._run_riak_map_reduce(
+            mapreduce, timeout)
+        mapreduce.stream = lambda callback, timeout=None: (
+            self._stream_riak_map_reduce(mapreduce, callback, timeout))
+        return mapreduce
+
+    def _run_riak_map_reduce(self, mapreduce, timeout):
+        query, link_results_flag = mapreduce._normalize_query()
+        d = self.client.transport.mapred(mapreduce._inputs, query, timeout)
+        phases = mapreduce._phases
+        if link_results_flag or isinstance(phases[-1], RiakLinkPhase):
+            d.addCallback(self._results_to_links)
+        return d
+
+    def _stream_riak_map_reduce(self, mapreduce, callback, timeout):
+        query, _ = mapreduce._normalize_query()
+        return self.client.transport.stream_mapred(
+            mapreduce._inputs, query, callback, timeout)
+
+    def _results_to_links(self, results):
+        if results is None:
+            return []
+        return [(r[0], r[1], r[2] if len(r) > 2 else None) for r in results]
+
+    def _search_iteration(self, bucket, query, rows, start):
+        d = self.client.transport.search(
+            bucket.name, query, rows=rows, start=start)
+        d.addCallback(lambda r: [doc["id"] for doc in r["docs"]])
+        return d
+
+    @inlineCallbacks
+    def riak_enable_search(self, modelcls):
+        search_enabled = yield self.riak_search_enabled(modelcls)
+        if not search_enabled:
+            yield self.client.transport.set_bucket_props(
+                self.bucket_name(modelcls), {'search': True})
+        returnValue(True)
+
+    @inlineCallbacks
+    def riak_search_enabled(self, modelcls):
+        props = yield self.client.transport.get_bucket_props(
+            self.bucket_name(modelcls))
+        returnValue(props.get('search', False))
+
+    def purge_all(self):
+        return self.client._purge_all(self.bucket_prefix)
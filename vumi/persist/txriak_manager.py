@@ -2,11 +2,21 @@
 
 """An async manager implementation on top of the riak Python package."""
 
+import threading
+import time
+from collections import deque
+from itertools import chain
+
 from riak import RiakObject, RiakMapReduce, RiakError
-from twisted.internet.threads import deferToThread
+from riak.transports.http import RiakHttpPool
+from riak.transports.pbc import RiakPbcPool
+from twisted.internet.threads import deferToThreadPool
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, gatherResults, maybeDeferred, succeed)
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred, succeed,
+    DeferredSemaphore)
+from twisted.python.threadpool import ThreadPool
 
+from vumi.blinkenlights.heartbeat.telemetry import percentile
 from vumi.persist.model import Manager, VumiRiakError
 from vumi.persist.riak_base import (
     VumiRiakClientBase, VumiIndexPageBase, VumiRiakBucketBase,
@@ -18,11 +28,208 @@ def riakErrorHandler(failure):
     raise VumiRiakError(e)
 
 
+class RiakThreadPool(object):
+    """
+    Runs blocking Riak calls in threads and keeps metrics about them.
+
+    :param int size:
+        Number of threads in a dedicated pool for Riak calls. If ``None``,
+        the reactor's shared thread pool is used instead.
+    :param reactor:
+        Reactor to run calls from. Defaults to the global reactor.
+    :param int max_samples:
+        Number of most recent timing samples kept (per operation) for
+        percentile calculations.
+    :param callable get_time:
+        Function returning the current time in seconds. Defaults to
+        :func:`time.time`.
+    """
+
+    MAX_SAMPLES = 1000
+
+    def __init__(self, size=None, reactor=None, max_samples=MAX_SAMPLES,
+                 get_time=time.time):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.size = size
+        self.reactor = reactor
+        self.max_samples = max_samples
+        self.get_time = get_time
+        self.queued = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._queue_waits = deque(maxlen=max_samples)
+        self._latencies = {}
+        self._threadpool = None
+        self._shutdown_trigger = None
+
+    @property
+    def dedicated(self):
+        return self.size is not None
+
+    @property
+    def threadpool(self):
+        """
+        The thread pool calls are run in. A dedicated pool is started the
+        first time it is needed.
+        """
+        if not self.dedicated:
+            return self.reactor.getThreadPool()
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(
+                minthreads=0, maxthreads=self.size, name='riak')
+            self._threadpool.start()
+            self._shutdown_trigger = self.reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.stop)
+        return self._threadpool
+
+    def stop(self):
+        """
+        Stop the dedicated thread pool (if it is running). It will be
+        restarted if more calls are made.
+        """
+        if self._threadpool is None:
+            return
+        self.reactor.removeSystemEventTrigger(self._shutdown_trigger)
+        self._threadpool.stop()
+        self._threadpool = None
+        self._shutdown_trigger = None
+
+    def run(self, op_name, func, *args, **kw):
+        """
+        Call `func` in a thread and record how long it waited for a thread
+        and how long it took under `op_name`.
+
+        :returns: A deferred that fires with the result of the call.
+        """
+        submitted = self.get_time()
+        timings = {}
+
+        def call():
+            with self._lock:
+                self.queued -= 1
+                self.in_flight += 1
+            timings['started'] = self.get_time()
+            try:
+                return func(*args, **kw)
+            finally:
+                timings['finished'] = self.get_time()
+                with self._lock:
+                    self.in_flight -= 1
+
+        with self._lock:
+            self.queued += 1
+        d = deferToThreadPool(self.reactor, self.threadpool, call)
+        d.addBoth(self._record, op_name, submitted, timings)
+        return d
+
+    def _record(self, result, op_name, submitted, timings):
+        started, finished = timings['started'], timings['finished']
+        self._queue_waits.append(started - submitted)
+        latencies = self._latencies.get(op_name)
+        if latencies is None:
+            latencies = self._latencies[op_name] = deque(
+                maxlen=self.max_samples)
+        latencies.append(finished - started)
+        return result
+
+    def snapshot(self):
+        """
+        Return a dict of the current metrics and start a new measurement
+        window.
+        """
+        operations = {}
+        for op_name, latencies in self._latencies.iteritems():
+            operations[op_name] = {
+                'count': len(latencies),
+                'p95_latency': percentile(latencies, 95),
+                'max_latency': max(latencies),
+            }
+        metrics = {
+            'threads': self.size,
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'p95_queue_wait': percentile(self._queue_waits, 95),
+            'max_queue_wait': max(self._queue_waits or [None]),
+            'operations': operations,
+        }
+        self._queue_waits.clear()
+        self._latencies.clear()
+        return metrics
+
+
+class ThreadLocalPool(object):
+    """
+    A Riak connection pool that gives each thread a pool of its own, so
+    threads never contend for a lock on a shared pool.
+
+    :param callable make_pool:
+        Function returning a new connection pool.
+    """
+
+    def __init__(self, make_pool):
+        self._make_pool = make_pool
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pools = []
+
+    def _pool(self):
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = self._make_pool()
+            with self._lock:
+                self._pools.append(pool)
+        return pool
+
+    def acquire(self, *args, **kw):
+        return self._pool().acquire(*args, **kw)
+
+    def release(self, *args, **kw):
+        return self._pool().release(*args, **kw)
+
+    def transaction(self, *args, **kw):
+        return self._pool().transaction(*args, **kw)
+
+    def __iter__(self):
+        with self._lock:
+            pools = list(self._pools)
+        return chain.from_iterable(pools)
+
+    def clear(self):
+        with self._lock:
+            pools = list(self._pools)
+        for pool in pools:
+            pool.clear()
+
+
 class VumiTxRiakClient(VumiRiakClientBase):
     """
     Wrapper around a RiakClient to manage resources better.
+
+    :param RiakThreadPool threadpool:
+        Thread pool to make Riak calls in. If it's a dedicated pool, each
+        thread gets its own connections to Riak.
     """
 
+    def __init__(self, threadpool=None, **client_args):
+        super(VumiTxRiakClient, self).__init__(**client_args)
+        if threadpool is None:
+            threadpool = RiakThreadPool()
+        self.threadpool = threadpool
+        if threadpool.dedicated:
+            client = self._raw_client
+            options = client_args.get('transport_options', {})
+            client._http_pool = ThreadLocalPool(
+                lambda: RiakHttpPool(client, **options))
+            client._pb_pool = ThreadLocalPool(
+                lambda: RiakPbcPool(client, **options))
+
+    def run_in_thread(self, op_name, func, *args, **kw):
+        """
+        Call a function that touches the network in a thread.
+        """
+        return self.threadpool.run(op_name, func, *args, **kw)
+
 
 class VumiTxIndexPage(VumiIndexPageBase):
     """
@@ -31,6 +238,10 @@ class VumiTxIndexPage(VumiIndexPageBase):
     Iterating over this object will return the results for the current page.
     """
 
+    def __init__(self, index_page, client):
+        super(VumiTxIndexPage, self).__init__(index_page)
+        self._client = client
+
     # Methods that touch the network.
 
     def next_page(self):
@@ -43,8 +254,9 @@ class VumiTxIndexPage(VumiIndexPageBase):
         """
         if not self.has_next_page():
             return succeed(None)
-        d = deferToThread(self._index_page.next_page)
-        d.addCallback(type(self))
+        d = self._client.run_in_thread(
+            'next_page', self._index_page.next_page)
+        d.addCallback(type(self), self._client)
         d.addErrback(riakErrorHandler)
         return d
 
@@ -54,6 +266,10 @@ class VumiTxRiakBucket(VumiRiakBucketBase):
     Wrapper around a RiakBucket to manage network access better.
     """
 
+    def __init__(self, riak_bucket, client):
+        super(VumiTxRiakBucket, self).__init__(riak_bucket)
+        self._client = client
+
     # Methods that touch the network.
 
     def get_index(self, index_name, start_value, end_value=None,
@@ -65,11 +281,11 @@ class VumiTxRiakBucket(VumiRiakBucketBase):
 
     def get_index_page(self, index_name, start_value, end_value=None,
                        return_terms=None, max_results=None, continuation=None):
-        d = deferToThread(
-            self._riak_bucket.get_index, index_name, start_value, end_value,
-            return_terms=return_terms, max_results=max_results,
-            continuation=continuation)
-        d.addCallback(VumiTxIndexPage)
+        d = self._client.run_in_thread(
+            'get_index', self._riak_bucket.get_index, index_name,
+            start_value, end_value, return_terms=return_terms,
+            max_results=max_results, continuation=continuation)
+        d.addCallback(VumiTxIndexPage, self._client)
         d.addErrback(riakErrorHandler)
         return d
 
@@ -80,7 +296,7 @@ class VumiTxRiakObject(VumiRiakObjectBase):
     """
 
     def get_bucket(self):
-        return VumiTxRiakBucket(self._riak_obj.bucket)
+        return VumiTxRiakBucket(self._riak_obj.bucket, self._riak_obj.client)
 
     # Methods that touch the network.
 
@@ -89,7 +305,7 @@ class VumiTxRiakObject(VumiRiakObjectBase):
         Call a function that touches the network and wrap the result in this
         class.
         """
-        d = deferToThread(func)
+        d = self._riak_obj.client.run_in_thread(func.__name__, func)
         d.addCallback(type(self))
         return d
 
@@ -97,16 +313,45 @@ class VumiTxRiakObject(VumiRiakObjectBase):
 class TxRiakManager(Manager):
     """An async persistence manager for the riak Python package."""
 
+    DEFAULT_LOAD_CONCURRENCY = 10
+
     call_decorator = staticmethod(inlineCallbacks)
+    riak_object_class = VumiTxRiakObject
+
+    def __init__(self, client, bucket_prefix, load_concurrency=None, **kw):
+        super(TxRiakManager, self).__init__(client, bucket_prefix, **kw)
+        if self._parent is not None:
+            # Sub-managers share their parent's limit on bulk loads.
+            self._load_limiter = self._parent._load_limiter
+        else:
+            self._load_limiter = DeferredSemaphore(
+                load_concurrency or self.DEFAULT_LOAD_CONCURRENCY)
 
     @classmethod
     def from_config(cls, config):
+        if cls is TxRiakManager and config.get('transport_type') == 'txhttp':
+            # The reactor-native client needs its own manager class.
+            from vumi.persist.txriak_http import TxRiakHttpManager
+            return TxRiakHttpManager.from_config(config)
+        client_args, manager_args = cls._parse_config(config)
+        threadpool_size = config.get('threadpool_size')
+        client = VumiTxRiakClient(
+            threadpool=RiakThreadPool(threadpool_size), **client_args)
+        return cls(client, **manager_args)
+
+    @classmethod
+    def _parse_config(cls, config):
+        """
+        Split a manager config into client arguments and manager arguments.
+        """
         config = config.copy()
         bucket_prefix = config.pop('bucket_prefix')
         load_bunch_size = config.pop(
             'load_bunch_size', cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop(
             'mapreduce_timeout', cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_concurrency = config.pop(
+            'load_concurrency', cls.DEFAULT_LOAD_CONCURRENCY)
         transport_type = config.pop('transport_type', 'http')
         store_versions = config.pop('store_versions', None)
 
@@ -125,15 +370,18 @@ class TxRiakManager(Manager):
         if port is not None:
             client_args['port'] = port
 
-        client = VumiTxRiakClient(**client_args)
-        return cls(
-            client, bucket_prefix, load_bunch_size=load_bunch_size,
-            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions)
+        manager_args = dict(
+            bucket_prefix=bucket_prefix, load_bunch_size=load_bunch_size,
+            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions,
+            load_concurrency=load_concurrency)
+        return client_args, manager_args
 
     def close_manager(self):
         if self._parent is None:
             # Only top-level managers may close the client.
-            return deferToThread(self.client.close)
+            d = self.client.run_in_thread('close', self.client.close)
+            d.addCallback(lambda _: self.client.threadpool.stop())
+            return d
         return succeed(None)
 
     def _is_unclosed(self):
@@ -147,12 +395,13 @@ class TxRiakManager(Manager):
     def riak_bucket(self, bucket_name):
         bucket = self.client.bucket(bucket_name)
         if bucket is not None:
-            bucket = VumiTxRiakBucket(bucket)
+            bucket = VumiTxRiakBucket(bucket, self.client)
         return bucket
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)._riak_bucket
-        riak_object = VumiTxRiakObject(RiakObject(self.client, bucket, key))
+        riak_object = self.riak_object_class(
+            RiakObject(self.client, bucket, key))
         if result:
             metadata = result['metadata']
             indexes = metadata['index']
@@ -190,19 +439,51 @@ class TxRiakManager(Manager):
         returnValue(self._migrate_riak_object(modelcls, key, riak_object))
 
     def _load_multiple(self, modelcls, keys):
-        d = gatherResults([self.load(modelcls, key) for key in keys])
+        """
+        Load model instances for a list of keys, in the same order as the
+        keys. Missing keys are skipped.
+
+        Loads from all bulk loads on this manager (and its sub-managers) are
+        queued so that at most `load_concurrency` of them are in flight at
+        once.
+        """
+        d = gatherResults([
+            self._load_limiter.run(self.load, modelcls, key) for key in keys
+        ], consumeErrors=True)
         d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
         return d
 
+    def load_all_bunches(self, modelcls, keys):
+        """
+        Load batches of model instances for a list of keys from Riak.
+
+        Each bunch starts loading when the one before it is handed out, so
+        the next bunch is usually ready by the time the caller has finished
+        with the current one.
+
+        :returns:
+            An iterator over deferred lists of model instances.
+        """
+        pending = None
+        for i in xrange(0, len(keys), self.load_bunch_size):
+            d = self._load_bunch(modelcls, keys[i:i + self.load_bunch_size])
+            if pending is not None:
+                yield pending
+            pending = d
+        if pending is not None:
+            yield pending
+
     def riak_map_reduce(self):
         mapreduce = RiakMapReduce(self.client)
         # Hack: We replace the two methods that hit the network with
-        #       deferToThread wrappers to prevent accidental sync calls in
-        #       other code.
+        #       threaded wrappers to prevent accidental sync calls in other
+        #       code.
         run = mapreduce.run
         stream = mapreduce.stream
-        mapreduce.run = lambda *a, **kw: deferToThread(run, *a, **kw)
-        mapreduce.stream = lambda *a, **kw: deferToThread(stream, *a, **kw)
+        mapreduce.run = lambda *a, **kw: self.client.run_in_thread(
+            'mapreduce', run, *a, **kw)
+        mapreduce.stream = lambda *a, **kw: self.client.run_in_thread(
+            'mapreduce', stream, *a, **kw)
         return mapreduce
 
     def run_map_reduce(self, mapreduce, mapper_func=None, reducer_func=None):
@@ -220,7 +501,8 @@ class TxRiakManager(Manager):
         return mapreduce_done
 
     def _search_iteration(self, bucket, query, rows, start):
-        d = deferToThread(bucket.search, query, rows=rows, start=start)
+        d = self.client.run_in_thread(
+            'search', bucket.search, query, rows=rows, start=start)
         d.addCallback(lambda r: [doc["id"] for doc in r["docs"]])
         return d
 
@@ -243,15 +525,17 @@ class TxRiakManager(Manager):
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
-        return deferToThread(bucket.enable_search)
+        return self.client.run_in_thread('enable_search', bucket.enable_search)
 
     def riak_search_enabled(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
-        return deferToThread(bucket.search_enabled)
+        return self.client.run_in_thread(
+            'search_enabled', bucket.search_enabled)
 
     def should_quote_index_values(self):
         return False
 
     def purge_all(self):
-        return deferToThread(self.client._purge_all, self.bucket_prefix)
+        return self.client.run_in_thread(
+            'purge_all', self.client._purge_all, self.bucket_prefix)
@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.scripts.tests.test_db_backup -*-
 import sys
+import gzip
 import json
 import pkg_resources
 import traceback
@@ -21,35 +22,129 @@ def vumi_version():
     return str(vumi)
 
 
+def open_backup(filename):
+    """
+    Open a backup file for reading, decompressing it if it was written with
+    ``--compress``.
+    """
+    backup = open(filename, "rb")
+    magic = backup.read(2)
+    backup.seek(0)
+    if magic == "\x1f\x8b":
+        return gzip.GzipFile(fileobj=backup, mode="rb")
+    return backup
+
+
+def chunks(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def scan_keys(redis, count=None):
+    """
+    Iterate over all keys using ``SCAN``, which doesn't block the server the
+    way ``KEYS`` does.
+    """
+    cursor = None
+    while True:
+        cursor, keys = redis.scan(cursor, count=count)
+        for key in keys:
+            yield key
+        if cursor is None:
+            break
+
+
 class KeyHandler(object):
+    """
+    Dumps keys to and restores keys from backup records.
+
+    The ``<type>_get`` and ``<type>_set`` methods only make redis calls
+    (and don't look at the results), so they can be used with a pipeline.
+    Keys backed up with ``use_dump`` are stored as ``dump`` records holding
+    the base64 encoded result of ``DUMP``, which preserves values exactly
+    (including types not listed in ``REDIS_TYPES``).
+    """
 
     REDIS_TYPES = ('string', 'list', 'set', 'zset', 'hash')
 
-    def __init__(self):
+    def __init__(self, use_dump=False):
+        self.use_dump = use_dump
         self._get_handlers = dict((ktype, getattr(self, '%s_get' % ktype))
                                   for ktype in self.REDIS_TYPES)
         self._set_handlers = dict((ktype, getattr(self, '%s_set' % ktype))
-                                  for ktype in self.REDIS_TYPES)
+                                  for ktype in self.REDIS_TYPES + ('dump',))
 
     def dump_key(self, redis, key):
-        key_type = redis.type(key)
-        record = {
-            'type': key_type,
-            'key': key,
-            'value': self._get_handlers[key_type](redis, key),
-            'ttl': redis.ttl(key),
-        }
+        [record] = self.dump_keys(redis, [key])
         return record
 
+    def dump_keys(self, redis, keys):
+        """
+        Return backup records for ``keys``, fetching their types and TTLs in
+        one pipeline and their values in another. Keys that have been deleted
+        since they were listed are skipped.
+        """
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.type(key)
+            pipe.ttl(key)
+        results = pipe.execute()
+
+        records = []
+        for key, key_type, ttl in zip(keys, results[::2], results[1::2]):
+            if self.use_dump and key_type != 'none':
+                key_type = 'dump'
+                pipe.dump(key)
+            elif key_type in self._get_handlers:
+                self._get_handlers[key_type](pipe, key)
+            else:
+                continue
+            records.append({'type': key_type, 'key': key, 'ttl': ttl})
+        for record, value in zip(records, pipe.execute()):
+            record['value'] = self.record_value(record['type'], value)
+        return [record for record in records if record['value'] is not None]
+
+    def record_value(self, key_type, value):
+        if value is None or (key_type != 'string' and not value):
+            # The key was deleted between the two pipelines. Missing lists,
+            # sets, sorted sets and hashes read as empty, and Redis has no
+            # empty ones, so we skip those too.
+            return None
+        if key_type == 'set':
+            return sorted(value)
+        if key_type == 'dump':
+            return value.encode('base64')
+        return value
+
     def restore_key(self, redis, record, ttl_offset=0):
-        key, key_type, ttl = record['key'], record['type'], record['ttl']
-        if ttl is not None:
-            ttl -= ttl_offset
-            if ttl <= 0:
-                return
-        self._set_handlers[key_type](redis, key, record['value'])
-        if ttl is not None:
-            redis.expire(key, int(round(ttl)))
+        self.restore_records(redis, [record], ttl_offset)
+
+    def restore_records(self, redis, records, ttl_offset=0):
+        """
+        Restore keys from backup records in a single pipeline. Existing keys
+        are replaced.
+        """
+        pipe = redis.pipeline()
+        for record in records:
+            key, key_type, ttl = record['key'], record['type'], record['ttl']
+            if ttl is not None:
+                ttl -= ttl_offset
+                if ttl <= 0:
+                    continue
+            pipe.delete(key)
+            self._set_handlers[key_type](pipe, key, record['value'])
+            if ttl is not None:
+                pipe.expire(key, int(round(ttl)))
+        pipe.execute()
 
     def record_okay(self, record):
         if not isinstance(record, dict):
@@ -73,7 +168,7 @@ class KeyHandler(object):
             redis.rpush(key, item)
 
     def set_get(self, redis, key):
-        return sorted(redis.smembers(key))
+        return redis.smembers(key)
 
     def set_set(self, redis, key, value):
         for item in value:
@@ -90,7 +185,13 @@ class KeyHandler(object):
         return redis.hgetall(key)
 
     def hash_set(self, redis, key, value):
-        redis.hmset(key, value)
+        # HMSET fails without fields, and older backups may contain empty
+        # hashes for keys deleted while they were being backed up.
+        if value:
+            redis.hmset(key, value)
+
+    def dump_set(self, redis, key, value):
+        redis.restore(key, 0, value.decode('base64'))
 
 
 class BackupDbsCmd(usage.Options):
@@ -98,7 +199,19 @@ class BackupDbsCmd(usage.Options):
     synopsis = "<db-config.yaml> <db-backup-output.json>"
 
     optFlags = [
-        ["not-sorted", None, "Don't sort keys when doing backup."],
+        ["not-sorted", None, "Don't sort keys when doing backup. Keys are "
+                             "then streamed to the backup as they are "
+                             "scanned instead of being collected in memory "
+                             "first."],
+        ["dump", None, "Back up keys using DUMP. Values are stored exactly, "
+                       "but can only be restored to a redis server with a "
+                       "compatible RDB version."],
+        ["compress", "z", "Compress the backup with gzip."],
+    ]
+
+    optParameters = [
+        ["chunk-size", None, 1000,
+         "Number of keys to scan and fetch in each pipeline.", int],
     ]
 
     def parseArgs(self, db_config, db_backup):
@@ -106,6 +219,10 @@ class BackupDbsCmd(usage.Options):
         self.db_backup = open(db_backup, "wb")
         self.redis_config = self.db_config.get('redis_manager', {})
 
+    def postOptions(self):
+        if self['compress']:
+            self.db_backup = gzip.GzipFile(fileobj=self.db_backup, mode="wb")
+
     def header(self, cfg):
         return {
             'vumi_version': vumi_version(),
@@ -123,16 +240,19 @@ class BackupDbsCmd(usage.Options):
     def run(self, cfg):
         cfg.emit("Backing up dbs ...")
         redis = cfg.get_redis(self.redis_config)
-        key_handler = KeyHandler()
-        keys = redis.keys()
+        key_handler = KeyHandler(use_dump=self['dump'])
+        chunk_size = self['chunk-size']
+        keys = scan_keys(redis, count=chunk_size)
         if not self.opts['not-sorted']:
-            keys = sorted(keys)
+            keys = sorted(set(keys))
         self.write_line(self.header(cfg))
-        for key in keys:
-            record = key_handler.dump_key(redis, key)
-            self.write_line(record)
+        key_count = 0
+        for chunk in chunks(keys, chunk_size):
+            for record in key_handler.dump_keys(redis, chunk):
+                self.write_line(record)
+                key_count += 1
         self.db_backup.close()
-        cfg.emit("Backed up %d keys." % (len(keys),))
+        cfg.emit("Backed up %d keys." % (key_count,))
 
 
 class RestoreDbsCmd(usage.Options):
@@ -150,9 +270,14 @@ class RestoreDbsCmd(usage.Options):
                               "keys whose TTLs are then zero or negative."],
     ]
 
+    optParameters = [
+        ["chunk-size", None, 1000,
+         "Number of keys to restore in each pipeline.", int],
+    ]
+
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def check_header(self, header):
@@ -199,6 +324,7 @@ class RestoreDbsCmd(usage.Options):
             redis._purge_all()
         key_handler = KeyHandler()
         keys, skipped = 0, 0
+        records = []
         for i, line in enumerate(line_iter):
             try:
                 record = json.loads(line)
@@ -212,8 +338,14 @@ class RestoreDbsCmd(usage.Options):
                 cfg.emit("Skipping bad backup record on line %d." % (i + 1,))
                 skipped += 1
                 continue
-            key_handler.restore_key(redis, record, ttl_offset)
-            keys += 1
+            records.append(record)
+            if len(records) >= self['chunk-size']:
+                key_handler.restore_records(redis, records, ttl_offset)
+                keys += len(records)
+                records = []
+        if records:
+            key_handler.restore_records(redis, records, ttl_offset)
+            keys += len(records)
 
         cfg.emit("%d keys successfully restored." % keys)
         if skipped != 0:
@@ -227,7 +359,7 @@ class MigrateDbsCmd(usage.Options):
 
     def parseArgs(self, migration_config, db_backup, migrated_backup):
         self.migration_config = yaml.safe_load(open(migration_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.migrated_backup = open(migrated_backup, "wb")
 
     def postOptions(self):
@@ -358,7 +490,7 @@ class AnalyzeCmd(usage.Options):
     ]
 
     def parseArgs(self, db_backup):
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
 
     def run(self, cfg):
         backup_lines = iter(self.db_backup)
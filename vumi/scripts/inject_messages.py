@@ -1,11 +1,14 @@
 # -*- test-case-name: vumi.scripts.tests.test_inject_messages -*-
+import gzip
 import sys
-import json
+import time
+from itertools import islice
 from twisted.python import usage
 from twisted.internet import reactor, threads
 from twisted.internet.defer import (maybeDeferred, DeferredQueue,
-                                    inlineCallbacks)
-from vumi.message import TransportUserMessage
+                                    inlineCallbacks, succeed)
+from twisted.internet.task import deferLater
+from vumi.message import TransportUserMessage, from_json
 from vumi.service import Worker, WorkerCreator
 from vumi.servicemaker import VumiOptions
 from vumi.utils import to_kwargs
@@ -18,6 +21,18 @@ class InjectorOptions(VumiOptions):
         ["direction", None, "inbound",
             "Direction messages are to be sent to."],
         ["verbose", "v", False, "Output the JSON being injected"],
+        ["input", "i", None,
+            "File of JSON messages, one per line, to inject. May be"
+            " gzipped. Defaults to stdin."],
+        ["rate", None, None,
+            "Target number of messages to publish per second. Defaults to"
+            " publishing as fast as possible."],
+        ["chunk-size", None, "1000",
+            "Number of lines to read from the input at a time."],
+        ["window", None, "100",
+            "Maximum number of messages published but not yet confirmed."],
+        ["report-interval", None, "10",
+            "Seconds between publish rate reports. Set to 0 to disable."],
     ]
 
     def postOptions(self):
@@ -25,6 +40,33 @@ class InjectorOptions(VumiOptions):
         if not self['transport-name']:
             raise usage.UsageError("Please provide the "
                                     "transport-name parameter.")
+        if self['rate'] is not None:
+            self['rate'] = float(self['rate'])
+        self['chunk-size'] = int(self['chunk-size'])
+        self['window'] = int(self['window'])
+        self['report-interval'] = float(self['report-interval'])
+
+
+def open_input(filename):
+    """
+    Open an input file, decompressing it if it is gzipped. Reads from stdin
+    if `filename` is ``None`` or ``-``.
+    """
+    if filename in (None, '-'):
+        return sys.stdin
+    in_file = open(filename, 'rb')
+    magic = in_file.read(2)
+    in_file.seek(0)
+    if magic == '\x1f\x8b':
+        return gzip.GzipFile(fileobj=in_file, mode='rb')
+    return in_file
+
+
+def read_chunk(in_file, size):
+    """
+    Read up to `size` lines from `in_file`.
+    """
+    return list(islice(in_file, size))
 
 
 class MessageInjector(Worker):
@@ -35,19 +77,80 @@ class MessageInjector(Worker):
     def startWorker(self):
         self.transport_name = self.config['transport-name']
         self.direction = self.config['direction']
+        self.rate = self.config.get('rate')
+        self.chunk_size = self.config.get('chunk-size', 1000)
+        self.window = self.config.get('window', 100)
+        self.report_interval = self.config.get('report-interval', 10)
+        self.report_file = None
         self.publisher = yield self.publish_to(
-            '%s.%s' % (self.transport_name, self.direction))
+            '%s.%s' % (self.transport_name, self.direction),
+            max_unconfirmed=self.window)
         self.WORKER_QUEUE.put(self)
 
-    def process_file(self, in_file, out_file=None):
-        return threads.deferToThread(self._process_file_in_thread,
-                                     in_file, out_file)
+    def get_time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        return deferLater(reactor, seconds, lambda: None)
+
+    def read_chunk(self, in_file):
+        return threads.deferToThread(read_chunk, in_file, self.chunk_size)
 
-    def _process_file_in_thread(self, in_file, out_file):
-        for line in in_file:
-            line = line.strip()
-            self.emit(out_file, line)
-            threads.blockingCallFromThread(reactor, self.process_line, line)
+    @inlineCallbacks
+    def process_file(self, in_file, out_file=None):
+        """
+        Publish a message for each line of `in_file`.
+
+        Lines are read from `in_file` a chunk at a time in a thread while the
+        previous chunk is parsed and published on the reactor. At most
+        ``window`` messages are left waiting for the publisher at a time and
+        publishing is paced to the target ``rate``, if there is one.
+        """
+        start = last_report = self.get_time()
+        published = last_published = 0
+        in_flight = []
+        next_chunk_d = self.read_chunk(in_file)
+        while True:
+            lines = yield next_chunk_d
+            if not lines:
+                break
+            next_chunk_d = self.read_chunk(in_file)
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                self.emit(out_file, line)
+                if len(in_flight) >= self.window:
+                    yield in_flight.pop(0)
+                yield self.throttle(start, published)
+                in_flight.append(self.process_line(line))
+                published += 1
+
+            now = self.get_time()
+            if self.report_interval and (
+                    now - last_report >= self.report_interval):
+                self.report(published - last_published, now - last_report)
+                last_report, last_published = now, published
+
+        for d in in_flight:
+            yield d
+        self.report(published, self.get_time() - start, total=True)
+
+    def throttle(self, start, published):
+        """
+        Wait until it is time to publish the next message at the target rate.
+        """
+        if not self.rate:
+            return succeed(None)
+        delay = start + published / self.rate - self.get_time()
+        if delay <= 0:
+            return succeed(None)
+        return self.sleep(delay)
+
+    def report(self, count, elapsed, total=False):
+        rate = float(count) / elapsed if elapsed > 0 else 0.0
+        self.emit(self.report_file, "%s %d messages (%.1f/s)." % (
+            "Injected" if total else "Published", count, rate))
 
     def emit(self, out_file, obj):
         if out_file is not None:
@@ -58,8 +161,8 @@ class MessageInjector(Worker):
             'transport_name': self.transport_name,
             'transport_metadata': {},
         }
-        data.update(json.loads(line))
-        self.publisher.publish_message(
+        data.update(from_json(line))
+        return self.publisher.publish_message(
             TransportUserMessage(**to_kwargs(data)))
 
 
@@ -72,10 +175,11 @@ def main(options):
         MessageInjector, options)
     yield service.startService()
 
-    in_file = sys.stdin
+    in_file = open_input(options['input'])
     out_file = sys.stdout if verbose else None
 
     worker = yield MessageInjector.WORKER_QUEUE.get()
+    worker.report_file = sys.stderr
     yield worker.process_file(in_file, out_file)
     reactor.stop()
 
@@ -1,11 +1,13 @@
 """Tests for vumi.scripts.db_backup."""
 
+import gzip
 import json
 import datetime
 
 import yaml
 
-from vumi.scripts.db_backup import ConfigHolder, Options, vumi_version
+from vumi.scripts.db_backup import (
+    ConfigHolder, Options, KeyHandler, vumi_version)
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
@@ -95,12 +97,14 @@ class TestBackupDbCmd(DbBackupBaseTestCase):
                 {'key': 'baz', 'type': 'string', 'value': 'bar', 'ttl': None},
             ])
 
-    def check_backup(self, key_prefix, expected):
+    def check_backup(self, key_prefix, expected, args=()):
         db_backup = self.mktemp()
-        cfg = self.make_cfg(["backup", self.mkdbconfig(key_prefix), db_backup])
+        cfg = self.make_cfg(["backup"] + list(args) +
+                            [self.mkdbconfig(key_prefix), db_backup])
         cfg.run()
         with open(db_backup) as backup:
             self.assertEqual([json.loads(x) for x in backup][1:], expected)
+        return cfg
 
     def test_backup_string(self):
         self.redis.set("bar:s", "foo")
@@ -146,6 +150,84 @@ class TestBackupDbCmd(DbBackupBaseTestCase):
             self.assertEqual(record, {'key': 's', 'type': 'string',
                                       'value': "foo"})
 
+    def test_backup_in_chunks(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % (i,), str(i))
+        cfg = self.check_backup("bar", [
+            {'key': 's%d' % (i,), 'type': 'string', 'value': str(i),
+             'ttl': None} for i in range(5)], args=["--chunk-size", "2"])
+        self.assertEqual(cfg.output[-1], 'Backed up 5 keys.')
+
+    def test_backup_not_sorted(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % (i,), str(i))
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted", "--chunk-size", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(records[0]['sorted'], False)
+        self.assertEqual(
+            sorted(records[1:]),
+            sorted({'key': 's%d' % (i,), 'type': 'string', 'value': str(i),
+                    'ttl': None} for i in range(5)))
+
+    def test_backup_dump(self):
+        self.redis.zadd("bar:z", a=1)
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--dump", self.mkdbconfig("bar"),
+                             db_backup])
+        cfg.run()
+        with open(db_backup) as backup:
+            [record] = [json.loads(x) for x in backup][1:]
+        self.assertEqual(record['type'], 'dump')
+        self.assertEqual(
+            record['value'].decode('base64'), self.redis.dump("bar:z"))
+
+    def test_backup_compressed(self):
+        self.redis.set("bar:s", "foo")
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--compress", self.mkdbconfig("bar"),
+                             db_backup])
+        cfg.run()
+        with gzip.open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(records[1:], [
+            {'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+
+    def test_dump_keys_skips_missing_keys(self):
+        self.redis.set("s", "foo")
+        self.assertEqual(KeyHandler().dump_keys(self.redis, ["s", "gone"]), [
+            {'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+
+    def test_dump_keys_skips_keys_deleted_while_dumping(self):
+        self.redis.set("s", "foo")
+        self.redis.hmset("h", {"a": "1"})
+        self.redis.rpush("l", "a")
+        self.redis.sadd("set", "a")
+        self.redis.zadd("z", a=1)
+        deleted = ["h", "l", "set", "z"]
+        orig_pipeline = self.redis.pipeline
+
+        def pipeline():
+            pipe = orig_pipeline()
+            orig_execute = pipe.execute
+
+            def execute():
+                results = orig_execute()
+                for key in deleted:
+                    self.redis.delete(key)
+                return results
+
+            pipe.execute = execute
+            return pipe
+
+        self.patch(self.redis, 'pipeline', pipeline)
+        self.assertEqual(
+            KeyHandler().dump_keys(self.redis, ["s"] + deleted), [
+                {'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+
 
 class TestRestoreDbCmd(DbBackupBaseTestCase):
 
@@ -267,12 +349,56 @@ class TestRestoreDbCmd(DbBackupBaseTestCase):
                              'ttl': None}],
                            {'h': hvalue}, self.redis.hgetall)
 
+    def test_restore_empty_hash(self):
+        self.check_restore([{'key': 'h', 'type': 'hash', 'value': {},
+                             'ttl': None}], {}, self.redis.hgetall)
+
     def test_restore_ttl(self):
         self.check_restore([{'key': 's', 'type': 'string', 'value': 'ping',
                              'ttl': 30}],
                            {'s': 'ping'}, self.redis.get, key_prefix="bar")
         self.assertTrue(0 < self.redis.ttl("bar:s") <= 30)
 
+    def test_restore_in_chunks(self):
+        self.check_restore([{'key': 's%d' % (i,), 'type': 'string',
+                             'value': str(i), 'ttl': None} for i in range(5)],
+                           dict(('s%d' % (i,), str(i)) for i in range(5)),
+                           self.redis.get, args=["--chunk-size", "2"])
+
+    def test_restore_replaces_existing_keys(self):
+        self.redis.rpush("bar:l", "old")
+        self.check_restore([{'key': 'l', 'type': 'list', 'value': ['new'],
+                             'ttl': None}],
+                           {'l': ['new']},
+                           lambda k: self.redis.lrange(k, 0, -1))
+
+    def test_restore_dump(self):
+        self.redis.zadd("z", a=1, b=2)
+        value = self.redis.dump("z").encode('base64')
+        self.redis.delete("z")
+        self.check_restore([{'key': 'z', 'type': 'dump', 'value': value,
+                             'ttl': None}],
+                           {'z': [('a', 1), ('b', 2)]},
+                           lambda k: self.redis.zrange(k, 0, -1,
+                                                       withscores=True))
+
+    def test_restore_compressed(self):
+        backup_data = [
+            {'backup_type': 'redis',
+             'timestamp': datetime.datetime.utcnow().isoformat()},
+            {'key': 's', 'type': 'string', 'value': 'ping', 'ttl': None},
+        ]
+        db_backup = self.mktemp()
+        with gzip.open(db_backup, "wb") as backup:
+            backup.write("\n".join(json.dumps(x) for x in backup_data))
+        cfg = self.make_cfg(["restore", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Restoring dbs ...',
+            '1 keys successfully restored.',
+        ])
+        self.assertEqual(self.redis.get("bar:s"), "ping")
+
     def test_restore_ttl_frozen(self):
         yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
         self.check_restore([{'key': 's', 'type': 'string', 'value': 'ping',
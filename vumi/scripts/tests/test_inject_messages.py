@@ -1,9 +1,10 @@
 import StringIO
+import gzip
 import json
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
 
-from vumi.scripts.inject_messages import MessageInjector
+from vumi.scripts.inject_messages import MessageInjector, open_input
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
 
@@ -20,11 +21,21 @@ class TestMessageInjector(VumiTestCase):
     def setUp(self):
         self.worker_helper = self.add_helper(WorkerHelper('sphex'))
 
-    def get_worker(self, direction):
-        return self.worker_helper.get_worker(MessageInjector, {
+    def get_worker(self, direction, **config):
+        config.update({
             'transport-name': 'sphex',
             'direction': direction,
         })
+        return self.worker_helper.get_worker(MessageInjector, config)
+
+    def patch_time(self, worker, now=0):
+        sleeps = []
+        self.patch(worker, 'get_time', lambda: now)
+        self.patch(worker, 'sleep', lambda s: succeed(sleeps.append(s)))
+        return sleeps
+
+    def make_file(self, data):
+        return StringIO.StringIO("\n".join(json.dumps(d) for d in data))
 
     def make_data(self, **kw):
         kw.update(self.DEFAULT_DATA)
@@ -75,3 +86,98 @@ class TestMessageInjector(VumiTestCase):
         for msg, datum in zip(msgs, data):
             self.check_msg(msg, datum)
         self.assertEqual(out_file.getvalue(), data_string + "\n")
+
+    @inlineCallbacks
+    def test_process_file_skips_blank_lines(self):
+        worker = yield self.get_worker('inbound')
+        data = [dict(self.DEFAULT_DATA, message_id=str(i)) for i in range(2)]
+        in_file = StringIO.StringIO("\n%s\n\n%s\n\n" % tuple(
+            json.dumps(datum) for datum in data))
+        yield worker.process_file(in_file)
+        msgs = yield self.worker_helper.wait_for_dispatched_inbound()
+        self.assertEqual([msg['message_id'] for msg in msgs], ['0', '1'])
+
+    @inlineCallbacks
+    def test_process_file_in_chunks(self):
+        worker = yield self.get_worker('inbound', **{'chunk-size': 3})
+        reads = []
+        orig_read_chunk = worker.read_chunk
+
+        def read_chunk(in_file):
+            d = orig_read_chunk(in_file)
+            return d.addCallback(lambda lines: reads.append(lines) or lines)
+
+        self.patch(worker, 'read_chunk', read_chunk)
+        data = [dict(self.DEFAULT_DATA, message_id=str(i)) for i in range(7)]
+        yield worker.process_file(self.make_file(data))
+        self.assertEqual([len(lines) for lines in reads], [3, 3, 1, 0])
+        msgs = yield self.worker_helper.wait_for_dispatched_inbound()
+        self.assertEqual(
+            [msg['message_id'] for msg in msgs], map(str, range(7)))
+
+    @inlineCallbacks
+    def test_process_file_at_target_rate(self):
+        worker = yield self.get_worker('inbound', rate=10.0)
+        sleeps = self.patch_time(worker)
+        data = [dict(self.DEFAULT_DATA, message_id=str(i)) for i in range(4)]
+        yield worker.process_file(self.make_file(data))
+        self.assertEqual(sleeps, [0.1, 0.2, 0.3])
+        msgs = yield self.worker_helper.wait_for_dispatched_inbound()
+        self.assertEqual(len(msgs), 4)
+
+    @inlineCallbacks
+    def test_process_file_window(self):
+        worker = yield self.get_worker('inbound', window=2)
+        published = []
+
+        def publish_message(msg):
+            d = Deferred()
+            published.append((msg, d))
+            return d
+
+        self.patch(worker.publisher, 'publish_message', publish_message)
+        data = [dict(self.DEFAULT_DATA, message_id=str(i)) for i in range(3)]
+        done = worker.process_file(self.make_file(data))
+        while len(published) < 2:
+            yield self.worker_helper.kick_delivery()
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(len(published), 2)
+
+        msg, d = published[0]
+        d.callback(msg)
+        while len(published) < 3:
+            yield self.worker_helper.kick_delivery()
+        self.assertFalse(done.called)
+        for msg, d in published[1:]:
+            d.callback(msg)
+        yield done
+
+    @inlineCallbacks
+    def test_process_file_reports_rate(self):
+        worker = yield self.get_worker('inbound', **{
+            'chunk-size': 2, 'report-interval': 1})
+        times = iter(range(0, 100, 2))
+        self.patch(worker, 'get_time', lambda: next(times))
+        worker.report_file = StringIO.StringIO()
+        data = [dict(self.DEFAULT_DATA, message_id=str(i)) for i in range(3)]
+        yield worker.process_file(self.make_file(data))
+        self.assertEqual(worker.report_file.getvalue().splitlines(), [
+            "Published 2 messages (1.0/s).",
+            "Published 1 messages (0.5/s).",
+            "Injected 3 messages (0.5/s).",
+        ])
+
+    def test_open_input_gzipped(self):
+        filename = self.mktemp()
+        data = '{"content": "foo"}\n{"content": "bar"}\n'
+        gz_file = gzip.GzipFile(filename, 'wb')
+        gz_file.write(data)
+        gz_file.close()
+        self.assertEqual(open_input(filename).read(), data)
+
+    def test_open_input_plain(self):
+        filename = self.mktemp()
+        data = '{"content": "foo"}\n'
+        with open(filename, 'wb') as f:
+            f.write(data)
+        self.assertEqual(open_input(filename).read(), data)
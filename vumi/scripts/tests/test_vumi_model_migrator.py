@@ -3,7 +3,8 @@
 import sys
 from StringIO import StringIO
 
-from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.defer import (
+    inlineCallbacks, succeed, returnValue, gatherResults)
 from twisted.internet.task import deferLater
 from twisted.python import usage
 
@@ -72,11 +73,19 @@ class StubbedModelMigrator(ModelMigrator):
         self.output = []
         self.recorded_loads = []
         self.recorded_stores = []
+        self.sleeps = []
         super(StubbedModelMigrator, self).__init__(*args, **kwargs)
 
     def emit(self, s):
         self.output.append(s)
 
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        return succeed(None)
+
+    def get_redis_manager(self, redis_config):
+        return self.testcase.get_redis_manager(redis_config)
+
     def get_riak_manager(self, riak_config):
         manager = self.testcase.get_riak_manager(riak_config)
         if self._manager_load_func is not None:
@@ -130,6 +139,19 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(config["bucket_prefix"], self.expected_bucket_prefix)
         return self.persistence_helper.get_riak_manager(config)
 
+    @inlineCallbacks
+    def get_redis_manager(self, config):
+        if not hasattr(self, "redis"):
+            self.redis = yield self.persistence_helper.get_redis_manager()
+        # Several migrators may share this manager, so they mustn't close it.
+        redis = self.redis.sub_manager("migrator")
+        redis._close = lambda: succeed(None)
+        returnValue(redis)
+
+    def work_queue_args(self, *args):
+        return self.default_args + [
+            "--work-queue", "queue", "--retry-delay", "0"] + list(args)
+
     def recorded_loads_and_stores(self, model_migrator):
         return model_migrator.recorded_loads, model_migrator.recorded_stores
 
@@ -436,3 +458,132 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(obj_1.a, u"value-1")
         obj_2 = yield self.model.load(u"key-2")
         self.assertEqual(obj_2.a, u"value-2-modified")
+
+    def test_work_queue_with_keys(self):
+        self.assertRaises(
+            usage.UsageError, self.make_migrator,
+            self.work_queue_args("--keys", "foo,bar"))
+
+    def test_work_queue_with_continuation_token(self):
+        self.assertRaises(
+            usage.UsageError, self.make_migrator,
+            self.work_queue_args("--continuation-token", "foo"))
+
+    @inlineCallbacks
+    def test_work_queue_migration(self):
+        yield self.mk_simple_models_old(3)
+        model_migrator = self.make_migrator(
+            self.work_queue_args("--unit-size", "2"))
+        loads, stores = self.recorded_loads_and_stores(model_migrator)
+
+        yield model_migrator.run()
+        output = model_migrator.output
+        self.assertEqual(output[0], "Migrating using work queue 'queue' ...")
+        self.assertTrue(output[1].startswith("2 of 3 objects migrated ("))
+        self.assertTrue(output[2].startswith("3 of 3 objects migrated ("))
+        self.assertEqual(output[3:], ["Done, 3 objects migrated."])
+        self.assertEqual(sorted(loads), [u"key-0", u"key-1", u"key-2"])
+        self.assertEqual(sorted(stores), [u"key-0", u"key-1", u"key-2"])
+
+    @inlineCallbacks
+    def test_work_queue_migration_in_parallel(self):
+        yield self.mk_simple_models_old(5)
+        migrator_1 = self.make_migrator(
+            self.work_queue_args("--unit-size", "1"))
+        migrator_2 = self.make_migrator(
+            self.work_queue_args("--unit-size", "1"))
+        loads_1, _ = self.recorded_loads_and_stores(migrator_1)
+        loads_2, _ = self.recorded_loads_and_stores(migrator_2)
+
+        yield gatherResults([migrator_1.run(), migrator_2.run()])
+        self.assertEqual(
+            sorted(loads_1 + loads_2),
+            [u"key-0", u"key-1", u"key-2", u"key-3", u"key-4"])
+        self.assertNotEqual(loads_1, [])
+        self.assertNotEqual(loads_2, [])
+        for i in range(5):
+            obj = yield self.model.load(u"key-%d" % i)
+            self.assertEqual(obj.was_migrated, False)
+
+    @inlineCallbacks
+    def test_work_queue_migration_resumed_when_done(self):
+        yield self.mk_simple_models_old(3)
+        model_migrator = self.make_migrator(self.work_queue_args())
+        yield model_migrator.run()
+
+        resumed_migrator = self.make_migrator(self.work_queue_args())
+        loads, stores = self.recorded_loads_and_stores(resumed_migrator)
+        yield resumed_migrator.run()
+        self.assertEqual(resumed_migrator.output, [
+            "Migrating using work queue 'queue' ...",
+            "Done, 0 objects migrated.",
+        ])
+        self.assertEqual(loads, [])
+
+    @inlineCallbacks
+    def test_work_queue_migration_retries_failed_units(self):
+        yield self.mk_simple_models_old(2)
+        failed = []
+        orig_load = self.riak_manager.load
+
+        def flaky_load(modelcls, key, result=None):
+            if key == u"key-1" and not failed:
+                failed.append(key)
+                raise ValueError("Failed to load.")
+            return orig_load(modelcls, key, result=result)
+
+        model_migrator = self.make_migrator(
+            self.work_queue_args(), manager_load_func=flaky_load)
+        yield model_migrator.run()
+        self.assertTrue(
+            "Retrying unit u'key-0' in 0 seconds." in model_migrator.output)
+        self.assertEqual(
+            model_migrator.output[-1], "Done, 2 objects migrated.")
+        for i in range(2):
+            obj = yield self.model.load(u"key-%d" % i)
+            self.assertEqual(obj.was_migrated, False)
+
+    @inlineCallbacks
+    def test_work_queue_migration_gives_up_on_failed_units(self):
+        yield self.mk_simple_models_old(2)
+
+        def error_load(modelcls, key, result=None):
+            raise ValueError("Failed to load.")
+
+        model_migrator = self.make_migrator(
+            self.work_queue_args("--unit-size", "1", "--max-retries", "1"),
+            manager_load_func=error_load)
+        yield model_migrator.run()
+        output = model_migrator.output
+        self.assertTrue("Retrying unit u'key-0' in 0 seconds." in output)
+        self.assertTrue(
+            "Giving up on unit u'key-0' after 2 attempts." in output)
+        self.assertTrue(
+            "Giving up on unit u'key-1' after 2 attempts." in output)
+        self.assertEqual(output[-2:], [
+            "2 units failed to migrate.",
+            "Done, 0 objects migrated.",
+        ])
+
+    def test_throttle_below_target_latency(self):
+        model_migrator = self.make_migrator(
+            self.default_args + ["--target-latency", "0.5"])
+        model_migrator.record_load_latency(0.2)
+        model_migrator.throttle()
+        self.assertEqual(model_migrator.sleeps, [])
+
+    def test_throttle_above_target_latency(self):
+        model_migrator = self.make_migrator(
+            self.default_args + ["--target-latency", "0.5"])
+        model_migrator.record_load_latency(1.0)
+        model_migrator.record_load_latency(2.0)
+        self.assertAlmostEqual(model_migrator.load_latency, 1.2)
+        model_migrator.throttle()
+        [sleep] = model_migrator.sleeps
+        self.assertAlmostEqual(sleep, 0.7)
+
+    def test_throttle_without_target_latency(self):
+        model_migrator = self.make_migrator()
+        model_migrator.record_load_latency(10.0)
+        model_migrator.throttle()
+        self.assertEqual(model_migrator.sleeps, [])
@@ -7,7 +7,7 @@ import yaml
 from twisted.python.usage import UsageError
 
 from vumi.scripts.vumi_redis_tools import (
-    scan_keys, TaskRunner, Options, Task, TaskError,
+    scan_keys, scan_key_chunks, TaskRunner, Options, Task, TaskError,
     Count, Expire, Persist, ListKeys, Skip)
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
@@ -92,6 +92,12 @@ class TestCount(VumiTestCase):
         self.assertEqual(t.count, 1)
         self.assertEqual(key, "foo")
 
+    def test_process_keys(self):
+        t = self.mk_count()
+        keys = t.process_keys(["foo", "bar"])
+        self.assertEqual(t.count, 2)
+        self.assertEqual(keys, ["foo", "bar"])
+
     def test_after(self):
         t = self.mk_count()
         for i in range(5):
@@ -138,6 +144,16 @@ class TestExpire(VumiTestCase):
         self.assertEqual(
             self.redis.ttl("key2"), None)
 
+    def test_process_keys(self):
+        t = self.mk_expire(seconds=10)
+        for i in range(3):
+            self.redis.set("key%d" % (i,), "bar")
+        keys = t.process_keys(["key0", "key1"])
+        self.assertEqual(keys, ["key0", "key1"])
+        self.assertTrue(0 < self.redis.ttl("key0") <= 10)
+        self.assertTrue(0 < self.redis.ttl("key1") <= 10)
+        self.assertEqual(self.redis.ttl("key2"), None)
+
 
 class TestPersist(VumiTestCase):
 
@@ -174,6 +190,16 @@ class TestPersist(VumiTestCase):
         self.assertTrue(
             0 < self.redis.ttl("key2") <= 20)
 
+    def test_process_keys(self):
+        t = self.mk_persist()
+        for i in range(3):
+            self.redis.setex("key%d" % (i,), 10, "bar")
+        keys = t.process_keys(["key0", "key1"])
+        self.assertEqual(keys, ["key0", "key1"])
+        self.assertEqual(self.redis.ttl("key0"), None)
+        self.assertEqual(self.redis.ttl("key1"), None)
+        self.assertTrue(0 < self.redis.ttl("key2") <= 10)
+
 
 class TestListKeys(VumiTestCase):
 
@@ -230,6 +256,12 @@ class TestSkip(VumiTestCase):
         self.assertEqual(t.process_key("skip_this"), None)
         self.assertEqual(t.process_key("dont_skip"), "dont_skip")
 
+    def test_process_keys(self):
+        t = self.mk_skip("skip_.*")
+        self.assertEqual(
+            t.process_keys(["skip_this", "dont_skip", "skip_that"]),
+            ["dont_skip"])
+
 
 class TestOptions(VumiTestCase):
     def mk_file(self, data):
@@ -311,6 +343,10 @@ class TestTaskRunner(VumiTestCase):
         runner = TaskRunner(options)
         runner.redis._purge_all()   # Make sure we start fresh.
         runner.stdout = StringIO.StringIO()
+        runner.stderr = StringIO.StringIO()
+        runner.sleeps = []
+        runner.get_time = lambda: 0
+        runner.sleep = runner.sleeps.append
         return runner
 
     def output(self, runner):
@@ -379,6 +415,69 @@ class TestTaskRunner(VumiTestCase):
             'key2',
         ])
 
+    def test_scan_count(self):
+        runner = self.make_runner([
+            "--scan-count", "4",
+            "-t", "count",
+        ])
+        self.assertEqual(runner.scan_count, 4)
+        chunks = []
+        process_keys = Count.process_keys
+
+        def record_chunk(task, keys):
+            chunks.append(len(keys))
+            return process_keys(task, keys)
+        self.patch(Count, 'process_keys', record_chunk)
+        for i in range(10):
+            runner.redis.set("key%d" % (i,), "v")
+        runner.run()
+        self.assertEqual(self.output(runner), [
+            'Found 10 matching keys.',
+        ])
+        self.assertEqual(chunks, [4, 4, 2])
+
+    def test_max_rate(self):
+        runner = self.make_runner([
+            "--scan-count", "4",
+            "--max-rate", "2",
+            "-t", "count",
+        ])
+        for i in range(10):
+            runner.redis.set("key%d" % (i,), "v")
+        runner.run()
+        # Time doesn't pass, so we sleep until the next chunk is allowed.
+        self.assertEqual(runner.sleeps, [2.0, 4.0, 5.0])
+
+    def test_max_rate_not_exceeded(self):
+        runner = self.make_runner([
+            "--scan-count", "4",
+            "--max-rate", "2",
+            "-t", "count",
+        ])
+        for i in range(10):
+            runner.redis.set("key%d" % (i,), "v")
+        times = iter(range(0, 100, 10))
+        runner.get_time = lambda: next(times)
+        runner.run()
+        self.assertEqual(runner.sleeps, [])
+
+    def test_progress(self):
+        runner = self.make_runner([
+            "--scan-count", "4",
+            "--progress", "5",
+            "-t", "count",
+        ])
+        for i in range(10):
+            runner.redis.set("key%d" % (i,), "v")
+        runner.run()
+        self.assertEqual(runner.stderr.getvalue().splitlines(), [
+            'Processed 8 keys in 0.0 seconds.',
+            'Processed 10 keys in 0.0 seconds.',
+        ])
+        self.assertEqual(self.output(runner), [
+            'Found 10 matching keys.',
+        ])
+
 
 class TestScanKeys(VumiTestCase):
     def setUp(self):
@@ -410,3 +509,11 @@ class TestScanKeys(VumiTestCase):
         self.redis.set("tea:rooibos", "yes")
         keys = list(scan_keys(self.redis, "coffee:*"))
         self.assertEqual(keys, ["coffee:latte"])
+
+    def test_scan_key_chunks(self):
+        for i in range(5):
+            self.redis.set("key%d" % i, "foo")
+        chunks = list(scan_key_chunks(self.redis, "*", count=2))
+        self.assertEqual([len(keys) for keys in chunks], [2, 2, 1])
+        self.assertEqual(
+            sorted(sum(chunks, [])), ["key%d" % i for i in range(5)])
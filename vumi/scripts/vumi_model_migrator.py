@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 # -*- test-case-name: vumi.scripts.tests.test_vumi_model_migrator -*-
+import json
 import sys
-
-from twisted.internet.defer import inlineCallbacks, gatherResults, succeed
-from twisted.internet.task import react
+import time
+from datetime import timedelta
+from uuid import uuid4
+
+import yaml
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, succeed, returnValue)
+from twisted.internet.task import react, deferLater
 from twisted.python import usage
 
+from vumi.components.delay_queue import DelayQueue
 from vumi.utils import load_class_by_string
+from vumi.persist.redis_base import gather_calls
+from vumi.persist.txredis_manager import TxRedisManager
 from vumi.persist.txriak_manager import TxRiakManager
 
 
@@ -30,6 +39,29 @@ class Options(usage.Options):
          "Full Python name of a callable to post-process each migrated object."
          " Should update the model object and return a (possibly deferred)"
          " boolean to indicate whether the object has been modified."],
+        ["work-queue", None, None,
+         "Name of a Redis work queue to share the migration between"
+         " processes. Every process started with the same name migrates"
+         " units of keys from the queue until the whole bucket is done."
+         " Starting it again with the same name resumes an interrupted"
+         " migration."],
+        ["redis-config", None, None,
+         "YAML file with a 'redis_manager' section configuring the Redis"
+         " manager for the work queue."],
+        ["unit-size", None, "1000",
+         "The number of keys in each work queue unit."],
+        ["unit-timeout", None, "600",
+         "Seconds before a claimed work queue unit that hasn't been"
+         " completed is handed to another process."],
+        ["max-retries", None, "3",
+         "The number of times to retry a work queue unit containing keys"
+         " that failed to migrate."],
+        ["retry-delay", None, "5",
+         "Seconds to wait before retrying a failed work queue unit. Doubled"
+         " for each further retry."],
+        ["target-latency", None, None,
+         "Target Riak load latency in seconds. Migrations are paused while"
+         " the average load latency is above this."],
     ]
 
     optFlags = [
@@ -39,6 +71,12 @@ class Options(usage.Options):
     longdesc = """Offline model migrator. Necessary for updating
                   models when index names change so that old model
                   instances remain findable by index searches.
+
+                  With --work-queue, the bucket's keys are split into
+                  units in Redis so that several processes can share the
+                  migration. Completed units are removed from the queue,
+                  failed units are retried with backoff and units claimed
+                  by a process that died are handed to another one.
                   """
 
     def postOptions(self):
@@ -48,6 +86,23 @@ class Options(usage.Options):
             raise usage.UsageError("Please specify a bucket prefix.")
         self['concurrent-migrations'] = int(self['concurrent-migrations'])
         self['index-page-size'] = int(self['index-page-size'])
+        self['unit-size'] = int(self['unit-size'])
+        self['unit-timeout'] = float(self['unit-timeout'])
+        self['max-retries'] = int(self['max-retries'])
+        self['retry-delay'] = float(self['retry-delay'])
+        if self['target-latency'] is not None:
+            self['target-latency'] = float(self['target-latency'])
+        if self['work-queue'] is not None:
+            if self['keys'] is not None:
+                raise usage.UsageError(
+                    "--keys can't be used with --work-queue.")
+            if self['continuation-token'] is not None:
+                raise usage.UsageError(
+                    "--continuation-token can't be used with --work-queue.")
+        self['redis-manager'] = {}
+        if self['redis-config'] is not None:
+            config = yaml.safe_load(open(self['redis-config'])) or {}
+            self['redis-manager'] = config.get('redis_manager', {})
 
 
 class ProgressEmitter(object):
@@ -80,7 +135,20 @@ class FakeIndexPage(object):
             type(self)(self._keys[self._page_size:], self._page_size))
 
 
+def format_duration(seconds):
+    return str(timedelta(seconds=int(round(seconds))))
+
+
 class ModelMigrator(object):
+    # Weight of the latest load latency in the moving average used for
+    # throttling.
+    LATENCY_WEIGHT = 0.2
+    # Seconds to wait for work queue units that are claimed but not yet done.
+    POLL_INTERVAL = 5
+    # Seconds before the work queue's populating lock expires if the process
+    # holding it dies.
+    POPULATE_LOCK_TTL = 300
+
     def __init__(self, options):
         self.options = options
         model_cls = load_class_by_string(options['model'])
@@ -89,6 +157,9 @@ class ModelMigrator(object):
         }
         self.manager = self.get_riak_manager(riak_config)
         self.model = self.manager.proxy(model_cls)
+        self.redis_manager = None
+        self.redis = None
+        self.load_latency = None
 
         # The default post-migrate-function does nothing and returns True if
         # and only if the object was migrated.
@@ -97,19 +168,61 @@ class ModelMigrator(object):
             self.post_migrate_function = load_class_by_string(
                 options['post-migrate-function'])
 
+    @inlineCallbacks
     def cleanup(self):
-        return self.manager.close_manager()
+        if self.redis_manager is not None:
+            yield self.redis_manager.close_manager()
+        yield self.manager.close_manager()
 
     def get_riak_manager(self, riak_config):
         return TxRiakManager.from_config(riak_config)
 
+    def get_redis_manager(self, redis_config):
+        return TxRedisManager.from_config(redis_config)
+
+    def get_time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        from twisted.internet import reactor
+        return deferLater(reactor, seconds, lambda: None)
+
     def emit(self, s):
         print s
 
+    def record_load_latency(self, latency):
+        if self.load_latency is None:
+            self.load_latency = latency
+        else:
+            self.load_latency += self.LATENCY_WEIGHT * (
+                latency - self.load_latency)
+
+    def throttle(self):
+        """
+        Pause for as long as the average load latency exceeds the target
+        latency.
+        """
+        target = self.options["target-latency"]
+        if target is None or self.load_latency is None:
+            return succeed(None)
+        if self.load_latency <= target:
+            return succeed(None)
+        return self.sleep(self.load_latency - target)
+
     @inlineCallbacks
     def migrate_key(self, key, dry_run):
+        """
+        Migrate a single key.
+
+        :returns:
+            A deferred that fires with ``True`` if the key was migrated (or
+            is a tombstone) and ``False`` if migrating it failed.
+        """
         try:
+            yield self.throttle()
+            start = self.get_time()
             obj = yield self.model.load(key)
+            self.record_load_latency(self.get_time() - start)
             if obj is not None:
                 should_save = yield self.post_migrate_function(obj)
                 if should_save and not dry_run:
@@ -119,6 +232,8 @@ class ModelMigrator(object):
         except Exception, e:
             self.emit("Failed to migrate key %r:" % (key,))
             self.emit("  %s: %s" % (type(e).__name__, e))
+            returnValue(False)
+        returnValue(True)
 
     @inlineCallbacks
     def migrate_keys(self, _result, keys_list, dry_run):
@@ -127,19 +242,35 @@ class ModelMigrator(object):
 
         This method is expected to be called multiple times concurrently with
         all instances sharing the same `keys_list`.
+
+        :returns:
+            A deferred that fires with the number of keys that failed to
+            migrate.
         """
+        failures = 0
         # keys_list is a shared mutable list, so we can't just iterate over it.
         while keys_list:
             key = keys_list.pop(0)
-            yield self.migrate_key(key, dry_run)
+            migrated = yield self.migrate_key(key, dry_run)
+            if not migrated:
+                failures += 1
+        returnValue(failures)
 
     def migrate_page(self, keys, dry_run):
+        """
+        Migrate `keys` concurrently.
+
+        :returns:
+            A deferred that fires with the number of keys that failed to
+            migrate.
+        """
         # Depending on our Riak client, Python version, and JSON library we may
         # get bytes or unicode here.
         keys = [k.decode('utf-8') if isinstance(k, str) else k for k in keys]
-        return gatherResults([
+        d = gatherResults([
             self.migrate_keys(None, keys, dry_run)
             for _ in xrange(self.options["concurrent-migrations"])])
+        return d.addCallback(sum)
 
     @inlineCallbacks
     def migrate_pages(self, index_page, emit_progress):
@@ -189,7 +320,148 @@ class ModelMigrator(object):
             continuation=continuation)
         yield self.migrate_pages(index_page, emit_progress)
 
+    @inlineCallbacks
+    def populate_work_queue(self, queue, worker_id):
+        """
+        Split the bucket's keys into units on the work queue, unless another
+        process is already doing so.
+
+        The continuation token for the next unit is stored in Redis, so if
+        the populating process dies another one takes over where it left off
+        once the populating lock expires.
+
+        :returns:
+            A deferred that fires with ``True`` once the work queue has been
+            populated and ``False`` if another process holds the populating
+            lock.
+        """
+        # The lock is set with its expiry in one command, so a process that
+        # dies straight after taking it can't leave it locked forever.
+        locked = yield self.redis.set(
+            "populate_lock", worker_id, ex=self.POPULATE_LOCK_TTL, nx=True)
+        if not locked:
+            holder = yield self.redis.get("populate_lock")
+            if holder != worker_id:
+                returnValue(False)
+
+        continuation = yield self.redis.get("continuation")
+        while True:
+            yield self.redis.expire("populate_lock", self.POPULATE_LOCK_TTL)
+            index_page = yield self.model.all_keys_page(
+                max_results=self.options["unit-size"],
+                continuation=continuation)
+            keys = list(index_page)
+            if keys:
+                unit = {"start": keys[0], "end": keys[-1], "attempts": 0}
+                yield gather_calls([
+                    queue.add(json.dumps(unit), 0, item_id=keys[0]),
+                    self.redis.incr("total_keys", len(keys)),
+                ])
+            if not index_page.has_next_page():
+                break
+            continuation = index_page.continuation
+            yield self.redis.set("continuation", continuation)
+
+        yield self.redis.set("populated", "1")
+        yield self.redis.delete("populate_lock")
+        returnValue(True)
+
+    @inlineCallbacks
+    def migrate_unit(self, queue, item_id, payload):
+        """
+        Migrate the keys in a work queue unit.
+
+        A unit with keys that failed to migrate is put back on the queue to
+        be retried after a delay that doubles with each attempt, until it has
+        been retried ``max-retries`` times.
+
+        :returns:
+            A deferred that fires with the number of keys migrated, which is
+            zero if the unit failed.
+        """
+        unit = json.loads(payload)
+        keys = yield self.manager.index_keys(
+            self.model._modelcls, '$key', unit["start"], unit["end"])
+        failures = yield self.migrate_page(keys, self.options["dry-run"])
+        if not failures:
+            yield gather_calls([
+                queue.ack(item_id),
+                self.redis.incr("done_keys", len(keys)),
+            ])
+            returnValue(len(keys))
+
+        unit["attempts"] += 1
+        if unit["attempts"] > self.options["max-retries"]:
+            self.emit("Giving up on unit %r after %d attempts." % (
+                item_id, unit["attempts"]))
+            yield gather_calls([
+                queue.ack(item_id),
+                self.redis.sadd("failed_units", json.dumps(unit)),
+            ])
+        else:
+            delay = self.options["retry-delay"] * 2 ** (unit["attempts"] - 1)
+            self.emit("Retrying unit %r in %g seconds." % (item_id, delay))
+            yield queue.add(json.dumps(unit), delay, item_id=item_id)
+        returnValue(0)
+
+    @inlineCallbacks
+    def emit_work_queue_progress(self, start_time, start_done):
+        total_keys, done_keys = yield gather_calls([
+            self.redis.get("total_keys"),
+            self.redis.get("done_keys"),
+        ])
+        total_keys, done_keys = int(total_keys or 0), int(done_keys or 0)
+        elapsed = self.get_time() - start_time
+        rate = (done_keys - start_done) / elapsed if elapsed > 0 else 0.0
+        if rate > 0:
+            eta = format_duration((total_keys - done_keys) / rate)
+        else:
+            eta = "unknown"
+        self.emit("%s of %s objects migrated (%.1f/s, ETA %s)." % (
+            done_keys, total_keys, rate, eta))
+
+    @inlineCallbacks
+    def migrate_work_queue(self, name):
+        """
+        Migrate units of keys from a shared work queue until it is empty.
+        """
+        self.emit("Migrating using work queue %r ..." % (name,))
+        self.redis_manager = yield self.get_redis_manager(
+            self.options["redis-manager"])
+        self.redis = self.redis_manager.sub_manager(name)
+        queue = DelayQueue(
+            self.redis, "units", visibility_timeout=self.options[
+                "unit-timeout"], get_time=self.get_time)
+        worker_id = uuid4().get_hex()
+        start_time = self.get_time()
+        start_done = int((yield self.redis.get("done_keys")) or 0)
+        processed = 0
+        while True:
+            populated = yield self.redis.get("populated")
+            if not populated:
+                populated = yield self.populate_work_queue(queue, worker_id)
+            units = yield queue.claim_due(limit=1)
+            if units:
+                [(item_id, payload)] = units
+                processed += yield self.migrate_unit(queue, item_id, payload)
+                yield self.emit_work_queue_progress(start_time, start_done)
+            elif populated and (yield queue.count()) == 0:
+                break
+            else:
+                # Wait for another process to add units, or for units it has
+                # claimed to be retried or to time out.
+                yield self.sleep(self.POLL_INTERVAL)
+
+        failed_units = yield self.redis.scard("failed_units")
+        if failed_units:
+            self.emit("%d unit%s failed to migrate." % (
+                failed_units, "" if failed_units == 1 else "s"))
+        self.emit("Done, %s object%s migrated." % (
+            processed, "" if processed == 1 else "s"))
+
     def _run(self):
+        if self.options["work-queue"] is not None:
+            return self.migrate_work_queue(self.options["work-queue"])
         if self.options["keys"] is not None:
             return self.migrate_specified_keys(self.options["keys"].split(","))
         else:
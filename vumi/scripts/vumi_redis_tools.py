@@ -2,6 +2,7 @@
 # -*- test-case-name: vumi.scripts.tests.test_vumi_redis_tools -*-
 import re
 import sys
+import time
 
 import yaml
 from twisted.python import usage
@@ -77,6 +78,16 @@ class Task(object):
         """
         return key
 
+    def process_keys(self, keys):
+        """Run once for each chunk of keys.
+
+        Returns a list of the keys that should be processed by later
+        tasks (see :meth:`process_key`). Tasks that make redis calls
+        should override this to pipeline the calls for the whole chunk.
+        """
+        keys = [self.process_key(key) for key in keys]
+        return [key for key in keys if key is not None]
+
 
 class Count(Task):
     """A task that counts the number of keys."""
@@ -96,6 +107,10 @@ class Count(Task):
         self.count += 1
         return key
 
+    def process_keys(self, keys):
+        self.count += len(keys)
+        return keys
+
 
 class Expire(Task):
     """A task that sets an expiry time on each key."""
@@ -109,6 +124,13 @@ class Expire(Task):
         self.redis.expire(key, self.seconds)
         return key
 
+    def process_keys(self, keys):
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.expire(key, self.seconds)
+        pipe.execute()
+        return keys
+
 
 class Persist(Task):
     """A task that persists each key."""
@@ -119,6 +141,13 @@ class Persist(Task):
         self.redis.persist(key)
         return key
 
+    def process_keys(self, keys):
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.persist(key)
+        pipe.execute()
+        return keys
+
 
 class ListKeys(Task):
     """A task that prints out each key."""
@@ -150,6 +179,19 @@ class Options(usage.Options):
 
     longdesc = "Perform tasks on Redis keys."
 
+    optParameters = [
+        ["scan-count", None, 100,
+         "COUNT hint for each SCAN. Keys from each SCAN are processed "
+         "together, so this also sets roughly how many calls each task "
+         "pipelines.", int],
+        ["max-rate", None, None,
+         "Maximum number of keys to process per second. Defaults to no "
+         "limit.", float],
+        ["progress", None, 0,
+         "Report progress to stderr after every N keys (0 to disable).",
+         int],
+    ]
+
     def __init__(self):
         usage.Options.__init__(self)
         self['tasks'] = []
@@ -180,13 +222,13 @@ class Options(usage.Options):
             raise usage.UsageError("Please specify a task.")
 
 
-def scan_keys(redis, match):
-    """Iterate over matching keys."""
+def scan_key_chunks(redis, match, count=None):
+    """Iterate over lists of matching keys, one for each SCAN."""
     prev_cursor = None
     while True:
-        cursor, keys = redis.scan(prev_cursor, match=match)
-        for key in keys:
-            yield key
+        cursor, keys = redis.scan(prev_cursor, match=match, count=count)
+        if keys:
+            yield keys
         if cursor is None:
             break
         if cursor == prev_cursor:
@@ -194,14 +236,25 @@ def scan_keys(redis, match):
         prev_cursor = cursor
 
 
+def scan_keys(redis, match, count=None):
+    """Iterate over matching keys."""
+    for keys in scan_key_chunks(redis, match, count=count):
+        for key in keys:
+            yield key
+
+
 class TaskRunner(object):
 
     stdout = sys.stdout
+    stderr = sys.stderr
 
     def __init__(self, options):
         self.options = options
         self.match_pattern = options['match_pattern']
         self.tasks = options['tasks']
+        self.scan_count = options['scan-count']
+        self.max_rate = options['max-rate']
+        self.progress = options['progress']
         self.redis = self.get_redis(options['config'])
 
     def emit(self, s):
@@ -211,6 +264,20 @@ class TaskRunner(object):
         self.stdout.write(s)
         self.stdout.write("\n")
 
+    def emit_progress(self, s):
+        """
+        Print the given progress message and then a newline to stderr, so
+        that it doesn't get mixed up with task output.
+        """
+        self.stderr.write(s)
+        self.stderr.write("\n")
+
+    def get_time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
     def get_redis(self, config):
         """
         Create and return a redis manager.
@@ -228,15 +295,35 @@ class TaskRunner(object):
         for task in self.tasks:
             task.before()
 
-        for key in scan_keys(self.redis, self.match_pattern):
+        start = self.get_time()
+        processed = reported = 0
+        for keys in scan_key_chunks(
+                self.redis, self.match_pattern, count=self.scan_count):
+            processed += len(keys)
             for task in self.tasks:
-                key = task.process_key(key)
-                if key is None:
+                keys = task.process_keys(keys)
+                if not keys:
                     break
 
+            elapsed = self.get_time() - start
+            if self.progress and processed - reported >= self.progress:
+                reported = processed
+                self.report_progress(processed, elapsed)
+            if self.max_rate is not None:
+                delay = processed / self.max_rate - elapsed
+                if delay > 0:
+                    self.sleep(delay)
+
+        if self.progress and processed != reported:
+            self.report_progress(processed, self.get_time() - start)
+
         for task in self.tasks:
             task.after()
 
+    def report_progress(self, processed, elapsed):
+        self.emit_progress("Processed %d keys in %.1f seconds." % (
+            processed, elapsed))
+
 
 if __name__ == '__main__':
     try:
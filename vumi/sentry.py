@@ -1,9 +1,11 @@
 # -*- test-case-name: vumi.tests.test_sentry -*-
 
 import logging
+from collections import deque, OrderedDict
 
-from twisted.python import log
+from twisted.python import log, reflect
 from twisted.web.client import HTTPClientFactory, _makeGetterFactory
+from twisted.internet import reactor
 from twisted.internet.defer import DeferredList
 from twisted.application.service import Service
 
@@ -96,15 +98,48 @@ def vumi_raven_client(dsn, log_context_sentinel=None):
     return client
 
 
+class SentryEvent(object):
+    """An event waiting to be sent to Sentry."""
+
+    def __init__(self, fingerprint, capture_type, capture_arg, data, tags):
+        self.fingerprint = fingerprint
+        self.capture_type = capture_type
+        self.capture_arg = capture_arg
+        self.data = data
+        self.tags = tags
+        # Number of identical events counted instead of sent.
+        self.repeats = 0
+
+
 class SentryLogObserver(object):
-    """Twisted log observer that logs to a Raven Sentry client."""
+    """Twisted log observer that logs to a Raven Sentry client.
+
+    Events are sent to Sentry at no more than `rate` events per second, with
+    bursts of up to `burst` events. Events over the rate limit wait in a queue
+    of at most `max_queue_size` events and further events are dropped while
+    the queue is full.
+
+    Events with the same fingerprint (logger, level and message or exception)
+    as one sent or queued in the last `dedupe_window` seconds are counted
+    instead of sent. The count is sent as the ``repeats`` extra value, either
+    with the queued event or in a repeat of the event when the window ends.
+
+    The ``dropped_events`` and ``deduplicated_events`` counters and the
+    ``queue_depth`` property show how much is being held back.
+    """
 
     DEFAULT_ERROR_LEVEL = logging.ERROR
     DEFAULT_LOG_LEVEL = logging.INFO
     LOG_LEVEL_THRESHOLD = logging.WARN
 
+    DEFAULT_MAX_QUEUE_SIZE = 1000
+    DEFAULT_RATE = 10
+    DEFAULT_BURST = 20
+    DEFAULT_DEDUPE_WINDOW = 60
+
     def __init__(self, client, logger_name, worker_id,
-                 log_context_sentinel=None):
+                 log_context_sentinel=None, max_queue_size=None, rate=None,
+                 burst=None, dedupe_window=None):
         if log_context_sentinel is None:
             log_context_sentinel = DEFAULT_LOG_CONTEXT_SENTINEL
         self.client = client
@@ -113,6 +148,32 @@ class SentryLogObserver(object):
         self.log_context_sentinel = log_context_sentinel
         self.log_context = {self.log_context_sentinel: True}
 
+        self.max_queue_size = (
+            self.DEFAULT_MAX_QUEUE_SIZE if max_queue_size is None
+            else max_queue_size)
+        self.rate = self.DEFAULT_RATE if rate is None else rate
+        self.burst = self.DEFAULT_BURST if burst is None else burst
+        self.dedupe_window = (
+            self.DEFAULT_DEDUPE_WINDOW if dedupe_window is None
+            else dedupe_window)
+        self.clock = reactor
+
+        self.dropped_events = 0
+        self.deduplicated_events = 0
+        self._queue = deque()
+        # Maps fingerprints to the queued event for that fingerprint.
+        self._queued = {}
+        # Maps fingerprints to the (expiry time, event) of their dedupe
+        # window, in the order the windows were opened.
+        self._windows = OrderedDict()
+        self._tokens = self.burst
+        self._last_refill = None
+        self._flush_call = None
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
     def level_for_event(self, event):
         level = event.get('logLevel')
         if level is not None:
@@ -129,6 +190,13 @@ class SentryLogObserver(object):
         logger = ".".join(parts)
         return logger.lower()
 
+    def fingerprint_for_failure(self, failure):
+        location = None
+        if failure.frames:
+            location = failure.frames[-1][1:3]
+        return (reflect.safe_str(failure.type), failure.getErrorMessage(),
+                location)
+
     def _log_to_sentry(self, event):
         level = self.level_for_event(event)
         if level < self.LOG_LEVEL_THRESHOLD:
@@ -143,10 +211,130 @@ class SentryLogObserver(object):
         failure = event.get('failure')
         if failure:
             exc_info = (failure.type, failure.value, failure.tb)
-            self.client.captureException(exc_info, data=data, tags=tags)
+            fingerprint = (data["logger"], level,
+                           self.fingerprint_for_failure(failure))
+            self._submit(SentryEvent(
+                fingerprint, 'exception', exc_info, data, tags))
         else:
             msg = log.textFromEventDict(event)
-            self.client.captureMessage(msg, data=data, tags=tags)
+            fingerprint = (data["logger"], level, msg)
+            self._submit(SentryEvent(
+                fingerprint, 'message', msg, data, tags))
+
+    def _submit(self, sentry_event):
+        now = self.clock.seconds()
+        self._expire_windows(now)
+        fingerprint = sentry_event.fingerprint
+        queued = self._queued.get(fingerprint)
+        if queued is None and fingerprint in self._windows:
+            queued = self._windows[fingerprint][1]
+        if queued is not None:
+            queued.repeats += 1
+            self.deduplicated_events += 1
+            return
+        if not self._enqueue(sentry_event):
+            return
+        self._windows[fingerprint] = (now + self.dedupe_window, sentry_event)
+        self._flush(now)
+
+    def _enqueue(self, sentry_event):
+        if len(self._queue) >= self.max_queue_size:
+            self.dropped_events += 1
+            return False
+        self._queue.append(sentry_event)
+        self._queued[sentry_event.fingerprint] = sentry_event
+        return True
+
+    def _expire_windows(self, now):
+        """
+        Close dedupe windows that have ended, queueing a repeat of the event
+        for any that counted identical events after it was sent.
+        """
+        while self._windows:
+            fingerprint, (expires_at, sentry_event) = next(
+                self._windows.iteritems())
+            if expires_at > now:
+                break
+            del self._windows[fingerprint]
+            if sentry_event.repeats and fingerprint not in self._queued:
+                repeat_event = self._repeat_event(sentry_event)
+                if self._enqueue(repeat_event):
+                    self._windows[fingerprint] = (
+                        now + self.dedupe_window, repeat_event)
+
+    def _repeat_event(self, sentry_event):
+        repeat_event = SentryEvent(
+            sentry_event.fingerprint, sentry_event.capture_type,
+            sentry_event.capture_arg, sentry_event.data, sentry_event.tags)
+        repeat_event.repeats = sentry_event.repeats
+        sentry_event.repeats = 0
+        return repeat_event
+
+    def _refill_tokens(self, now):
+        if self._last_refill is not None:
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _flush(self, now):
+        """
+        Send as many queued events as the rate limit allows and schedule
+        another flush if any are left.
+        """
+        self._refill_tokens(now)
+        while self._queue and self._tokens >= 1:
+            self._tokens -= 1
+            self._send(self._queue.popleft())
+        if self._queue and self._flush_call is None:
+            delay = (1 - self._tokens) / float(self.rate)
+            self._flush_call = self.clock.callLater(delay, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_call = None
+        log.callWithContext(self.log_context, self._flush_with_expiry)
+
+    def _flush_with_expiry(self):
+        now = self.clock.seconds()
+        self._expire_windows(now)
+        self._flush(now)
+
+    def _send(self, sentry_event):
+        self._queued.pop(sentry_event.fingerprint, None)
+        kw = {'data': sentry_event.data, 'tags': sentry_event.tags}
+        if sentry_event.repeats:
+            kw['extra'] = {'repeats': sentry_event.repeats}
+            # Later repeats are counted on the event in the dedupe window.
+            sentry_event.repeats = 0
+        if sentry_event.capture_type == 'exception':
+            self.client.captureException(sentry_event.capture_arg, **kw)
+        else:
+            self.client.captureMessage(sentry_event.capture_arg, **kw)
+
+    def stop(self):
+        """
+        Stop sending events. Up to `burst` events are sent immediately,
+        starting with repeats of events in open dedupe windows and then
+        queued events. The rest are dropped.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        log.callWithContext(self.log_context, self._stop)
+
+    def _stop(self):
+        pending = [
+            self._repeat_event(sentry_event)
+            for _, sentry_event in self._windows.itervalues()
+            if sentry_event.repeats and
+            sentry_event.fingerprint not in self._queued]
+        pending.extend(self._queue)
+        self._windows.clear()
+        self._queue.clear()
+        for sentry_event in pending[:self.burst]:
+            self._send(sentry_event)
+        self.dropped_events += len(pending[self.burst:])
+        self._queued.clear()
 
     def __call__(self, event):
         if self.log_context_sentinel in event:
@@ -155,14 +343,22 @@ class SentryLogObserver(object):
 
 
 class SentryLoggerService(Service):
+    """Service that logs to Sentry while it is running.
+
+    `max_queue_size`, `rate`, `burst` and `dedupe_window` are passed to the
+    :class:`SentryLogObserver`.
+    """
 
-    def __init__(self, dsn, logger_name, worker_id, logger=None):
+    def __init__(self, dsn, logger_name, worker_id, logger=None,
+                 max_queue_size=None, rate=None, burst=None,
+                 dedupe_window=None):
         self.setName('Sentry Logger')
         self.dsn = dsn
         self.client = vumi_raven_client(dsn=dsn)
-        self.sentry_log_observer = SentryLogObserver(self.client,
-                                                     logger_name,
-                                                     worker_id)
+        self.sentry_log_observer = SentryLogObserver(
+            self.client, logger_name, worker_id,
+            max_queue_size=max_queue_size, rate=rate, burst=burst,
+            dedupe_window=dedupe_window)
         self.logger = logger if logger is not None else log.theLogPublisher
 
     def startService(self):
@@ -172,6 +368,7 @@ class SentryLoggerService(Service):
     def stopService(self):
         if self.running:
             self.logger.removeObserver(self.sentry_log_observer)
+            self.sentry_log_observer.stop()
             return self.client.teardown()
         return Service.stopService(self)
 
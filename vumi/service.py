@@ -2,18 +2,19 @@
 
 import json
 import warnings
+from collections import OrderedDict
 from copy import deepcopy
 
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, succeed)
+    inlineCallbacks, returnValue, Deferred, succeed, maybeDeferred)
 from twisted.internet import protocol, reactor
 import txamqp
 from txamqp.client import TwistedDelegate
 from txamqp.content import Content
-from txamqp.protocol import AMQClient
+from txamqp.protocol import AMQChannel, AMQClient
 
 from vumi.errors import VumiError
 from vumi.message import Message
@@ -42,7 +43,7 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
-        self.delegate = TwistedDelegate()
+        self.delegate = WorkerDelegate()
         self.worker = worker
         self.amqp_client = None
 
@@ -76,7 +77,38 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class WorkerDelegate(TwistedDelegate):
+    """
+    Delegate that passes publisher confirms from the broker on to the
+    :class:`DynamicPublisher` whose channel they arrived on.
+    """
+
+    def basic_ack(self, ch, msg):
+        ch.confirm_listener.confirmed(msg.delivery_tag, msg.multiple)
+
+    def basic_nack(self, ch, msg):
+        ch.confirm_listener.rejected(msg.delivery_tag, msg.multiple)
+
+
+class WorkerAMQChannel(AMQChannel):
+    """
+    Channel that tells the :class:`DynamicPublisher` using it for publisher
+    confirms when it is closed, whether by the broker or because the
+    connection was lost.
+    """
+
+    def doClose(self, reason):
+        if self.closed:
+            return
+        AMQChannel.doClose(self, reason)
+        confirm_listener = getattr(self, 'confirm_listener', None)
+        if confirm_listener is not None:
+            confirm_listener.channel_closed(reason)
+
+
 class WorkerAMQClient(AMQClient):
+    channelClass = WorkerAMQChannel
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -224,10 +256,22 @@ class Worker(MultiService, object):
         return self._amqp_client.start_consumer(consumer_class, *args, **kw)
 
     @inlineCallbacks
-    def publish_to(self, routing_key):
+    def publish_to(self, routing_key, max_unconfirmed=None):
+        """
+        Create a :class:`DynamicPublisher` for `routing_key` on a new
+        channel.
+
+        :param int max_unconfirmed:
+            If set, the publisher's channel is put in confirm mode and at
+            most this many published messages are left waiting for the
+            broker to confirm them. See
+            :meth:`DynamicPublisher.enable_confirms`.
+        """
         channel = yield self._amqp_client.get_channel()
         publisher = DynamicPublisher(channel, routing_key)
         yield self._amqp_client._declare_exchange(publisher, channel)
+        if max_unconfirmed:
+            yield publisher.enable_confirms(max_unconfirmed)
         # return the publisher
         returnValue(publisher)
 
@@ -383,6 +427,19 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class PublishRejectedError(VumiError):
+    """
+    Raised when the broker rejects a message published in confirm mode.
+    """
+
+
+class PublishChannelClosedError(VumiError):
+    """
+    Raised when the channel closes before the broker has confirmed a message
+    published in confirm mode.
+    """
+
+
 class _Publisher(object):
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -449,18 +506,118 @@ class DynamicPublisher(_Publisher):
         self.channel = channel
         self.check_routing_key(routing_key)
         self.routing_key = routing_key
+        self.max_unconfirmed = None
+        self._delivery_tag = 0
+        self._unconfirmed = OrderedDict()
+        self._window_waiters = []
+
+    @inlineCallbacks
+    def enable_confirms(self, max_unconfirmed):
+        """
+        Put the channel in confirm mode.
+
+        In confirm mode, the deferreds returned by the publish methods fire
+        once the broker has confirmed the message (or fail with
+        :class:`PublishRejectedError` if the broker rejects it) rather than
+        immediately. Confirms are pipelined: messages are published without
+        waiting for earlier confirms until `max_unconfirmed` messages are
+        unconfirmed, after which further messages wait for a free slot. Since
+        message handlers wait for the messages they publish, consumers stop
+        taking messages while the window is full.
+
+        If the channel closes, messages that are unconfirmed or waiting for a
+        slot fail with :class:`PublishChannelClosedError`.
+        """
+        self.channel.confirm_listener = self
+        yield self.channel.confirm_select(nowait=False)
+        self.max_unconfirmed = max_unconfirmed
 
     def publish_message(self, message):
-        self.publish_raw(message.to_json())
-        return succeed(message)
+        d = self.publish_raw(message.to_json())
+        return d.addCallback(lambda _: message)
 
     def publish_json(self, data):
-        self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
+        return self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
 
     def publish_raw(self, data):
         amq_message = Content(data)
         amq_message['delivery mode'] = self.delivery_mode
-        self._publish(amq_message)
+        if self.max_unconfirmed is None:
+            self._publish(amq_message)
+            return succeed(None)
+        if (not self._window_waiters and
+                len(self._unconfirmed) < self.max_unconfirmed):
+            return self._publish_confirmed(amq_message)
+        d = Deferred()
+        self._window_waiters.append(d)
+        return d.addCallback(lambda _: self._publish_confirmed(amq_message))
+
+    def _publish_confirmed(self, message):
+        # The broker numbers the messages published on a channel in confirm
+        # mode from 1, so our count is the message's delivery tag.
+        self._delivery_tag += 1
+        delivery_tag = self._delivery_tag
+        d = Deferred()
+        self._unconfirmed[delivery_tag] = d
+        maybeDeferred(self._publish, message).addErrback(
+            self._publish_failed, delivery_tag)
+        return d
+
+    def _publish_failed(self, failure, delivery_tag):
+        d = self._unconfirmed.pop(delivery_tag, None)
+        if d is not None:
+            d.errback(failure)
+            self._release_window()
+
+    def _pop_unconfirmed(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        return [(tag, self._unconfirmed.pop(tag)) for tag in tags
+                if tag in self._unconfirmed]
+
+    def _release_window(self):
+        while (self._window_waiters and
+               len(self._unconfirmed) < self.max_unconfirmed):
+            self._window_waiters.pop(0).callback(None)
+
+    def confirmed(self, delivery_tag, multiple):
+        """
+        Called when the broker confirms one (or, if `multiple` is set, all up
+        to and including `delivery_tag`) of our messages.
+        """
+        for _, d in self._pop_unconfirmed(delivery_tag, multiple):
+            d.callback(None)
+        self._release_window()
+
+    def rejected(self, delivery_tag, multiple):
+        """
+        Called when the broker rejects one (or, if `multiple` is set, all up
+        to and including `delivery_tag`) of our messages.
+        """
+        for tag, d in self._pop_unconfirmed(delivery_tag, multiple):
+            d.errback(PublishRejectedError(
+                "Message %s published to %r was rejected by the broker." % (
+                    tag, self.routing_key)))
+        self._release_window()
+
+    def channel_closed(self, reason):
+        """
+        Called when our channel closes. Nothing we're waiting for will be
+        confirmed, so all unconfirmed messages and messages waiting for a free
+        slot fail.
+        """
+        unconfirmed, self._unconfirmed = self._unconfirmed, OrderedDict()
+        waiters, self._window_waiters = self._window_waiters, []
+        for tag, d in unconfirmed.iteritems():
+            d.errback(PublishChannelClosedError(
+                "Channel closed before message %s published to %r was"
+                " confirmed: %s" % (tag, self.routing_key, reason)))
+        for d in waiters:
+            d.errback(PublishChannelClosedError(
+                "Channel closed before a message could be published to %r:"
+                " %s" % (self.routing_key, reason)))
 
     def _publish(self, message):
         return self.channel.basic_publish(
@@ -68,6 +68,15 @@ class VumiOptions(usage.Options):
         ["vhost", None, None, "AMQP virtual host (*)"],
         ["specfile", None, None, "AMQP spec file (*)"],
         ["sentry", None, None, "Sentry DSN (*)"],
+        ["sentry-max-queue-size", None, None,
+         "Maximum number of Sentry events waiting to be sent (*)", int],
+        ["sentry-rate", None, None,
+         "Maximum Sentry events sent per second (*)", float],
+        ["sentry-burst", None, None,
+         "Maximum burst of Sentry events sent at once (*)", int],
+        ["sentry-dedupe-window", None, None,
+         "Seconds in which identical Sentry events are counted instead of"
+         " sent (*)", float],
         ["vumi-config", None, None,
          "YAML config file for setting core vumi options (any command-line"
          " parameter marked with an asterisk)"],
@@ -211,6 +220,14 @@ class VumiWorkerServiceMaker(object):
 
     def makeService(self, options):
         sentry_dsn = options.vumi_options.pop('sentry', None)
+        sentry_options = {
+            'max_queue_size': options.vumi_options.pop(
+                'sentry-max-queue-size', None),
+            'rate': options.vumi_options.pop('sentry-rate', None),
+            'burst': options.vumi_options.pop('sentry-burst', None),
+            'dedupe_window': options.vumi_options.pop(
+                'sentry-dedupe-window', None),
+        }
         class_name = options.worker_class.rpartition('.')[2].lower()
         logger_name = options.worker_config.get('worker_name', class_name)
         system_id = options.vumi_options.get('system-id', 'global')
@@ -225,7 +242,8 @@ class VumiWorkerServiceMaker(object):
         if sentry_dsn is not None:
             sentry_service = SentryLoggerService(sentry_dsn,
                                                  logger_name,
-                                                 worker_id)
+                                                 worker_id,
+                                                 **sentry_options)
             worker.addService(sentry_service)
 
         return worker
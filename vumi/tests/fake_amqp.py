@@ -5,10 +5,9 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
+from vumi.service import WorkerAMQClient, WorkerDelegate
 from vumi.message import Message as VumiMessage
 
 
@@ -77,6 +76,15 @@ def mk_deliver(body, exchange, routing_key, ctag, dtag):
             ], mkContent(body))
 
 
+def mk_confirm(method_name, dtag):
+    index = {'ack': 80, 'nack': 120}[method_name]
+    return Message(mkMethod(method_name, index), [
+            ('delivery_tag', dtag),
+            ('multiple', False),
+            ('requeue', False),
+            ])
+
+
 def mk_get_ok(body, exchange, routing_key, dtag):
     return Message(mkMethod('get-ok', 71), [
             ('delivery_tag', dtag),
@@ -92,6 +100,8 @@ class FakeAMQPBroker(object):
         self.exchanges = {}
         self.channels = []
         self.dispatched = {}
+        self.hold_confirms = False
+        self.held_confirms = []
         self._delivering = None
 
     def _get_queue(self, queue):
@@ -160,6 +170,24 @@ class FakeAMQPBroker(object):
         self.kick_delivery()
         return None
 
+    def confirm_publish(self, channel, delivery_tag):
+        """
+        Confirm a message published on a channel in confirm mode, unless
+        :attr:`hold_confirms` is set, in which case the confirm is held
+        until :meth:`release_confirms` is called.
+        """
+        self.held_confirms.append((channel, delivery_tag))
+        if not self.hold_confirms:
+            self.release_confirms()
+
+    def release_confirms(self, reject=False):
+        """
+        Send all held publisher confirms, as nacks if `reject` is set.
+        """
+        confirms, self.held_confirms = self.held_confirms, []
+        for channel, delivery_tag in confirms:
+            channel.send_confirm(delivery_tag, reject)
+
     def basic_get(self, queue):
         return self._get_queue(queue).get_message()
 
@@ -295,10 +323,21 @@ class FakeAMQPChannel(object):
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        self.confirm_channel = None
+        self.published = 0
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
 
+    def confirm_select(self, confirm_channel):
+        self.confirm_channel = confirm_channel
+        return Message(mkMethod("select-ok", 11))
+
+    def send_confirm(self, delivery_tag, reject=False):
+        method_name = 'nack' if reject else 'ack'
+        handler = getattr(self.delegate, 'basic_%s' % (method_name,))
+        handler(self.confirm_channel, mk_confirm(method_name, delivery_tag))
+
     def channel_open(self):
         return self.broker.channel_open(self)
 
@@ -342,7 +381,11 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
-        return self.broker.basic_publish(exchange, routing_key, content)
+        resp = self.broker.basic_publish(exchange, routing_key, content)
+        if self.confirm_channel is not None:
+            self.published += 1
+            self.broker.confirm_publish(self, self.published)
+        return resp
 
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
@@ -480,7 +523,7 @@ class FakeAMQPQueue(object):
 
 class FakeAMQClient(WorkerAMQClient):
     def __init__(self, spec, vumi_options=None, broker=None):
-        WorkerAMQClient.__init__(self, TwistedDelegate(), '', spec)
+        WorkerAMQClient.__init__(self, WorkerDelegate(), '', spec)
         if vumi_options is not None:
             self.vumi_options = vumi_options
         if broker is None:
@@ -524,8 +567,11 @@ class FakeAMQPChannelWrapper(object):
     def channel_flow(self, active):
         return self._fake_channel.channel_flow(active)
 
-    def close(self, _reason):
-        pass
+    def close(self, reason):
+        # Like WorkerAMQChannel, we tell our confirm listener we're closed.
+        confirm_listener = getattr(self, 'confirm_listener', None)
+        if confirm_listener is not None:
+            confirm_listener.channel_closed(reason)
 
     def basic_qos(self, prefetch_size, prefetch_count, is_global):
         return self._fake_channel.basic_qos(
@@ -549,6 +595,9 @@ class FakeAMQPChannelWrapper(object):
     def basic_publish(self, exchange, routing_key, content):
         return self._fake_channel.basic_publish(exchange, routing_key, content)
 
+    def confirm_select(self, nowait=False):
+        return self._fake_channel.confirm_select(self)
+
     def basic_ack(self, delivery_tag, multiple):
         return self._fake_channel.basic_ack(delivery_tag, multiple)
 
@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 
 from vumi.connectors import (
     BaseConnector, ReceiveInboundConnector, ReceiveOutboundConnector,
@@ -299,6 +299,42 @@ class TestReceiveInboundConnector(BaseConnectorTestCase):
             self.assertTrue(log.startswith(
                 "Ignoring msg due to IgnoreMessage(): <Message"))
 
+    @inlineCallbacks
+    def test_inbound_handler_stats(self):
+        handler_wait = Deferred()
+        handler_continue = Deferred()
+
+        def handler(msg):
+            handler_wait.callback(None)
+            return handler_continue
+
+        conn = yield self.mk_connector(connector_name='foo', setup=True)
+        conn.unpause()
+        conn.set_default_inbound_handler(handler)
+        msg = self.msg_helper.make_inbound("inbound")
+        d = self.worker_helper.dispatch_inbound(msg, 'foo')
+        yield handler_wait
+        self.assertEqual(conn.stats.in_flight, 1)
+
+        handler_continue.callback(None)
+        yield d
+        stats = conn.stats.snapshot()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertTrue(stats['p95_latency'] >= 0)
+
+    @inlineCallbacks
+    def test_inbound_handler_stats_ignore_message(self):
+        def im_handler(msg):
+            raise IgnoreMessage()
+
+        conn = yield self.mk_connector(connector_name='foo', setup=True)
+        conn.unpause()
+        conn.set_default_inbound_handler(im_handler)
+        msg = self.msg_helper.make_inbound("inbound")
+        with LogCatcher():
+            yield self.worker_helper.dispatch_inbound(msg, 'foo')
+        self.assertEqual(conn.stats.in_flight, 0)
+
 
 class TestReceiveOutboundConnector(BaseConnectorTestCase):
 
@@ -6,7 +6,8 @@ import json
 import sys
 import traceback
 
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import inlineCallbacks, Deferred, DeferredQueue
+from twisted.internet.task import Clock
 from twisted.web import http
 from twisted.python.failure import Failure
 from twisted.python.log import LogPublisher
@@ -107,6 +108,145 @@ class TestSentryLogObserver(VumiTestCase):
         self.assertEqual(self.client.messages, [])  # should be filtered out
 
 
+class TestSentryLogObserverRateLimiting(VumiTestCase):
+    def setUp(self):
+        self.client = DummySentryClient()
+        self.obs = SentryLogObserver(
+            self.client, 'test', "worker-1", max_queue_size=5, rate=2,
+            burst=3, dedupe_window=10)
+        self.clock = Clock()
+        self.obs.clock = self.clock
+        self.add_cleanup(self.obs.stop)
+
+    def log_warning(self, msg):
+        self.obs({'message': [msg], 'logLevel': logging.WARN})
+
+    def sent_messages(self):
+        return [args[0] for args, kw in self.client.messages]
+
+    def test_rate_limit(self):
+        """
+        Events over the rate limit are queued and sent at the limited rate.
+        """
+        for i in range(6):
+            self.log_warning("msg %d" % (i,))
+        self.assertEqual(self.sent_messages(), ["msg 0", "msg 1", "msg 2"])
+        self.assertEqual(self.obs.queue_depth, 3)
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent_messages(), [
+            "msg 0", "msg 1", "msg 2", "msg 3"])
+        self.clock.advance(1)
+        self.assertEqual(self.sent_messages(), [
+            "msg 0", "msg 1", "msg 2", "msg 3", "msg 4", "msg 5"])
+        self.assertEqual(self.obs.queue_depth, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_queue_full(self):
+        """
+        Events are dropped while the queue is full.
+        """
+        for i in range(10):
+            self.log_warning("msg %d" % (i,))
+        self.assertEqual(self.obs.queue_depth, 5)
+        self.assertEqual(self.obs.dropped_events, 2)
+
+        self.clock.pump([0.5] * 5)
+        self.assertEqual(self.sent_messages(), [
+            "msg %d" % (i,) for i in range(8)])
+        self.assertEqual(self.obs.queue_depth, 0)
+
+    def test_dedupe_queued(self):
+        """
+        Identical events are counted on a queued event and the count is sent
+        with it.
+        """
+        for i in range(3):
+            self.log_warning("msg %d" % (i,))
+        for i in range(4):
+            self.log_warning("queued")
+        self.assertEqual(self.obs.queue_depth, 1)
+        self.assertEqual(self.obs.deduplicated_events, 3)
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.client.messages[-1], (("queued",), {
+            'data': {'level': 30, 'logger': 'test'},
+            'tags': {'worker-id': 'worker-1'},
+            'extra': {'repeats': 3},
+        }))
+
+    def test_dedupe_sent(self):
+        """
+        Identical events after an event is sent are counted and the count is
+        sent in a repeat of the event when the dedupe window ends.
+        """
+        for i in range(5):
+            self.log_warning("storm")
+        self.assertEqual(self.sent_messages(), ["storm"])
+        self.assertEqual(self.obs.deduplicated_events, 4)
+
+        self.clock.advance(10)
+        self.log_warning("other")
+        self.assertEqual(self.client.messages[1:], [
+            (("storm",), {
+                'data': {'level': 30, 'logger': 'test'},
+                'tags': {'worker-id': 'worker-1'},
+                'extra': {'repeats': 4},
+            }),
+            (("other",), {
+                'data': {'level': 30, 'logger': 'test'},
+                'tags': {'worker-id': 'worker-1'},
+            }),
+        ])
+
+        # The repeat starts a new window.
+        self.log_warning("storm")
+        self.assertEqual(len(self.client.messages), 3)
+        self.clock.advance(10)
+        self.log_warning("other")
+        self.assertEqual(
+            self.client.messages[3][1]['extra'], {'repeats': 1})
+
+    def test_dedupe_failures(self):
+        """
+        Failures are deduplicated by type, message and location.
+        """
+        def fail(msg):
+            try:
+                raise ValueError(msg)
+            except ValueError:
+                return Failure()
+
+        self.obs({'failure': fail("foo"), 'isError': 1})
+        self.obs({'failure': fail("foo"), 'isError': 1})
+        self.obs({'failure': fail("bar"), 'isError': 1})
+        self.assertEqual(len(self.client.exceptions), 2)
+        self.assertEqual(self.obs.deduplicated_events, 1)
+
+    def test_stop(self):
+        """
+        When the observer is stopped, up to `burst` queued events are sent
+        and the rest are dropped.
+        """
+        for i in range(3):
+            self.log_warning("msg %d" % (i,))
+        self.log_warning("msg 0")
+        for i in range(3, 8):
+            self.log_warning("msg %d" % (i,))
+        self.assertEqual(self.obs.queue_depth, 5)
+
+        self.obs.stop()
+        self.assertEqual(self.client.messages[3], (("msg 0",), {
+            'data': {'level': 30, 'logger': 'test'},
+            'tags': {'worker-id': 'worker-1'},
+            'extra': {'repeats': 1},
+        }))
+        self.assertEqual(self.sent_messages()[4:], ["msg 3", "msg 4"])
+        self.assertEqual(self.obs.queue_depth, 0)
+        self.assertEqual(self.obs.dropped_events, 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
 class TestSentryLoggerSerivce(VumiTestCase):
 
     def setUp(self):
@@ -133,6 +273,17 @@ class TestSentryLoggerSerivce(VumiTestCase):
         self.logger.msg("Foo", logLevel=logging.WARN)
         self.assertEqual(self.client.messages, [])
 
+    def test_rate_limit_options(self):
+        service = SentryLoggerService(
+            "http://example.com/", "test.logger", "worker-1",
+            logger=self.logger, max_queue_size=50, rate=0.5, burst=5,
+            dedupe_window=300)
+        observer = service.sentry_log_observer
+        self.assertEqual(observer.max_queue_size, 50)
+        self.assertEqual(observer.rate, 0.5)
+        self.assertEqual(observer.burst, 5)
+        self.assertEqual(observer.dedupe_window, 300)
+
     @inlineCallbacks
     def test_stop_not_running(self):
         yield self.service.stopService()
@@ -187,3 +338,41 @@ class TestRavenUtilityFunctions(VumiTestCase):
         [sentry_call] = call_history
         sentry_data = self.parse_call(sentry_call)
         self.assertEqual(sentry_data['message'], "my message")
+
+    @inlineCallbacks
+    def test_rate_limited_logging_to_fake_sentry(self):
+        requests = DeferredQueue()
+
+        def handle_request(request):
+            request.do_not_log = True
+            requests.put(self.parse_call(
+                ((), {'postdata': request.content.read()})))
+            return "{}"
+
+        mock_sentry = MockHttpServer(handle_request)
+        self.add_cleanup(mock_sentry.stop)
+        yield mock_sentry.start()
+        host = mock_sentry.url.split('/')[2]
+        dsn = "http://user:key@%s/2" % (host,)
+
+        client = vumi_raven_client(dsn)
+        obs = SentryLogObserver(client, 'test', "worker-1", rate=1, burst=2)
+        obs.clock = Clock()
+        self.add_cleanup(client.teardown)
+        self.add_cleanup(obs.stop)
+
+        for i in range(10):
+            obs({'message': ["storm"], 'logLevel': logging.WARN})
+        obs({'message': ["first"], 'logLevel': logging.WARN})
+        obs({'message': ["second"], 'logLevel': logging.WARN})
+
+        sent = [(yield requests.get()) for i in range(2)]
+        self.assertEqual(
+            [data['message'] for data in sent], ["storm", "first"])
+        self.assertEqual(obs.queue_depth, 1)
+        self.assertEqual(obs.deduplicated_events, 9)
+
+        obs.clock.advance(1)
+        data = yield requests.get()
+        self.assertEqual(data['message'], "second")
+        self.assertEqual(requests.pending, [])
@@ -4,8 +4,11 @@ from collections import namedtuple
 from twisted.internet.defer import inlineCallbacks, Deferred
 
 from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
+from vumi.service import (
+    Worker, WorkerCreator, WorkerAMQClient, WorkerDelegate, get_spec,
+    PublishRejectedError, PublishChannelClosedError)
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.utils import vumi_resource_path
 
 
 def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
@@ -104,6 +107,126 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publish_without_confirms(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to('test.routing.key')
+        self.assertEqual(publisher.max_unconfirmed, None)
+        self.worker_helper.broker.hold_confirms = True
+        msg = Message(key="value")
+        d = publisher.publish_message(msg)
+        self.assertEqual(d.result, msg)
+        self.assertEqual(self.worker_helper.broker.held_confirms, [])
+
+    @inlineCallbacks
+    def test_publish_with_confirms(self):
+        broker = self.worker_helper.broker
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', max_unconfirmed=10)
+        self.assertEqual(publisher.max_unconfirmed, 10)
+        broker.hold_confirms = True
+        msg = Message(key="value")
+        d = publisher.publish_message(msg)
+        self.assertEqual(len(broker.get_dispatched(
+            'vumi', 'test.routing.key')), 1)
+        self.assertNoResult(d)
+        broker.release_confirms()
+        self.assertEqual((yield d), msg)
+
+    @inlineCallbacks
+    def test_publish_with_confirms_rejected(self):
+        broker = self.worker_helper.broker
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', max_unconfirmed=10)
+        broker.hold_confirms = True
+        d = publisher.publish_message(Message(key="value"))
+        broker.release_confirms(reject=True)
+        yield self.assertFailure(d, PublishRejectedError)
+
+    @inlineCallbacks
+    def test_publish_with_confirms_window(self):
+        broker = self.worker_helper.broker
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', max_unconfirmed=2)
+        broker.hold_confirms = True
+        msgs = [Message(key=i) for i in range(5)]
+        ds = [publisher.publish_message(msg) for msg in msgs]
+        confirmed = []
+        for d in ds:
+            d.addCallback(lambda msg: confirmed.append(msg['key']) or msg)
+
+        def dispatched_keys():
+            return [json.loads(m.body)['key'] for m in broker.get_dispatched(
+                'vumi', 'test.routing.key')]
+
+        self.assertEqual(dispatched_keys(), [0, 1])
+        self.assertEqual(confirmed, [])
+
+        # Confirming the first two messages lets the next two through, but
+        # their confirms are held.
+        broker.release_confirms()
+        self.assertEqual(dispatched_keys(), [0, 1, 2, 3])
+        self.assertEqual(confirmed, [0, 1])
+
+        broker.release_confirms()
+        self.assertEqual(dispatched_keys(), [0, 1, 2, 3, 4])
+        self.assertEqual(confirmed, [0, 1, 2, 3])
+
+        broker.release_confirms()
+        self.assertEqual((yield ds[4]), msgs[4])
+        self.assertEqual(confirmed, [0, 1, 2, 3, 4])
+
+    @inlineCallbacks
+    def test_publish_with_confirms_channel_closed(self):
+        broker = self.worker_helper.broker
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', max_unconfirmed=1)
+        broker.hold_confirms = True
+        unconfirmed_d = publisher.publish_message(Message(key=0))
+        waiting_d = publisher.publish_message(Message(key=1))
+        self.assertEqual(len(broker.get_dispatched(
+            'vumi', 'test.routing.key')), 1)
+
+        publisher.channel.close("Connection lost.")
+        yield self.assertFailure(unconfirmed_d, PublishChannelClosedError)
+        yield self.assertFailure(waiting_d, PublishChannelClosedError)
+        self.assertEqual(len(broker.get_dispatched(
+            'vumi', 'test.routing.key')), 1)
+
+    @inlineCallbacks
+    def test_publish_with_confirms_publish_failed(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', max_unconfirmed=1)
+
+        def basic_publish(**kw):
+            raise ValueError("Channel is closed.")
+
+        self.patch(publisher.channel, 'basic_publish', basic_publish)
+        d = publisher.publish_message(Message(key=0))
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(len(publisher._unconfirmed), 0)
+
+    def test_channel_close_notifies_confirm_listener(self):
+        client = WorkerAMQClient(
+            WorkerDelegate(), '',
+            get_spec(vumi_resource_path("amqp-spec-0-8.xml")))
+        channel = client.channelFactory(1, client.outgoing, client)
+        closed = []
+
+        class ConfirmListener(object):
+            def channel_closed(self, reason):
+                closed.append(reason)
+
+        channel.confirm_listener = ConfirmListener()
+        channel.close("Connection lost.")
+        channel.close("Connection lost again.")
+        self.assertEqual(closed, ["Connection lost."])
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
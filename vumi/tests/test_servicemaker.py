@@ -227,10 +227,37 @@ class TestVumiWorkerServiceMaker(OptionsTestCase):
         self.assertEqual(services, [
                 (('http://1:2@example.com/2/',
                   'echoworker',
-                  'global:echoworker'), {})
+                  'global:echoworker'),
+                 {'max_queue_size': None, 'rate': None, 'burst': None,
+                  'dedupe_window': None})
         ])
         self.assertTrue(dummy_service in worker.services)
 
+    def test_make_worker_with_sentry_rate_limits(self):
+        services = []
+
+        def service(*a, **kw):
+            services.append((a, kw))
+            return DummyService()
+
+        self.patch(servicemaker, 'SentryLoggerService', service)
+        self.mk_config_file('worker', ["transport_name: sphex"])
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'vumi.demos.words.EchoWorker',
+                              '--config', self.config_file['worker'],
+                              '--sentry', 'http://1:2@example.com/2/',
+                              '--sentry-max-queue-size', '50',
+                              '--sentry-rate', '0.5',
+                              '--sentry-burst', '5',
+                              '--sentry-dedupe-window', '300',
+                              ])
+        maker = VumiWorkerServiceMaker()
+        maker.makeService(options)
+        [(_, kw)] = services
+        self.assertEqual(kw, {
+            'max_queue_size': 50, 'rate': 0.5, 'burst': 5,
+            'dedupe_window': 300.0})
+
     def test_make_worker_with_threadpool_size(self):
         """
         The reactor threadpool can be resized with a command line option.
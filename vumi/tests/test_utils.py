@@ -14,7 +14,7 @@ from vumi.utils import (
     normalize_msisdn, vumi_resource_path, cleanup_msisdn, get_operator_name,
     http_request, http_request_full, get_first_word, redis_from_config,
     build_web_site, LogFilterSite, PkgResources, HttpTimeoutError,
-    StatusEdgeDetector)
+    StatusEdgeDetector, LRUCache, PrefixTrie)
 from vumi.message import TransportStatus
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.fake_connection import (
@@ -527,3 +527,82 @@ class TestStatusEdgeDetector(VumiTestCase):
             'type': 'baz',
             'message': 'test'}
         self.assertEqual(sed.check_status(**status2), status2)
+
+
+class TestLRUCache(VumiTestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LRUCache(2, ttl=10, get_time=clock.seconds)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=20)
+        clock.advance(10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.get('b'), 2)
+        clock.advance(10)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'gone'), 'gone')
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
+
+class TestPrefixTrie(VumiTestCase):
+
+    def mk_trie(self, *items):
+        trie = PrefixTrie()
+        for prefix, value in items:
+            trie.add(prefix, value)
+        return trie
+
+    def test_matches(self):
+        trie = self.mk_trie(("27", "a"), ("2782", "b"), ("278", "c"))
+        self.assertEqual(trie.matches("27821234"), ["a", "c", "b"])
+        self.assertEqual(trie.matches("27731234"), ["a"])
+        self.assertEqual(trie.matches("2"), [])
+
+    def test_matches_empty_prefix(self):
+        trie = self.mk_trie(("", "a"), ("1", "b"))
+        self.assertEqual(trie.matches(""), ["a"])
+        self.assertEqual(trie.matches("12"), ["a", "b"])
+
+    def test_matches_multiple_values(self):
+        trie = self.mk_trie(("1", "a"), ("1", "b"))
+        self.assertEqual(trie.matches("12"), ["a", "b"])
+
+    def test_longest_match(self):
+        trie = self.mk_trie(("27", "a"), ("2782", "b"), ("27821", "c"))
+        self.assertEqual(trie.longest_match("27829"), "b")
+        self.assertEqual(trie.longest_match("278219"), "c")
+        self.assertEqual(trie.longest_match("2773"), "a")
+        self.assertEqual(trie.longest_match("1"), None)
+        self.assertEqual(trie.longest_match("1", "default"), "default")
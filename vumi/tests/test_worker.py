@@ -52,6 +52,14 @@ class TestBaseConfig(VumiTestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_no_amqp_publisher_confirms(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_publisher_confirms, None)
+
+    def test_amqp_publisher_confirms(self):
+        config = BaseConfig({'amqp_publisher_confirms': 100})
+        self.assertEqual(config.amqp_publisher_confirms, 100)
+
 
 class TestBaseWorker(VumiTestCase):
 
@@ -105,6 +113,40 @@ class TestBaseWorker(VumiTestCase):
             ('teardown_heartbeat', (), {}),
         ])
 
+    @inlineCallbacks
+    def test_gen_heartbeat_attrs_telemetry(self):
+        yield self.worker.startWorker()
+        connector = yield self.worker.setup_ri_connector('foo')
+        connector.stats.message_started()
+        attrs = self.worker._gen_heartbeat_attrs()
+        telemetry = attrs['telemetry']
+        self.assertEqual(
+            sorted(telemetry.keys()),
+            ['connectors', 'loop_lag', 'open_fds', 'rss'])
+        self.assertEqual(telemetry['loop_lag'], 0.0)
+        self.assertEqual(telemetry['connectors']['foo']['in_flight'], 1)
+
+    @inlineCallbacks
+    def test_teardown_heartbeat_stops_loop_lag_monitor(self):
+        yield self.worker.startWorker()
+        self.assertNotEqual(self.worker._loop_lag, None)
+        yield self.worker.teardown_heartbeat()
+        self.assertEqual(self.worker._loop_lag, None)
+
+    @inlineCallbacks
+    def test_setup_connector_without_publisher_confirms(self):
+        connector = yield self.worker.setup_ri_connector('foo')
+        self.assertEqual(
+            connector._publishers['outbound'].max_unconfirmed, None)
+
+    @inlineCallbacks
+    def test_setup_connector_with_publisher_confirms(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_publisher_confirms': 50}, False)
+        connector = yield worker.setup_ri_connector('foo')
+        self.assertEqual(
+            connector._publishers['outbound'].max_unconfirmed, 50)
+
     def test_setup_connectors_raises(self):
         worker = self.worker_helper.get_worker_raw(BaseWorker, {})
         self.assertRaises(NotImplementedError, worker.setup_connectors)
@@ -154,6 +196,48 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertTrue(cfg1 is cfg2)
+
+    @inlineCallbacks
+    def test_get_config_config_replaced(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        self.worker.config = {'amqp_prefetch_count': 5}
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertEqual(cfg2.amqp_prefetch_count, 5)
+        self.assertFalse(cfg1 is cfg2)
+
+    @inlineCallbacks
+    def test_invalidate_config_cache(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        yield self.worker.get_config(msg)
+        self.worker.config['amqp_prefetch_count'] = 5
+        self.worker.invalidate_config_cache()
+        cfg = yield self.worker.get_config(msg)
+        self.assertEqual(cfg.amqp_prefetch_count, 5)
+
+    def test_get_cached_config_ctxt_key(self):
+        calls = []
+
+        def make_config_data(count):
+            def make():
+                calls.append(count)
+                return {'amqp_prefetch_count': count}
+            return make
+
+        cfg1 = self.worker.get_cached_config('a', make_config_data(1))
+        cfg2 = self.worker.get_cached_config('b', make_config_data(2))
+        cfg3 = self.worker.get_cached_config('a', make_config_data(3))
+        self.assertEqual(cfg1.amqp_prefetch_count, 1)
+        self.assertEqual(cfg2.amqp_prefetch_count, 2)
+        self.assertTrue(cfg3 is cfg1)
+        self.assertEqual(calls, [1, 2])
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
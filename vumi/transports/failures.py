@@ -1,6 +1,5 @@
 # -*- test-case-name: vumi.transports.tests.test_failures -*-
 
-import time
 from datetime import datetime
 from uuid import uuid4
 
@@ -10,6 +9,7 @@ from twisted.internet.task import LoopingCall
 from vumi.service import Worker
 from vumi.message import TransportMessage, to_json
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.components.delay_queue import DelayQueue
 
 
 class FailureMessage(TransportMessage):
@@ -59,8 +59,9 @@ class FailureWorker(Worker):
     Subclasses should implement :meth:`handle_failure`.
     """
 
-    GRANULARITY = 5  # seconds
     DELIVERY_PERIOD = 3
+    BATCH_SIZE = 100
+    VISIBILITY_TIMEOUT = 60
 
     MAX_DELAY = 3600
     INITIAL_DELAY = 1
@@ -86,8 +87,8 @@ class FailureWorker(Worker):
         yield self.redis.close_manager()
 
     def configure_retries(self):
-        for param in ['GRANULARITY', 'MAX_DELAY', 'INITIAL_DELAY',
-                      'DELAY_FACTOR', 'DELIVERY_PERIOD']:
+        for param in ['MAX_DELAY', 'INITIAL_DELAY', 'DELAY_FACTOR',
+                      'DELIVERY_PERIOD', 'BATCH_SIZE', 'VISIBILITY_TIMEOUT']:
             setattr(self, param, self.config.get('retry_' + param.lower(),
                                                  getattr(self, param)))
 
@@ -97,6 +98,10 @@ class FailureWorker(Worker):
         redis = yield TxRedisManager.from_config(r_config)
         self.redis = redis.sub_manager("failures:%s" % (
                 self.config['transport_name'],))
+        self.retry_queue = DelayQueue(
+            self.redis, 'retries', visibility_timeout=self.VISIBILITY_TIMEOUT,
+            batch_size=self.BATCH_SIZE)
+        yield self.migrate_legacy_retries()
 
     def start_retry_delivery(self):
         self.delivery_loop = None
@@ -148,63 +153,73 @@ class FailureWorker(Worker):
                 })
         yield self.add_to_failure_set(key)
         if retry_delay:
-            yield self.store_retry(key, retry_delay)
+            yield self.store_retry(key, retry_delay, message_json=message_json)
         returnValue(key)
 
     def get_failure(self, failure_key):
         return self.redis.hgetall(failure_key)
 
     @inlineCallbacks
-    def store_retry(self, failure_key, retry_delay, now=None):
-        timestamp = self.get_next_write_timestamp(retry_delay, now=now)
-        bucket_key = "retry_keys." + timestamp
-        yield self.redis.sadd(bucket_key, failure_key)
-        yield self.store_read_timestamp(timestamp)
-
-    def store_read_timestamp(self, timestamp):
-        score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        return self.redis.zadd('retry_timestamps', **{timestamp: score})
-
-    def get_next_write_timestamp(self, delta, now=None):
-        if now is None:
-            now = int(time.time())
-        timestamp = now + delta
-        timestamp += self.GRANULARITY - (timestamp % self.GRANULARITY)
-        return datetime.utcfromtimestamp(timestamp).isoformat().split('.')[0]
+    def store_retry(self, failure_key, retry_delay, now=None,
+                    message_json=None):
+        """
+        Schedule a stored failure to be retried ``retry_delay`` seconds after
+        ``now``.
 
-    @inlineCallbacks
-    def get_next_read_timestamp(self):
-        now = int(time.time())
-        timestamp = datetime.utcfromtimestamp(now).isoformat().split('.')[0]
-        next_timestamp = yield self.redis.zrange('retry_timestamps', 0, 0)
-        if next_timestamp and next_timestamp[0] <= timestamp:
-            returnValue(next_timestamp[0])
-        returnValue(None)
+        If ``message_json`` is ``None``, the message is read from the stored
+        failure.
+        """
+        if message_json is None:
+            failure = yield self.get_failure(failure_key)
+            message_json = failure['message']
+        yield self.retry_queue.add(
+            message_json, retry_delay, now=now, item_id=failure_key)
+
+    def get_retry_keys(self):
+        """
+        Return the failure keys of all scheduled retries in due order.
+        """
+        return self.retry_queue.item_ids()
 
     @inlineCallbacks
-    def get_next_retry_key(self):
-        timestamp = yield self.get_next_read_timestamp()
-        if not timestamp:
-            return
-        bucket_key = "retry_keys." + timestamp
-        failure_key = yield self.redis.spop(bucket_key)
-        if (yield self.redis.scard(bucket_key)) < 1:
+    def migrate_legacy_retries(self):
+        """
+        Move retries stored in the old per-timestamp ``retry_keys.*`` sets
+        into the retry queue. Retries keep their original due times.
+        """
+        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1,
+                                             withscores=True)
+        for timestamp, score in timestamps:
+            bucket_key = "retry_keys." + timestamp
+            for failure_key in (yield self.redis.smembers(bucket_key)):
+                failure = yield self.get_failure(failure_key)
+                if failure:
+                    yield self.retry_queue.add(
+                        failure['message'], 0, now=score,
+                        item_id=failure_key)
+            yield self.redis.delete(bucket_key)
             yield self.redis.zrem('retry_timestamps', timestamp)
-        returnValue(failure_key)
 
     @inlineCallbacks
-    def deliver_retry(self, retry_key, publisher):
-        failure = yield self.get_failure(retry_key)
-        published = yield publisher.publish_raw(failure['message'])
-        returnValue(published)
+    def deliver_retries(self, now=None):
+        """
+        Publish all due retries, a batch at a time.
 
-    @inlineCallbacks
-    def deliver_retries(self):
+        Each retry is only removed from the queue once its batch has been
+        published, so a worker dying part way through a batch leaves the
+        unpublished retries to be delivered again once the visibility timeout
+        expires.
+        """
         while True:
-            retry_key = yield self.get_next_retry_key()
-            if not retry_key:
+            retries = yield self.retry_queue.claim_due(now=now)
+            if not retries:
+                return
+            for failure_key, message_json in retries:
+                self.retry_publisher.publish_raw(message_json)
+            yield self.retry_queue.ack(
+                *[failure_key for failure_key, _ in retries])
+            if len(retries) < self.retry_queue.batch_size:
                 return
-            yield self.deliver_retry(retry_key, self.retry_publisher)
 
     def next_retry_delay(self, delay):
         if not delay:
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.transports.mtn_nigeria.tests.test_xml_over_tcp -*-
 # -*- coding: utf-8 -*-
 
+import random
 import struct
 from itertools import count
 
@@ -335,6 +336,50 @@ class TestXmlOverTcpClient(VumiTestCase, XmlOverTcpClientServerMixin):
             self.client.received_dummy_packets,
             [('0', {'someParam': '123'})])
 
+    def test_many_packets_split_at_random(self):
+        packets = []
+        for i in range(3000):
+            body = (
+                "<DummyPacket><someParam>%d</someParam>"
+                "<userdata>caf\xe9 &amp; \x18</userdata></DummyPacket>"
+                % (i,))
+            packets.append(utils.mk_packet(str(i), body))
+        data = ''.join(packets)
+        self.client.authenticated = True
+
+        rand = random.Random(42)
+        position = 0
+        while position < len(data):
+            size = rand.randint(1, 200)
+            self.client.dataReceived(data[position:position + size])
+            position += size
+
+        self.assertEqual(
+            self.client.received_dummy_packets,
+            [(str(i), {'someParam': str(i), 'userdata': u'caf\xe9 & \x18'})
+             for i in range(3000)])
+        self.assertEqual(self.client._buffer, bytearray())
+
+    def test_packet_with_invalid_length_header(self):
+        self.client.authenticated = True
+        self.client.dataReceived(self.mk_raw_packet('0', 'abc', 'foo'))
+        self.assert_in_log('err', 'Error parsing packet header')
+        self.assertTrue(self.client.disconnected)
+        self.assertEqual(self.client._buffer, bytearray())
+
+    def test_packet_with_length_shorter_than_header(self):
+        self.client.authenticated = True
+        self.client.dataReceived(self.mk_raw_packet('0', '3', 'foo'))
+        self.assert_in_log(
+            'err', 'Error parsing packet header (invalid length): 3')
+        self.assertTrue(self.client.disconnected)
+
+    def test_packet_body_deserializing_ignores_nested_text(self):
+        packet_type, params = XmlOverTcpClient.deserialize_body(
+            "<DummyPacket><someParam>12<b>xx</b>3</someParam></DummyPacket>")
+        self.assertEqual(packet_type, 'DummyPacket')
+        self.assertEqual(params, {'someParam': u'123'})
+
     @inlineCallbacks
     def test_authentication(self):
         request_body = (
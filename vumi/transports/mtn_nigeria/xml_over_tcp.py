@@ -1,5 +1,6 @@
 import random
 import struct
+from xml.etree import cElementTree as ElementTree
 
 from twisted.web import microdom
 from twisted.internet import reactor
@@ -95,6 +96,13 @@ class XmlOverTcpClient(Protocol):
     # By observation, it appears that latin1 is the protocol's encoding
     ENCODING = 'latin1'
 
+    # Control characters aren't allowed in XML, but can appear in packet
+    # bodies, so they're swapped for private use characters while parsing.
+    XML_INVALID_CHARS = [c for c in range(32) if c not in (9, 10, 13)]
+    ESCAPE_INVALID_CHARS = dict((c, 0xe000 + c) for c in XML_INVALID_CHARS)
+    UNESCAPE_INVALID_CHARS = dict(
+        (0xe000 + c, c) for c in XML_INVALID_CHARS)
+
     # Data requests and responses need to include a 'phase' field. The
     # documentation does not provide any information about 'phase', but we are
     # assuming this refers to the USSD phase. This should be set to 2 for
@@ -127,7 +135,8 @@ class XmlOverTcpClient(Protocol):
         self.reset_buffer()
 
     def reset_buffer(self):
-        self._buffer = ''
+        self._buffer = bytearray()
+        self._offset = 0
         self._current_header = None
 
     def timeout(self):
@@ -170,19 +179,35 @@ class XmlOverTcpClient(Protocol):
         log.msg("Heartbeat stopped")
 
     def dataReceived(self, data):
-        self._buffer += data
-
-        while self._buffer:
-            header = self.peak_buffer(self.HEADER_SIZE)
-
-            if not header:
+        self._buffer.extend(data)
+
+        while self._current_header is not None or (
+                len(self._buffer) - self._offset >= self.HEADER_SIZE):
+            start = self._offset
+            if self._current_header is None:
+                header = str(self._buffer[start:start + self.HEADER_SIZE])
+                try:
+                    self._current_header = self.deserialize_header(header)
+                except ValueError, e:
+                    log.err("Error parsing packet header (%s): %r" % (
+                        e, header))
+                    self.disconnect()
+                    self.reset_buffer()
+                    return
+
+            session_id, length = self._current_header
+            if length < self.HEADER_SIZE:
+                log.err("Error parsing packet header (invalid length): %r" % (
+                    length,))
+                self.disconnect()
+                self.reset_buffer()
                 return
+            if len(self._buffer) - start < length:
+                break
 
-            session_id, length = self.deserialize_header(header)
-            packet = self.pop_buffer(length)
-
-            if not packet:
-                return
+            packet = str(self._buffer[start:start + length])
+            self._offset = start + length
+            self._current_header = None
 
             body = packet[self.HEADER_SIZE:]
 
@@ -191,23 +216,14 @@ class XmlOverTcpClient(Protocol):
             except Exception, e:
                 log.err("Error parsing packet (%s): %r" % (e, packet))
                 self.disconnect()
-                return
+                break
 
             self.packet_received(session_id, packet_type, params)
 
-    def pop_buffer(self, n):
-        if n > len(self._buffer):
-            return None
-
-        buffer = self._buffer
-        self._buffer = buffer[n:]
-        return buffer[:n]
-
-    def peak_buffer(self, n):
-        if n > len(self._buffer):
-            return None
-
-        return self._buffer[:n]
+        # Drop the packets we've handled all at once, rather than after each
+        # packet, so that a burst of packets is only copied once.
+        del self._buffer[:self._offset]
+        self._offset = 0
 
     @classmethod
     def remove_nullbytes(cls, s):
@@ -222,29 +238,25 @@ class XmlOverTcpClient(Protocol):
         return (cls.remove_nullbytes(session_id),
                 int(cls.remove_nullbytes(length)))
 
-    @staticmethod
-    def _xml_node_text(node):
-        result = ''
-
-        for child in node.childNodes:
-            if isinstance(child, microdom.CharacterData):
-                result += child.value
-            elif isinstance(child, microdom.EntityReference):
-                result += microdom.unescape(
-                    child.toxml(), chars=microdom.XML_ESCAPE_CHARS)
-
-        return result.strip()
+    @classmethod
+    def _xml_node_text(cls, node):
+        # Only text directly inside the node is used, not text inside any
+        # child nodes.
+        result = ''.join([node.text or ''] + [
+            child.tail or '' for child in node])
+        return unicode(result).translate(cls.UNESCAPE_INVALID_CHARS).strip()
 
     @classmethod
     def deserialize_body(cls, body):
-        document = microdom.parseXMLString(body.decode(cls.ENCODING))
-        root = document.firstChild()
+        body = body.decode(cls.ENCODING).translate(cls.ESCAPE_INVALID_CHARS)
+        parser = ElementTree.XMLParser(encoding='utf-8')
+        parser.feed(body.encode('utf-8'))
+        root = parser.close()
 
         params = dict(
-            (node.nodeName, cls._xml_node_text(node))
-            for node in root.childNodes)
+            (node.tag, cls._xml_node_text(node)) for node in root)
 
-        return root.nodeName, params
+        return root.tag, params
 
     def packet_received(self, session_id, packet_type, params):
         log.debug("Packet of type '%s' with session id '%s' received: %s"
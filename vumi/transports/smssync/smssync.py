@@ -2,12 +2,13 @@
 import json
 import datetime
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet import reactor
 
 from vumi import log
 from vumi.message import TransportUserMessage
 from vumi.utils import normalize_msisdn
+from vumi.persist.redis_base import gather_calls
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.transports.failures import PermanentFailure
 from vumi.transports.httprpc import HttpRpcTransport
@@ -49,6 +50,10 @@ class BaseSmsSyncTransport(HttpRpcTransport):
         before closing the SMSSync HTTP inbound message
         request. Replies received within this amount of time will be
         returned with the reply (default: 0.5s).
+    :param int max_messages_per_poll:
+        The maximum number of pending outbound messages to return in
+        response to a single request. Any remaining messages are left for
+        the next poll (default: 100).
     """
 
     transport_type = 'sms'
@@ -63,6 +68,8 @@ class BaseSmsSyncTransport(HttpRpcTransport):
     def validate_config(self):
         super(BaseSmsSyncTransport, self).validate_config()
         self._reply_delay = float(self.config.get('reply_delay', '0.5'))
+        self._max_messages_per_poll = int(
+            self.config.get('max_messages_per_poll', 100))
 
     @inlineCallbacks
     def setup_transport(self):
@@ -178,21 +185,52 @@ class BaseSmsSyncTransport(HttpRpcTransport):
         response = {'payload': kw}
         return self.finish_request(message_id, json.dumps(response))
 
+    @inlineCallbacks
+    def _pop_pending_messages(self, account_key):
+        """Pops up to ``max_messages_per_poll`` pending messages.
+
+        The pops are sent without waiting for each other so that draining a
+        long queue costs two round-trips rather than one per message.
+        """
+        pending = yield self.redis.llen(account_key)
+        count = min(pending, self._max_messages_per_poll)
+        msg_jsons = yield gather_calls(
+            [self.redis.lpop(account_key) for _ in xrange(count)])
+        returnValue([msg_json for msg_json in msg_jsons
+                     if msg_json is not None])
+
+    def _requeue_pending_messages(self, account_key, msg_jsons):
+        """Puts popped messages back at the front of the queue in their
+        original order."""
+        return gather_calls([self.redis.lpush(account_key, msg_json)
+                             for msg_json in reversed(msg_jsons)])
+
     @inlineCallbacks
     def _respond_with_pending_messages(self, msginfo, message_id, **kw):
         """Gathers pending messages and sends a response including them."""
+        account_key = self.key_for_account(msginfo.account_id)
+        msg_jsons = yield self._pop_pending_messages(account_key)
         outbound_ids = []
         outbound_messages = []
-        account_key = self.key_for_account(msginfo.account_id)
-        while True:
-            msg_json = yield self.redis.lpop(account_key)
-            if msg_json is None:
-                break
+        for msg_json in msg_jsons:
             msg = TransportUserMessage.from_json(msg_json)
             outbound_ids.append(msg['message_id'])
             outbound_messages.append({'to': msg['to_addr'],
                                       'message': msg['content'] or ''})
-        yield self._send_response(message_id, messages=outbound_messages, **kw)
+        try:
+            response_id = yield self._send_response(
+                message_id, messages=outbound_messages, **kw)
+        except Exception:
+            log.err(None, "Error sending SMSSync response.")
+            response_id = None
+        if response_id is None:
+            # The request has gone away, so leave the messages for the next
+            # poll.
+            if msg_jsons:
+                log.warning("Requeueing %d messages for account %r." % (
+                    len(msg_jsons), msginfo.account_id))
+                yield self._requeue_pending_messages(account_key, msg_jsons)
+            return
         for outbound_id in outbound_ids:
             yield self.publish_ack(user_message_id=outbound_id,
                                    sent_message_id=outbound_id)
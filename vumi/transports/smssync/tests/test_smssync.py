@@ -6,7 +6,7 @@ import json
 import datetime
 from urllib import urlencode
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import Clock
 
 from vumi.utils import http_request
@@ -182,6 +182,68 @@ class TestSingleSmsSync(VumiTestCase):
         self.assertEqual(event['event_type'], 'ack')
         self.assertEqual(event['user_message_id'], outbound_msg['message_id'])
 
+    @inlineCallbacks
+    def dispatch_outbound_msgs(self, count):
+        msginfo = self.default_msginfo()
+        msgs = []
+        for i in range(count):
+            msg = self.tx_helper.make_outbound(u'msg %d' % (i,))
+            self.transport.add_msginfo_metadata(msg.payload, msginfo)
+            yield self.tx_helper.dispatch_outbound(msg)
+            msgs.append(msg)
+        returnValue(msgs)
+
+    @inlineCallbacks
+    def test_poll_outbound_limited(self):
+        self.transport._max_messages_per_poll = 2
+        yield self.dispatch_outbound_msgs(3)
+        response = yield self.smssync_poll()
+        self.assertEqual(
+            [m['message'] for m in response["payload"]["messages"]],
+            ['msg 0', 'msg 1'])
+        response = yield self.smssync_poll()
+        self.assertEqual(
+            [m['message'] for m in response["payload"]["messages"]],
+            ['msg 2'])
+        response = yield self.smssync_poll()
+        self.assertEqual(response["payload"]["messages"], [])
+        events = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(
+            [e['event_type'] for e in events], ['ack', 'ack', 'ack'])
+
+    @inlineCallbacks
+    def test_poll_outbound_requeued_if_request_gone(self):
+        msgs = yield self.dispatch_outbound_msgs(3)
+        yield self.transport._respond_with_pending_messages(
+            self.default_msginfo(), 'gone', task='send')
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        response = yield self.smssync_poll()
+        self.assertEqual(
+            [m['message'] for m in response["payload"]["messages"]],
+            ['msg 0', 'msg 1', 'msg 2'])
+        events = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(
+            [e['user_message_id'] for e in events],
+            [m['message_id'] for m in msgs])
+
+    @inlineCallbacks
+    def test_poll_outbound_requeued_if_response_fails(self):
+        yield self.dispatch_outbound_msgs(2)
+
+        def broken_finish_request(*args, **kw):
+            raise RuntimeError("connection lost")
+
+        self.patch(self.transport, 'finish_request', broken_finish_request)
+        yield self.transport._respond_with_pending_messages(
+            self.default_msginfo(), 'broken', task='send')
+        [err] = self.flushLoggedErrors(RuntimeError)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        account_key = self.transport.key_for_account(self.account_id)
+        queued = yield self.transport.redis.lrange(account_key, 0, -1)
+        self.assertEqual(
+            [json.loads(msg_json)['content'] for msg_json in queued],
+            ['msg 0', 'msg 1'])
+
     @inlineCallbacks
     def test_reply_round_trip(self):
         # test that calling .reply(...) generates a working reply (this is
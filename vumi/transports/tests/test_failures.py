@@ -1,6 +1,5 @@
 import time
 import json
-from datetime import datetime, timedelta
 
 from twisted.internet.defer import inlineCallbacks
 
@@ -9,11 +8,6 @@ from vumi.transports.failures import FailureWorker
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper, WorkerHelper
 
 
-def mktimestamp(delta=0):
-    timestamp = datetime.utcnow() + timedelta(seconds=delta)
-    return timestamp.isoformat().split('.')[0]
-
-
 class TestFailureWorker(VumiTestCase):
 
     def setUp(self):
@@ -34,10 +28,6 @@ class TestFailureWorker(VumiTestCase):
         self.redis = self.worker.redis
         yield self.redis._purge_all()  # Just in case
 
-    def assert_write_timestamp(self, expected, delta, now):
-        self.assertEqual(expected,
-                         self.worker.get_next_write_timestamp(delta, now=now))
-
     @inlineCallbacks
     def assert_zcard(self, expected, key):
         self.assertEqual(expected, (yield self.redis.zcard(key)))
@@ -51,17 +41,8 @@ class TestFailureWorker(VumiTestCase):
         self.assertNotEqual((yield expected), (yield value))
 
     @inlineCallbacks
-    def assert_get_retry_key(self, exists=True):
-        retry_key = yield self.worker.get_next_retry_key()
-        if exists:
-            self.assertNotEqual(None, retry_key)
-        else:
-            self.assertEqual(None, retry_key)
-
-    @inlineCallbacks
-    def assert_stored_timestamps(self, *expected):
-        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1)
-        self.assertEqual(list(expected), timestamps)
+    def assert_retry_count(self, expected):
+        self.assertEqual(expected, (yield self.worker.retry_queue.count()))
 
     def assert_published_retries(self, expected):
         msgs = self.worker_helper.get_dispatched(
@@ -123,168 +104,102 @@ class TestFailureWorker(VumiTestCase):
                 "reason": "reason",
                 }, self.redis.hgetall(key2))
 
-    def test_write_timestamp(self):
-        """
-        We need granular timestamps.
-        """
-        start = datetime.utcnow().isoformat()
-        timestamp = self.worker.get_next_write_timestamp(0)
-        end = (datetime.utcnow() + timedelta(seconds=6)).isoformat()
-        self.assertTrue(start < timestamp < end)
-
-        self.assert_write_timestamp("1970-01-01T00:00:05", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:05", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 9)
-
-        self.assert_write_timestamp("1970-01-01T00:00:05", 2, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 2, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 2, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:15", 2, 9)
-
-        self.assert_write_timestamp("1970-01-01T00:03:25", 101, 100)
-        self.assert_write_timestamp("1970-01-01T00:03:30", 101, 104)
-        self.assert_write_timestamp("1970-01-01T00:03:30", 101, 105)
-        self.assert_write_timestamp("1970-01-01T00:03:35", 101, 109)
-
-    def test_write_timestamp_granularity(self):
-        """
-        We need granular timestamps with assorted granularity.
-        """
-        self.worker.GRANULARITY = 10
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 0, 11)
-
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:30", 12, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:30", 12, 11)
-
-        self.worker.GRANULARITY = 3
-        self.assert_write_timestamp("1970-01-01T00:00:03", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:06", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:06", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:12", 0, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:12", 0, 11)
-
-        self.assert_write_timestamp("1970-01-01T00:00:15", 12, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:18", 12, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:18", 12, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:24", 12, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:24", 12, 11)
-
-    @inlineCallbacks
-    def test_store_read_timestamp(self):
-        """
-        We need to store granular timestamps.
-        """
-        timestamp1 = "1977-07-28T12:34:56"
-        timestamp2 = "1980-07-30T12:34:56"
-        timestamp3 = "1980-09-02T12:34:56"
-        yield self.assert_stored_timestamps()
-        yield self.worker.store_read_timestamp(timestamp2)
-        yield self.assert_stored_timestamps(timestamp2)
-        yield self.worker.store_read_timestamp(timestamp1)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2)
-        yield self.worker.store_read_timestamp(timestamp3)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2, timestamp3)
-
     @inlineCallbacks
-    def test_read_timestamp(self):
+    def test_store_failure_with_retry(self):
         """
-        We need to read the next timestamp.
+        Storing a failure with a retry delay schedules a retry.
         """
-        past = mktimestamp(-10)
-        future = mktimestamp(10)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(future)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(past)
-        yield self.assert_equal_d(past, self.worker.get_next_read_timestamp())
+        key = yield self.worker.store_failure(
+            {'message': 'foo'}, "reason", retry_delay=10)
+        yield self.assert_equal_d([key], self.worker.get_retry_keys())
+        yield self.assert_equal_d(
+            json.dumps({'message': 'foo'}), self.worker.retry_queue.get(key))
 
     @inlineCallbacks
     def test_store_retry(self):
         """
         Store a retry in redis and make sure we can get at it again.
         """
-        timestamp = "1970-01-01T00:00:05"
-        retry_key = "retry_keys." + timestamp
         key = yield self.store_failure()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        yield self.assert_retry_count(0)
 
-        yield self.worker.store_retry(key, 0, now=0)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_equal_d([timestamp],
-                                  self.redis.zrange('retry_timestamps', 0, 0))
-        yield self.assert_equal_d(set([key]), self.redis.smembers(retry_key))
-
-    def test_get_retry_key_none(self):
-        """
-        If there are no stored retries, get None.
-        """
-        return self.assert_get_retry_key(False)
+        yield self.worker.store_retry(key, 5, now=100)
+        yield self.assert_retry_count(1)
+        yield self.assert_equal_d([key], self.worker.get_retry_keys())
+        yield self.assert_equal_d(
+            105, self.worker.retry_queue.due_time(key))
+        yield self.assert_equal_d(
+            json.dumps({'message': 'foo', 'reason': 'bad stuff happened'}),
+            self.worker.retry_queue.get(key))
 
     @inlineCallbacks
-    def test_get_retry_key_future(self):
+    def test_migrate_legacy_retries(self):
         """
-        If there are no retries due, get None.
+        Retries stored in the old time-bucketed format are moved to the retry
+        queue.
         """
-        yield self.store_retry(10)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        key = yield self.store_failure()
+        timestamp = "1970-01-01T00:00:05"
+        yield self.redis.sadd("retry_keys." + timestamp, key)
+        yield self.redis.zadd('retry_timestamps', **{timestamp: 5})
 
-    @inlineCallbacks
-    def test_get_retry_key_one_due(self):
-        """
-        Get a retry from redis when we have one due.
-        """
-        yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
+        yield self.worker.migrate_legacy_retries()
         yield self.assert_zcard(0, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
+        yield self.assert_equal_d(
+            set(), self.redis.smembers("retry_keys." + timestamp))
+        yield self.assert_equal_d([key], self.worker.get_retry_keys())
+        yield self.assert_equal_d(5, self.worker.retry_queue.due_time(key))
 
     @inlineCallbacks
-    def test_get_retry_key_two_due(self):
+    def test_deliver_retries_leaves_future(self):
         """
-        Get a retry from redis when we have two due.
+        Delivering retries leaves retries that aren't due yet in the queue.
         """
         yield self.store_retry(0, -5)
-        yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.store_retry(10)
+        yield self.assert_retry_count(2)
+        yield self.worker.deliver_retries()
+        yield self.assert_retry_count(1)
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }])
 
     @inlineCallbacks
-    def test_get_retry_key_two_due_different_times(self):
+    def test_deliver_retries_batches(self):
         """
-        Get a retry from redis when we have two due at different times.
+        Due retries are delivered in batches until none are left.
         """
-        yield self.store_retry(0, -5)
-        yield self.store_retry(0, -15)
-        yield self.assert_zcard(2, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        self.worker.retry_queue.batch_size = 2
+        for i in range(5):
+            yield self.store_retry(0, -5)
+        yield self.worker.deliver_retries()
+        yield self.assert_retry_count(0)
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }] * 5)
 
     @inlineCallbacks
-    def test_get_retry_key_one_due_one_future(self):
+    def test_deliver_retries_unacked_redelivered(self):
         """
-        Get a retry from redis when we have one due and one in the future.
+        A retry that was claimed but never acked is delivered again once the
+        visibility timeout has expired.
         """
-        yield self.store_retry(0, -5)
-        yield self.worker.store_retry(self.store_failure(), 0)
-        yield self.assert_zcard(2, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        now = 1000
+        key = yield self.store_failure()
+        yield self.worker.store_retry(key, 0, now=now - 5)
+        [(claimed_key, _)] = yield self.worker.retry_queue.claim_due(now=now)
+        self.assertEqual(claimed_key, key)
+        yield self.worker.deliver_retries(now=now)
+        self.assert_published_retries([])
+        yield self.worker.deliver_retries(
+            now=now + self.worker.VISIBILITY_TIMEOUT)
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }])
+        yield self.assert_retry_count(0)
 
     @inlineCallbacks
     def test_deliver_retries_none(self):
@@ -299,7 +214,7 @@ class TestFailureWorker(VumiTestCase):
         """
         Delivering no current retries should do nothing.
         """
-        yield self.worker.store_retry(self.store_failure(), 0)
+        yield self.store_retry(10)
         yield self.worker.deliver_retries()
         self.assert_published_retries([])
 
@@ -37,27 +37,29 @@ class TestScheduler(VumiTestCase):
         self.assertEqual(number, len(self._delivery_history))
 
     def get_pending_messages(self):
-        scheduled_timestamps = self.scheduler.r_key('scheduled_timestamps')
-        return self.r_server.zrange(scheduled_timestamps, 0, -1)
+        due_key = self.scheduler.r_key(self.scheduler.queue.due_key())
+        return self.r_server.zrange(due_key, 0, -1)
 
     def test_scheduling(self):
         msg = self.msg_helper.make_inbound("inbound")
         now = time.mktime(datetime(2012, 1, 1).timetuple())
         delta = 10  # seconds from now
-        key, bucket_key = self.scheduler.schedule(delta, msg.payload, now)
-        self.assertEqual(bucket_key, '%s#%s.%s' % (
-            self.scheduler.r_prefix,
-            'scheduled_keys',
-            self.scheduler.get_next_write_timestamp(delta, now)
-        ))
-        scheduled_key = self.scheduler.get_scheduled_key(now)
-        self.assertEqual(scheduled_key, None)
+        key = self.scheduler.schedule(delta, msg.payload, now)
+        self.assertEqual(self.scheduler.queue.claim_due(now), [])
         scheduled_time = now + delta
-        scheduled_key = self.scheduler.get_scheduled_key(scheduled_time)
-        self.assertTrue(scheduled_key)
+        [(scheduled_key, _)] = self.scheduler.queue.claim_due(scheduled_time)
+        self.assertEqual(scheduled_key, key)
         self.assertEqual(set([scheduled_key]),
                         self.scheduler.get_all_scheduled_keys())
 
+    def test_get_scheduled(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        key = self.scheduler.schedule(10, msg.payload)
+        scheduled_data = self.scheduler.get_scheduled(key)
+        self.assertEqual(
+            sorted(scheduled_data.keys()), ['payload', 'scheduled_at'])
+        self.assertEqual(self.scheduler.get_scheduled('unknown'), None)
+
     @inlineCallbacks
     def test_delivery_loop(self):
         msg = self.msg_helper.make_inbound("inbound")
@@ -75,7 +77,7 @@ class TestScheduler(VumiTestCase):
             msg = self.msg_helper.make_inbound(
                 "inbound", message_id='message_%s' % (i,))
             delta = i * 10
-            key, _ = self.scheduler.schedule(delta, msg.payload, now)
+            key = self.scheduler.schedule(delta, msg.payload, now)
             scheduled_time = now + delta + self.scheduler.granularity
             self.assertEqual(set([key]),
                 self.scheduler.get_all_scheduled_keys())
@@ -89,15 +91,13 @@ class TestScheduler(VumiTestCase):
         # been running since 1912
         msg = self.msg_helper.make_inbound("inbound")
         way_back = time.mktime(datetime(1912, 1, 1).timetuple())
-        scheduled_key, _ = self.scheduler.schedule(0, msg.payload, way_back)
+        scheduled_key = self.scheduler.schedule(0, msg.payload, way_back)
         self.assertTrue(scheduled_key)
-        now = time.mktime(datetime.now().timetuple())
-        yield self.scheduler.deliver_scheduled(now)
         self.assertEqual(set([scheduled_key]),
             self.scheduler.get_all_scheduled_keys())
         self.assertEqual(len(self.get_pending_messages()), 1)
-        yield self.scheduler.deliver_scheduled(
-            way_back + self.scheduler.granularity)
+        now = time.mktime(datetime.now().timetuple())
+        yield self.scheduler.deliver_scheduled(now)
         self.assertDelivered(msg)
         self.assertEqual(self.get_pending_messages(), [])
         self.assertEqual(set(), self.scheduler.get_all_scheduled_keys())
@@ -107,12 +107,46 @@ class TestScheduler(VumiTestCase):
         msg = self.msg_helper.make_inbound("inbound")
         now = time.mktime(datetime.now().timetuple())
         scheduled_time = now + self.scheduler.granularity
-        key, bucket = self.scheduler.schedule(0, msg.payload, scheduled_time)
+        key = self.scheduler.schedule(0, msg.payload, scheduled_time)
         self.assertEqual(len(self.get_pending_messages()), 1)
         self.assertEqual(set([key]),
             self.scheduler.get_all_scheduled_keys())
         self.scheduler.clear_scheduled(key)
         yield self.scheduler.deliver_scheduled()
-        self.assertEqual(self.r_server.hgetall(key), {})
-        self.assertEqual(self.r_server.smembers(bucket), set())
+        self.assertEqual(self.scheduler.get_scheduled(key), None)
+        self.assertEqual(self.get_pending_messages(), [])
+        self.assertNumDelivered(0)
+
+    @inlineCallbacks
+    def test_deliver_batches(self):
+        self.scheduler.queue.batch_size = 2
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        msgs = [self.msg_helper.make_inbound("inbound %s" % (i,))
+                for i in range(5)]
+        for msg in msgs:
+            self.scheduler.schedule(0, msg.payload, now)
+        yield self.scheduler.deliver_scheduled(now)
+        self.assertNumDelivered(5)
+        for msg in msgs:
+            self.assertDelivered(msg)
+        self.assertEqual(self.get_pending_messages(), [])
+
+    @inlineCallbacks
+    def test_failed_delivery_redelivered(self):
+        def failing_callback(scheduled_at, payload):
+            raise ValueError("Failed")
+
+        msg = self.msg_helper.make_inbound("inbound")
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        key = self.scheduler.schedule(0, msg.payload, now)
+        self.scheduler.callback = failing_callback
+        yield self.assertFailure(
+            self.scheduler.deliver_scheduled(now), ValueError)
+        self.assertEqual(set([key]), self.scheduler.get_all_scheduled_keys())
+
+        self.scheduler.callback = self._scheduler_callback
+        yield self.scheduler.deliver_scheduled(now)
         self.assertNumDelivered(0)
+        yield self.scheduler.deliver_scheduled(
+            now + self.scheduler.queue.visibility_timeout)
+        self.assertDelivered(msg)
@@ -87,12 +87,8 @@ class TestVas2NetsFailureWorker(VumiTestCase):
 
     @inlineCallbacks
     def get_retry_keys(self):
-        timestamps = yield self.redis.zrange('retry_timestamps', 0, 0)
-        retry_keys = set()
-        for timestamp in timestamps:
-            bucket_key = "retry_keys." + timestamp
-            retry_keys.update((yield self.redis.smembers(bucket_key)))
-        returnValue(retry_keys)
+        retry_keys = yield self.fail_worker.get_retry_keys()
+        returnValue(set(retry_keys))
 
     def make_outbound(self, content, **kw):
         kw.setdefault('transport_metadata', {'network_id': 'network-id'})
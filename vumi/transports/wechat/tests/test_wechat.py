@@ -83,6 +83,7 @@ class WeChatTestCase(VumiTestCase):
         defaults.update(config)
         transport = yield self.tx_helper.get_transport(defaults)
         transport.agent_factory = self.fake_http.get_agent
+        transport.clock = task.Clock()
         returnValue(transport)
 
     @inlineCallbacks
@@ -378,9 +379,50 @@ class TestWeChatOutboundMessaging(WeChatTestCase):
         self.assertEqual(ack['event_type'], 'ack')
         self.assertEqual(ack['user_message_id'], msg['message_id'])
 
+    @inlineCallbacks
+    def test_parallel_push_messages_share_access_token_request(self):
+        """
+        If there is no cached access token, concurrent outbound messages wait
+        for a single access token request.
+        """
+        yield self.get_transport()
+        msgs_d = gatherResults([
+            self.dispatch_push_message('foo %d' % (i,), {}, to_addr='toaddr')
+            for i in range(20)])
+
+        token_req = yield self.request_queue.get()
+        self.assertEqual(token_req.path, self.api_url + 'token')
+        self.assertEqual(self.request_queue.pending, [])
+        token_req.write(json.dumps({
+            'access_token': 'the_access_token',
+            'expires_in': 7200,
+        }))
+        token_req.finish()
+
+        for i in range(20):
+            req = yield self.request_queue.get()
+            self.assertEqual(req.path, self.api_url + 'message/custom/send')
+            self.assertEqual(req.args, {'access_token': ['the_access_token']})
+            req.finish()
+
+        msgs = yield msgs_d
+        acks = yield self.tx_helper.wait_for_dispatched_events(20)
+        self.assertEqual(
+            sorted(ack['user_message_id'] for ack in acks),
+            sorted(msg['message_id'] for msg in msgs))
+        self.assertEqual(self.request_queue.pending, [])
+
 
 class TestWeChatAccessToken(WeChatTestCase):
 
+    def reply_with_access_token(self, req, access_token, expires_in=7200):
+        self.assertEqual(req.path, self.api_url + 'token')
+        req.write(json.dumps({
+            'access_token': access_token,
+            'expires_in': expires_in,
+        }))
+        req.finish()
+
     @inlineCallbacks
     def test_request_new_access_token(self):
         transport = yield self.get_transport()
@@ -418,6 +460,103 @@ class TestWeChatAccessToken(WeChatTestCase):
         # Empty request queue means no WeChat API calls were made
         self.assertEqual(self.request_queue.size, None)
 
+    @inlineCallbacks
+    def test_concurrent_access_token_requests(self):
+        """
+        Concurrent callers share a single access token request.
+        """
+        transport = yield self.get_transport()
+        d = gatherResults(
+            [transport.get_access_token() for i in range(5)])
+
+        req = yield self.request_queue.get()
+        self.assertEqual(self.request_queue.pending, [])
+        self.reply_with_access_token(req, 'the_access_token')
+
+        access_tokens = yield d
+        self.assertEqual(access_tokens, ['the_access_token'] * 5)
+        self.assertEqual(transport.in_progress, {})
+
+    @inlineCallbacks
+    def test_concurrent_access_token_requests_failure(self):
+        """
+        If the shared access token request fails, all the callers get the
+        error and the next caller makes a new request.
+        """
+        transport = yield self.get_transport()
+        d1 = transport.get_access_token()
+        d2 = transport.get_access_token()
+
+        req = yield self.request_queue.get()
+        req.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        req.finish()
+
+        yield self.assertFailure(d1, WeChatApiException)
+        yield self.assertFailure(d2, WeChatApiException)
+        self.assertEqual(transport.in_progress, {})
+
+        d3 = transport.get_access_token()
+        req = yield self.request_queue.get()
+        self.reply_with_access_token(req, 'the_access_token')
+        access_token = yield d3
+        self.assertEqual(access_token, 'the_access_token')
+
+    @inlineCallbacks
+    def test_refresh_access_token_ahead_of_expiry(self):
+        """
+        A new access token is requested in the background shortly before
+        the cached one expires.
+        """
+        transport = yield self.get_transport(access_token_refresh_lead=300)
+        d = transport.request_new_access_token()
+        req = yield self.request_queue.get()
+        self.reply_with_access_token(req, 'old_token', expires_in=1000)
+        yield d
+
+        refresh_call = transport.access_token_refresh_call
+        self.assertEqual(refresh_call.getTime(), 900 - 300)
+
+        transport.clock.advance(599)
+        self.assertEqual(self.request_queue.pending, [])
+        transport.clock.advance(1)
+        req = yield self.request_queue.get()
+        # The old token is still used until the new one arrives.
+        access_token = yield transport.get_access_token()
+        self.assertEqual(access_token, 'old_token')
+
+        # Joining the refresh in progress doesn't make another request.
+        refresh_d = transport.coalesce(
+            transport.ACCESS_TOKEN_KEY, transport.request_new_access_token)
+        self.assertEqual(self.request_queue.pending, [])
+        self.reply_with_access_token(req, 'new_token', expires_in=1000)
+        yield refresh_d
+        access_token = yield transport.get_access_token()
+        self.assertEqual(access_token, 'new_token')
+        self.assertEqual(
+            transport.access_token_refresh_call.getTime(), 600 + 600)
+
+    @inlineCallbacks
+    def test_refresh_access_token_failure(self):
+        """
+        If a background access token refresh fails, the error is logged and
+        the cached token is kept.
+        """
+        transport = yield self.get_transport(access_token_refresh_lead=300)
+        d = transport.request_new_access_token()
+        req = yield self.request_queue.get()
+        self.reply_with_access_token(req, 'old_token', expires_in=1000)
+        yield d
+
+        refresh_d = transport.refresh_access_token()
+        req = yield self.request_queue.get()
+        req.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        req.finish()
+        yield refresh_d
+
+        [err] = self.flushLoggedErrors(WeChatApiException)
+        access_token = yield transport.get_access_token()
+        self.assertEqual(access_token, 'old_token')
+
 
 class TestWeChatAddrMasking(WeChatTestCase):
 
@@ -714,6 +853,56 @@ class TestWeChatEmbedUserProfile(WeChatTestCase):
                         <= config.embed_user_profile_lifetime)
         yield resp_d
 
+    @inlineCallbacks
+    def test_concurrent_user_profile_requests(self):
+        """
+        Concurrent lookups of the same User Profile share a single API
+        request, and later lookups are served from memory.
+        """
+        user_profile = {"openid": "fromUser", "nickname": "Band"}
+        transport = yield self.get_transport_with_access_token(
+            'foo', embed_user_profile=True)
+        d = gatherResults(
+            [transport.get_user_profile('fromUser') for i in range(5)])
+
+        req = yield self.request_queue.get()
+        self.assertEqual(req.path, self.api_url + 'user/info')
+        self.assertEqual(self.request_queue.pending, [])
+        req.write(json.dumps(user_profile))
+        req.finish()
+
+        profiles = yield d
+        self.assertEqual(profiles, [user_profile] * 5)
+        # Each caller gets its own copy.
+        profiles[0]['nickname'] = 'Changed'
+        self.assertEqual(profiles[1], user_profile)
+
+        yield transport.redis.delete(transport.user_profile_key('fromUser'))
+        cached_profile = yield transport.get_user_profile('fromUser')
+        self.assertEqual(cached_profile, user_profile)
+        self.assertEqual(self.request_queue.pending, [])
+
+    @inlineCallbacks
+    def test_user_profile_from_redis(self):
+        """
+        User Profiles cached in Redis are used without an API request and
+        kept in memory until they expire.
+        """
+        user_profile = {"openid": "fromUser", "nickname": "Band"}
+        transport = yield self.get_transport_with_access_token(
+            'foo', embed_user_profile=True, embed_user_profile_lifetime=60)
+        yield transport.redis.set(
+            transport.user_profile_key('fromUser'), json.dumps(user_profile))
+
+        profile = yield transport.get_user_profile('fromUser')
+        self.assertEqual(profile, user_profile)
+        self.assertEqual(self.request_queue.pending, [])
+        self.assertEqual(
+            transport.user_profile_cache.get('fromUser'), user_profile)
+
+        transport.clock.advance(60)
+        self.assertEqual(transport.user_profile_cache.get('fromUser'), None)
+
 
 class TestWeChatInsanity(WeChatTestCase):
 
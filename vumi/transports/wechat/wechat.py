@@ -7,7 +7,9 @@ from datetime import datetime
 from functools import partial
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, Deferred, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, Deferred, returnValue, maybeDeferred, succeed)
+from twisted.python.failure import Failure
 from twisted.web.resource import Resource
 from twisted.web import http
 from twisted.web.server import NOT_DONE_YET
@@ -21,7 +23,8 @@ from vumi.transports.httprpc.httprpc import HttpRpcHealthResource
 from vumi.transports.wechat.errors import WeChatException, WeChatApiException
 from vumi.transports.wechat.message_types import (
     TextMessage, EventMessage, NewsMessage, WeChatXMLParser)
-from vumi.utils import build_web_site, http_request_full, StatusEdgeDetector
+from vumi.utils import (
+    build_web_site, http_request_full, StatusEdgeDetector, LRUCache)
 
 from vumi.message import TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
@@ -87,6 +90,13 @@ class WeChatConfig(Transport.CONFIG_CLASS):
     embed_user_profile_lifetime = ConfigInt(
         'How long to cache User Profiles for.', default=(60 * 60),
         required=False, static=True)
+    embed_user_profile_cache_size = ConfigInt(
+        'How many User Profiles to keep in memory in front of the Redis '
+        'cache.', default=1000, required=False, static=True)
+    access_token_refresh_lead = ConfigInt(
+        'How many seconds before the cached access token expires to request '
+        'a new one in the background.', default=(60 * 5), required=False,
+        static=True)
     double_delivery_lifetime = ConfigInt(
         'How long to keep track of Message IDs and responses for double '
         'delivery tracking.', default=(60 * 60), required=False, static=True)
@@ -242,6 +252,16 @@ class WeChatTransport(Transport):
             config.web_path: self.resource,
         })
 
+        self.clock = reactor
+        # Maps keys to the Deferreds waiting on the API call in progress for
+        # that key, so concurrent callers share a single API call.
+        self.in_progress = {}
+        self.access_token_refresh_call = None
+        self.user_profile_cache = LRUCache(
+            config.embed_user_profile_cache_size,
+            ttl=config.embed_user_profile_lifetime,
+            get_time=lambda: self.clock.seconds())
+
         self.redis = yield TxRedisManager.from_config(config.redis_manager)
         self.server = yield self.endpoint.listen(self.factory)
         self.status_detect = StatusEdgeDetector()
@@ -521,31 +541,66 @@ class WeChatTransport(Transport):
             reason='Received status code: %s' % (response.code,))
         returnValue(nack)
 
+    def coalesce(self, key, func, *args):
+        """
+        Call ``func(*args)`` unless a call for `key` is already in progress,
+        and return a Deferred that fires with the result of the call in
+        progress.
+        """
+        waiter = Deferred()
+        waiters = self.in_progress.get(key)
+        if waiters is not None:
+            waiters.append(waiter)
+            return waiter
+        self.in_progress[key] = [waiter]
+        d = maybeDeferred(func, *args)
+        d.addBoth(self._fire_waiters, key)
+        return waiter
+
+    def _fire_waiters(self, result, key):
+        for waiter in self.in_progress.pop(key):
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
     @inlineCallbacks
     def get_access_token(self):
         access_token = yield self.redis.get(self.ACCESS_TOKEN_KEY)
         if access_token is None:
-            access_token = yield self.request_new_access_token()
+            access_token = yield self.coalesce(
+                self.ACCESS_TOKEN_KEY, self.request_new_access_token)
         returnValue(access_token)
 
-    @inlineCallbacks
     def get_user_profile(self, open_id):
+        user_profile = self.user_profile_cache.get(open_id)
+        if user_profile is not None:
+            return succeed(dict(user_profile))
+        d = self.coalesce(
+            self.user_profile_key(open_id), self.fetch_user_profile, open_id)
+        # Concurrent callers share the result, so give each its own copy.
+        d.addCallback(dict)
+        return d
+
+    @inlineCallbacks
+    def fetch_user_profile(self, open_id):
         config = self.get_static_config()
         up_key = self.user_profile_key(open_id)
-        cached_up = yield self.redis.get(open_id)
-        if cached_up:
-            returnValue(json.loads(cached_up))
-
-        access_token = yield self.get_access_token()
-        response = yield self.http_request_full(self.make_url('user/info', {
-            'access_token': access_token,
-            'openid': open_id,
-            'lang': config.embed_user_profile_lang,
-        }), method='GET')
-        user_profile = response.delivered_body
-        yield self.redis.setex(up_key, config.embed_user_profile_lifetime,
-                               user_profile)
-        returnValue(json.loads(user_profile))
+        user_profile = yield self.redis.get(up_key)
+        if user_profile is None:
+            access_token = yield self.get_access_token()
+            response = yield self.http_request_full(
+                self.make_url('user/info', {
+                    'access_token': access_token,
+                    'openid': open_id,
+                    'lang': config.embed_user_profile_lang,
+                }), method='GET')
+            user_profile = response.delivered_body
+            yield self.redis.setex(
+                up_key, config.embed_user_profile_lifetime, user_profile)
+        user_profile = json.loads(user_profile)
+        self.user_profile_cache.set(open_id, user_profile)
+        returnValue(user_profile)
 
     @inlineCallbacks
     def request_new_access_token(self):
@@ -568,17 +623,41 @@ class WeChatTransport(Transport):
 
         # make sure we're always ahead of the WeChat expiry
         access_token = data['access_token']
-        expiry = int(data['expires_in']) * 0.90
-        yield self.redis.setex(
-            self.ACCESS_TOKEN_KEY, int(expiry), access_token)
+        expiry = int(int(data['expires_in']) * 0.90)
+        yield self.redis.setex(self.ACCESS_TOKEN_KEY, expiry, access_token)
+        self.schedule_access_token_refresh(expiry)
         returnValue(access_token)
 
+    def schedule_access_token_refresh(self, expiry):
+        """
+        Request a new access token in the background shortly before the
+        cached one expires, so outbound messages don't have to wait for it.
+        """
+        self.cancel_access_token_refresh()
+        delay = expiry - self.get_static_config().access_token_refresh_lead
+        if delay > 0:
+            self.access_token_refresh_call = self.clock.callLater(
+                delay, self.refresh_access_token)
+
+    def cancel_access_token_refresh(self):
+        if (self.access_token_refresh_call is not None and
+                self.access_token_refresh_call.active()):
+            self.access_token_refresh_call.cancel()
+        self.access_token_refresh_call = None
+
+    def refresh_access_token(self):
+        self.access_token_refresh_call = None
+        d = self.coalesce(self.ACCESS_TOKEN_KEY, self.request_new_access_token)
+        d.addErrback(log.err, 'Error refreshing WeChat access token.')
+        return d
+
     def make_url(self, path, params):
         config = self.get_static_config()
         return '%s%s?%s' % (
             config.api_url, path, urllib.urlencode(params))
 
     def teardown_transport(self):
+        self.cancel_access_token_refresh()
         return self.server.stopListening()
 
     def get_health_response(self):
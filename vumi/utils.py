@@ -3,9 +3,11 @@
 import os.path
 import re
 import sys
+import time
 import base64
 import pkg_resources
 import warnings
+from collections import OrderedDict
 from functools import wraps
 
 from zope.interface import implements
@@ -504,3 +506,128 @@ class StatusEdgeDetector(object):
             self._add_type(component, type_)
             return True
         return False
+
+
+class LRUCache(object):
+    """
+    A small in-memory least-recently-used cache with optional expiry.
+
+    :param int max_size:
+        Maximum number of entries. The least recently used entry is evicted
+        when this is exceeded.
+    :param float ttl:
+        Seconds after which an entry expires. ``None`` (the default) means
+        entries never expire.
+    :param callable get_time:
+        Function returning the current time in seconds. Defaults to
+        :func:`time.time`.
+    """
+
+    def __init__(self, max_size, ttl=None, get_time=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.get_time = get_time
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= self.get_time():
+            return None
+        self._data[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key` (marking it as recently used) or `default`
+        if it isn't cached or has expired.
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache `value` for `key`, optionally overriding the cache's ttl.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = None if ttl is None else self.get_time() + ttl
+        self._data.pop(key, None)
+        self._data[key] = (expires_at, value)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove `key` from the cache and return its value, or `default` if it
+        isn't cached.
+        """
+        entry = self._lookup(key)
+        self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+
+class PrefixTrie(object):
+    """
+    A trie of string prefixes used to find all the values stored under
+    prefixes of a given string without checking every prefix.
+
+    Several values may be stored under the same prefix. Values are returned in
+    the order they were added to each prefix, shortest prefix first.
+    """
+
+    def __init__(self):
+        self._root = ({}, [])
+
+    def add(self, prefix, value):
+        """
+        Store `value` under `prefix`.
+        """
+        node = self._root
+        for char in prefix:
+            node = node[0].setdefault(char, ({}, []))
+        node[1].append(value)
+
+    def _walk(self, string):
+        node = self._root
+        yield node[1]
+        for char in string:
+            node = node[0].get(char)
+            if node is None:
+                return
+            yield node[1]
+
+    def matches(self, string):
+        """
+        Return a list of all values stored under prefixes of `string`.
+        """
+        found = []
+        for values in self._walk(string):
+            found.extend(values)
+        return found
+
+    def longest_match(self, string, default=None):
+        """
+        Return the first value stored under the longest prefix of `string`
+        that has values, or `default` if there isn't one.
+        """
+        found = default
+        for values in self._walk(string):
+            if values:
+                found = values[0]
+        return found
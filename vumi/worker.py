@@ -17,9 +17,11 @@ from vumi.connectors import (
     PublishStatusConnector, ReceiveStatusConnector)
 from vumi.config import Config, ConfigInt
 from vumi.errors import DuplicateConnectorError
-from vumi.utils import generate_worker_id
+from vumi.utils import generate_worker_id, LRUCache
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
+from vumi.blinkenlights.heartbeat.telemetry import (
+    LoopLagMonitor, process_rss, open_fd_count)
 
 
 def then_call(d, func, *args, **kw):
@@ -36,6 +38,12 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_publisher_confirms = ConfigInt(
+        "If set, each publisher waits for the broker to confirm the messages"
+        " it publishes, with at most this many messages unconfirmed at a"
+        " time. Handlers that publish messages wait for their confirms, so"
+        " consumers stop taking messages while publishing is backed up.",
+        default=None, static=True)
 
 
 class BaseWorker(Worker):
@@ -47,13 +55,16 @@ class BaseWorker(Worker):
     """
 
     CONFIG_CLASS = BaseConfig
+    CONFIG_CACHE_SIZE = 100
 
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache = LRUCache(self.CONFIG_CACHE_SIZE)
         self._hb_pub = None
+        self._loop_lag = None
         self._worker_id = None
         self.log = WrappingLogger(system=self.config.get('worker_name'))
 
@@ -92,6 +103,8 @@ class BaseWorker(Worker):
             self.log.msg(
                 "Starting HeartBeat publisher with worker_name=%s"
                 % self._worker_name)
+            self._loop_lag = LoopLagMonitor()
+            self._loop_lag.start()
             self._hb_pub = yield self.start_publisher(
                 HeartBeatPublisher, self._gen_heartbeat_attrs)
         else:
@@ -103,6 +116,9 @@ class BaseWorker(Worker):
         if self._hb_pub is not None:
             self._hb_pub.stop()
             self._hb_pub = None
+        if self._loop_lag is not None:
+            self._loop_lag.stop()
+            self._loop_lag = None
 
     def _gen_heartbeat_attrs(self):
         # worker_name is guaranteed to be set here, otherwise this func would
@@ -115,10 +131,28 @@ class BaseWorker(Worker):
             'hostname': socket.gethostname(),
             'timestamp': time.time(),
             'pid': os.getpid(),
+            'telemetry': self._gen_telemetry_attrs(),
         }
         attrs.update(self.custom_heartbeat_attrs())
         return attrs
 
+    def _gen_telemetry_attrs(self):
+        """
+        Collect performance telemetry for this worker process. Counters that
+        cover an interval (lag, rates, latencies) are reset on each call.
+        """
+        loop_lag = None
+        if self._loop_lag is not None:
+            loop_lag = self._loop_lag.snapshot()
+        return {
+            'loop_lag': loop_lag,
+            'rss': process_rss(),
+            'open_fds': open_fd_count(),
+            'connectors': dict(
+                (name, connector.stats.snapshot())
+                for name, connector in self.connectors.iteritems()),
+        }
+
     def custom_heartbeat_attrs(self):
         """Worker subclasses can override this to add custom attributes"""
         return {}
@@ -159,7 +193,40 @@ class BaseWorker(Worker):
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        return succeed(self.get_cached_config())
+
+    def get_cached_config(self, ctxt_key=None, make_config_data=None):
+        """Return a config object for the current config, building it only
+        if there isn't one cached already.
+
+        Building a config object validates every field, which is expensive
+        for large configs, so config objects are cached per worker.
+
+        :param ctxt_key:
+            Hashable key identifying the message context the config is for.
+            Messages with the same context key share a config object.
+        :param callable make_config_data:
+            Function returning the config dict to build the config object
+            from. Defaults to returning the worker's config.
+
+        Cached config objects are discarded when the worker's config is
+        replaced. Workers that modify their config in place must call
+        :meth:`invalidate_config_cache` afterwards.
+        """
+        entry = self._config_cache.get(ctxt_key)
+        if entry is not None and entry[0] is self.config:
+            return entry[1]
+        if make_config_data is None:
+            config_data = self.config
+        else:
+            config_data = make_config_data()
+        config = self.CONFIG_CLASS(config_data)
+        self._config_cache.set(ctxt_key, (self.config, config))
+        return config
+
+    def invalidate_config_cache(self):
+        """Discard all cached config objects."""
+        self._config_cache.clear()
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -183,12 +250,14 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=static_config.amqp_prefetch_count,
+            middlewares=middlewares,
+            max_unconfirmed=static_config.amqp_publisher_confirms)
         self.connectors[connector_name] = connector
 
         d = connector.setup()